@@ -7,9 +7,16 @@ def genera_html_da_xml(xml_string, xslt_path):
     """
     Applica il FoglioStile.xsl ufficiale di FatturaPA al contenuto XML
     e ritorna l'HTML generato.
+    `xml_string` può essere in byte (si rispetta l'encoding dichiarato)
+    o già decodificato in stringa.
     """
-    # Convertiamo la stringa in un elemento
-    xml_root = ET.fromstring(xml_string.encode("utf-8"))
+    if isinstance(xml_string, bytes):
+        xml_root = ET.fromstring(xml_string, parser=ET.XMLParser(huge_tree=True))
+    else:
+        # La stringa è già decodificata: i byte sono UTF-8 anche se il
+        # prologo dichiara un altro encoding
+        parser = ET.XMLParser(huge_tree=True, encoding="utf-8")
+        xml_root = ET.fromstring(xml_string.encode("utf-8"), parser=parser)
     # Carichiamo lo XSLT
     xslt_tree = ET.parse(xslt_path)
     transform = ET.XSLT(xslt_tree)
@@ -0,0 +1,56 @@
+# benchmarks/bench_dropbox.py
+
+"""
+Download degli XML da Dropbox (services.dropbox_service.scarica_tutti_xml_memoria)
+con diversi limiti di richieste in volo, su un client finto
+(benchmarks.dropbox_finto) che simula la latenza di ogni richiesta HTTPS.
+max_in_volo=1 equivale al vecchio download seriale.
+Poi lo stesso download con il mirror locale (services.mirror_dropbox) vuoto
+e già pieno, come dopo una ricostruzione del DB.
+
+Uso:
+    python -m benchmarks.bench_dropbox --n 2000 --latenza 0.05
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+
+from benchmarks.dropbox_finto import DropboxFinto, file_finti
+from services.dropbox_service import scarica_tutti_xml_memoria
+from services.mirror_dropbox import MirrorDropbox
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=2000, help="file su Dropbox")
+    parser.add_argument("--latenza", type=float, default=0.05, help="secondi per richiesta")
+    parser.add_argument("--paralleli", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench_dropbox")
+    logger.disabled = True
+    file = file_finti(args.n)
+    print(f"{args.n} file, latenza {args.latenza * 1000:.0f} ms per richiesta")
+    for paralleli in args.paralleli:
+        client = DropboxFinto(file, latenza=args.latenza)
+        inizio = time.perf_counter()
+        scaricati = scarica_tutti_xml_memoria(logger, client=client, max_in_volo=paralleli)
+        secondi = time.perf_counter() - inizio
+        print(f"  in volo {paralleli:>3}: {secondi:7.2f} s  {len(scaricati) / secondi:8.0f} file/s  "
+              f"(max in volo osservato {client.max_in_volo})")
+
+    with tempfile.TemporaryDirectory() as cartella:
+        mirror = MirrorDropbox(cartella)
+        for giro in ("vuoto", "pieno"):
+            client = DropboxFinto(file, latenza=args.latenza)
+            inizio = time.perf_counter()
+            scaricati = scarica_tutti_xml_memoria(logger, client=client, mirror=mirror)
+            secondi = time.perf_counter() - inizio
+            print(f"  mirror {giro:>5}: {secondi:7.2f} s  {len(scaricati) / secondi:8.0f} file/s  "
+                  f"({client.download} download in rete)")
+
+
+if __name__ == "__main__":
+    main()
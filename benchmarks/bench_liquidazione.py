@@ -0,0 +1,99 @@
+# benchmarks/bench_liquidazione.py
+
+"""
+Liquidazione IVA: group-by vettoriale con NumPy (services.liquidazione_iva)
+contro il GROUP BY fatto da SQLite, su un DB temporaneo con --n fatture e
+--riepiloghi riepiloghi IVA ciascuna. Verifica anche che i due risultati
+coincidano.
+
+Uso:
+    python -m benchmarks.bench_liquidazione --n 50000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date
+
+from sqlalchemy import insert
+
+from database.db_session import crea_engine, PROFILO_IMPORT
+from database.models import Base, Fattura, DatiRiepilogoIVA
+from services.liquidazione_iva import (
+    carica_riepiloghi,
+    raggruppa_liquidazione,
+    liquidazione_iva_sql,
+    PERIODICITA_MENSILE,
+    PERIODICITA_TRIMESTRALE,
+)
+
+ALIQUOTE = [(22.0, ""), (10.0, ""), (4.0, ""), (0.0, "N2.2"), (0.0, "N3.1"), (0.0, "N6.3")]
+ESIGIBILITA = ["I", "I", "I", "D", "S"]
+
+
+def popola(engine, n, riepiloghi, blocco=10_000):
+    casuale = random.Random(42)
+    with engine.begin() as conn:
+        for inizio in range(0, n, blocco):
+            fatture = [{
+                "numero": f"FT/{i}",
+                "data": date(2022 + (i // 12) % 3, 1 + i % 12, 1 + i % 28),
+                "fornitore": f"Fornitore {i % 500:03d}",
+                "tipo_documento": "TD04" if i % 20 == 0 else "TD01",
+            } for i in range(inizio, min(n, inizio + blocco))]
+            ids = conn.execute(insert(Fattura).returning(Fattura.id), fatture).scalars().all()
+            righe = []
+            for id_fattura in ids:
+                for _ in range(riepiloghi):
+                    aliquota, natura = casuale.choice(ALIQUOTE)
+                    imponibile = round(casuale.uniform(10, 5000), 2)
+                    righe.append({
+                        "fattura_id": id_fattura, "aliquota_iva": aliquota, "natura": natura or None,
+                        "esigibilita_iva": casuale.choice(ESIGIBILITA), "imponibile_importo": imponibile,
+                        "imposta": round(imponibile * aliquota / 100, 2),
+                    })
+            conn.execute(insert(DatiRiepilogoIVA), righe)
+
+
+def misura(funzione, ripetizioni, *args, **kwargs):
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        risultato = funzione(*args, **kwargs)
+    return (time.perf_counter() - inizio) / ripetizioni * 1000, risultato
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=50_000, help="fatture nel DB")
+    parser.add_argument("--riepiloghi", type=int, default=2, help="riepiloghi IVA per fattura")
+    parser.add_argument("--ripetizioni", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = crea_engine(f"sqlite:///{os.path.join(tmp, 'liquidazione.db')}", PROFILO_IMPORT)
+        Base.metadata.create_all(engine)
+        popola(engine, args.n, args.riepiloghi)
+        print(f"{args.n} fatture, {args.n * args.riepiloghi} riepiloghi IVA")
+
+        with engine.connect() as conn:
+            for anno in (None, 2023):
+                print(f"anno={anno or 'tutti'}")
+                ms_carica, colonne = misura(carica_riepiloghi, args.ripetizioni, conn, anno)
+                print(f"  lettura colonne NumPy      {ms_carica:8.1f} ms")
+                totale_numpy, totale_sql = ms_carica, 0.0
+                for periodicita in (PERIODICITA_MENSILE, PERIODICITA_TRIMESTRALE):
+                    ms_numpy, numpy_ = misura(raggruppa_liquidazione, args.ripetizioni, colonne, periodicita)
+                    ms_sql, sql = misura(liquidazione_iva_sql, args.ripetizioni, conn, anno, periodicita)
+                    totale_numpy += ms_numpy
+                    totale_sql += ms_sql
+                    esito = "ok" if numpy_ == sql else "DIVERSI"
+                    print(f"  {periodicita:<12} group-by NumPy {ms_numpy:8.1f} ms   "
+                          f"GROUP BY SQL {ms_sql:8.1f} ms   {len(numpy_)} righe ({esito})")
+                print(f"  mensile + trimestrale: NumPy {totale_numpy:8.1f} ms   SQL {totale_sql:8.1f} ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# benchmarks/bench_p7m.py
+
+"""
+Confronta la decodifica .p7m in-process (services.p7m_service) con il
+vecchio percorso via subprocess `openssl smime`.
+
+Uso:
+    python -m benchmarks.bench_p7m cartella_con_p7m/
+    python -m benchmarks.bench_p7m --genera 200      # corpus firmato sintetico (serve openssl)
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from services.p7m_service import estrai_contenuto_p7m
+from services.parser_fatture import decode_p7m_openssl
+from benchmarks.bench_parser import fattura_sintetica
+
+
+def genera_corpus(n, righe=20):
+    """
+    Firma `n` fatture sintetiche con una chiave usa-e-getta. Ritorna la lista dei byte DER.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        chiave = os.path.join(tmp, "chiave.pem")
+        cert = os.path.join(tmp, "cert.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", chiave,
+             "-out", cert, "-subj", "/CN=Benchmark p7m/C=IT", "-days", "1"],
+            check=True, capture_output=True,
+        )
+        corpus = []
+        for i in range(n):
+            xml = fattura_sintetica(righe).replace("BENCH-1", f"BENCH-{i}").encode("utf-8")
+            firmato = subprocess.run(
+                ["openssl", "smime", "-sign", "-binary", "-nodetach", "-outform", "DER",
+                 "-signer", cert, "-inkey", chiave],
+                input=xml, check=True, capture_output=True,
+            ).stdout
+            corpus.append(firmato)
+        return corpus
+
+
+def leggi_corpus(cartella):
+    corpus = []
+    for nome in sorted(os.listdir(cartella)):
+        if nome.lower().endswith(".p7m"):
+            with open(os.path.join(cartella, nome), "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def misura(nome, funzione, corpus):
+    inizio = time.perf_counter()
+    falliti = 0
+    for dati in corpus:
+        try:
+            if funzione(dati) is None:
+                falliti += 1
+        except Exception:
+            falliti += 1
+    durata = time.perf_counter() - inizio
+    print(f"{nome:>10}: {durata * 1000:9.1f} ms, {len(corpus) / durata:9.1f} file/s, falliti: {falliti}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cartella", nargs="?", help="cartella con i file .p7m")
+    parser.add_argument("--genera", type=int, default=0, help="numero di .p7m sintetici da generare")
+    args = parser.parse_args()
+
+    if args.cartella:
+        corpus = leggi_corpus(args.cartella)
+    else:
+        corpus = genera_corpus(args.genera or 100)
+
+    print(f"Corpus: {len(corpus)} file, {sum(len(c) for c in corpus) / 1024:.0f} KiB")
+    misura("in-process", estrai_contenuto_p7m, corpus)
+    misura("openssl", decode_p7m_openssl, corpus)
+
+
+if __name__ == "__main__":
+    main()
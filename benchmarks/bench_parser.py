@@ -0,0 +1,114 @@
+# benchmarks/bench_parser.py
+
+"""
+Confronta i motori di parse_fattura_xml (xpath / stream) e misura il costo
+della validazione XSD (--validazione off warn strict).
+
+Uso:
+    python -m benchmarks.bench_parser                 # fattura sintetica da 2000 righe
+    python -m benchmarks.bench_parser --righe 5000
+    python -m benchmarks.bench_parser fattura1.xml fattura2.xml
+    python -m benchmarks.bench_parser --righe 50 --batch 2000 --workers 1 2 4
+    python -m benchmarks.bench_parser --validazione off warn
+"""
+
+import argparse
+import time
+
+from services.parser_fatture import (
+    parse_fattura_xml,
+    parse_fatture_batch,
+    ENGINE_XPATH,
+    ENGINE_STREAM,
+)
+
+
+def fattura_sintetica(n_righe):
+    """
+    Costruisce una fattura FPR12 minimale con `n_righe` DettaglioLinee.
+    """
+    righe = "".join(
+        f"<DettaglioLinee><NumeroLinea>{i}</NumeroLinea>"
+        f"<Descrizione>Articolo {i}</Descrizione><Quantita>1.00</Quantita>"
+        f"<PrezzoUnitario>1.00</PrezzoUnitario><PrezzoTotale>1.00</PrezzoTotale>"
+        f"<AliquotaIVA>22.00</AliquotaIVA></DettaglioLinee>"
+        for i in range(1, n_righe + 1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<p:FatturaElettronica versione="FPR12" '
+        'xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">'
+        "<FatturaElettronicaHeader><CedentePrestatore><DatiAnagrafici><Anagrafica>"
+        "<Denominazione>Fornitore Benchmark</Denominazione>"
+        "</Anagrafica></DatiAnagrafici></CedentePrestatore></FatturaElettronicaHeader>"
+        "<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento>"
+        f"<Data>2024-01-31</Data><Numero>BENCH-1</Numero>"
+        f"<ImportoTotaleDocumento>{n_righe * 1.22:.2f}</ImportoTotaleDocumento>"
+        "</DatiGeneraliDocumento></DatiGenerali>"
+        f"<DatiBeniServizi>{righe}<DatiRiepilogo><AliquotaIVA>22.00</AliquotaIVA>"
+        f"<ImponibileImporto>{n_righe:.2f}</ImponibileImporto></DatiRiepilogo></DatiBeniServizi>"
+        "</FatturaElettronicaBody></p:FatturaElettronica>"
+    )
+
+
+def misura(documenti, engine, ripetizioni, validazione="off"):
+    """
+    Ritorna il tempo migliore (in secondi) per parsare tutti i documenti.
+    """
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        for doc in documenti:
+            parse_fattura_xml(doc, is_memory=True, engine=engine, validazione=validazione)
+        durata = time.perf_counter() - inizio
+        migliore = durata if migliore is None else min(migliore, durata)
+    return migliore
+
+
+def misura_batch(documenti, workers, engine, validazione="off"):
+    """
+    Tempo per parsare tutti i documenti con parse_fatture_batch.
+    """
+    inizio = time.perf_counter()
+    documenti = ((f"doc{i}", d) for i, d in enumerate(documenti))
+    for _ in parse_fatture_batch(documenti, workers=workers, engine=engine, validazione=validazione):
+        pass
+    return time.perf_counter() - inizio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="fatture XML da usare al posto di quella sintetica")
+    parser.add_argument("--righe", type=int, default=2000, help="righe della fattura sintetica")
+    parser.add_argument("--ripetizioni", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=0, help="misura parse_fatture_batch su N copie dei documenti")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="processi da provare con --batch")
+    parser.add_argument("--validazione", nargs="+", default=["off"], choices=["off", "warn", "strict"],
+                        help="modalità di validazione XSD da misurare")
+    args = parser.parse_args()
+
+    if args.files:
+        documenti = []
+        for path in args.files:
+            with open(path, "rb") as f:
+                documenti.append(f.read())
+    else:
+        documenti = [fattura_sintetica(args.righe)]
+
+    if args.batch:
+        copie = (documenti * (args.batch // len(documenti) + 1))[:args.batch]
+        for validazione in args.validazione:
+            for workers in args.workers:
+                durata = misura_batch(copie, workers, ENGINE_XPATH, validazione)
+                print(f"validazione={validazione:<6} workers={workers:>2}: {len(copie) / durata:8.1f} doc/s")
+        return
+
+    for validazione in args.validazione:
+        for engine in (ENGINE_XPATH, ENGINE_STREAM):
+            durata = misura(documenti, engine, args.ripetizioni, validazione)
+            print(f"validazione={validazione:<6} {engine:>6}: {durata * 1000:8.1f} ms per {len(documenti)} documenti "
+                  f"({len(documenti) / durata:8.1f} doc/s)")
+
+
+if __name__ == "__main__":
+    main()
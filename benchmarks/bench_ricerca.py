@@ -0,0 +1,84 @@
+# benchmarks/bench_ricerca.py
+
+"""
+Ricerca globale: ilike('%testo%') su fornitore e numero (la vecchia ricerca)
+contro l'indice FTS5 di database.ricerca, su un DB temporaneo con --n fatture
+e 5 righe ciascuna.
+
+Uso:
+    python -m benchmarks.bench_ricerca --n 200000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import insert, or_
+from sqlalchemy.orm import Session
+
+from database.db_session import crea_engine, PROFILO_IMPORT
+from database.migrazioni import esegui_migrazioni
+from database.models import Base, Fattura, RigheFattura
+from database.query_fatture import query_fatture
+
+PAROLE = ["valvola", "cemento", "consulenza", "trasporto", "noleggio", "toner", "gasolio", "manutenzione"]
+RICERCHE = ["fornitore 012", "cod 4711", "valvola cod 12345", "FT/1234", "inesistente"]
+
+
+def popola(engine, n, blocco=10_000):
+    with engine.begin() as conn:
+        for inizio in range(0, n, blocco):
+            fatture = [{"numero": f"FT/{i}", "fornitore": f"Fornitore {i % 500:03d} Srl",
+                        "causale": f"Fornitura {PAROLE[i % len(PAROLE)]}"}
+                       for i in range(inizio, min(n, inizio + blocco))]
+            ids = conn.execute(insert(Fattura).returning(Fattura.id), fatture).scalars().all()
+            conn.execute(insert(RigheFattura), [
+                {"fattura_id": id_fattura, "descrizione": f"{PAROLE[(id_fattura + k) % len(PAROLE)]} cod {id_fattura * 5 + k}"}
+                for id_fattura in ids for k in range(5)
+            ])
+
+
+def _ilike(db, testo):
+    return db.query(Fattura).filter(or_(Fattura.fornitore.ilike(f"%{testo}%"), Fattura.numero.ilike(f"%{testo}%")))
+
+
+def misura(db, crea_query, ripetizioni):
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        for testo in RICERCHE:
+            crea_query(db, testo).limit(200).all()
+    return (time.perf_counter() - inizio) / (ripetizioni * len(RICERCHE)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=200_000, help="fatture nel DB")
+    parser.add_argument("--ripetizioni", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = crea_engine(f"sqlite:///{os.path.join(tmp, 'ricerca.db')}", PROFILO_IMPORT)
+        Base.metadata.create_all(engine)
+        popola(engine, args.n)
+        # Come su un DB esistente: la migrazione indicizza tutto in un colpo solo
+        inizio = time.perf_counter()
+        esegui_migrazioni(engine)
+        print(f"indicizzazione di {args.n} fatture: {time.perf_counter() - inizio:.1f} s")
+
+        with Session(engine) as db:
+            for testo in RICERCHE:
+                trovate = query_fatture(db, search=testo).count()
+                print(f"  {testo!r:<24} {trovate:>7} fatture")
+            print(f"ilike: {misura(db, _ilike, args.ripetizioni):8.2f} ms/ricerca")
+            print(f"FTS5:  {misura(db, lambda d, t: query_fatture(d, search=t), args.ripetizioni):8.2f} ms/ricerca")
+
+        # Costo dei trigger sugli insert successivi (import)
+        inizio = time.perf_counter()
+        popola(engine, 2000)
+        print(f"insert con i trigger FTS: {2000 / (time.perf_counter() - inizio):.0f} fatture/s")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# benchmarks/bench_sqlite.py
+
+"""
+Confronta i profili SQLite di database.db_session (predefinito, interattivo,
+import) su un DB temporaneo:
+  - insert con un commit per fattura (come salva_fattura_su_db)
+  - insert di tutte le fatture in una sola transazione (come salva_fatture_bulk)
+  - query tipiche della UI (filtro per fornitore e anno)
+  - letture concorrenti mentre un altro thread scrive (resync + UI)
+
+Uso:
+    python -m benchmarks.bench_sqlite --n 2000
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import date
+
+from sqlalchemy import extract, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from database.db_session import crea_engine, PROFILO_INTERATTIVO, PROFILO_IMPORT
+from database.models import Base, Fattura, RigheFattura
+
+FORNITORI = [f"Fornitore {i:03d} Srl" for i in range(200)]
+
+
+def _fattura(i):
+    return {
+        "numero": f"B-{i}",
+        "data": date(2020 + i % 5, 1 + i % 12, 1 + i % 28),
+        "fornitore": FORNITORI[i % len(FORNITORI)],
+        "totale": float(i % 1000),
+        "pagata": False,
+        "hash_xml": f"{i:064x}",
+    }
+
+
+def _righe(id_fattura, n=5):
+    return [{"fattura_id": id_fattura, "descrizione": f"Riga {k}", "quantita": 1.0,
+             "prezzo_unitario": 1.0, "importo_riga": 1.0} for k in range(n)]
+
+
+def misura_commit_singoli(engine, n):
+    inizio = time.perf_counter()
+    for i in range(n):
+        with engine.begin() as conn:
+            id_fattura = conn.execute(insert(Fattura).values(**_fattura(i))).inserted_primary_key[0]
+            conn.execute(insert(RigheFattura), _righe(id_fattura))
+    return n / (time.perf_counter() - inizio)
+
+
+def misura_transazione_unica(engine, n, offset):
+    inizio = time.perf_counter()
+    with engine.begin() as conn:
+        for i in range(offset, offset + n):
+            id_fattura = conn.execute(insert(Fattura).values(**_fattura(i))).inserted_primary_key[0]
+            conn.execute(insert(RigheFattura), _righe(id_fattura))
+    return n / (time.perf_counter() - inizio)
+
+
+def _query_ui(conn, i):
+    return conn.execute(
+        select(Fattura.id, Fattura.numero, Fattura.totale)
+        .where(Fattura.fornitore == FORNITORI[i % len(FORNITORI)])
+        .where(extract("year", Fattura.data) == 2020 + i % 5)
+    ).all()
+
+
+def misura_query(engine, n):
+    inizio = time.perf_counter()
+    with engine.connect() as conn:
+        for i in range(n):
+            _query_ui(conn, i)
+    return n / (time.perf_counter() - inizio)
+
+
+def misura_concorrenza(engine_scrittura, engine_lettura, secondi=2.0, offset=10_000_000):
+    """
+    Un thread scrive blocchi da 500 fatture (transazioni lunghe), un altro legge.
+    Ritorna (query riuscite, query fallite con "database is locked").
+    """
+    fine = time.perf_counter() + secondi
+    esito = {"ok": 0, "bloccate": 0}
+
+    def scrittore():
+        i = offset
+        while time.perf_counter() < fine:
+            misura_transazione_unica(engine_scrittura, 500, i)
+            i += 500
+
+    def lettore():
+        while time.perf_counter() < fine:
+            try:
+                with engine_lettura.connect() as conn:
+                    conn.execute(select(func.count(Fattura.id))).scalar()
+                    _query_ui(conn, esito["ok"])
+                esito["ok"] += 1
+            except OperationalError:
+                esito["bloccate"] += 1
+
+    thread = [threading.Thread(target=scrittore), threading.Thread(target=lettore)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    return esito["ok"], esito["bloccate"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=2000, help="fatture da inserire")
+    parser.add_argument("--query", type=int, default=2000, help="query da eseguire")
+    args = parser.parse_args()
+
+    print(f"{'profilo':<12} {'commit/fatt.':>13} {'transazione':>12} {'query/s':>9} {'letture ok':>11} {'bloccate':>9}")
+    for profilo in (None, PROFILO_INTERATTIVO, PROFILO_IMPORT):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+            # timeout=1: senza profilo i lettori bloccati falliscono invece di aspettare 5 s
+            engine = crea_engine(url, profilo, connect_args={"timeout": 1})
+            Base.metadata.create_all(engine)
+
+            singoli = misura_commit_singoli(engine, args.n)
+            unica = misura_transazione_unica(engine, args.n, args.n)
+            query = misura_query(engine, args.query)
+            lettore = crea_engine(url, profilo if profilo is None else PROFILO_INTERATTIVO,
+                                  connect_args={"timeout": 1})
+            ok, bloccate = misura_concorrenza(engine, lettore)
+            engine.dispose()
+            lettore.dispose()
+
+        print(f"{profilo or 'predefinito':<12} {singoli:>11.0f}/s {unica:>10.0f}/s {query:>9.0f} {ok:>11} {bloccate:>9}")
+
+
+if __name__ == "__main__":
+    main()
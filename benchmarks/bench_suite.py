@@ -0,0 +1,216 @@
+# benchmarks/bench_suite.py
+
+"""
+Suite di benchmark su un corpus sintetico (benchmarks.corpus_fatturapa):
+documenti al secondo e picco di memoria per
+  - parse:  parse_fattura_xml su file .xml/.p7m da disco
+  - salva:  salva_fattura_su_db su un DB SQLite nuovo
+  - salva_bulk: salva_fatture_bulk (un commit per blocco) sugli stessi dati
+  - resync: resync_from_dropbox_memoria con il download da Dropbox simulato
+
+Ogni scenario gira in un processo nuovo (spawn), in una cartella temporanea
+con il suo fatture.db, così il picco di RSS è solo suo. Il picco non include
+i processi worker del parsing parallelo (resync).
+
+Uso:
+    python -m benchmarks.bench_suite --n 500
+    python -m benchmarks.bench_suite --n 500 --scenari parse salva --salva-json base.json
+    python -m benchmarks.bench_suite --n 500 --confronta base.json --soglia 0.15
+Con --confronta esce con codice 1 se uno scenario perde più di --soglia in doc/s.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.corpus_fatturapa import genera_corpus, scrivi_corpus
+
+SCENARI = ("parse", "salva", "salva_bulk", "resync")
+
+
+def _picco_rss_mib():
+    if resource is None:
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux in KiB, macOS in byte
+    return picco / (1024 * 1024) if sys.platform == "darwin" else picco / 1024
+
+
+def _file_corpus(cartella_corpus):
+    return [os.path.join(cartella_corpus, nome) for nome in sorted(os.listdir(cartella_corpus))]
+
+
+def _scenario_parse(cartella_corpus):
+    from services.parser_fatture import parse_fattura_xml
+
+    files = _file_corpus(cartella_corpus)
+    inizio = time.perf_counter()
+    fatture = sum(1 for path in files if parse_fattura_xml(path) is not None)
+    return len(files), fatture, time.perf_counter() - inizio
+
+
+def _scenario_salva(cartella_corpus):
+    from database.db_session import init_db
+    from services.parser_fatture import iter_fatture_xml, salva_fattura_su_db
+
+    init_db()
+    files = _file_corpus(cartella_corpus)
+    fatture = [f for path in files for f in iter_fatture_xml(path)]
+    inizio = time.perf_counter()
+    for fattura in fatture:
+        salva_fattura_su_db(fattura)
+    return len(fatture), len(fatture), time.perf_counter() - inizio
+
+
+def _scenario_salva_bulk(cartella_corpus):
+    from database.db_session import init_db
+    from services.parser_fatture import decode_p7m_to_xml, iter_record_fattura, salva_fatture_bulk
+
+    init_db()
+    records = []
+    for path in _file_corpus(cartella_corpus):
+        with open(path, "rb") as f:
+            dati = f.read()
+        if path.endswith(".p7m"):
+            dati = decode_p7m_to_xml(dati)
+        records.extend(iter_record_fattura(dati))
+    inizio = time.perf_counter()
+    esito = salva_fatture_bulk(records)
+    return len(records), len(esito["inseriti"]), time.perf_counter() - inizio
+
+
+def _scenario_resync(cartella_corpus):
+    import logging
+    from database.db_session import init_db
+    import main  # richiede PySide6
+
+    from benchmarks.dropbox_finto import DropboxFinto
+
+    init_db()
+    os.makedirs("logs", exist_ok=True)
+    file = {}
+    for path in _file_corpus(cartella_corpus):
+        with open(path, "rb") as f:
+            file[f"/fatture/{os.path.basename(path)}"] = f.read()
+    # Dropbox simulato senza latenza: dal resync passano solo gli .xml (vedi elenca_xml)
+    client = DropboxFinto(file)
+
+    logger = logging.getLogger("bench_resync")
+    logger.disabled = True
+    inizio = time.perf_counter()
+    statistiche = main.resync_from_dropbox_memoria(logger, client=client)
+    return statistiche["ricevuti"], statistiche["inseriti"], time.perf_counter() - inizio
+
+
+def _esegui_scenario(nome, cartella_corpus):
+    """
+    Eseguita nel processo figlio: lavora in una cartella temporanea
+    (DB, allegati e log propri) e ritorna le misure dello scenario.
+    """
+    cartella_iniziale = os.getcwd()
+    with tempfile.TemporaryDirectory() as lavoro:
+        os.chdir(lavoro)
+        os.environ["ALLEGATI_DIR"] = os.path.join(lavoro, "allegati")
+        tracemalloc.start()
+        try:
+            documenti, fatture, secondi = globals()[f"_scenario_{nome}"](cartella_corpus)
+            _, picco_python = tracemalloc.get_traced_memory()
+        except ImportError as e:
+            return {"scenario": nome, "saltato": str(e)}
+        finally:
+            tracemalloc.stop()
+            os.chdir(cartella_iniziale)
+    return {
+        "scenario": nome,
+        "documenti": documenti,
+        "fatture": fatture,
+        "secondi": secondi,
+        "doc_s": documenti / secondi if secondi else None,
+        "picco_rss_mib": _picco_rss_mib(),
+        "picco_python_mib": picco_python / (1024 * 1024),
+    }
+
+
+def esegui(scenari, cartella_corpus):
+    risultati = []
+    contesto = multiprocessing.get_context("spawn")
+    for nome in scenari:
+        with ProcessPoolExecutor(max_workers=1, mp_context=contesto) as pool:
+            risultati.append(pool.submit(_esegui_scenario, nome, cartella_corpus).result())
+    return risultati
+
+
+def stampa(risultati):
+    print(f"{'scenario':<10} {'documenti':>9} {'fatture':>8} {'secondi':>8} {'doc/s':>9} {'RSS MiB':>8} {'Python MiB':>10}")
+    for r in risultati:
+        if "saltato" in r:
+            print(f"{r['scenario']:<10} saltato: {r['saltato']}")
+            continue
+        rss = f"{r['picco_rss_mib']:8.1f}" if r["picco_rss_mib"] is not None else f"{'n/d':>8}"
+        print(f"{r['scenario']:<10} {r['documenti']:>9} {r['fatture']:>8} {r['secondi']:>8.2f} "
+              f"{r['doc_s']:>9.1f} {rss} {r['picco_python_mib']:>10.1f}")
+
+
+def confronta(risultati, riferimento, soglia):
+    """
+    Ritorna gli scenari in cui doc/s è peggiorato più di `soglia` (es. 0.15 = 15%).
+    """
+    base = {r["scenario"]: r for r in riferimento if "saltato" not in r}
+    regressioni = []
+    for r in risultati:
+        prima = base.get(r["scenario"])
+        if "saltato" in r or not prima:
+            continue
+        calo = 1 - r["doc_s"] / prima["doc_s"]
+        if calo > soglia:
+            regressioni.append(f"{r['scenario']}: {prima['doc_s']:.1f} -> {r['doc_s']:.1f} doc/s (-{calo:.0%})")
+    return regressioni
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=500, help="documenti nel corpus sintetico")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="cartella con un corpus già generato (al posto di quello sintetico)")
+    parser.add_argument("--scenari", nargs="+", choices=SCENARI, default=list(SCENARI))
+    parser.add_argument("--salva-json", help="scrive i risultati in questo file")
+    parser.add_argument("--confronta", help="risultati di riferimento (JSON di --salva-json)")
+    parser.add_argument("--soglia", type=float, default=0.15, help="calo di doc/s tollerato con --confronta")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cartella_corpus = args.corpus
+        if not cartella_corpus:
+            cartella_corpus = os.path.join(tmp, "corpus")
+            scrivi_corpus(cartella_corpus, genera_corpus(args.n, seed=args.seed))
+        cartella_corpus = os.path.abspath(cartella_corpus)
+        risultati = esegui(args.scenari, cartella_corpus)
+
+    stampa(risultati)
+
+    if args.salva_json:
+        with open(args.salva_json, "w", encoding="utf-8") as f:
+            json.dump(risultati, f, indent=2)
+
+    if args.confronta:
+        with open(args.confronta, encoding="utf-8") as f:
+            regressioni = confronta(risultati, json.load(f), args.soglia)
+        for riga in regressioni:
+            print(f"REGRESSIONE {riga}")
+        if regressioni:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
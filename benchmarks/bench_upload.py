@@ -0,0 +1,61 @@
+# benchmarks/bench_upload.py
+
+"""
+Archiviazione su Dropbox di molte fatture dopo uno scarico PEC, su un client
+finto (benchmarks.dropbox_finto) con latenza per richiesta:
+  - per file: files_get_metadata + files_upload, uno dopo l'altro
+    (come upload_xml_to_dropbox)
+  - in blocco: carica_xml_su_dropbox (indice dall'elenco, sessioni di upload
+    in parallelo, una files_upload_session_finish_batch_v2)
+
+Uso:
+    python -m benchmarks.bench_upload --n 500 --latenza 0.05
+"""
+
+import argparse
+import time
+
+from dropbox.exceptions import ApiError
+
+from benchmarks.dropbox_finto import DropboxFinto, file_finti
+from services.dropbox_service import carica_xml_su_dropbox
+
+
+def per_file(client, file):
+    for percorso, dati in file.items():
+        try:
+            client.files_get_metadata(percorso)
+            continue
+        except ApiError:
+            pass
+        client.files_upload(dati, percorso)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=500, help="fatture da archiviare")
+    parser.add_argument("--gia-presenti", type=int, default=2000, help="file già su Dropbox")
+    parser.add_argument("--latenza", type=float, default=0.05, help="secondi per richiesta")
+    args = parser.parse_args()
+
+    presenti = file_finti(args.gia_presenti)
+    nuovi = {p.replace("/fatture/", "/fatture/nuove/"): dati for p, dati in file_finti(args.n).items()}
+    print(f"{args.n} fatture da archiviare, {args.gia_presenti} già su Dropbox, "
+          f"latenza {args.latenza * 1000:.0f} ms per richiesta")
+
+    client = DropboxFinto(presenti, latenza=args.latenza)
+    inizio = time.perf_counter()
+    per_file(client, nuovi)
+    secondi = time.perf_counter() - inizio
+    print(f"  per file : {secondi:7.2f} s  ({client.richieste_upload} richieste)")
+
+    client = DropboxFinto(presenti, latenza=args.latenza)
+    inizio = time.perf_counter()
+    esito = carica_xml_su_dropbox(list(nuovi.items()), client=client)
+    secondi = time.perf_counter() - inizio
+    print(f"  in blocco: {secondi:7.2f} s  ({client.sessioni} sessioni, {client.batch} conferme, "
+          f"{len(esito['caricati'])} caricati)")
+
+
+if __name__ == "__main__":
+    main()
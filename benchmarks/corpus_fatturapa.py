@@ -0,0 +1,338 @@
+# benchmarks/corpus_fatturapa.py
+
+"""
+Generatore di fatture FatturaPA sintetiche ma realistiche, conformi a
+assets/Schema_VFPA12_v1.2.3.xsd, per benchmark e test di carico.
+
+Ogni fattura è configurabile:
+  - formato FPR12 (tra privati) o FPA12 (verso la PA)
+  - numero di DettaglioLinee, con aliquote diverse e riepiloghi coerenti
+  - numero di FatturaElettronicaBody (lotti)
+  - Allegati in base64 di dimensione data
+  - encoding del documento (UTF-8, UTF-8 con BOM, ISO-8859-1)
+  - busta .p7m (CMS SignedData in DER)
+
+Le buste .p7m sono costruite in Python e la "firma" è fittizia: vanno bene
+per misurare l'estrazione del contenuto, non per verificarle. Per buste
+firmate davvero c'è benchmarks.bench_p7m.genera_corpus (serve openssl).
+
+Uso:
+    python -m benchmarks.corpus_fatturapa cartella/ --n 1000
+"""
+
+import argparse
+import base64
+import os
+import random
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+NS_FATTURA = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
+
+FORMATO_PRIVATI = "FPR12"
+FORMATO_PA = "FPA12"
+
+ENCODING_UTF8 = "UTF-8"
+ENCODING_UTF8_BOM = "UTF-8-BOM"
+ENCODING_LATIN1 = "ISO-8859-1"
+ENCODING_CORPUS = (ENCODING_UTF8, ENCODING_UTF8_BOM, ENCODING_LATIN1)
+
+# Nomi con caratteri accentati (Latin-1), così l'encoding conta davvero
+_FORNITORI = (
+    "Ferramenta Rossi Srl", "Caffè Centrale Snc", "Società Agricola Le Querce",
+    "Tipografia Città Nuova Srl", "Elettrodomestici Bianchi Spa", "Studio Tecnico Martinelli",
+    "Cartoleria Perù di Esposito", "Autofficina Brambilla & Figli",
+)
+_CLIENTI = ("Cliente Spa", "Comune di Pontedera", "Ristorante Da Nanà", "Condominio Via Verdi 12")
+_COMUNI = (("Roma", "RM", "00184"), ("Milano", "MI", "20121"), ("Napoli", "NA", "80133"),
+           ("Torino", "TO", "10121"), ("Forlì", "FC", "47121"))
+_ARTICOLI = (
+    "Consulenza tecnica", "Viti autofilettanti 4x40", "Caffè in grani 1 kg", "Manutenzione caldaia",
+    "Carta A4 80 g/m²", "Noleggio attrezzatura", "Servizio di pulizia uffici", "Licenza software annuale",
+    "Cavo elettrico unipolare", "Trasporto e consegna",
+)
+_UNITA = ("PZ", "KG", "ORE", "NR", "LT")
+# (aliquota, natura): l'aliquota 0 richiede la natura dell'operazione
+_ALIQUOTE = ((Decimal("22.00"), None), (Decimal("10.00"), None), (Decimal("4.00"), None),
+             (Decimal("0.00"), "N2.2"))
+_MODALITA = ("MP05", "MP01", "MP08", "MP12")
+
+_CENTESIMI = Decimal("0.01")
+
+
+def _importo(valore):
+    return valore.quantize(_CENTESIMI, rounding=ROUND_HALF_UP)
+
+
+def _partita_iva(rng):
+    return "".join(rng.choice("0123456789") for _ in range(11))
+
+
+def _sede(rng, indirizzo):
+    comune, provincia, cap = rng.choice(_COMUNI)
+    return (
+        f"<Sede><Indirizzo>{indirizzo}</Indirizzo><NumeroCivico>{rng.randint(1, 200)}</NumeroCivico>"
+        f"<CAP>{cap}</CAP><Comune>{comune}</Comune><Provincia>{provincia}</Provincia>"
+        f"<Nazione>IT</Nazione></Sede>"
+    )
+
+
+def _testata(rng, formato, progressivo):
+    piva_trasmittente = _partita_iva(rng)
+    if formato == FORMATO_PA:
+        codice_destinatario = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(6))
+    else:
+        codice_destinatario = "0000000"
+    return (
+        "<FatturaElettronicaHeader>"
+        "<DatiTrasmissione>"
+        f"<IdTrasmittente><IdPaese>IT</IdPaese><IdCodice>{piva_trasmittente}</IdCodice></IdTrasmittente>"
+        f"<ProgressivoInvio>{progressivo}</ProgressivoInvio>"
+        f"<FormatoTrasmissione>{formato}</FormatoTrasmissione>"
+        f"<CodiceDestinatario>{codice_destinatario}</CodiceDestinatario>"
+        "</DatiTrasmissione>"
+        "<CedentePrestatore><DatiAnagrafici>"
+        f"<IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>{_partita_iva(rng)}</IdCodice></IdFiscaleIVA>"
+        f"<Anagrafica><Denominazione>{rng.choice(_FORNITORI).replace('&', '&amp;')}</Denominazione></Anagrafica>"
+        "<RegimeFiscale>RF01</RegimeFiscale>"
+        "</DatiAnagrafici>"
+        f"{_sede(rng, 'Via Garibaldi')}"
+        "</CedentePrestatore>"
+        "<CessionarioCommittente><DatiAnagrafici>"
+        f"<CodiceFiscale>{_partita_iva(rng)}</CodiceFiscale>"
+        f"<Anagrafica><Denominazione>{rng.choice(_CLIENTI)}</Denominazione></Anagrafica>"
+        "</DatiAnagrafici>"
+        f"{_sede(rng, 'Piazza della Repubblica')}"
+        "</CessionarioCommittente>"
+        "</FatturaElettronicaHeader>"
+    )
+
+
+def _allegato(rng, n, dimensione):
+    # Un finto PDF: intestazione vera e contenuto casuale (non comprimibile)
+    n_byte = max(dimensione - 9, 0)
+    contenuto = b"%PDF-1.4\n" + rng.getrandbits(8 * n_byte).to_bytes(n_byte, "little")
+    return (
+        "<Allegati>"
+        f"<NomeAttachment>allegato_{n}.pdf</NomeAttachment>"
+        "<FormatoAttachment>PDF</FormatoAttachment>"
+        "<DescrizioneAttachment>Copia di cortesia</DescrizioneAttachment>"
+        f"<Attachment>{base64.encodebytes(contenuto).decode('ascii')}</Attachment>"
+        "</Allegati>"
+    )
+
+
+def _corpo(rng, numero, data_documento, righe, allegati, dimensione_allegato):
+    linee = []
+    imponibili = {}
+    for i in range(1, righe + 1):
+        aliquota, natura = rng.choice(_ALIQUOTE)
+        quantita = Decimal(rng.randint(1, 50))
+        prezzo = _importo(Decimal(rng.randint(50, 50000)) / 100)
+        totale = _importo(quantita * prezzo)
+        imponibili[(aliquota, natura)] = imponibili.get((aliquota, natura), Decimal("0")) + totale
+        linee.append(
+            "<DettaglioLinee>"
+            f"<NumeroLinea>{i}</NumeroLinea>"
+            f"<CodiceArticolo><CodiceTipo>INTERNO</CodiceTipo><CodiceValore>ART{rng.randint(1, 99999):05d}</CodiceValore></CodiceArticolo>"
+            f"<Descrizione>{rng.choice(_ARTICOLI)}</Descrizione>"
+            f"<Quantita>{quantita}.00</Quantita>"
+            f"<UnitaMisura>{rng.choice(_UNITA)}</UnitaMisura>"
+            f"<PrezzoUnitario>{prezzo}</PrezzoUnitario>"
+            f"<PrezzoTotale>{totale}</PrezzoTotale>"
+            f"<AliquotaIVA>{aliquota}</AliquotaIVA>"
+            + (f"<Natura>{natura}</Natura>" if natura else "")
+            + "</DettaglioLinee>"
+        )
+
+    riepiloghi = []
+    totale_documento = Decimal("0")
+    for (aliquota, natura), imponibile in sorted(imponibili.items(), key=lambda v: -v[0][0]):
+        imposta = _importo(imponibile * aliquota / 100)
+        totale_documento += imponibile + imposta
+        riepiloghi.append(
+            "<DatiRiepilogo>"
+            f"<AliquotaIVA>{aliquota}</AliquotaIVA>"
+            + (f"<Natura>{natura}</Natura>" if natura else "")
+            + f"<ImponibileImporto>{imponibile}</ImponibileImporto>"
+            f"<Imposta>{imposta}</Imposta>"
+            + ("<RiferimentoNormativo>Art. 7 DPR 633/72</RiferimentoNormativo>" if natura
+               else "<EsigibilitaIVA>I</EsigibilitaIVA>")
+            + "</DatiRiepilogo>"
+        )
+
+    scadenza = data_documento + timedelta(days=rng.choice((0, 30, 60, 90)))
+    return (
+        "<FatturaElettronicaBody>"
+        "<DatiGenerali><DatiGeneraliDocumento>"
+        "<TipoDocumento>TD01</TipoDocumento><Divisa>EUR</Divisa>"
+        f"<Data>{data_documento.isoformat()}</Data><Numero>{numero}</Numero>"
+        f"<ImportoTotaleDocumento>{totale_documento}</ImportoTotaleDocumento>"
+        f"<Causale>Fornitura come da ordine n. {rng.randint(1, 9999)}</Causale>"
+        "</DatiGeneraliDocumento></DatiGenerali>"
+        f"<DatiBeniServizi>{''.join(linee)}{''.join(riepiloghi)}</DatiBeniServizi>"
+        "<DatiPagamento><CondizioniPagamento>TP02</CondizioniPagamento><DettaglioPagamento>"
+        f"<ModalitaPagamento>{rng.choice(_MODALITA)}</ModalitaPagamento>"
+        f"<DataScadenzaPagamento>{scadenza.isoformat()}</DataScadenzaPagamento>"
+        f"<ImportoPagamento>{totale_documento}</ImportoPagamento>"
+        "</DettaglioPagamento></DatiPagamento>"
+        + "".join(_allegato(rng, n, dimensione_allegato) for n in range(1, allegati + 1))
+        + "</FatturaElettronicaBody>"
+    )
+
+
+def genera_fattura(numero=1, righe=10, corpi=1, allegati=0, dimensione_allegato=64 * 1024,
+                   formato=FORMATO_PRIVATI, encoding=ENCODING_UTF8, seed=None):
+    """
+    Ritorna i byte di una fattura conforme allo schema FatturaPA.
+    `corpi` > 1 produce un lotto; gli Allegati (`allegati` per body) sono
+    finti PDF di `dimensione_allegato` byte.
+    """
+    rng = random.Random(seed if seed is not None else numero)
+    data_documento = date(2024, 1, 1) + timedelta(days=rng.randint(0, 364))
+    corpi_xml = "".join(
+        _corpo(rng, f"{numero}/{n}" if corpi > 1 else str(numero), data_documento, righe, allegati, dimensione_allegato)
+        for n in range(1, corpi + 1)
+    )
+
+    codifica = "UTF-8" if encoding == ENCODING_UTF8_BOM else encoding
+    testo = (
+        f'<?xml version="1.0" encoding="{codifica}"?>'
+        f'<p:FatturaElettronica versione="{formato}" xmlns:p="{NS_FATTURA}">'
+        f"{_testata(rng, formato, f'{numero % 10 ** 10:05d}')}"
+        f"{corpi_xml}"
+        "</p:FatturaElettronica>"
+    )
+    dati = testo.encode(codifica)
+    if encoding == ENCODING_UTF8_BOM:
+        dati = b"\xef\xbb\xbf" + dati
+    return dati
+
+
+# --- Busta .p7m (CMS SignedData, DER) --------------------------------------
+
+def _tlv(tag, contenuto):
+    n = len(contenuto)
+    if n < 0x80:
+        lunghezza = bytes([n])
+    else:
+        b = n.to_bytes((n.bit_length() + 7) // 8, "big")
+        lunghezza = bytes([0x80 | len(b)]) + b
+    return bytes([tag]) + lunghezza + contenuto
+
+
+def _seq(*figli):
+    return _tlv(0x30, b"".join(figli))
+
+
+def _set(*figli):
+    return _tlv(0x31, b"".join(figli))
+
+
+def _oid(testo):
+    valori = [int(v) for v in testo.split(".")]
+    corpo = bytes([valori[0] * 40 + valori[1]])
+    for v in valori[2:]:
+        pezzi = [v & 0x7F]
+        v >>= 7
+        while v:
+            pezzi.append(0x80 | (v & 0x7F))
+            v >>= 7
+        corpo += bytes(reversed(pezzi))
+    return _tlv(0x06, corpo)
+
+
+def _nome_x509(cn):
+    return _seq(
+        _set(_seq(_oid("2.5.4.6"), _tlv(0x13, b"IT"))),
+        _set(_seq(_oid("2.5.4.3"), _tlv(0x0C, cn.encode("utf-8")))),
+    )
+
+
+def busta_p7m(xml_bytes, firmatario="Firmatario Benchmark"):
+    """
+    Avvolge l'XML in una busta CAdES "attached" (DER) con un certificato e un
+    SignerInfo fittizi ma strutturalmente corretti.
+    """
+    emittente = _nome_x509("CA Benchmark")
+    serie = _tlv(0x02, b"\x01\x23")
+    sha256 = _seq(_oid("2.16.840.1.101.3.4.2.1"))
+    certificato = _seq(_seq(_tlv(0xA0, _tlv(0x02, b"\x02")), serie, sha256, emittente,
+                            _seq(_tlv(0x17, b"240101000000Z"), _tlv(0x17, b"270101000000Z")),
+                            _nome_x509(firmatario)))
+    signer_info = _seq(
+        _tlv(0x02, b"\x01"),
+        _seq(emittente, serie),
+        sha256,
+        _tlv(0xA0, _seq(_oid("1.2.840.113549.1.9.5"), _set(_tlv(0x17, b"240131103000Z")))),
+        _seq(_oid("1.2.840.113549.1.1.11")),
+        _tlv(0x04, b"\x00" * 256),
+    )
+    signed_data = _seq(
+        _tlv(0x02, b"\x01"),
+        _set(sha256),
+        _seq(_oid("1.2.840.113549.1.7.1"), _tlv(0xA0, _tlv(0x04, xml_bytes))),
+        _tlv(0xA0, certificato),
+        _set(signer_info),
+    )
+    return _seq(_oid("1.2.840.113549.1.7.2"), _tlv(0xA0, signed_data))
+
+
+# ---------------------------------------------------------------------------
+
+def genera_corpus(n, seed=0, righe=(1, 40), quota_lotti=0.05, quota_allegati=0.2,
+                  quota_p7m=0.3, quota_pa=0.1, dimensione_allegato=64 * 1024):
+    """
+    Genera `n` documenti (nome, byte) con un mix realistico: la maggior parte
+    fatture singole con poche righe, alcune PA, alcuni lotti, alcune con allegati,
+    una parte firmata (.p7m) ed encoding misti.
+    `righe` è l'intervallo (min, max) delle DettaglioLinee per body.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(1, n + 1):
+        xml = genera_fattura(
+            numero=i,
+            righe=rng.randint(*righe),
+            corpi=rng.randint(2, 5) if rng.random() < quota_lotti else 1,
+            allegati=1 if rng.random() < quota_allegati else 0,
+            dimensione_allegato=dimensione_allegato,
+            formato=FORMATO_PA if rng.random() < quota_pa else FORMATO_PRIVATI,
+            encoding=rng.choice(ENCODING_CORPUS),
+            seed=seed * 1_000_003 + i,
+        )
+        nome = f"IT{i:011d}_{i:05d}.xml"
+        if rng.random() < quota_p7m:
+            corpus.append((nome + ".p7m", busta_p7m(xml)))
+        else:
+            corpus.append((nome, xml))
+    return corpus
+
+
+def scrivi_corpus(cartella, corpus):
+    os.makedirs(cartella, exist_ok=True)
+    for nome, dati in corpus:
+        with open(os.path.join(cartella, nome), "wb") as f:
+            f.write(dati)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cartella", help="dove scrivere i file generati")
+    parser.add_argument("--n", type=int, default=1000, help="numero di documenti")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--righe", type=int, nargs=2, default=[1, 40], metavar=("MIN", "MAX"))
+    parser.add_argument("--p7m", type=float, default=0.3, help="quota di documenti firmati")
+    parser.add_argument("--allegati", type=float, default=0.2, help="quota di documenti con allegato")
+    parser.add_argument("--lotti", type=float, default=0.05, help="quota di lotti (più body)")
+    args = parser.parse_args()
+
+    corpus = genera_corpus(args.n, seed=args.seed, righe=tuple(args.righe), quota_lotti=args.lotti,
+                           quota_allegati=args.allegati, quota_p7m=args.p7m)
+    scrivi_corpus(args.cartella, corpus)
+    print(f"Generati {len(corpus)} documenti in {args.cartella} "
+          f"({sum(len(d) for _, d in corpus) / 1024 / 1024:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
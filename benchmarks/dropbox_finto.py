@@ -0,0 +1,203 @@
+# benchmarks/dropbox_finto.py
+
+"""
+Client Dropbox finto per benchmark e test di services.dropbox_service:
+stessa interfaccia usata dal resync (files_list_folder,
+files_list_folder_continue, files_download) e dall'osservatore
+(files_list_folder_longpoll, files_list_folder_get_latest_cursor) e
+dall'archiviazione (sessioni di upload, files_get_metadata, files_upload) su
+file tenuti in memoria, con latenza artificiale per richiesta ed errori
+temporanei a comando.
+Conta le richieste in volo, per verificare il limite dei download paralleli.
+
+Come su Dropbox il cursore ricorda fin dove si è arrivati: ogni file ha la
+versione dell'ultima modifica (aggiungi()), e continuando da un cursore si
+vedono solo i file modificati dopo.
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+from dropbox.exceptions import ApiError, InternalServerError
+from dropbox.files import (
+    FileMetadata,
+    GetMetadataError,
+    ListFolderContinueError,
+    ListFolderLongpollError,
+    LookupError as LookupErrorDropbox,
+    UploadSessionFinishBatchResult,
+    UploadSessionFinishBatchResultEntry,
+)
+
+from services.mirror_dropbox import content_hash_dropbox
+
+
+class DropboxFinto:
+    """
+    `file`: {percorso: byte}. `latenza`: secondi per ogni download (e metà per
+    ogni pagina dell'elenco). `errori`: {percorso: quante volte fallire con
+    InternalServerError prima di rispondere}.
+    """
+
+    def __init__(self, file, latenza=0.0, per_pagina=1000, errori=None):
+        self.file = dict(file)
+        # Come Dropbox: si scarica per path_lower, l'elenco riporta il nome originale
+        self._percorsi = {p.lower(): p for p in self.file}
+        self.versione = 1
+        self._versioni = dict.fromkeys(self.file, 1)
+        # True: i cursori già dati sono scaduti (errore reset)
+        self.cursori_scaduti = False
+        self._modifiche = threading.Condition()
+        self.latenza = latenza
+        self.per_pagina = per_pagina
+        self.errori = dict(errori or {})
+        self.download = 0
+        # Richieste di archiviazione: sessioni avviate, conferme in blocco, richieste per file
+        self.sessioni = 0
+        self.batch = 0
+        self.richieste_upload = 0
+        self._sessioni = {}
+        self.in_volo = 0
+        self.max_in_volo = 0
+        self._lock = threading.Lock()
+
+    def aggiungi(self, percorso, contenuto):
+        """
+        Carica (o sovrascrive) un file: i cursori e il longpoll lo vedono come modifica.
+        """
+        with self._modifiche:
+            self.versione += 1
+            self.file[percorso] = contenuto
+            self._percorsi[percorso.lower()] = percorso
+            self._versioni[percorso] = self.versione
+            self._modifiche.notify_all()
+
+    def rimuovi(self, percorso):
+        """
+        Cancella un file: non si scarica più e non compare nell'elenco.
+        """
+        with self._modifiche:
+            self.versione += 1
+            del self.file[percorso]
+            del self._percorsi[percorso.lower()]
+            del self._versioni[percorso]
+
+    def _voce(self, percorso):
+        return FileMetadata(
+            name=percorso.rsplit("/", 1)[-1], path_lower=percorso.lower(),
+            content_hash=content_hash_dropbox(self.file[percorso]),
+        )
+
+    def _pagina(self, dopo, fino, inizio):
+        # Cursore "dopo:fino:inizio": file con versione in (dopo, fino], dal numero inizio
+        time.sleep(self.latenza / 2)
+        modificati = sorted(p for p, v in self._versioni.items() if dopo < v <= fino)
+        percorsi = modificati[inizio:inizio + self.per_pagina]
+        fine = inizio + len(percorsi)
+        has_more = fine < len(modificati)
+        return SimpleNamespace(
+            entries=[self._voce(p) for p in percorsi],
+            cursor=f"{dopo}:{fino}:{fine}" if has_more else f"{fino}::0",
+            has_more=has_more,
+        )
+
+    def _leggi_cursore(self, cursor, errore):
+        if self.cursori_scaduti:
+            raise ApiError("finto", errore, "cursore scaduto", None)
+        dopo, fino, inizio = cursor.split(":")
+        return int(dopo), int(fino) if fino else self.versione, int(inizio)
+
+    def files_list_folder(self, path, recursive=False):
+        self.cursori_scaduti = False
+        return self._pagina(0, self.versione, 0)
+
+    def files_list_folder_continue(self, cursor):
+        return self._pagina(*self._leggi_cursore(cursor, ListFolderContinueError.reset))
+
+    def files_list_folder_get_latest_cursor(self, path, recursive=False):
+        return SimpleNamespace(cursor=f"{self.versione}::0")
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        dopo, _, _ = self._leggi_cursore(cursor, ListFolderLongpollError.reset)
+        with self._modifiche:
+            cambiato = self._modifiche.wait_for(lambda: self.versione > dopo, timeout)
+        return SimpleNamespace(changes=cambiato, backoff=None)
+
+    def files_download(self, path):
+        with self._lock:
+            self.download += 1
+            self.in_volo += 1
+            self.max_in_volo = max(self.max_in_volo, self.in_volo)
+            percorso = self._percorsi.get(path)
+            fallisci = self.errori.get(percorso, 0) > 0
+            if fallisci:
+                self.errori[percorso] -= 1
+        try:
+            time.sleep(self.latenza)
+            if fallisci:
+                raise InternalServerError("finto", 503, "errore temporaneo")
+            if percorso is None:
+                raise ApiError("finto", "not_found", "file non trovato", None)
+            metadati = FileMetadata(name=percorso.rsplit("/", 1)[-1], path_lower=path)
+            return metadati, SimpleNamespace(content=self.file[percorso])
+        finally:
+            with self._lock:
+                self.in_volo -= 1
+
+
+    # -------- Archiviazione
+    def files_upload_session_start(self, f, close=False):
+        time.sleep(self.latenza)
+        with self._lock:
+            self.sessioni += 1
+            id_sessione = f"sessione-{self.sessioni}"
+            self._sessioni[id_sessione] = [bytearray(f), close]
+        return SimpleNamespace(session_id=id_sessione)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+        time.sleep(self.latenza)
+        with self._lock:
+            dati, chiusa = self._sessioni[cursor.session_id]
+            assert not chiusa and cursor.offset == len(dati)
+            dati.extend(f)
+            self._sessioni[cursor.session_id][1] = close
+
+    def files_upload_session_finish_batch_v2(self, entries):
+        time.sleep(self.latenza)
+        self.batch += 1
+        esiti = []
+        for voce in entries:
+            dati, chiusa = self._sessioni.pop(voce.cursor.session_id)
+            assert chiusa and voce.cursor.offset == len(dati)
+            self.aggiungi(voce.commit.path, bytes(dati))
+            esiti.append(UploadSessionFinishBatchResultEntry.success(self._voce(voce.commit.path)))
+        return UploadSessionFinishBatchResult(entries=esiti)
+
+    def files_get_metadata(self, path):
+        time.sleep(self.latenza)
+        with self._lock:
+            self.richieste_upload += 1
+            percorso = self._percorsi.get(path.lower())
+        if percorso is None:
+            raise ApiError("finto", GetMetadataError.path(LookupErrorDropbox.not_found), "non trovato", None)
+        return self._voce(percorso)
+
+    def files_upload(self, f, path, mode=None):
+        time.sleep(self.latenza)
+        with self._lock:
+            self.richieste_upload += 1
+        self.aggiungi(path, f)
+        return self._voce(path)
+
+
+def file_finti(n, dimensione=2048):
+    """
+    {percorso: byte} con `n` file .xml in cartelle anno/mese come su Dropbox,
+    ognuno con un contenuto (e quindi un content_hash) diverso.
+    """
+    return {
+        f"/fatture/2024/{1 + i % 12:02d}/fornitore_{i % 50}/ft_{i:06d}.xml":
+            b"<FatturaElettronica>" + b"%06d" % i + b"x" * dimensione + b"</FatturaElettronica>"
+        for i in range(n)
+    }
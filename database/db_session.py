@@ -1,16 +1,130 @@
 # software_fatture/database/db_session.py
 
-import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
 from .models import Base
+from .migrazioni import esegui_migrazioni
+from .ricerca import aggiorna_righe_al_commit
 
 # Nome del DB locale
 DB_URL = "sqlite:///fatture.db"
 
-engine = create_engine(DB_URL, echo=False)  # echo=True se vuoi vedere i log SQL
-SessionLocal = sessionmaker(bind=engine)
+# ----------------------------------------------------------------------------
+# Profili SQLite: PRAGMA applicati a ogni nuova connessione.
+# WAL permette alla UI di leggere mentre un resync scrive; con WAL
+# synchronous=NORMAL resta sicuro contro la corruzione (al più si perdono
+# gli ultimi commit in caso di blackout) e risparmia un fsync per commit.
+# cache_size negativo = KiB.
+# ----------------------------------------------------------------------------
+PROFILO_INTERATTIVO = "interattivo"
+PROFILO_IMPORT = "import"
+
+PROFILI = {
+    # UI: query brevi, cache moderata, attesa breve se il DB è occupato
+    PROFILO_INTERATTIVO: {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -20000,          # ~20 MB
+        "mmap_size": 256 * 1024 ** 2,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,          # ms
+    },
+    # Resync / import massivi: cache grande, checkpoint del WAL meno frequenti,
+    # attesa lunga invece di fallire se la UI sta scrivendo
+    PROFILO_IMPORT: {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -200000,         # ~200 MB
+        "mmap_size": 1024 ** 3,
+        "temp_store": "MEMORY",
+        "busy_timeout": 30000,
+        "wal_autocheckpoint": 10000,   # pagine
+    },
+}
+
+
+def applica_profilo(engine, profilo):
+    """
+    Registra sull'engine i PRAGMA del profilo, eseguiti a ogni nuova connessione.
+    """
+    pragma = PROFILI[profilo]
+
+    @event.listens_for(engine, "connect")
+    def _imposta_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for nome, valore in pragma.items():
+            cursor.execute(f"PRAGMA {nome}={valore}")
+        cursor.close()
+
+    return engine
+
+
+def abilita_savepoint(engine, begin="BEGIN"):
+    """
+    Il driver sqlite3 apre le transazioni da solo, e solo prima di un
+    INSERT/UPDATE: un SAVEPOINT (Session.begin_nested) emesso prima finisce
+    fuori transazione e il suo RELEASE fa commit. Qui il driver non apre più
+    niente e ogni transazione di SQLAlchemy inizia con `begin`
+    ("BEGIN IMMEDIATE" prende subito il lock di scrittura).
+    """
+    @event.listens_for(engine, "connect")
+    def _disattiva_begin_del_driver(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql(begin)
+
+    return engine
+
+
+def crea_engine(url=DB_URL, profilo=PROFILO_INTERATTIVO, **kwargs):
+    """
+    Engine SQLite con il profilo indicato (None = impostazioni predefinite di SQLite).
+    """
+    engine = create_engine(url, echo=False, **kwargs)  # echo=True se vuoi vedere i log SQL
+    if profilo is not None:
+        applica_profilo(engine, profilo)
+    return engine
+
+
+# Engine della UI e di tutto il codice "normale"
+engine = crea_engine(DB_URL, PROFILO_INTERATTIVO)
+# Le sessioni che scrivono ricompongono al commit le descrizioni di fatture_fts (vedi ricerca.py)
+SessionLocal = aggiorna_righe_al_commit(sessionmaker(bind=engine))
+
+# Sessioni per le sole letture, una per thread (vedi sessione_lettura)
+SessionLettura = scoped_session(sessionmaker(bind=engine))
+
+# Engine per le scritture massive (salva_fatture_bulk, resync) e per il thread
+# scrittore (database/scrittore.py): stesso DB, profilo import, savepoint
+# funzionanti e lock di scrittura preso all'inizio della transazione, così
+# due scrittori si mettono in coda (busy_timeout) invece di fallire a metà
+engine_import = abilita_savepoint(crea_engine(DB_URL, PROFILO_IMPORT), begin="BEGIN IMMEDIATE")
+SessionImport = aggiorna_righe_al_commit(sessionmaker(bind=engine_import))
+# Il thread scrittore restituisce oggetti usati da altri thread: niente expire dopo il commit
+SessionScrittore = aggiorna_righe_al_commit(sessionmaker(bind=engine_import, expire_on_commit=False))
+
+
+@contextmanager
+def sessione_lettura():
+    """
+    Sessione del thread corrente per le letture. All'uscita viene chiusa
+    (gli oggetti già caricati restano leggibili); se il thread ne aveva
+    già una aperta da un chiamante, la riusa e la lascia aperta.
+    """
+    gia_aperta = SessionLettura.registry.has()
+    db = SessionLettura()
+    try:
+        yield db
+    finally:
+        if not gia_aperta:
+            SessionLettura.remove()
+
 
 def init_db():
     # Crea effettivamente le tabelle
     Base.metadata.create_all(engine)
+    # Aggiorna lo schema dei DB creati con versioni precedenti
+    esegui_migrazioni(engine)
@@ -0,0 +1,372 @@
+# software_fatture/database/migrazioni.py
+
+"""
+Migrazioni dello schema per i DB già esistenti.
+
+create_all() crea solo le tabelle mancanti, non aggiunge colonne a quelle
+che ci sono già. Ogni migrazione ha un numero progressivo; quello dell'ultima
+applicata è salvato in PRAGMA user_version. Le migrazioni devono essere
+idempotenti: su un DB nuovo girano dopo create_all(), a schema già aggiornato.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+
+def _colonne(conn, tabella):
+    return {riga[1] for riga in conn.exec_driver_sql(f"PRAGMA table_info({tabella})")}
+
+
+def _aggiungi_colonna(conn, tabella, colonna, tipo):
+    if colonna not in _colonne(conn, tabella):
+        conn.exec_driver_sql(f"ALTER TABLE {tabella} ADD COLUMN {colonna} {tipo}")
+
+
+def _v1_allegati_su_disco(conn):
+    """
+    Gli allegati passano dall'archivio su disco (services.allegati_store):
+    nel DB restano solo SHA-256 e descrizione. Gli allegati già salvati in
+    base64 nella colonna `attachment` vengono spostati su disco.
+    """
+    from services.allegati_store import salva_allegato
+
+    _aggiungi_colonna(conn, "allegato_fattura", "sha256", "VARCHAR(64)")
+    _aggiungi_colonna(conn, "allegato_fattura", "descrizione_attachment", "VARCHAR")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_allegato_fattura_sha256 ON allegato_fattura (sha256)"
+    )
+
+    righe = conn.exec_driver_sql(
+        "SELECT id, attachment FROM allegato_fattura WHERE attachment IS NOT NULL AND sha256 IS NULL"
+    ).fetchall()
+    for id_allegato, contenuto in righe:
+        try:
+            sha256 = salva_allegato(base64.b64decode(contenuto))
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"⚠️ Allegato {id_allegato} non in base64, lasciato nel DB: {e}")
+            continue
+        conn.exec_driver_sql(
+            "UPDATE allegato_fattura SET sha256 = ?, attachment = NULL WHERE id = ?",
+            (sha256, id_allegato),
+        )
+    if righe:
+        logger.info(f"📎 Spostati su disco {len(righe)} allegati")
+
+
+def _v2_indici_fatture(conn):
+    """
+    Indici per i filtri della UI e per le scadenze (vedi Fattura.__table_args__).
+    """
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fatture_data_fornitore ON fatture (data, fornitore)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fatture_fornitore_data ON fatture (fornitore, data)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_fatture_scadenza_non_pagate ON fatture (data_scadenza) WHERE pagata = 0"
+    )
+    # Statistiche aggiornate per il query planner
+    conn.exec_driver_sql("ANALYZE fatture")
+
+
+def _v3_xml_compresso(conn, blocco=500):
+    """
+    L'XML integrale passa dalla colonna fatture.xml_raw alla tabella
+    documenti_xml, compresso (vedi models.DocumentoXML). Ritorna True se ha
+    spostato dei dati, così esegui_migrazioni() recupera lo spazio con VACUUM.
+    """
+    from database.models import DocumentoXML, comprimi_xml
+
+    if "xml_raw" not in _colonne(conn, "fatture"):
+        return False
+    DocumentoXML.__table__.create(conn, checkfirst=True)
+
+    spostati = 0
+    ultimo_id = 0
+    while True:
+        righe = conn.exec_driver_sql(
+            "SELECT id, hash_xml, xml_raw FROM fatture WHERE xml_raw IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+            (ultimo_id, blocco),
+        ).fetchall()
+        if not righe:
+            break
+        for id_fattura, hash_xml, xml_raw in righe:
+            if hash_xml is None:
+                # Fatture vecchie senza hash: lo calcolo dal testo salvato,
+                # a meno che la stessa fattura non sia già presente con quell'hash
+                hash_xml = hashlib.sha256(xml_raw.encode("utf-8")).hexdigest()
+                conn.exec_driver_sql(
+                    "UPDATE fatture SET hash_xml = ? WHERE id = ? "
+                    "AND NOT EXISTS (SELECT 1 FROM fatture WHERE hash_xml = ?)",
+                    (hash_xml, id_fattura, hash_xml),
+                )
+            documento = comprimi_xml(xml_raw)
+            conn.exec_driver_sql(
+                "INSERT OR IGNORE INTO documenti_xml (hash_xml, compressione, dimensione, contenuto) "
+                "VALUES (?, ?, ?, ?)",
+                (hash_xml, documento["compressione"], documento["dimensione"], documento["contenuto"]),
+            )
+        spostati += len(righe)
+        ultimo_id = righe[-1][0]
+
+    try:
+        conn.exec_driver_sql("ALTER TABLE fatture DROP COLUMN xml_raw")
+    except OperationalError:
+        # SQLite < 3.35 non ha DROP COLUMN: la colonna resta, ma vuota
+        conn.exec_driver_sql("UPDATE fatture SET xml_raw = NULL")
+    logger.info(f"🗜️ Compressi in documenti_xml {spostati} XML di fatture")
+    return True
+
+
+def _v4_ricerca_full_text(conn):
+    """
+    Indice FTS5 per la ricerca globale, con i trigger che lo tengono aggiornato
+    (vedi database/ricerca.py). Le fatture già presenti vengono indicizzate.
+    """
+    from database.ricerca import crea_indice_ricerca
+
+    # I trigger sulle righe rileggono tutte le righe della fattura
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_righe_fattura_fattura_id ON righe_fattura (fattura_id)"
+    )
+    crea_indice_ricerca(conn)
+
+
+def _v5_totali_aggregati(conn):
+    """
+    Tabelle dei totali per periodo/fornitore/aliquota con i trigger che le
+    aggiornano (vedi database/totali.py), calcolate sui dati già presenti.
+    """
+    from database.totali import crea_trigger_totali
+
+    # I trigger su fatture rileggono i riepiloghi IVA della fattura
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_dati_riepilogo_iva_fattura_id ON dati_riepilogo_iva (fattura_id)"
+    )
+    crea_trigger_totali(conn)
+
+
+def _v6_righe_ricerca_al_commit(conn):
+    """
+    I trigger su righe_fattura non ricompongono più le descrizioni di fatture_fts
+    a ogni riga inserita (costo quadratico sulle fatture con molte righe): le
+    segnano, e la ricomposizione avviene una volta per fattura al commit
+    (vedi database/ricerca.py).
+    """
+    from database.ricerca import ricrea_trigger_righe
+
+    ricrea_trigger_righe(conn)
+
+
+_TABELLE_FIGLIE = ("righe_fattura", "dati_riepilogo_iva", "dati_pagamento", "allegato_fattura")
+
+
+def _crea_trigger_cascata(conn):
+    """
+    Un solo trigger AFTER DELETE su fatture, con le istruzioni in ordine:
+    prima toglie la fattura dai totali (vedi database/totali.py), poi cancella
+    documento XML e righe figlie. Con due trigger SQLite esegue per primo il
+    più recente, e i riepiloghi sparirebbero prima di essere sottratti.
+    """
+    from database.totali import istruzioni_togli_fattura
+
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS fatture_cascata_ad AFTER DELETE ON fatture BEGIN "
+        + " ".join(istruzioni_togli_fattura("old"))
+        + " DELETE FROM documenti_xml WHERE hash_xml = old.hash_xml; "
+        + " ".join(f"DELETE FROM {tabella} WHERE fattura_id = old.id;" for tabella in _TABELLE_FIGLIE)
+        + " END"
+    )
+
+
+def _v7_cancellazione_a_cascata(conn):
+    """
+    Documento XML, righe, riepiloghi, pagamenti e allegati seguono la loro
+    fattura anche quando questa viene cancellata in SQL, senza passare
+    dall'ORM (es. query(Fattura).delete()): un trigger li rimuove. Quelli
+    rimasti orfani finora vengono cancellati, così reimportare le fatture non
+    urta la chiave di documenti_xml e gli id riusati da SQLite non ereditano
+    righe di altre fatture.
+    """
+    _crea_trigger_cascata(conn)
+
+    orfani = conn.exec_driver_sql(
+        "DELETE FROM documenti_xml WHERE hash_xml NOT IN "
+        "(SELECT hash_xml FROM fatture WHERE hash_xml IS NOT NULL)"
+    ).rowcount
+    for tabella in _TABELLE_FIGLIE:
+        orfani += conn.exec_driver_sql(
+            f"DELETE FROM {tabella} WHERE fattura_id IS NOT NULL AND fattura_id NOT IN (SELECT id FROM fatture)"
+        ).rowcount
+    if orfani:
+        logger.info(f"🧹 Rimosse {orfani} righe di fatture cancellate")
+
+
+def _v8_allegati_fuori_dall_xml(conn, blocco=200):
+    """
+    Nell'XML salvato il base64 degli <Attachment> è sostituito dal riferimento
+    "sha256:<hash>" all'archivio su disco (vedi services.allegati_store), dove
+    gli allegati vengono salvati se mancano. Si rileggono solo i documenti
+    delle fatture con allegati. Ritorna True se ha riscritto dei documenti,
+    così esegui_migrazioni() recupera lo spazio con VACUUM.
+    """
+    from database.models import DocumentoXML, comprimi_xml
+    from services.allegati_store import esiste_allegato, salva_allegato, togli_allegati
+
+    riscritti = 0
+    ultimo_hash = ""
+    while True:
+        righe = conn.exec_driver_sql(
+            "SELECT d.hash_xml, d.compressione, d.contenuto FROM documenti_xml AS d "
+            "JOIN fatture AS f ON f.hash_xml = d.hash_xml "
+            "WHERE d.hash_xml > ? AND EXISTS (SELECT 1 FROM allegato_fattura AS a WHERE a.fattura_id = f.id) "
+            "ORDER BY d.hash_xml LIMIT ?",
+            (ultimo_hash, blocco),
+        ).fetchall()
+        if not righe:
+            break
+        for hash_xml, compressione, contenuto in righe:
+            testo, allegati = togli_allegati(DocumentoXML(compressione=compressione, contenuto=contenuto).testo())
+            if not allegati:
+                continue
+            for sha256, dati in allegati.items():
+                if not esiste_allegato(sha256):
+                    salva_allegato(dati)
+            documento = comprimi_xml(testo)
+            conn.exec_driver_sql(
+                "UPDATE documenti_xml SET compressione = ?, dimensione = ?, contenuto = ? WHERE hash_xml = ?",
+                (documento["compressione"], documento["dimensione"], documento["contenuto"], hash_xml),
+            )
+            riscritti += 1
+        ultimo_hash = righe[-1][0]
+
+    if riscritti:
+        logger.info(f"📎 Tolti gli allegati in base64 da {riscritti} XML di fatture")
+    return riscritti > 0
+
+
+def _v9_file_dropbox_da_riprovare(conn):
+    """
+    file_dropbox registra anche i file falliti, con l'errore, da riprovare
+    alle sincronizzazioni successive (vedi database/sync_dropbox.py).
+    """
+    from database.models import FileDropbox
+
+    FileDropbox.__table__.create(conn, checkfirst=True)
+    _aggiungi_colonna(conn, "file_dropbox", "errore", "TEXT")
+
+
+def _v10_totali_prima_della_cascata(conn):
+    """
+    Il trigger fatture_cascata_ad, più recente di fatture_totali_ad, cancellava
+    i riepiloghi IVA prima che venissero tolti da totali_iva_mese: i due trigger
+    diventano uno solo, con i totali tolti per primi, e i totali rimasti
+    sbagliati vengono ricalcolati.
+    """
+    from database.totali import ricostruisci_totali, verifica_totali
+
+    conn.exec_driver_sql("DROP TRIGGER IF EXISTS fatture_totali_ad")
+    conn.exec_driver_sql("DROP TRIGGER IF EXISTS fatture_cascata_ad")
+    _crea_trigger_cascata(conn)
+    if verifica_totali(conn):
+        ricostruisci_totali(conn)
+        logger.info("🧮 Ricalcolati i totali rimasti dopo fatture cancellate")
+
+
+def _v11_id_mai_riusati(conn):
+    """
+    Fatture, righe, riepiloghi e pagamenti passano ad AUTOINCREMENT: senza,
+    SQLite riassegna l'id più alto dopo averlo cancellato e l'esportazione
+    incrementale salterebbe la riga nuova. SQLite non permette di cambiare
+    la chiave di una tabella esistente: ciascuna viene ricreata dal modello e
+    ricopiata con gli stessi id, poi si rimettono i suoi indici e trigger.
+    legacy_alter_table evita che la RENAME riscriva i trigger e le chiavi
+    esterne delle altre tabelle, che devono continuare a nominare l'originale.
+    Ritorna True se ha ricreato delle tabelle, così esegui_migrazioni()
+    recupera lo spazio con VACUUM.
+    """
+    from database.models import DatiPagamento, DatiRiepilogoIVA, Fattura, RigheFattura
+
+    ricreate = 0
+    conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+    for modello in (Fattura, RigheFattura, DatiRiepilogoIVA, DatiPagamento):
+        tabella = modello.__table__
+        nome = tabella.name
+        (ddl,) = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (nome,)
+        ).one()
+        if "AUTOINCREMENT" in ddl.upper():
+            continue
+
+        oggetti = conn.exec_driver_sql(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL",
+            (nome,),
+        ).fetchall()
+        colonne = ", ".join(c for c in _colonne(conn, nome) if c in tabella.c)
+
+        # Gli indici restano legati alla vecchia tabella: vanno tolti prima
+        # che create() li ricrei con lo stesso nome sulla nuova
+        for tipo, nome_oggetto, _ in oggetti:
+            if tipo == "index":
+                conn.exec_driver_sql(f"DROP INDEX {nome_oggetto}")
+        conn.exec_driver_sql(f"ALTER TABLE {nome} RENAME TO {nome}_vecchia")
+        tabella.create(conn)
+        conn.exec_driver_sql(f"INSERT INTO {nome} ({colonne}) SELECT {colonne} FROM {nome}_vecchia")
+        # DROP TABLE porta via anche i trigger della vecchia tabella
+        conn.exec_driver_sql(f"DROP TABLE {nome}_vecchia")
+
+        indici_modello = {indice.name for indice in tabella.indexes}
+        for tipo, nome_oggetto, sql in oggetti:
+            if tipo == "trigger" or nome_oggetto not in indici_modello:
+                conn.exec_driver_sql(sql)
+        ricreate += 1
+    conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+
+    if ricreate:
+        logger.info(f"🔢 {ricreate} tabelle ricreate con id AUTOINCREMENT")
+    return ricreate > 0
+
+
+# (numero, funzione) in ordine crescente
+MIGRAZIONI = (
+    (1, _v1_allegati_su_disco),
+    (2, _v2_indici_fatture),
+    (3, _v3_xml_compresso),
+    (4, _v4_ricerca_full_text),
+    (5, _v5_totali_aggregati),
+    (6, _v6_righe_ricerca_al_commit),
+    (7, _v7_cancellazione_a_cascata),
+    (8, _v8_allegati_fuori_dall_xml),
+    (9, _v9_file_dropbox_da_riprovare),
+    (10, _v10_totali_prima_della_cascata),
+    (11, _v11_id_mai_riusati),
+)
+
+
+def versione_schema(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def esegui_migrazioni(engine):
+    """
+    Applica le migrazioni non ancora eseguite, ciascuna nella sua transazione.
+    Se una migrazione ritorna True (ha liberato molto spazio) alla fine
+    il file del DB viene compattato con VACUUM.
+    """
+    compatta = False
+    for numero, migrazione in MIGRAZIONI:
+        with engine.begin() as conn:
+            if versione_schema(conn) >= numero:
+                continue
+            compatta = migrazione(conn) or compatta
+            # PRAGMA non accetta parametri: `numero` viene dalla tabella sopra
+            conn.exec_driver_sql(f"PRAGMA user_version = {numero}")
+
+    if compatta:
+        # VACUUM non può girare dentro una transazione
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
@@ -1,13 +1,27 @@
 # software_fatture/database/models.py
 
+import zlib
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import (
-    Column, Integer, String, Float, Date, Boolean,
-    ForeignKey, Text
+    Column, Integer, String, Float, Date, DateTime, Boolean,
+    ForeignKey, Text, Index, text, LargeBinary
 )
 
 Base = declarative_base()
 
+COMPRESSIONE_ZLIB = "zlib"
+
+def comprimi_xml(testo):
+    """
+    Valori per una riga di DocumentoXML: l'XML (già decodificato) in UTF-8 compresso con zlib.
+    """
+    dati = testo.encode("utf-8")
+    return {
+        "contenuto": zlib.compress(dati, 6),
+        "compressione": COMPRESSIONE_ZLIB,
+        "dimensione": len(dati),
+    }
+
 class Fattura(Base):
     """
     Tabella principale che unisce i campi 'storici' (numero, fornitore, ecc.)
@@ -15,6 +29,16 @@ class Fattura(Base):
     Cessionario, DatiGenerali, ecc.).
     """
     __tablename__ = "fatture"
+    __table_args__ = (
+        # Filtri della UI: anno/mese (intervallo su data) con o senza fornitore
+        Index("ix_fatture_data_fornitore", "data", "fornitore"),
+        Index("ix_fatture_fornitore_data", "fornitore", "data"),
+        # Scadenze: solo le fatture non pagate, le uniche che interessano
+        Index("ix_fatture_scadenza_non_pagate", "data_scadenza", sqlite_where=text("pagata = 0")),
+        # Id mai riusati dopo una cancellazione: l'esportazione incrementale
+        # riparte dall'ultimo id assegnato (vedi services/esportazione.py)
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -34,9 +58,26 @@ class Fattura(Base):
     righe = relationship("RigheFattura", back_populates="fattura")
 
     # ----------------------------
-    # NUOVO: Memorizziamo l'XML integrale per XSLT
+    # XML integrale (per XSLT e per ri-parsare): sta compresso in DocumentoXML
+    # e viene caricato solo quando si legge `xml_raw`, mai dalle query di elenco
     # ----------------------------
-    xml_raw = Column(Text, nullable=True)
+    documento = relationship(
+        "DocumentoXML",
+        uselist=False,
+        cascade="all, delete-orphan"
+    )
+
+    @property
+    def xml_raw(self):
+        return self.documento.testo() if self.documento is not None else None
+
+    @xml_raw.setter
+    def xml_raw(self, testo):
+        self.documento = DocumentoXML(**comprimi_xml(testo)) if testo is not None else None
+
+    # Hash con cui le versioni precedenti registravano lo stesso file (vedi
+    # services.parser_fatture.calcola_hash_legacy), non mappato: None se coincide
+    hash_legacy = None
 
     # ----------------------------
     # FATTURAELETTRONICAHEADER
@@ -126,6 +167,24 @@ class Fattura(Base):
         cascade="all, delete-orphan"
     )
 
+# ----------------------------------------------------------------------------
+class DocumentoXML(Base):
+    """
+    XML originale della fattura, compresso, in una tabella a parte:
+    l'elenco delle fatture non lo legge mai e il DB resta piccolo.
+    """
+    __tablename__ = "documenti_xml"
+
+    hash_xml = Column(String, ForeignKey("fatture.hash_xml"), primary_key=True)
+    compressione = Column(String, default=COMPRESSIONE_ZLIB)
+    dimensione = Column(Integer)  # byte non compressi
+    contenuto = Column(LargeBinary, nullable=False)
+
+    def testo(self):
+        if self.compressione != COMPRESSIONE_ZLIB:
+            raise ValueError(f"Compressione non supportata: {self.compressione}")
+        return zlib.decompress(self.contenuto).decode("utf-8")
+
 # ----------------------------------------------------------------------------
 class RigheFattura(Base):
     """
@@ -134,9 +193,10 @@ class RigheFattura(Base):
     prezzo_totale, natura, ecc.
     """
     __tablename__ = "righe_fattura"
+    __table_args__ = {"sqlite_autoincrement": True}  # come Fattura
 
     id = Column(Integer, primary_key=True)
-    fattura_id = Column(Integer, ForeignKey("fatture.id"))
+    fattura_id = Column(Integer, ForeignKey("fatture.id"), index=True)  # usato dai trigger di fatture_fts
 
     # Preesistente
     descrizione = Column(Text, nullable=False)
@@ -161,9 +221,10 @@ class DatiRiepilogoIVA(Base):
     esigibilita, natura (se presente).
     """
     __tablename__ = "dati_riepilogo_iva"
+    __table_args__ = {"sqlite_autoincrement": True}  # come Fattura
 
     id = Column(Integer, primary_key=True)
-    fattura_id = Column(Integer, ForeignKey("fatture.id"))
+    fattura_id = Column(Integer, ForeignKey("fatture.id"), index=True)  # usato dai trigger dei totali
 
     aliquota_iva = Column(Float)
     imponibile_importo = Column(Float)
@@ -179,6 +240,7 @@ class DatiPagamento(Base):
     Mappa i <DatiPagamento><DettaglioPagamento>
     """
     __tablename__ = "dati_pagamento"
+    __table_args__ = {"sqlite_autoincrement": True}  # come Fattura
 
     id = Column(Integer, primary_key=True)
     fattura_id = Column(Integer, ForeignKey("fatture.id"))
@@ -193,8 +255,9 @@ class DatiPagamento(Base):
 # ----------------------------------------------------------------------------
 class AllegatoFattura(Base):
     """
-    Mappa <Allegati>. Può contenere NomeAttachment, FormatoAttachment,
-    e l’attachment in base64 (o un path).
+    Mappa <Allegati>: NomeAttachment, FormatoAttachment, DescrizioneAttachment.
+    Il contenuto non sta nel DB: è nell'archivio su disco (services.allegati_store),
+    indirizzato dallo SHA-256 dei byte decodificati.
     """
     __tablename__ = "allegato_fattura"
 
@@ -203,10 +266,16 @@ class AllegatoFattura(Base):
 
     nome_attachment = Column(String)
     formato_attachment = Column(String)
-    attachment = Column(Text)  # base64
+    descrizione_attachment = Column(String)
+    sha256 = Column(String(64), index=True)  # chiave nell'archivio allegati
+    attachment = Column(Text)  # base64, solo DB vecchi non ancora migrati
 
     fattura = relationship("Fattura", back_populates="allegati")
 
+    # Non mappato: path del file con l'allegato appena letto dall'XML
+    # (services.allegati_store.parcheggia_allegato), va nell'archivio al commit
+    in_arrivo = None
+
 # ----------------------------------------------------------------------------
 class PagamentiExtra(Base):
     """
@@ -220,3 +289,67 @@ class PagamentiExtra(Base):
     importo = Column(Float, default=0.0)
     descrizione = Column(Text)
     categoria = Column(String, nullable=True)
+
+# ----------------------------------------------------------------------------
+# Totali aggregati (vedi database/totali.py): aggiornati dai trigger SQLite
+# a ogni scrittura su fatture e dati_riepilogo_iva, mai a mano.
+# anno/mese valgono 0 per le fatture senza data, fornitore "" se manca.
+# ----------------------------------------------------------------------------
+class TotaleFornitoreMese(Base):
+    """
+    Numero di fatture, totale e importo non pagato per anno, mese e fornitore.
+    """
+    __tablename__ = "totali_fornitore_mese"
+
+    anno = Column(Integer, primary_key=True)
+    mese = Column(Integer, primary_key=True)
+    fornitore = Column(String, primary_key=True)
+
+    n_fatture = Column(Integer, nullable=False, default=0)
+    totale = Column(Float, nullable=False, default=0.0)
+    non_pagato = Column(Float, nullable=False, default=0.0)
+
+class TotaleIvaMese(Base):
+    """
+    Imponibile e imposta dei DatiRiepilogo per anno, mese, fornitore e aliquota.
+    """
+    __tablename__ = "totali_iva_mese"
+
+    anno = Column(Integer, primary_key=True)
+    mese = Column(Integer, primary_key=True)
+    fornitore = Column(String, primary_key=True)
+    aliquota_iva = Column(Float, primary_key=True)
+
+    n_riepiloghi = Column(Integer, nullable=False, default=0)
+    imponibile = Column(Float, nullable=False, default=0.0)
+    imposta = Column(Float, nullable=False, default=0.0)
+
+
+# ----------------------------------------------------------------------------
+# Stato della sincronizzazione con Dropbox (vedi database/sync_dropbox.py)
+# ----------------------------------------------------------------------------
+class CursoreDropbox(Base):
+    """
+    Cursore di files_list_folder dopo l'ultima sincronizzazione completa della
+    cartella: la successiva riparte da lì con files_list_folder_continue.
+    """
+    __tablename__ = "cursori_dropbox"
+
+    cartella = Column(String, primary_key=True)
+    cursore = Column(String, nullable=False)
+    aggiornato_il = Column(DateTime)
+
+class FileDropbox(Base):
+    """
+    File di Dropbox già elaborati (importati o già presenti), con il
+    content_hash di Dropbox: un file con lo stesso contenuto non viene
+    scaricato di nuovo. I file falliti (download, parsing o salvataggio)
+    hanno `errore` valorizzato e vengono riprovati alla sincronizzazione
+    successiva, anche se il cursore è andato avanti.
+    """
+    __tablename__ = "file_dropbox"
+
+    path_lower = Column(String, primary_key=True)
+    content_hash = Column(String(64), index=True)
+    sincronizzato_il = Column(DateTime)
+    errore = Column(Text)  # NULL se elaborato, altrimenti l'ultimo errore
@@ -0,0 +1,115 @@
+# software_fatture/database/query_fatture.py
+
+"""
+Query usate dalla UI e dalle notifiche, scritte in modo che SQLite possa
+usare gli indici di models.Fattura: i filtri per data sono intervalli
+[inizio, fine) sulla colonna, non extract() (che obbliga a leggere tutta la tabella).
+La ricerca per testo passa dall'indice full-text di database/ricerca.py.
+"""
+
+from datetime import date
+from sqlalchemy import extract
+from sqlalchemy.orm import selectinload
+
+from .models import Fattura, DocumentoXML
+from .ricerca import filtra_ricerca
+
+MESI = {
+    "Gennaio": 1, "Febbraio": 2, "Marzo": 3, "Aprile": 4, "Maggio": 5, "Giugno": 6,
+    "Luglio": 7, "Agosto": 8, "Settembre": 9, "Ottobre": 10, "Novembre": 11, "Dicembre": 12,
+}
+
+
+def intervallo_date(anno, mese=None):
+    """
+    (inizio, fine) dell'anno o del mese, con `fine` esclusa.
+    """
+    if mese is None:
+        return date(anno, 1, 1), date(anno + 1, 1, 1)
+    if mese == 12:
+        return date(anno, 12, 1), date(anno + 1, 1, 1)
+    return date(anno, mese, 1), date(anno, mese + 1, 1)
+
+
+def query_fatture(db, anno=None, mese=None, cedente=None, search=None):
+    """
+    Fatture filtrate per anno/mese di `data`, fornitore e testo libero.
+    `mese` senza `anno` non è un intervallo unico e resta un extract().
+    Con `search` le fatture sono ordinate per pertinenza (vedi filtra_ricerca).
+    """
+    query = db.query(Fattura)
+
+    if anno is not None:
+        inizio, fine = intervallo_date(anno, mese)
+        query = query.filter(Fattura.data >= inizio, Fattura.data < fine)
+    elif mese is not None:
+        query = query.filter(extract("month", Fattura.data) == mese)
+
+    if cedente:
+        query = query.filter(Fattura.fornitore == cedente)
+
+    if search:
+        query = filtra_ricerca(query, Fattura.id, search)
+
+    return query
+
+
+def query_non_pagate_in_scadenza(db, inizio=None, fine=None):
+    """
+    Fatture non pagate con data_scadenza in [inizio, fine) (estremi opzionali).
+    La condizione `pagata = 0` è quella dell'indice parziale ix_fatture_scadenza_non_pagate.
+    """
+    query = db.query(Fattura).filter(
+        Fattura.pagata == False,
+        Fattura.data_scadenza != None,
+    )
+    if inizio is not None:
+        query = query.filter(Fattura.data_scadenza >= inizio)
+    if fine is not None:
+        query = query.filter(Fattura.data_scadenza < fine)
+    return query.order_by(Fattura.data_scadenza)
+
+
+def query_fornitori(db):
+    """
+    Fornitori distinti (senza i vuoti), in ordine alfabetico.
+    """
+    return (
+        db.query(Fattura.fornitore)
+        .filter(Fattura.fornitore != None, Fattura.fornitore != "")
+        .distinct()
+        .order_by(Fattura.fornitore)
+    )
+
+
+def fattura_con_dettagli(db, fattura_id):
+    """
+    La fattura con righe e allegati già caricati (leggibili anche a sessione chiusa), o None.
+    """
+    return (
+        db.query(Fattura)
+        .options(selectinload(Fattura.righe), selectinload(Fattura.allegati))
+        .filter(Fattura.id == fattura_id)
+        .first()
+    )
+
+
+def testo_xml_fattura(db, fattura_id, con_allegati=False):
+    """
+    XML della fattura (decompresso), leggendo solo la sua riga di documenti_xml.
+    Gli <Attachment> contengono il riferimento all'archivio su disco; con
+    `con_allegati` il base64 viene reinserito (services.allegati_store).
+    """
+    documento = (
+        db.query(DocumentoXML)
+        .join(Fattura, Fattura.hash_xml == DocumentoXML.hash_xml)
+        .filter(Fattura.id == fattura_id)
+        .first()
+    )
+    if documento is None:
+        return None
+    if con_allegati:
+        from services.allegati_store import reinserisci_allegati
+
+        return reinserisci_allegati(documento.testo())
+    return documento.testo()
@@ -0,0 +1,85 @@
+# software_fatture/database/repository_async.py
+
+"""
+Accesso al DB per asyncio (engine asincrono di SQLAlchemy con aiosqlite).
+
+La UI gira sul loop asyncio integrato in Qt (qasync, vedi main.py): con
+`await repository.lista_fatture(...)` la query gira sul thread di aiosqlite
+mentre la finestra continua a ridisegnarsi.
+
+Le query sono le stesse della versione sincrona (database/query_fatture.py),
+eseguite con AsyncSession.run_sync: una sola implementazione per entrambe.
+Le scritture passano dal thread scrittore (database/scrittore.py).
+"""
+
+import asyncio
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from .db_session import DB_URL, PROFILO_INTERATTIVO, applica_profilo
+from .query_fatture import (
+    query_fatture,
+    query_fornitori,
+    query_non_pagate_in_scadenza,
+    fattura_con_dettagli,
+    testo_xml_fattura,
+)
+
+DB_URL_ASYNC = DB_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+
+def crea_engine_async(url=DB_URL_ASYNC, profilo=PROFILO_INTERATTIVO, **kwargs):
+    """
+    Engine asincrono con il profilo SQLite indicato (vedi database.db_session).
+    """
+    engine = create_async_engine(url, echo=False, **kwargs)
+    if profilo is not None:
+        # I PRAGMA si registrano sull'engine sincrono sottostante
+        applica_profilo(engine.sync_engine, profilo)
+    return engine
+
+
+class RepositoryFatture:
+    """
+    Le query della UI e delle notifiche in versione `async`.
+    Ogni metodo usa una sessione nuova; gli oggetti ritornati hanno già
+    caricato tutto quello che serve e si leggono a sessione chiusa.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else crea_engine_async()
+        self._sessioni = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def esegui(self, funzione, *args, **kwargs):
+        """
+        Esegue `funzione(db, *args, **kwargs)` con una sessione sincrona
+        sulla connessione asincrona e ne ritorna il risultato.
+        """
+        async with self._sessioni() as db:
+            return await db.run_sync(funzione, *args, **kwargs)
+
+    async def lista_fatture(self, anno=None, mese=None, cedente=None, search=None):
+        return await self.esegui(
+            lambda db: query_fatture(db, anno=anno, mese=mese, cedente=cedente, search=search).all()
+        )
+
+    async def fornitori(self):
+        return await self.esegui(lambda db: [f for (f,) in query_fornitori(db)])
+
+    async def fattura(self, fattura_id):
+        return await self.esegui(fattura_con_dettagli, fattura_id)
+
+    async def testo_xml(self, fattura_id, con_allegati=False):
+        return await self.esegui(testo_xml_fattura, fattura_id, con_allegati)
+
+    async def non_pagate_in_scadenza(self, inizio=None, fine=None):
+        return await self.esegui(lambda db: query_non_pagate_in_scadenza(db, inizio, fine).all())
+
+    async def scrivi(self, scrittore, lavoro, *args, **kwargs):
+        """
+        Manda `lavoro` al thread scrittore e aspetta il commit senza bloccare il loop.
+        """
+        return await asyncio.wrap_future(scrittore.invia(lavoro, *args, **kwargs))
+
+    async def chiudi(self):
+        await self.engine.dispose()
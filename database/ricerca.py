@@ -0,0 +1,196 @@
+# software_fatture/database/ricerca.py
+
+"""
+Ricerca globale full-text con SQLite FTS5.
+
+La tabella virtuale fatture_fts ha una riga per fattura (rowid = fatture.id)
+con numero, fornitore, dati di cedente e cessionario, causale e le descrizioni
+di tutte le righe. I trigger la tengono allineata a fatture e righe_fattura
+su insert, update e delete, quindi nessun codice applicativo deve ricordarsene.
+
+Le descrizioni non si ricalcolano a ogni riga (sarebbe quadratico sulle
+fatture con molte righe): i trigger su righe_fattura segnano solo la fattura
+in TABELLA_DA_AGGIORNARE, e la colonna "righe" viene ricomposta una volta per
+fattura nella stessa transazione, subito prima del commit della sessione
+(aggiorna_righe_al_commit, agganciata alle sessioni dell'applicazione in
+database/db_session.py). Chi scrive senza quelle sessioni chiama da sé
+aggiorna_righe_ricerca() prima del commit.
+"""
+
+import re
+
+from sqlalchemy import Column, Integer, MetaData, Table, event, literal_column
+
+TABELLA_FTS = "fatture_fts"
+# Fatture con righe inserite/modificate/eliminate e "righe" ancora da ricomporre
+TABELLA_DA_AGGIORNARE = "fatture_fts_righe_da_aggiornare"
+
+# Colonne di fatture_fts -> colonne di `fatture` da cui sono composte
+COLONNE_FTS = {
+    "numero": ("numero", "numero_documento"),
+    "fornitore": ("fornitore",),
+    "cedente": ("cedente_denominazione", "cedente_id_codice", "cedente_codice_fiscale", "cedente_comune"),
+    "cessionario": ("cessionario_denominazione", "cessionario_id_codice", "cessionario_codice_fiscale",
+                    "cessionario_comune"),
+    "causale": ("causale",),
+}
+
+# Pesi bm25 per colonna (nell'ordine di COLONNE_FTS, poi "righe"):
+# una corrispondenza su numero o fornitore vale più di una nelle descrizioni
+PESI_BM25 = (10.0, 5.0, 3.0, 2.0, 1.0, 1.0)
+
+# Solo per costruire le query: la tabella la crea crea_indice_ricerca(), non create_all()
+fatture_fts = Table(TABELLA_FTS, MetaData(), Column("rowid", Integer), Column("rank"))
+
+
+def _concatena(alias, colonne):
+    return " || ' ' || ".join(f"coalesce({alias}.{c}, '')" for c in colonne)
+
+
+def _righe(id_fattura):
+    return f"(SELECT group_concat(descrizione, ' ') FROM righe_fattura WHERE fattura_id = {id_fattura})"
+
+
+def _inserisci(alias):
+    """
+    INSERT della riga di fatture_fts per la fattura `alias` (new, f, ...).
+    """
+    colonne = ", ".join(COLONNE_FTS)
+    valori = ", ".join(_concatena(alias, sorgenti) for sorgenti in COLONNE_FTS.values())
+    return (
+        f"INSERT INTO {TABELLA_FTS} (rowid, {colonne}, righe) "
+        f"SELECT {alias}.id, {valori}, {_righe(f'{alias}.id')}"
+    )
+
+
+def _ddl():
+    colonne_sorgente = ", ".join(sorted({c for sorgenti in COLONNE_FTS.values() for c in sorgenti}))
+    segna = f"INSERT OR IGNORE INTO {TABELLA_DA_AGGIORNARE} (id) VALUES ({{id}});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABELLA_FTS} USING fts5("
+        f"{', '.join(COLONNE_FTS)}, righe, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+        f"CREATE TABLE IF NOT EXISTS {TABELLA_DA_AGGIORNARE} (id INTEGER PRIMARY KEY)",
+
+        f"CREATE TRIGGER IF NOT EXISTS fatture_fts_ai AFTER INSERT ON fatture BEGIN "
+        f"{_inserisci('new')} ; END",
+        f"CREATE TRIGGER IF NOT EXISTS fatture_fts_au AFTER UPDATE OF {colonne_sorgente} ON fatture BEGIN "
+        f"DELETE FROM {TABELLA_FTS} WHERE rowid = old.id; {_inserisci('new')} ; END",
+        f"CREATE TRIGGER IF NOT EXISTS fatture_fts_ad AFTER DELETE ON fatture BEGIN "
+        f"DELETE FROM {TABELLA_FTS} WHERE rowid = old.id; END",
+
+        f"CREATE TRIGGER IF NOT EXISTS righe_fts_ai AFTER INSERT ON righe_fattura BEGIN "
+        f"{segna.format(id='new.fattura_id')} END",
+        f"CREATE TRIGGER IF NOT EXISTS righe_fts_au AFTER UPDATE OF descrizione, fattura_id ON righe_fattura BEGIN "
+        f"{segna.format(id='old.fattura_id')} {segna.format(id='new.fattura_id')} END",
+        f"CREATE TRIGGER IF NOT EXISTS righe_fts_ad AFTER DELETE ON righe_fattura BEGIN "
+        f"{segna.format(id='old.fattura_id')} END",
+    ]
+
+
+# Trigger delle versioni precedenti, da ricreare (vedi ricrea_trigger_righe)
+TRIGGER_RIGHE = ("righe_fts_ai", "righe_fts_au", "righe_fts_ad")
+
+
+def crea_indice_ricerca(conn):
+    """
+    Crea fatture_fts e i trigger (se mancano) e indicizza le fatture già presenti.
+    """
+    esisteva = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (TABELLA_FTS,)
+    ).first()
+    for istruzione in _ddl():
+        conn.exec_driver_sql(istruzione)
+    # Pesi di bm25 salvati nella tabella: ORDER BY rank li usa
+    pesi = ", ".join(str(p) for p in PESI_BM25)
+    conn.exec_driver_sql(f"INSERT INTO {TABELLA_FTS} ({TABELLA_FTS}, rank) VALUES ('rank', 'bm25({pesi})')")
+    if not esisteva:
+        conn.exec_driver_sql(f"{_inserisci('f')} FROM fatture AS f")
+
+
+def ricrea_trigger_righe(conn):
+    """
+    Sostituisce i trigger su righe_fattura delle versioni precedenti (che
+    ricomponevano "righe" a ogni riga) con quelli attuali.
+    """
+    for trigger in TRIGGER_RIGHE:
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    for istruzione in _ddl():
+        conn.exec_driver_sql(istruzione)
+
+
+def aggiorna_righe_ricerca(conn):
+    """
+    Ricompone la colonna "righe" delle fatture segnate dai trigger, una volta
+    per fattura, e svuota TABELLA_DA_AGGIORNARE. `conn` è la Connection nella
+    transazione che ha scritto le righe.
+    """
+    if not conn.info.get("indice_ricerca"):
+        # DB senza indice (es. migrazioni non ancora eseguite): niente da fare
+        esiste = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (TABELLA_DA_AGGIORNARE,)
+        ).first()
+        if not esiste:
+            return
+        conn.info["indice_ricerca"] = True
+    conn.exec_driver_sql(
+        f"UPDATE {TABELLA_FTS} SET righe = {_righe(f'{TABELLA_FTS}.rowid')} "
+        f"WHERE rowid IN (SELECT id FROM {TABELLA_DA_AGGIORNARE})"
+    )
+    conn.exec_driver_sql(f"DELETE FROM {TABELLA_DA_AGGIORNARE}")
+
+
+def _aggiorna_righe_prima_del_commit(db):
+    if db.get_nested_transaction() is not None:
+        # RELEASE SAVEPOINT: si ricompone una volta sola, al commit vero
+        return
+    # before_commit arriva prima del flush finale: le righe pendenti servono già scritte
+    db.flush()
+    aggiorna_righe_ricerca(db.connection())
+
+
+def aggiorna_righe_al_commit(fabbrica):
+    """
+    Fa ricomporre le descrizioni di fatture_fts (aggiorna_righe_ricerca)
+    prima di ogni commit delle sessioni create da `fabbrica` (sessionmaker),
+    nella stessa transazione. Ritorna `fabbrica`.
+    """
+    event.listen(fabbrica, "before_commit", _aggiorna_righe_prima_del_commit)
+    return fabbrica
+
+
+def ricostruisci_indice_ricerca(conn):
+    """
+    Svuota e ripopola fatture_fts (es. dopo modifiche fatte con i trigger disattivati).
+    """
+    conn.exec_driver_sql(f"DELETE FROM {TABELLA_FTS}")
+    conn.exec_driver_sql(f"DELETE FROM {TABELLA_DA_AGGIORNARE}")
+    conn.exec_driver_sql(f"{_inserisci('f')} FROM fatture AS f")
+
+
+def espressione_ricerca(testo):
+    """
+    Trasforma il testo digitato dall'utente in una query FTS5: ogni parola
+    diventa un prefisso tra virgolette ("ross"* trova "Rossi"), tutte in AND.
+    Le virgolette impediscono che la sintassi FTS5 (AND, NEAR, *, :) digitata
+    dall'utente dia errore. Ritorna None se non resta nessuna parola.
+    """
+    parole = [p for p in re.split(r"\s+", (testo or "").replace('"', " ")) if p]
+    if not parole:
+        return None
+    return " ".join(f'"{p}"*' for p in parole)
+
+
+def filtra_ricerca(query, colonna_id, testo):
+    """
+    Aggiunge alla query la ricerca full-text su `testo`, con i risultati più
+    pertinenti per primi. `colonna_id` è la colonna con l'id della fattura.
+    """
+    espressione = espressione_ricerca(testo)
+    if espressione is None:
+        return query
+    return (
+        query.join(fatture_fts, fatture_fts.c.rowid == colonna_id)
+        .filter(literal_column(TABELLA_FTS).op("MATCH")(espressione))
+        .order_by(fatture_fts.c.rank)
+    )
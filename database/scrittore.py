@@ -0,0 +1,165 @@
+# software_fatture/database/scrittore.py
+
+"""
+Un solo thread scrive sul DB.
+
+SQLite ammette un solo scrittore alla volta: con più thread che scrivono
+ognuno con la sua sessione si finisce in "database is locked". Qui le
+scritture sono "lavori" (funzioni che ricevono la sessione come primo
+argomento, senza fare commit) messi in una coda ed eseguiti da un thread
+dedicato. I lavori già in coda vengono raggruppati in una sola transazione
+(group commit): un commit, e un fsync, per tutto il gruppo. Ogni lavoro gira
+in un SAVEPOINT, quindi un lavoro che fallisce non annulla gli altri.
+
+    scrittore = scrittore_condiviso()
+    futuro = scrittore.invia(segna_pagata, fattura_id)   # concurrent.futures.Future
+    scrittore.esegui(segna_pagata, fattura_id)           # invia e aspetta il risultato
+"""
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from .models import Fattura
+
+logger = logging.getLogger(__name__)
+
+_FINE = object()
+
+
+class ScrittoreDB:
+    """
+    Thread scrittore con coda dei lavori e group commit.
+    `max_lotto`: massimo numero di lavori per transazione.
+    `attesa`: secondi di attesa di altri lavori prima del commit (0 = solo quelli già in coda).
+    `max_coda`: lavori in attesa oltre i quali invia() si blocca (il parsing non corre
+    più veloce di quanto si riesca a scrivere).
+    """
+
+    def __init__(self, session_factory=None, max_lotto=50, attesa=0.0, max_coda=64):
+        if session_factory is None:
+            from .db_session import SessionScrittore
+            session_factory = SessionScrittore
+        self.session_factory = session_factory
+        self.max_lotto = max_lotto
+        self.attesa = attesa
+        self._coda = queue.Queue(maxsize=max_coda)
+        self._thread = threading.Thread(target=self._ciclo, name="scrittore-db", daemon=True)
+        self._thread.start()
+
+    def invia(self, lavoro, *args, **kwargs):
+        """
+        Mette in coda `lavoro(db, *args, **kwargs)`. Ritorna un Future con il
+        valore ritornato dal lavoro, disponibile dopo il commit.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("Scrittore DB chiuso")
+        futuro = Future()
+        self._coda.put((futuro, lavoro, args, kwargs))
+        return futuro
+
+    def esegui(self, lavoro, *args, **kwargs):
+        """
+        Come invia(), ma aspetta il commit e ritorna il risultato (o solleva l'errore del lavoro).
+        """
+        return self.invia(lavoro, *args, **kwargs).result()
+
+    def chiudi(self, timeout=None):
+        """
+        Esegue i lavori rimasti in coda e ferma il thread.
+        """
+        if self._thread.is_alive():
+            self._coda.put(_FINE)
+            self._thread.join(timeout)
+
+    def _prossimi_lavori(self, primo):
+        """
+        Il primo lavoro più quelli arrivati nel frattempo (fino a max_lotto).
+        Ritorna (lotto, fine) con fine=True se in coda c'era la richiesta di chiusura.
+        """
+        lotto = [primo]
+        while len(lotto) < self.max_lotto:
+            try:
+                lavoro = self._coda.get(timeout=self.attesa) if self.attesa else self._coda.get_nowait()
+            except queue.Empty:
+                break
+            if lavoro is _FINE:
+                return lotto, True
+            lotto.append(lavoro)
+        return lotto, False
+
+    def _ciclo(self):
+        fine = False
+        while not fine:
+            primo = self._coda.get()
+            if primo is _FINE:
+                break
+            lotto, fine = self._prossimi_lavori(primo)
+            self._esegui_lotto(lotto)
+
+    def _esegui_lotto(self, lotto):
+        esiti = []
+        db = self.session_factory()
+        try:
+            for futuro, lavoro, args, kwargs in lotto:
+                if not futuro.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db.begin_nested():
+                        risultato = lavoro(db, *args, **kwargs)
+                except Exception as e:
+                    esiti.append((futuro, None, e))
+                else:
+                    esiti.append((futuro, risultato, None))
+            db.commit()
+        except Exception as e:
+            # Commit fallito: nessun lavoro del gruppo è stato salvato
+            db.rollback()
+            logger.error(f"❌ Commit di {len(esiti)} lavori fallito: {e}")
+            esiti = [(futuro, None, errore or e) for futuro, _, errore in esiti]
+        finally:
+            db.close()
+
+        for futuro, risultato, errore in esiti:
+            if errore is not None:
+                futuro.set_exception(errore)
+            else:
+                futuro.set_result(risultato)
+
+
+_scrittore = None
+_lock_scrittore = threading.Lock()
+
+
+def scrittore_condiviso():
+    """
+    Lo scrittore dell'applicazione, avviato al primo uso.
+    """
+    global _scrittore
+    with _lock_scrittore:
+        if _scrittore is None or not _scrittore._thread.is_alive():
+            _scrittore = ScrittoreDB()
+        return _scrittore
+
+
+def chiudi_scrittore(timeout=None):
+    """
+    Ferma lo scrittore condiviso (se avviato) dopo aver scritto i lavori in coda.
+    """
+    global _scrittore
+    with _lock_scrittore:
+        if _scrittore is not None:
+            _scrittore.chiudi(timeout)
+            _scrittore = None
+
+
+# ----------------------------------------------------------------------------
+# Lavori di scrittura comuni
+# ----------------------------------------------------------------------------
+def segna_pagata(db, fattura_id, pagata=True):
+    """
+    Segna la fattura come pagata (o non pagata). Ritorna False se non esiste.
+    """
+    aggiornate = db.query(Fattura).filter(Fattura.id == fattura_id).update({"pagata": pagata})
+    return aggiornate > 0
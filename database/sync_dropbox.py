@@ -0,0 +1,113 @@
+# software_fatture/database/sync_dropbox.py
+
+"""
+Stato della sincronizzazione incrementale con Dropbox:
+  - cursori_dropbox: il cursore di files_list_folder dopo l'ultima
+    sincronizzazione completa, da cui riparte la successiva
+  - file_dropbox: path e content_hash dei file già elaborati, per non
+    scaricarli di nuovo, e dei file falliti (con l'errore), da riprovare
+
+Le scritture sono lavori per il thread scrittore (database/scrittore.py):
+ricevono la sessione e non fanno commit.
+"""
+
+from datetime import datetime
+
+from sqlalchemy.dialects.sqlite import insert
+
+from .db_session import sessione_lettura
+from .models import CursoreDropbox, FileDropbox
+
+
+def leggi_cursore(db, cartella):
+    """
+    Il cursore salvato per `cartella`, None se non è mai stata sincronizzata.
+    """
+    riga = db.get(CursoreDropbox, cartella)
+    return riga.cursore if riga is not None else None
+
+
+def salva_cursore(db, cartella, cursore):
+    istruzione = insert(CursoreDropbox).values(cartella=cartella, cursore=cursore, aggiornato_il=datetime.now())
+    db.execute(istruzione.on_conflict_do_update(
+        index_elements=[CursoreDropbox.cartella],
+        set_={"cursore": istruzione.excluded.cursore, "aggiornato_il": istruzione.excluded.aggiornato_il},
+    ))
+
+
+def cancella_cursore(db, cartella):
+    """
+    Dimentica il cursore (es. Dropbox lo ha invalidato): la prossima
+    sincronizzazione rielenca tutta la cartella.
+    """
+    db.query(CursoreDropbox).filter(CursoreDropbox.cartella == cartella).delete()
+
+
+def content_hash_noti(db):
+    """
+    {path_lower: content_hash} dei file già elaborati, con una sola query.
+    """
+    return dict(db.query(FileDropbox.path_lower, FileDropbox.content_hash).filter(FileDropbox.errore.is_(None)))
+
+
+def file_da_riprovare(db):
+    """
+    {path_lower: content_hash} dei file falliti in una sincronizzazione precedente.
+    """
+    return dict(db.query(FileDropbox.path_lower, FileDropbox.content_hash).filter(FileDropbox.errore.isnot(None)))
+
+
+def _registra(db, righe):
+    istruzione = insert(FileDropbox)
+    db.execute(
+        istruzione.on_conflict_do_update(
+            index_elements=[FileDropbox.path_lower],
+            set_={"content_hash": istruzione.excluded.content_hash,
+                  "sincronizzato_il": istruzione.excluded.sincronizzato_il,
+                  "errore": istruzione.excluded.errore},
+        ),
+        righe,
+    )
+
+
+def registra_file_dropbox(db, file):
+    """
+    Registra (o aggiorna) i file elaborati: `file` è una lista di
+    (path_lower, content_hash). Un file fallito in precedenza non è più da riprovare.
+    """
+    if not file:
+        return
+    adesso = datetime.now()
+    _registra(db, [{"path_lower": percorso, "content_hash": content_hash, "sincronizzato_il": adesso, "errore": None}
+                   for percorso, content_hash in file])
+
+
+def registra_errori_dropbox(db, file):
+    """
+    Registra i file falliti, da riprovare alla prossima sincronizzazione:
+    `file` è una lista di (path_lower, content_hash, messaggio di errore).
+    """
+    if not file:
+        return
+    adesso = datetime.now()
+    _registra(db, [{"path_lower": percorso, "content_hash": content_hash, "sincronizzato_il": adesso,
+                    "errore": messaggio}
+                   for percorso, content_hash, messaggio in file])
+
+
+def cancella_file_dropbox(db, percorsi):
+    """
+    Dimentica i file che non esistono più su Dropbox.
+    """
+    if percorsi:
+        db.query(FileDropbox).filter(FileDropbox.path_lower.in_(percorsi)).delete(synchronize_session=False)
+
+
+def carica_stato_dropbox(cartella):
+    """
+    (cursore, {path_lower: content_hash} dei file elaborati, {path_lower:
+    content_hash} dei file da riprovare) dal DB dell'applicazione, per
+    riprendere la sincronizzazione di `cartella` (vedi services/pipeline_resync.py).
+    """
+    with sessione_lettura() as db:
+        return leggi_cursore(db, cartella), content_hash_noti(db), file_da_riprovare(db)
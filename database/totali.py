@@ -0,0 +1,287 @@
+# software_fatture/database/totali.py
+
+"""
+Totali per anno, mese, fornitore (e aliquota IVA) mantenuti in modo incrementale.
+
+Le tabelle totali_fornitore_mese e totali_iva_mese (models.TotaleFornitoreMese,
+models.TotaleIvaMese) sono aggiornate da trigger SQLite su fatture e
+dati_riepilogo_iva: ogni percorso di scrittura (salva_fattura_su_db,
+salva_fatture_bulk, "segna saldata" nella UI, ...) le tiene allineate senza
+doverlo ricordare. I totali di un periodo costano così poche righe lette per
+chiave primaria invece di una scansione di fatture.
+
+Verifica (ed eventuale ricostruzione) rispetto alle tabelle di base:
+    python -m database.totali
+    python -m database.totali --ricostruisci
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import func
+
+from .models import TotaleFornitoreMese, TotaleIvaMese
+
+# Differenza massima tollerata sugli importi (somme di float)
+TOLLERANZA = 0.005
+
+
+def _anno(alias):
+    return f"coalesce(CAST(strftime('%Y', {alias}.data) AS INTEGER), 0)"
+
+
+def _mese(alias):
+    return f"coalesce(CAST(strftime('%m', {alias}.data) AS INTEGER), 0)"
+
+
+def _fornitore(alias):
+    return f"coalesce({alias}.fornitore, '')"
+
+
+def _chiave(alias):
+    return f"{_anno(alias)}, {_mese(alias)}, {_fornitore(alias)}"
+
+
+_SOMMA_FORNITORE = (
+    "ON CONFLICT (anno, mese, fornitore) DO UPDATE SET "
+    "n_fatture = n_fatture + excluded.n_fatture, "
+    "totale = totale + excluded.totale, "
+    "non_pagato = non_pagato + excluded.non_pagato"
+)
+
+_SOMMA_IVA = (
+    "ON CONFLICT (anno, mese, fornitore, aliquota_iva) DO UPDATE SET "
+    "n_riepiloghi = n_riepiloghi + excluded.n_riepiloghi, "
+    "imponibile = imponibile + excluded.imponibile, "
+    "imposta = imposta + excluded.imposta"
+)
+
+
+def _somma_fattura(alias, segno):
+    """
+    Aggiunge (segno 1) o toglie (segno -1) la fattura `alias` da totali_fornitore_mese.
+    """
+    totale = f"{segno} * coalesce({alias}.totale, 0)"
+    return (
+        "INSERT INTO totali_fornitore_mese (anno, mese, fornitore, n_fatture, totale, non_pagato) "
+        f"SELECT {_chiave(alias)}, {segno}, {totale}, "
+        f"CASE WHEN {alias}.pagata = 0 THEN {totale} ELSE 0 END WHERE true "
+        f"{_SOMMA_FORNITORE};"
+    )
+
+
+def _somma_riepiloghi_fattura(alias, segno):
+    """
+    Aggiunge o toglie da totali_iva_mese tutti i riepiloghi della fattura `alias`
+    (quando la fattura cambia data/fornitore o viene cancellata).
+    """
+    return (
+        "INSERT INTO totali_iva_mese (anno, mese, fornitore, aliquota_iva, n_riepiloghi, imponibile, imposta) "
+        f"SELECT {_chiave(alias)}, coalesce(r.aliquota_iva, 0), {segno} * count(*), "
+        f"{segno} * sum(coalesce(r.imponibile_importo, 0)), {segno} * sum(coalesce(r.imposta, 0)) "
+        f"FROM dati_riepilogo_iva AS r WHERE r.fattura_id = {alias}.id GROUP BY coalesce(r.aliquota_iva, 0) "
+        f"{_SOMMA_IVA};"
+    )
+
+
+def _somma_riepilogo(alias, segno):
+    """
+    Aggiunge o toglie il riepilogo `alias` da totali_iva_mese, con la chiave della sua fattura.
+    """
+    return (
+        "INSERT INTO totali_iva_mese (anno, mese, fornitore, aliquota_iva, n_riepiloghi, imponibile, imposta) "
+        f"SELECT {_chiave('f')}, coalesce({alias}.aliquota_iva, 0), {segno}, "
+        f"{segno} * coalesce({alias}.imponibile_importo, 0), {segno} * coalesce({alias}.imposta, 0) "
+        f"FROM fatture AS f WHERE f.id = {alias}.fattura_id "
+        f"{_SOMMA_IVA};"
+    )
+
+
+def _pulisci_fornitore(alias):
+    return (
+        f"DELETE FROM totali_fornitore_mese WHERE (anno, mese, fornitore) = ({_chiave(alias)}) "
+        "AND n_fatture = 0;"
+    )
+
+
+def _pulisci_iva(chiave):
+    return f"DELETE FROM totali_iva_mese WHERE (anno, mese, fornitore) = ({chiave}) AND n_riepiloghi = 0;"
+
+
+def _pulisci_iva_riepilogo(alias):
+    return _pulisci_iva(f"SELECT {_chiave('f')} FROM fatture AS f WHERE f.id = {alias}.fattura_id")
+
+
+def istruzioni_togli_fattura(alias="old"):
+    """
+    Istruzioni che tolgono la fattura `alias` da entrambe le tabelle dei totali,
+    riepiloghi IVA compresi: vanno eseguite prima di cancellarne i riepiloghi.
+    """
+    return [
+        _somma_fattura(alias, -1), _pulisci_fornitore(alias),
+        _somma_riepiloghi_fattura(alias, -1), _pulisci_iva(_chiave(alias)),
+    ]
+
+
+def _trigger(nome, evento, corpo):
+    return f"CREATE TRIGGER IF NOT EXISTS {nome} AFTER {evento} BEGIN {' '.join(corpo)} END"
+
+
+def _ddl():
+    return [
+        _trigger("fatture_totali_ai", "INSERT ON fatture", [_somma_fattura("new", 1)]),
+        _trigger("fatture_totali_au", "UPDATE OF data, fornitore, totale, pagata ON fatture", [
+            _somma_fattura("old", -1), _pulisci_fornitore("old"), _somma_fattura("new", 1),
+        ]),
+        _trigger("fatture_totali_iva_au", "UPDATE OF data, fornitore ON fatture", [
+            _somma_riepiloghi_fattura("old", -1), _pulisci_iva(_chiave("old")),
+            _somma_riepiloghi_fattura("new", 1),
+        ]),
+        # La cancellazione di una fattura è nel trigger fatture_cascata_ad
+        # (database/migrazioni.py): toglie i totali e poi cancella i riepiloghi
+        _trigger("riepiloghi_totali_ai", "INSERT ON dati_riepilogo_iva", [_somma_riepilogo("new", 1)]),
+        _trigger("riepiloghi_totali_au",
+                 "UPDATE OF aliquota_iva, imponibile_importo, imposta, fattura_id ON dati_riepilogo_iva", [
+            _somma_riepilogo("old", -1), _pulisci_iva_riepilogo("old"), _somma_riepilogo("new", 1),
+        ]),
+        _trigger("riepiloghi_totali_ad", "DELETE ON dati_riepilogo_iva", [
+            _somma_riepilogo("old", -1), _pulisci_iva_riepilogo("old"),
+        ]),
+    ]
+
+
+# Totali ricalcolati dalle tabelle di base, nello stesso ordine delle colonne
+_CALCOLO_FORNITORE = (
+    f"SELECT {_chiave('f')}, count(*), sum(coalesce(f.totale, 0)), "
+    "sum(CASE WHEN f.pagata = 0 THEN coalesce(f.totale, 0) ELSE 0 END) "
+    "FROM fatture AS f GROUP BY 1, 2, 3"
+)
+
+_CALCOLO_IVA = (
+    f"SELECT {_chiave('f')}, coalesce(r.aliquota_iva, 0), count(*), "
+    "sum(coalesce(r.imponibile_importo, 0)), sum(coalesce(r.imposta, 0)) "
+    "FROM dati_riepilogo_iva AS r JOIN fatture AS f ON f.id = r.fattura_id GROUP BY 1, 2, 3, 4"
+)
+
+
+def crea_trigger_totali(conn):
+    """
+    Crea le tabelle dei totali e i trigger (se mancano) e li ricalcola da zero.
+    """
+    TotaleFornitoreMese.__table__.create(conn, checkfirst=True)
+    TotaleIvaMese.__table__.create(conn, checkfirst=True)
+    for istruzione in _ddl():
+        conn.exec_driver_sql(istruzione)
+    ricostruisci_totali(conn)
+
+
+def ricostruisci_totali(conn):
+    """
+    Svuota e ricalcola le tabelle dei totali dalle tabelle di base.
+    """
+    conn.exec_driver_sql("DELETE FROM totali_fornitore_mese")
+    conn.exec_driver_sql("DELETE FROM totali_iva_mese")
+    conn.exec_driver_sql(
+        "INSERT INTO totali_fornitore_mese (anno, mese, fornitore, n_fatture, totale, non_pagato) "
+        + _CALCOLO_FORNITORE
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO totali_iva_mese (anno, mese, fornitore, aliquota_iva, n_riepiloghi, imponibile, imposta) "
+        + _CALCOLO_IVA
+    )
+
+
+def _confronta(tabella, attese, salvate, n_chiave):
+    differenze = []
+    attese = {tuple(r[:n_chiave]): tuple(r[n_chiave:]) for r in attese}
+    salvate = {tuple(r[:n_chiave]): tuple(r[n_chiave:]) for r in salvate}
+    for chiave in sorted(attese.keys() | salvate.keys(), key=repr):
+        atteso, salvato = attese.get(chiave), salvate.get(chiave)
+        if atteso is None or salvato is None or atteso[0] != salvato[0] or any(
+            abs(a - s) > TOLLERANZA for a, s in zip(atteso[1:], salvato[1:])
+        ):
+            differenze.append(f"{tabella} {chiave}: atteso {atteso}, trovato {salvato}")
+    return differenze
+
+
+def verifica_totali(conn):
+    """
+    Confronta le tabelle dei totali con quanto si ricalcola dalle tabelle di base.
+    Ritorna la lista delle differenze (vuota se tutto torna).
+    """
+    return _confronta(
+        "totali_fornitore_mese",
+        conn.exec_driver_sql(_CALCOLO_FORNITORE).all(),
+        conn.exec_driver_sql(
+            "SELECT anno, mese, fornitore, n_fatture, totale, non_pagato FROM totali_fornitore_mese"
+        ).all(),
+        3,
+    ) + _confronta(
+        "totali_iva_mese",
+        conn.exec_driver_sql(_CALCOLO_IVA).all(),
+        conn.exec_driver_sql(
+            "SELECT anno, mese, fornitore, aliquota_iva, n_riepiloghi, imponibile, imposta FROM totali_iva_mese"
+        ).all(),
+        4,
+    )
+
+
+def _filtra_periodo(query, modello, anno, mese, fornitore):
+    query = query.filter(modello.anno == anno)
+    if mese is not None:
+        query = query.filter(modello.mese == mese)
+    if fornitore is not None:
+        query = query.filter(modello.fornitore == fornitore)
+    return query
+
+
+def totali_per_fornitore(db, anno, mese=None, fornitore=None):
+    """
+    (fornitore, n_fatture, totale, non_pagato) dell'anno o del mese, per fornitore.
+    """
+    query = db.query(
+        TotaleFornitoreMese.fornitore,
+        func.sum(TotaleFornitoreMese.n_fatture),
+        func.sum(TotaleFornitoreMese.totale),
+        func.sum(TotaleFornitoreMese.non_pagato),
+    )
+    query = _filtra_periodo(query, TotaleFornitoreMese, anno, mese, fornitore)
+    return query.group_by(TotaleFornitoreMese.fornitore).order_by(TotaleFornitoreMese.fornitore)
+
+
+def totali_per_aliquota(db, anno, mese=None, fornitore=None):
+    """
+    (aliquota_iva, imponibile, imposta) dell'anno o del mese, per aliquota.
+    """
+    query = db.query(
+        TotaleIvaMese.aliquota_iva,
+        func.sum(TotaleIvaMese.imponibile),
+        func.sum(TotaleIvaMese.imposta),
+    )
+    query = _filtra_periodo(query, TotaleIvaMese, anno, mese, fornitore)
+    return query.group_by(TotaleIvaMese.aliquota_iva).order_by(TotaleIvaMese.aliquota_iva)
+
+
+def main():
+    from .db_session import engine, init_db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ricostruisci", action="store_true", help="ricalcola i totali se non tornano")
+    args = parser.parse_args()
+
+    init_db()  # su un DB vecchio crea tabelle e trigger con le migrazioni
+    with engine.begin() as conn:
+        differenze = verifica_totali(conn)
+        for riga in differenze:
+            print(riga)
+        if not differenze:
+            print("✅ Totali allineati alle fatture")
+        elif args.ricostruisci:
+            ricostruisci_totali(conn)
+            print(f"🔄 Totali ricalcolati ({len(differenze)} differenze corrette)")
+        else:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
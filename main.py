@@ -1,24 +1,34 @@
 # main.py
 
+import os
 import sys
+import asyncio
 from PySide6.QtWidgets import QApplication
+from qasync import QEventLoop
 import logging
 
 # Import DB
-from database.db_session import init_db, SessionLocal
+from database.db_session import init_db, sessione_lettura
 from database.models import Fattura
+from database.scrittore import scrittore_condiviso, chiudi_scrittore
+from database.sync_dropbox import leggi_cursore
 
 # Import della MainWindow
 from ui.main_window import MainWindow
 
 # Import dei servizi
 from logging_config import setup_logger
-from services.dropbox_service import scarica_tutti_xml_memoria
-from services.parser_fatture import parse_fattura_xml, salva_fattura_su_db
+from services.dropbox_service import dbx, OsservatoreDropbox
+from services.mirror_dropbox import mirror_condiviso
+from services.pipeline_resync import esegui_resync, descrivi_avanzamento
 
 # Configura log dettagliato per gli errori di parsing
 PARSING_ERROR_LOG = "logs/parsing_errors.log"
 
+# DROPBOX_LONGPOLL=1: all'avvio sincronizza con Dropbox e poi resta in ascolto
+# dei nuovi file (services.dropbox_service.OsservatoreDropbox)
+DROPBOX_LONGPOLL = os.getenv("DROPBOX_LONGPOLL", "0") == "1"
+
 
 def main():
     # 1) Inizializza il logger
@@ -30,70 +40,130 @@ def main():
     logger.info("✅ Database inizializzato (o già esistente).")
 
     # 3) Controllo se il DB è vuoto
-    db = SessionLocal()
-    count_f = db.query(Fattura).count()
-    db.close()
-
-    if count_f == 0:
-        logger.warning("⚠️ DB vuoto, avvio resync rapido da Dropbox...")
-        resync_from_dropbox_memoria(logger)
+    with sessione_lettura() as db:
+        count_f = db.query(Fattura).count()
 
-    # 4) Avvio l'app PySide6
+    # 4) Avvio l'app PySide6 sul loop asyncio di qasync: le query della UI
+    #    (database/repository_async.py) e il resync non bloccano la finestra
     app = QApplication(sys.argv)
+    loop = QEventLoop(app)
+    asyncio.set_event_loop(loop)
     window = MainWindow(logger)
     window.show()
 
+    osservatore = None
+    if DROPBOX_LONGPOLL:
+        osservatore = crea_osservatore(window, logger, loop)
+    if count_f == 0 or osservatore is not None:
+        if count_f == 0:
+            logger.warning("⚠️ DB vuoto, avvio resync rapido da Dropbox...")
+        asyncio.ensure_future(resync_in_background(window, logger, osservatore))
+
     # 5) Avvio il loop dell’app
     logger.info("🎨 Interfaccia grafica avviata.")
-    sys.exit(app.exec())
-
-
-def resync_from_dropbox_memoria(logger):
+    chiusura = asyncio.Event()
+    app.aboutToQuit.connect(chiusura.set)
+    with loop:
+        loop.run_until_complete(chiusura.wait())
+        loop.run_until_complete(window.repository.chiudi())
+    if osservatore is not None:
+        osservatore.ferma()
+    # Scrive i lavori ancora in coda prima di uscire
+    chiudi_scrittore()
+    sys.exit(0)
+
+
+async def resync_in_background(window, logger, osservatore=None):
     """
-    Scarica tutte le fatture XML da Dropbox **direttamente in memoria**
-    ed esegue il parsing senza scrivere su disco.
+    Esegue resync_from_dropbox_memoria in un thread mentre la finestra resta
+    utilizzabile (con l'avanzamento nella barra di stato), poi ricarica
+    cedenti e tabella e avvia l'eventuale `osservatore`.
     """
-    logger.info("📡 Inizio resync rapido da Dropbox...")
+    loop = asyncio.get_running_loop()
 
-    # Scarica tutti gli XML direttamente in memoria
-    xml_dict = scarica_tutti_xml_memoria(logger)
+    def on_progresso(istantanea):
+        # Chiamata dai thread della pipeline: la UI si aggiorna dal loop
+        loop.call_soon_threadsafe(window.mostra_avanzamento, descrivi_avanzamento(istantanea))
 
-    if not xml_dict:
-        logger.warning("⚠️ Nessun file XML trovato su Dropbox!")
-        return
+    statistiche = await loop.run_in_executor(None, resync_from_dropbox_memoria, logger, None, on_progresso)
+    window.mostra_avanzamento(
+        f"✅ Resync completato: {statistiche['inseriti']} fatture importate, {statistiche['errori']} errori"
+    )
+    await window.ricarica()
+    if osservatore is not None:
+        osservatore.avvia()
 
-    logger.info(f"📄 {len(xml_dict)} file XML ricevuti, avvio il parsing...")
 
-    errori = []
+def crea_osservatore(window, logger, loop):
+    """
+    OsservatoreDropbox che a ogni modifica su Dropbox esegue il resync
+    incrementale (nel suo thread) e poi ricarica la finestra.
+    """
+    def sincronizza():
+        statistiche = resync_from_dropbox_memoria(logger)
+        if statistiche["inseriti"]:
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(window.ricarica()))
 
-    for i, (filename, xml_content) in enumerate(xml_dict.items(), 1):
-        logger.info(f"🔍 [{i}/{len(xml_dict)}] Parsing file: {filename}")
+    def cursore_salvato():
+        with sessione_lettura() as db:
+            return leggi_cursore(db, "/fatture")
 
-        try:
-            # Parsing dell'XML direttamente in memoria
-            fattura_obj = parse_fattura_xml(xml_content, is_memory=True)
+    return OsservatoreDropbox(sincronizza, cursore_salvato, logger)
 
-            if fattura_obj:
-                salva_fattura_su_db(fattura_obj)
-                logger.info(f"✅ Fattura {fattura_obj.numero} importata nel database.")
-            else:
-                error_message = f"⚠️ Problema nel parsing del file: {filename}"
-                logger.warning(error_message)
-                errori.append(error_message)
 
-        except Exception as e:
-            error_message = f"❌ Errore nel parsing di {filename}: {e}"
-            logger.error(error_message)
-            errori.append(error_message)
+def resync_from_dropbox_memoria(logger, client=None, on_progresso=None):
+    """
+    Scarica le fatture XML da Dropbox **direttamente in memoria**, le parsa
+    (in parallelo su più processi) e le salva, senza scrivere su disco.
+    Download, parsing e salvataggio lavorano insieme con code limitate
+    (services/pipeline_resync.py): la memoria non cresce con l'archivio.
+    La sincronizzazione è incrementale: riparte dal cursore Dropbox salvato
+    e non scarica i file già elaborati (content_hash); i documenti il cui
+    hash è già nel DB vengono scartati prima del parsing. I file già scaricati
+    in passato si leggono dal mirror locale (services/mirror_dropbox.py),
+    quindi anche ricostruendo il DB da zero vanno in rete solo quelli nuovi.
+    La validazione XSD segue VALIDAZIONE_XSD (off / warn / strict): le fatture
+    non conformi importate in "warn" sono contate in "non_validi" e finiscono
+    nel log di dettaglio insieme agli errori.
+    `on_progresso(istantanea)` riceve periodicamente contatori e code per stadio.
+    Ritorna le statistiche: {"invariati", "ricevuti", "saltati_noti", "parsati", "inseriti", "non_validi", "errori"}.
+    """
+    logger.info("📡 Inizio resync rapido da Dropbox...")
 
-    # Salvataggio degli errori in un file di log dettagliato
-    if errori:
+    # I blocchi parsati passano al thread scrittore (database/scrittore.py),
+    # che li salva mentre il parsing continua; i blocchi in coda insieme hanno un solo commit
+    mirror = mirror_condiviso()
+    letti_dal_mirror = mirror.letti if mirror is not None else 0
+    statistiche, dettagli = esegui_resync(
+        client if client is not None else dbx, scrittore_condiviso(), logger, on_progresso=on_progresso,
+        mirror=mirror,
+    )
+    if mirror is not None:
+        logger.info(
+            f"💽 Mirror locale: {mirror.letti - letti_dal_mirror} file letti da disco, "
+            f"{mirror.dimensione() / 1024 ** 2:.1f} MB occupati"
+        )
+
+    if statistiche["ricevuti"] == 0 and statistiche["invariati"] == 0:
+        logger.info("ℹ️ Nessun file XML nuovo o modificato su Dropbox.")
+    logger.info(
+        f"📊 Resync: {statistiche['invariati']} invariati (non scaricati), {statistiche['ricevuti']} ricevuti, "
+        f"{statistiche['saltati_noti']} già presenti "
+        f"(saltati senza parsing), {statistiche['parsati']} parsati, {statistiche['inseriti']} inseriti, "
+        f"{statistiche['non_validi']} non conformi allo schema."
+    )
+
+    # Salvataggio degli errori (e degli avvisi di validazione) in un file di log dettagliato
+    if dettagli:
         with open(PARSING_ERROR_LOG, "w", encoding="utf-8") as f:
-            f.write("\n".join(errori))
+            f.write("\n".join(dettagli))
+    if statistiche["errori"]:
         logger.error(f"❌ Parsing completato con errori. Dettagli salvati in {PARSING_ERROR_LOG}")
     else:
         logger.info("✅ Resync rapido COMPLETATO senza errori!")
 
+    return statistiche
+
 
 if __name__ == "__main__":
     main()
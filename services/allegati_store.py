@@ -0,0 +1,278 @@
+# services/allegati_store.py
+
+"""
+Archivio su disco degli allegati delle fatture (<Allegati>), indirizzato per
+contenuto: ogni file è salvato una sola volta, con nome uguale al suo SHA-256,
+in  <CARTELLA_ALLEGATI>/<primi 2 caratteri>/<sha256>.
+
+Nel DB (AllegatoFattura.sha256) resta solo il riferimento; il contenuto
+si legge da disco quando serve davvero (es. quando l'utente apre l'allegato).
+Anche nell'XML salvato (documenti_xml) il base64 di <Attachment> è sostituito
+dal riferimento "sha256:<hash>" (vedi togli_allegati / reinserisci_allegati).
+
+I file entrano nell'archivio solo quando la fattura è confermata nel DB. Il
+parser (anche nei processi worker) scrive ogni allegato decodificato in un
+file temporaneo in <CARTELLA_ALLEGATI>/.in_arrivo (parcheggia_allegato) e
+passa avanti solo il path; chi salva la fattura lo registra sulla transazione
+corrente con salva_al_commit(). Il rilascio di un SAVEPOINT lo passa alla
+transazione che lo contiene, il suo rollback lo scarta; solo il commit della
+transazione più esterna lo sposta nell'archivio (un rename, senza rileggerlo).
+"""
+
+import os
+import re
+import time
+import base64
+import binascii
+import hashlib
+import logging
+import tempfile
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+CARTELLA_ALLEGATI = os.getenv("ALLEGATI_DIR", "allegati")
+
+# Testo di <Attachment> nell'XML salvato al posto del base64
+PREFISSO_RIFERIMENTO = "sha256:"
+
+_APERTURA = r"<(?:[\w.-]+:)?Attachment(?:\s[^>]*)?>"
+_CHIUSURA = r"</(?:[\w.-]+:)?Attachment\s*>"
+_ATTACHMENT = re.compile(f"({_APERTURA})(.*?)({_CHIUSURA})", re.S)
+_ATTACHMENT_BYTE = re.compile(_ATTACHMENT.pattern.encode("ascii"), re.S)
+_RIFERIMENTO = re.compile(f"({_APERTURA}){PREFISSO_RIFERIMENTO}([0-9a-f]{{64}})({_CHIUSURA})")
+
+# Chiave di Session.info con i file in arrivo da confermare al commit
+_DA_SALVARE = "allegati_da_salvare"
+# File in arrivo più vecchi di così sono di import interrotti
+ETA_MASSIMA_IN_ARRIVO = 24 * 3600
+
+
+def percorso_allegato(sha256):
+    """
+    Path su disco dell'allegato con hash `sha256`.
+    """
+    return os.path.join(CARTELLA_ALLEGATI, sha256[:2], sha256)
+
+
+def esiste_allegato(sha256):
+    return os.path.exists(percorso_allegato(sha256))
+
+
+def salva_allegato(contenuto):
+    """
+    Salva i byte `contenuto` nell'archivio (se non ci sono già) e ne ritorna lo SHA-256.
+    La scrittura passa da un file temporaneo + rename, quindi più processi
+    possono salvare lo stesso allegato in contemporanea senza corromperlo.
+    """
+    sha256 = hashlib.sha256(contenuto).hexdigest()
+    destinazione = percorso_allegato(sha256)
+    if os.path.exists(destinazione):
+        return sha256
+
+    cartella = os.path.dirname(destinazione)
+    os.makedirs(cartella, exist_ok=True)
+    fd, temporaneo = tempfile.mkstemp(dir=cartella, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenuto)
+        os.replace(temporaneo, destinazione)
+    except BaseException:
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+        raise
+    return sha256
+
+
+def _cartella_in_arrivo():
+    return os.path.join(CARTELLA_ALLEGATI, ".in_arrivo")
+
+
+def parcheggia_allegato(contenuto, sha256=None):
+    """
+    Scrive i byte `contenuto` in un file temporaneo tra gli allegati in arrivo,
+    così al processo che salva la fattura passa solo il path. `sha256` evita
+    di ricalcolare l'hash se il chiamante lo ha già.
+    Ritorna (sha256, path): il file va confermato con salva_al_commit()
+    oppure scartato con scarta_allegati().
+    """
+    if sha256 is None:
+        sha256 = hashlib.sha256(contenuto).hexdigest()
+    cartella = _cartella_in_arrivo()
+    os.makedirs(cartella, exist_ok=True)
+    fd, percorso = tempfile.mkstemp(dir=cartella, prefix=f"{sha256[:16]}-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contenuto)
+    except BaseException:
+        scarta_allegati([percorso])
+        raise
+    return sha256, percorso
+
+
+def _conferma_allegato(sha256, percorso):
+    # Stessa cartella radice: il file in arrivo diventa l'allegato con un rename
+    destinazione = percorso_allegato(sha256)
+    if os.path.exists(destinazione):
+        scarta_allegati([percorso])
+        return
+    os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+    os.replace(percorso, destinazione)
+
+
+def scarta_allegati(percorsi):
+    """
+    Cancella i file in arrivo `percorsi` (es. di una fattura già presente).
+    """
+    for percorso in percorsi:
+        try:
+            os.remove(percorso)
+        except FileNotFoundError:
+            pass
+
+
+def pulisci_in_arrivo(eta_massima=ETA_MASSIMA_IN_ARRIVO):
+    """
+    Cancella i file in arrivo rimasti da import interrotti (più vecchi di
+    `eta_massima` secondi). Ritorna quanti ne ha cancellati.
+    """
+    cartella = _cartella_in_arrivo()
+    if not os.path.isdir(cartella):
+        return 0
+    limite = time.time() - eta_massima
+    vecchi = []
+    for voce in os.scandir(cartella):
+        try:
+            if voce.stat().st_mtime < limite:
+                vecchi.append(voce.path)
+        except FileNotFoundError:
+            continue
+    scarta_allegati(vecchi)
+    if vecchi:
+        logger.info(f"🧹 Cancellati {len(vecchi)} allegati rimasti da import interrotti")
+    return len(vecchi)
+
+
+def salva_allegato_base64(testo_base64):
+    """
+    Decodifica il base64 di <Attachment> e lo salva nell'archivio. Ritorna lo SHA-256.
+    Spazi e a capo dentro il base64 vengono ignorati.
+    """
+    return salva_allegato(base64.b64decode(testo_base64))
+
+
+def leggi_allegato(sha256):
+    """
+    Legge da disco il contenuto dell'allegato. Solleva FileNotFoundError se manca.
+    """
+    with open(percorso_allegato(sha256), "rb") as f:
+        return f.read()
+
+
+def togli_allegati(xml, sha256_in_ordine=()):
+    """
+    Sostituisce il base64 di ogni <Attachment> di `xml` (byte o stringa) con
+    il riferimento "sha256:<hash>".
+    `sha256_in_ordine` sono gli hash già calcolati dal parser, nell'ordine del
+    documento: se sono tanti quanti gli <Attachment> il base64 non viene
+    decodificato una seconda volta.
+    Ritorna (xml, {sha256: byte}) con i byte degli allegati decodificati qui;
+    un <Attachment> che non è base64 valido resta com'è.
+    """
+    testo = isinstance(xml, str)
+    regex = _ATTACHMENT if testo else _ATTACHMENT_BYTE
+    trovati = regex.findall(xml)
+    if not trovati:
+        return xml, {}
+    noti = iter(sha256_in_ordine) if len(sha256_in_ordine) == len(trovati) else None
+    decodificati = {}
+
+    def riferimento(match):
+        if noti is not None:
+            sha256 = next(noti)
+        else:
+            try:
+                contenuto = base64.b64decode(match.group(2))
+            except (binascii.Error, ValueError):
+                return match.group(0)
+            sha256 = hashlib.sha256(contenuto).hexdigest()
+            decodificati[sha256] = contenuto
+        valore = PREFISSO_RIFERIMENTO + sha256
+        return match.group(1) + (valore if testo else valore.encode("ascii")) + match.group(3)
+
+    return regex.sub(riferimento, xml), decodificati
+
+
+def reinserisci_allegati(testo):
+    """
+    L'XML (stringa) con i riferimenti "sha256:<hash>" sostituiti dal base64
+    dell'allegato letto dall'archivio. Serve solo a chi ha bisogno del
+    documento integrale (es. per esportarlo): gli allegati mancanti restano
+    riferimenti.
+    """
+    def contenuto(match):
+        try:
+            dati = leggi_allegato(match.group(2))
+        except FileNotFoundError:
+            logger.warning(f"⚠️ Allegato {match.group(2)} mancante nell'archivio")
+            return match.group(0)
+        return match.group(1) + base64.b64encode(dati).decode("ascii") + match.group(3)
+
+    return _RIFERIMENTO.sub(contenuto, testo)
+
+
+def _transazione_corrente(db):
+    # La più interna: il SAVEPOINT aperto, se c'è
+    return db.get_nested_transaction() or db.get_transaction()
+
+
+def _aggiungi(in_arrivo, nuovi):
+    # Stesso allegato arrivato due volte: basta un file
+    for sha256, percorso in nuovi.items():
+        if in_arrivo.setdefault(sha256, percorso) != percorso:
+            scarta_allegati([percorso])
+
+
+def salva_al_commit(db, in_arrivo):
+    """
+    Registra i file in arrivo {sha256: path} (vedi parcheggia_allegato) da
+    spostare nell'archivio quando la transazione corrente della sessione `db`
+    (anche un SAVEPOINT) viene confermata fino a quella più esterna. Se invece
+    viene annullata i file sono cancellati: gli allegati di fatture scartate
+    non finiscono nell'archivio.
+    """
+    if not in_arrivo:
+        return
+    transazione = _transazione_corrente(db) or db.begin()
+    _aggiungi(db.info.setdefault(_DA_SALVARE, {}).setdefault(transazione, {}), in_arrivo)
+
+
+@event.listens_for(Session, "after_commit")
+def _salva_dopo_il_commit(db):
+    # Scatta anche al RELEASE SAVEPOINT, con il SAVEPOINT ancora corrente
+    in_attesa = db.info.get(_DA_SALVARE)
+    if not in_attesa:
+        return
+    transazione = _transazione_corrente(db)
+    in_arrivo = in_attesa.pop(transazione, None)
+    if not in_arrivo:
+        return
+    if transazione.parent is not None:
+        _aggiungi(in_attesa.setdefault(transazione.parent, {}), in_arrivo)
+        return
+    for sha256, percorso in in_arrivo.items():
+        try:
+            _conferma_allegato(sha256, percorso)
+        except OSError as e:
+            # Il commit c'è già stato: l'allegato risulterà mancante all'apertura
+            logger.error(f"❌ Allegato {sha256} non salvato nell'archivio: {e}")
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _scarta_non_confermati(db, transazione):
+    # Quel che resta di una transazione chiusa non è stato confermato
+    in_attesa = db.info.get(_DA_SALVARE)
+    if in_attesa:
+        scarta_allegati(in_attesa.pop(transazione, {}).values())
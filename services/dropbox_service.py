@@ -1,9 +1,25 @@
 # services/dropbox_service.py
 
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import dropbox
-from dropbox.exceptions import ApiError
-from dropbox.files import WriteMode, FileMetadata
+import requests
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from dropbox.files import (
+    WriteMode,
+    FileMetadata,
+    DeletedMetadata,
+    GetMetadataError,
+    ListFolderError,
+    ListFolderContinueError,
+    ListFolderLongpollError,
+    CommitInfo,
+    UploadSessionCursor,
+    UploadSessionFinishArg,
+)
 from dotenv import load_dotenv
 
 # Carichiamo le variabili d'ambiente dal file .env
@@ -14,25 +30,63 @@ APP_KEY = os.getenv("DROPBOX_APP_KEY")
 APP_SECRET = os.getenv("DROPBOX_APP_SECRET")
 REFRESH_TOKEN = os.getenv("DROPBOX_REFRESH_TOKEN")
 
-# Creiamo l'istanza "globale" di Dropbox con i parametri OAuth (refresh token)
+# Download contemporanei nel resync (richieste HTTPS in volo)
+MAX_DOWNLOAD_IN_VOLO = int(os.getenv("DROPBOX_DOWNLOAD_PARALLELI", "16"))
+# Tentativi per file e attesa iniziale (raddoppia a ogni tentativo)
+TENTATIVI_DOWNLOAD = 3
+ATTESA_TENTATIVO = 0.5  # secondi
+
+# Errori per cui vale la pena riprovare lo stesso file. Il client riprova già
+# da solo 5xx e 429; qui si aggiungono connessioni cadute e timeout.
+ERRORI_TEMPORANEI = (
+    InternalServerError,
+    RateLimitError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+# Upload contemporanei (sessioni di upload aperte) nell'archiviazione in blocco
+MAX_UPLOAD_IN_VOLO = int(os.getenv("DROPBOX_UPLOAD_PARALLELI", "8"))
+# Byte per richiesta di upload (i file più grandi si caricano in più pezzi)
+BLOCCO_UPLOAD = 8 * 1024 * 1024
+# File confermati al massimo da una chiamata a files_upload_session_finish_batch
+MAX_FILE_PER_BATCH = 1000
+
+# Attesa massima di una richiesta longpoll (Dropbox accetta 30-480 secondi)
+LONGPOLL_TIMEOUT = 480
+# Pausa dopo un errore dell'osservatore o una sincronizzazione non riuscita
+ATTESA_OSSERVATORE = 60  # secondi
+
+# Creiamo l'istanza "globale" di Dropbox con i parametri OAuth (refresh token).
+# È condivisa dai thread di download: il pool di connessioni della sessione
+# è grande quanto i download in volo, così ogni thread riusa la sua connessione.
 dbx = dropbox.Dropbox(
     app_key=APP_KEY,
     app_secret=APP_SECRET,
-    oauth2_refresh_token=REFRESH_TOKEN
+    oauth2_refresh_token=REFRESH_TOKEN,
+    session=dropbox.create_session(max_connections=MAX_DOWNLOAD_IN_VOLO),
 )
 
-def upload_xml_to_dropbox(local_path, fornitore, data_fattura, numero_fattura, logger=None):
+def percorso_dropbox(fornitore, data_fattura, numero_fattura):
     """
-    Carica il file XML su Dropbox, nella cartella:
+    Il path della fattura su Dropbox:
       /fatture/anno/mese/fornitore/datafattura_numerofattura.xml
     """
-    # Prepara i componenti del path su Dropbox
     anno = data_fattura.year
     mese = str(data_fattura.month).zfill(2)
     fornitore_sanitizzato = fornitore.replace(" ", "_")
 
     filename = f"{data_fattura}_{numero_fattura}.xml"
-    dropbox_path = f"/fatture/{anno}/{mese}/{fornitore_sanitizzato}/{filename}"
+    return f"/fatture/{anno}/{mese}/{fornitore_sanitizzato}/{filename}"
+
+
+def upload_xml_to_dropbox(local_path, fornitore, data_fattura, numero_fattura, logger=None):
+    """
+    Carica il file XML su Dropbox, nella cartella:
+      /fatture/anno/mese/fornitore/datafattura_numerofattura.xml
+    Per molti file insieme c'è carica_xml_su_dropbox (niente richieste per file).
+    """
+    dropbox_path = percorso_dropbox(fornitore, data_fattura, numero_fattura)
 
     # Controlliamo se esiste già
     try:
@@ -53,61 +107,153 @@ def upload_xml_to_dropbox(local_path, fornitore, data_fattura, numero_fattura, l
     return dropbox_path
 
 
-# 🔹 NUOVA FUNZIONE: Scaricare tutti gli XML direttamente in memoria con gestione degli encoding
-def scarica_tutti_xml_memoria(logger=None):
+def elenca_xml(client, cartella="/fatture", cursore=None, on_cursore=None):
+    """
+    Le voci (FileMetadata) dei file .xml sotto `cartella`, pagina per pagina:
+    la pagina successiva viene chiesta solo quando serve.
+    Con `cursore` (di una sincronizzazione precedente) elenca solo i file
+    aggiunti o modificati da allora; se Dropbox lo ha invalidato (reset)
+    riparte dall'elenco completo. `on_cursore(cursore)` riceve il cursore
+    dopo ogni pagina letta: quello dell'ultima serve alla prossima volta.
+    """
+    if cursore is None:
+        risposta = client.files_list_folder(cartella, recursive=True)
+    else:
+        try:
+            risposta = client.files_list_folder_continue(cursore)
+        except ApiError as e:
+            if not (isinstance(e.error, ListFolderContinueError) and e.error.is_reset()):
+                raise
+            risposta = client.files_list_folder(cartella, recursive=True)
+    while True:
+        for entry in risposta.entries:
+            if isinstance(entry, FileMetadata) and entry.name.endswith(".xml"):
+                yield entry
+        if on_cursore is not None:
+            on_cursore(risposta.cursor)
+        if not risposta.has_more:
+            return
+        risposta = client.files_list_folder_continue(risposta.cursor)
+
+
+def _con_tentativi(richiesta, tentativi, attesa):
+    """
+    Esegue `richiesta()` riprovando fino a `tentativi` volte sugli ERRORI_TEMPORANEI.
+    """
+    for tentativo in range(1, tentativi + 1):
+        try:
+            return richiesta()
+        except ERRORI_TEMPORANEI as e:
+            if tentativo == tentativi:
+                raise
+            # Con il 429 Dropbox dice quanto aspettare
+            time.sleep(getattr(e, "backoff", None) or attesa * 2 ** (tentativo - 1))
+
+
+def _scarica_con_tentativi(client, percorso, tentativi, attesa):
+    return _con_tentativi(lambda: client.files_download(percorso)[1].content, tentativi, attesa)
+
+
+def _scarica_voce(client, voce, tentativi, attesa, mirror):
+    content_hash = getattr(voce, "content_hash", None)
+    if mirror is not None:
+        contenuto = mirror.leggi(content_hash)
+        if contenuto is not None:
+            return contenuto
+    contenuto = _scarica_con_tentativi(client, voce.path_lower, tentativi, attesa)
+    if mirror is not None:
+        try:
+            mirror.salva(content_hash, contenuto)
+        except OSError:
+            pass  # il mirror è solo una scorciatoia: il file è comunque scaricato
+    return contenuto
+
+
+def metadati_attuali(client, percorsi, tentativi=TENTATIVI_DOWNLOAD, attesa=ATTESA_TENTATIVO):
+    """
+    Le voci (FileMetadata) attuali dei `percorsi`, con una files_get_metadata
+    ciascuno: servono a riprovare i file falliti nelle sincronizzazioni
+    precedenti, che l'elenco dal cursore non riporta più.
+    Genera (percorso, voce, errore): voce None senza errore se il file non
+    esiste più.
+    """
+    for percorso in percorsi:
+        try:
+            voce = _con_tentativi(lambda: client.files_get_metadata(percorso), tentativi, attesa)
+        except ApiError as e:
+            if isinstance(e.error, GetMetadataError) and e.error.is_path() and e.error.get_path().is_not_found():
+                yield percorso, None, None
+            else:
+                yield percorso, None, e
+            continue
+        except ERRORI_TEMPORANEI as e:
+            yield percorso, None, e
+            continue
+        yield percorso, voce if isinstance(voce, FileMetadata) else None, None
+
+
+def scarica_in_parallelo(client, voci, max_in_volo=MAX_DOWNLOAD_IN_VOLO,
+                         tentativi=TENTATIVI_DOWNLOAD, attesa=ATTESA_TENTATIVO, mirror=None):
+    """
+    Scarica le voci (con .path_lower) su un pool di thread che condividono
+    `client`, con al più `max_in_volo` richieste aperte. Ogni file viene
+    riprovato fino a `tentativi` volte sugli ERRORI_TEMPORANEI.
+    Con `mirror` (services.mirror_dropbox.MirrorDropbox) le voci il cui
+    content_hash è già su disco non vanno in rete, e i file scaricati vi
+    vengono salvati.
+    Genera (voce, contenuto, errore) nell'ordine in cui i download finiscono;
+    `voci` viene consumato man mano (può essere elenca_xml(), che pagina).
+    """
+    voci = iter(voci)
+    # Il token si rinnova qui una volta, non in parallelo da ogni thread
+    if hasattr(client, "check_and_refresh_access_token"):
+        client.check_and_refresh_access_token()
+
+    with ThreadPoolExecutor(max_workers=max_in_volo, thread_name_prefix="dropbox-download") as pool:
+        in_volo = {}
+
+        def riempi():
+            for voce in voci:
+                in_volo[pool.submit(_scarica_voce, client, voce, tentativi, attesa, mirror)] = voce
+                if len(in_volo) >= max_in_volo:
+                    return
+
+        riempi()
+        while in_volo:
+            finiti, _ = wait(in_volo, return_when=FIRST_COMPLETED)
+            for futuro in finiti:
+                voce = in_volo.pop(futuro)
+                errore = futuro.exception()
+                yield voce, None if errore else futuro.result(), errore
+            riempi()
+
+
+# 🔹 Scaricare tutti gli XML direttamente in memoria, come byte grezzi
+def scarica_tutti_xml_memoria(logger=None, client=None, max_in_volo=MAX_DOWNLOAD_IN_VOLO, mirror=None):
     """
     Scarica **tutte** le fatture XML da Dropbox in memoria con gestione della paginazione.
-    Se un file non è in UTF-8, tenta altre codifiche senza interrompere il processo.
-    Ritorna un dizionario {nome_file: contenuto_xml}
+    I download sono in parallelo (scarica_in_parallelo) e partono mentre
+    l'elenco delle pagine successive è ancora in corso; con `mirror` i file
+    già scaricati in passato si leggono da disco.
+    I file NON vengono decodificati: il parser lavora sui byte e rispetta
+    l'encoding dichiarato nel prologo XML.
+    Ritorna un dizionario {nome_file: contenuto_xml_in_byte}
     """
-    dropbox_root = "/fatture"
+    client = client if client is not None else dbx
     xml_files = {}
-    has_more = True
-    cursor = None
     total_files = 0
 
     try:
         logger.info("📡 Inizio download XML da Dropbox in memoria...")
 
-        while has_more:
-            if cursor:
-                response = dbx.files_list_folder_continue(cursor)
-            else:
-                response = dbx.files_list_folder(dropbox_root, recursive=True)
-
-            # Processa i file XML
-            for entry in response.entries:
-                if isinstance(entry, FileMetadata) and entry.name.endswith(".xml"):
-                    try:
-                        _, res = dbx.files_download(entry.path_lower)
-                        file_content = res.content  # Legge i byte grezzi
-
-                        # 🔹 Tenta la decodifica con UTF-8
-                        try:
-                            xml_text = file_content.decode("utf-8")
-                        except UnicodeDecodeError:
-                            logger.warning(f"⚠️ File {entry.name} non in UTF-8, provo ISO-8859-1...")
-                            try:
-                                xml_text = file_content.decode("ISO-8859-1")
-                            except UnicodeDecodeError:
-                                logger.warning(f"⚠️ File {entry.name} non leggibile, provo cp1252...")
-                                try:
-                                    xml_text = file_content.decode("cp1252")
-                                except UnicodeDecodeError:
-                                    logger.error(f"❌ File {entry.name} NON DECODIFICABILE. Saltato.")
-                                    continue  # Salta il file e passa al successivo
-
-                        # Se la decodifica è riuscita, aggiungi al dizionario
-                        xml_files[entry.name] = xml_text
-                        total_files += 1
-
-                    except Exception as e:
-                        logger.error(f"❌ Errore nel download di {entry.name}: {e}")
-
-            # Aggiorna il cursore e verifica se ci sono altre pagine
-            cursor = response.cursor
-            has_more = response.has_more
-            logger.info(f"🔄 Scaricati finora: {total_files} file XML...")
+        for entry, contenuto, errore in scarica_in_parallelo(client, elenca_xml(client), max_in_volo, mirror=mirror):
+            if errore is not None:
+                logger.error(f"❌ Errore nel download di {entry.name}: {errore}")
+                continue
+            xml_files[entry.name] = contenuto  # byte grezzi
+            total_files += 1
+            if total_files % 500 == 0:
+                logger.info(f"🔄 Scaricati finora: {total_files} file XML...")
 
         logger.info(f"📦 Totale file XML scaricati: {total_files}")
         return xml_files
@@ -117,6 +263,170 @@ def scarica_tutti_xml_memoria(logger=None):
         return {}
 
 
+class IndiceDropbox:
+    """
+    I file presenti sotto `cartella` ({path_lower: content_hash}): la prima
+    volta da un elenco completo, poi aggiornati dal cursore (solo le modifiche)
+    e dagli upload fatti con carica_xml_su_dropbox. Sapere se un file c'è già
+    non costa una richiesta per file.
+    """
+
+    def __init__(self, client=None, cartella="/fatture"):
+        self.client = client if client is not None else dbx
+        self.cartella = cartella
+        self.file = {}
+        self._cursore = None
+        self._lock = threading.Lock()
+
+    def _elenco_completo(self):
+        self.file.clear()
+        try:
+            return self.client.files_list_folder(self.cartella, recursive=True)
+        except ApiError as e:
+            if isinstance(e.error, ListFolderError) and e.error.is_path() and e.error.get_path().is_not_found():
+                return None  # cartella non ancora creata: nessun file
+            raise
+
+    def aggiorna(self):
+        with self._lock:
+            if self._cursore is None:
+                risposta = self._elenco_completo()
+            else:
+                try:
+                    risposta = self.client.files_list_folder_continue(self._cursore)
+                except ApiError as e:
+                    if not (isinstance(e.error, ListFolderContinueError) and e.error.is_reset()):
+                        raise
+                    risposta = self._elenco_completo()
+            while risposta is not None:
+                for entry in risposta.entries:
+                    if isinstance(entry, FileMetadata):
+                        self.file[entry.path_lower] = entry.content_hash
+                    elif isinstance(entry, DeletedMetadata):
+                        # Può essere una cartella: via anche tutto quello che conteneva
+                        sotto = entry.path_lower + "/"
+                        for percorso in [p for p in self.file if p == entry.path_lower or p.startswith(sotto)]:
+                            del self.file[percorso]
+                self._cursore = risposta.cursor
+                if not risposta.has_more:
+                    return
+                risposta = self.client.files_list_folder_continue(risposta.cursor)
+
+    def contiene(self, percorso):
+        return percorso.lower() in self.file
+
+    def registra(self, metadati):
+        with self._lock:
+            self.file[metadati.path_lower] = metadati.content_hash
+
+
+_indice = None
+_lock_indice = threading.Lock()
+
+
+def indice_condiviso():
+    """
+    L'IndiceDropbox di /fatture per il client dell'applicazione, creato al primo uso.
+    """
+    global _indice
+    with _lock_indice:
+        if _indice is None:
+            _indice = IndiceDropbox()
+        return _indice
+
+
+def _carica_in_sessione(client, dati):
+    """
+    Carica `dati` in una sessione di upload chiusa (a pezzi di BLOCCO_UPLOAD)
+    e ritorna il cursore da confermare con files_upload_session_finish_batch.
+    """
+    primo = dati[:BLOCCO_UPLOAD]
+    sessione = client.files_upload_session_start(primo, close=len(dati) <= BLOCCO_UPLOAD)
+    offset = len(primo)
+    while offset < len(dati):
+        blocco = dati[offset:offset + BLOCCO_UPLOAD]
+        cursore = UploadSessionCursor(session_id=sessione.session_id, offset=offset)
+        offset += len(blocco)
+        client.files_upload_session_append_v2(blocco, cursore, close=offset >= len(dati))
+    return UploadSessionCursor(session_id=sessione.session_id, offset=offset)
+
+
+def carica_xml_su_dropbox(file, client=None, indice=None, max_in_volo=MAX_UPLOAD_IN_VOLO,
+                          tentativi=TENTATIVI_DOWNLOAD, attesa=ATTESA_TENTATIVO, logger=None):
+    """
+    Archivia su Dropbox molti file già in memoria: `file` sono coppie
+    (percorso_dropbox, byte), es. percorso_dropbox(fornitore, data, numero).
+      - i file già presenti si riconoscono dall'indice (IndiceDropbox, di
+        default indice_condiviso()), senza una richiesta per file, e si saltano
+      - gli altri vanno in sessioni di upload, al più `max_in_volo` insieme,
+        ognuna riprovata fino a `tentativi` volte sugli ERRORI_TEMPORANEI
+      - le sessioni vengono confermate tutte insieme con
+        files_upload_session_finish_batch_v2 (MAX_FILE_PER_BATCH per chiamata)
+    Ritorna {"caricati": [percorsi], "presenti": [percorsi], "errori": {percorso: messaggio}}.
+    """
+    if client is None:
+        client = dbx
+        indice = indice if indice is not None else indice_condiviso()
+    elif indice is None:
+        indice = IndiceDropbox(client)
+    esito = {"caricati": [], "presenti": [], "errori": {}}
+
+    if hasattr(client, "check_and_refresh_access_token"):
+        client.check_and_refresh_access_token()
+    indice.aggiorna()
+
+    da_caricare = {}
+    for percorso, dati in file:
+        if indice.contiene(percorso) or percorso.lower() in da_caricare:
+            esito["presenti"].append(percorso)
+            continue
+        da_caricare[percorso.lower()] = (percorso, dati)
+    if not da_caricare:
+        return esito
+
+    # Upload in parallelo: ogni file nella sua sessione, ancora da confermare
+    confermabili = []
+    with ThreadPoolExecutor(max_workers=max_in_volo, thread_name_prefix="dropbox-upload") as pool:
+        futuri = [
+            (percorso, pool.submit(_con_tentativi, lambda dati=dati: _carica_in_sessione(client, dati),
+                                   tentativi, attesa))
+            for percorso, dati in da_caricare.values()
+        ]
+        for percorso, futuro in futuri:
+            try:
+                cursore = futuro.result()
+            except Exception as e:
+                esito["errori"][percorso] = str(e)
+                continue
+            commit = CommitInfo(path=percorso, mode=WriteMode("overwrite"))
+            confermabili.append(UploadSessionFinishArg(cursor=cursore, commit=commit))
+
+    # Conferma in blocco: una richiesta per MAX_FILE_PER_BATCH file
+    for inizio in range(0, len(confermabili), MAX_FILE_PER_BATCH):
+        gruppo = confermabili[inizio:inizio + MAX_FILE_PER_BATCH]
+        try:
+            risultato = client.files_upload_session_finish_batch_v2(gruppo)
+        except Exception as e:
+            for voce in gruppo:
+                esito["errori"][voce.commit.path] = str(e)
+            continue
+        for voce, risposta in zip(gruppo, risultato.entries):
+            if risposta.is_success():
+                indice.registra(risposta.get_success())
+                esito["caricati"].append(voce.commit.path)
+            else:
+                esito["errori"][voce.commit.path] = str(risposta.get_failure())
+
+    if logger:
+        logger.info(
+            f"☁️ Archiviazione su Dropbox: {len(esito['caricati'])} caricati, "
+            f"{len(esito['presenti'])} già presenti, {len(esito['errori'])} errori"
+        )
+        for percorso, messaggio in esito["errori"].items():
+            logger.error(f"❌ Upload di {percorso} non riuscito: {messaggio}")
+    return esito
+
+
 def conta_fatture_su_dropbox(logger=None):
     """
     Conta tutti i file XML presenti nella cartella /fatture di Dropbox.
@@ -148,3 +458,77 @@ def conta_fatture_su_dropbox(logger=None):
     except Exception as e:
         logger.error(f"❌ Errore nel conteggio delle fatture: {e}")
         return 0
+
+
+class OsservatoreDropbox:
+    """
+    Tiene d'occhio `cartella` con files_list_folder_longpoll: la richiesta
+    resta aperta finché su Dropbox non cambia qualcosa (o fino a `timeout`),
+    così i nuovi file arrivano in pochi secondi senza rielencare la cartella.
+    Il longpoll non consuma il cursore: a ogni modifica `sincronizza()`
+    (es. il resync incrementale) lo fa avanzare e lo salva, e `leggi_cursore()`
+    ritorna quello da cui ripartire.
+    """
+
+    def __init__(self, sincronizza, leggi_cursore, logger, client=None, cartella="/fatture",
+                 timeout=LONGPOLL_TIMEOUT, attesa_errore=ATTESA_OSSERVATORE):
+        self.sincronizza = sincronizza
+        self.leggi_cursore = leggi_cursore
+        self.logger = logger
+        self.client = client if client is not None else dbx
+        self.cartella = cartella
+        self.timeout = timeout
+        self.attesa_errore = attesa_errore
+        self._ferma = threading.Event()
+        self._thread = None
+
+    def avvia(self):
+        self._thread = threading.Thread(target=self._osserva, name="dropbox-longpoll", daemon=True)
+        self._thread.start()
+        self.logger.info(f"👀 Osservatore Dropbox avviato su {self.cartella}")
+
+    def ferma(self, attesa=10.0):
+        """
+        Ferma l'osservatore. Aspetta al più `attesa` secondi la sincronizzazione
+        in corso; un longpoll aperto non viene aspettato (thread daemon).
+        """
+        self._ferma.set()
+        if self._thread is not None:
+            self._thread.join(attesa)
+
+    def _cursore(self):
+        cursore = self.leggi_cursore()
+        if cursore is None:
+            # Mai sincronizzato: si parte da adesso, senza elencare la cartella
+            cursore = self.client.files_list_folder_get_latest_cursor(self.cartella, recursive=True).cursor
+        return cursore
+
+    def _osserva(self):
+        while not self._ferma.is_set():
+            cursore = None
+            try:
+                cursore = self._cursore()
+                risposta = self.client.files_list_folder_longpoll(cursore, self.timeout)
+                if risposta.changes and not self._ferma.is_set():
+                    self.logger.info("🔔 Nuovi file su Dropbox, sincronizzazione...")
+                    self.sincronizza()
+                    if self.leggi_cursore() == cursore:
+                        # Cursore non avanzato (errori): niente giri a vuoto
+                        self._ferma.wait(self.attesa_errore)
+                        continue
+                # Dropbox può chiedere di aspettare prima del prossimo longpoll
+                if risposta.backoff:
+                    self._ferma.wait(risposta.backoff)
+            except ApiError as e:
+                if isinstance(e.error, ListFolderLongpollError) and e.error.is_reset():
+                    # Cursore invalidato: il resync rielenca tutto e ne salva uno nuovo
+                    self.logger.warning("⚠️ Cursore Dropbox scaduto, sincronizzazione completa...")
+                    self.sincronizza()
+                    if self.leggi_cursore() == cursore:
+                        self._ferma.wait(self.attesa_errore)
+                else:
+                    self.logger.error(f"❌ Errore dell'osservatore Dropbox: {e}")
+                    self._ferma.wait(self.attesa_errore)
+            except Exception as e:
+                self.logger.error(f"❌ Errore dell'osservatore Dropbox: {e}")
+                self._ferma.wait(self.attesa_errore)
@@ -0,0 +1,329 @@
+# services/esportazione.py
+
+"""
+Esportazione colonnare di fatture, righe_fattura, dati_riepilogo_iva e
+dati_pagamento in Parquet (o Arrow IPC) per chi analizza i dati fuori
+dall'applicazione.
+
+Le righe vengono lette a blocchi di dimensione fissa (`blocco`) dal cursore
+del driver e scritte subito come row group / record batch: in memoria c'è
+al più un blocco per volta, qualunque sia la dimensione dell'archivio.
+
+Struttura della destinazione (con --partiziona, partizioni "hive" per anno e
+mese della fattura, anno=0/mese=00 per le fatture senza data):
+
+    DEST/fatture/anno=2024/mese=03/part-1-1520.parquet
+    DEST/righe_fattura/anno=2024/mese=03/part-1-7340.parquet
+    ...
+    DEST/_stato_export.json     ultimo id esportato per tabella
+
+Con --incrementale si esportano solo le righe aggiunte dopo l'ultima
+esportazione (id maggiore dell'ultimo salvato), in nuovi file part-*.
+Le tabelle esportate sono AUTOINCREMENT: un id cancellato non viene
+riassegnato, e il limite di ogni esportazione è l'ultimo id assegnato
+(sqlite_sequence), non il massimo tra le righe rimaste.
+Le modifiche a righe già esportate (es. fattura segnata pagata) non vengono
+riportate: per quelle serve un'esportazione completa.
+
+Uso:
+    python -m services.esportazione DEST [--formato parquet|arrow] [--partiziona] [--incrementale]
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Date, Float, Integer, Numeric, String, Text, cast, event, func, select
+
+from database.db_session import DB_URL, crea_engine, abilita_savepoint
+from database.migrazioni import esegui_migrazioni
+from database.models import Fattura, RigheFattura, DatiRiepilogoIVA, DatiPagamento
+
+logger = logging.getLogger(__name__)
+
+FORMATO_PARQUET = "parquet"
+FORMATO_ARROW = "arrow"
+ESTENSIONI = {FORMATO_PARQUET: ".parquet", FORMATO_ARROW: ".arrow"}
+
+FILE_STATO = "_stato_export.json"
+
+# Righe per blocco letto dal DB (= righe per row group / record batch)
+BLOCCO_DEFAULT = 50_000
+
+# Tabelle esportate, nell'ordine di scrittura
+TABELLE = {
+    "fatture": Fattura,
+    "righe_fattura": RigheFattura,
+    "dati_riepilogo_iva": DatiRiepilogoIVA,
+    "dati_pagamento": DatiPagamento,
+}
+
+_TIPI_ARROW = (
+    (Boolean, pa.bool_()),
+    (Integer, pa.int64()),
+    (Float, pa.float64()),
+    (Numeric, pa.float64()),
+    (Date, pa.date32()),
+    (String, pa.string()),
+    (Text, pa.string()),
+)
+
+
+def _tipo_arrow(colonna):
+    for tipo_sql, tipo_arrow in _TIPI_ARROW:
+        if isinstance(colonna.type, tipo_sql):
+            return tipo_arrow
+    raise TypeError(f"Colonna {colonna} di tipo {colonna.type} non esportabile")
+
+
+def schema_arrow(modello):
+    """
+    Schema Arrow con le colonne della tabella del modello, nello stesso ordine.
+    """
+    return pa.schema([
+        pa.field(c.name, _tipo_arrow(c), nullable=not c.primary_key)
+        for c in modello.__table__.columns
+    ])
+
+
+def _anno_mese():
+    """
+    (anno, mese) della fattura come espressioni SQL, 0 se manca la data
+    (come nelle tabelle dei totali).
+    """
+    return (
+        func.coalesce(cast(func.strftime("%Y", Fattura.data), Integer), 0),
+        func.coalesce(cast(func.strftime("%m", Fattura.data), Integer), 0),
+    )
+
+
+def query_esportazione(modello, da_id, a_id, partiziona=False):
+    """
+    SELECT delle righe di `modello` con da_id < id <= a_id. Con `partiziona`
+    aggiunge in testa anno e mese della fattura e ordina per partizione,
+    così ogni partizione arriva tutta di seguito.
+    """
+    colonne = list(modello.__table__.columns)
+    id_colonna = modello.__table__.c.id
+    if not partiziona:
+        return select(*colonne).where(id_colonna > da_id, id_colonna <= a_id).order_by(id_colonna)
+
+    anno, mese = _anno_mese()
+    query = select(anno, mese, *colonne)
+    if modello is not Fattura:
+        query = query.select_from(modello).outerjoin(Fattura, Fattura.id == modello.fattura_id)
+    return query.where(id_colonna > da_id, id_colonna <= a_id).order_by(anno, mese, id_colonna)
+
+
+def _apri_writer(percorso, schema, formato):
+    os.makedirs(os.path.dirname(percorso), exist_ok=True)
+    if formato == FORMATO_PARQUET:
+        return pq.ParquetWriter(percorso, schema, compression="zstd")
+    return pa.ipc.new_file(percorso, schema)
+
+
+def _batch(righe, schema, inizio=0):
+    """
+    RecordBatch dalle righe del blocco (tuple), saltando le prime `inizio` colonne.
+    """
+    colonne = list(zip(*righe))[inizio:]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(valori, type=campo.type) for valori, campo in zip(colonne, schema)],
+        schema=schema,
+    )
+
+
+class _FilePartizione:
+    """
+    File di una partizione in scrittura: si scrive su un .tmp rinominato in
+    chiusura, così un'esportazione interrotta non lascia file a metà.
+    """
+
+    def __init__(self, percorso, schema, formato):
+        self.percorso = percorso
+        self.writer = _apri_writer(percorso + ".tmp", schema, formato)
+
+    def scrivi(self, batch):
+        self.writer.write_batch(batch)
+
+    def chiudi(self):
+        self.writer.close()
+        os.replace(self.percorso + ".tmp", self.percorso)
+
+
+def _percorso_file(dest, tabella, nome_file, partizione=None):
+    if partizione is None:
+        return os.path.join(dest, tabella, nome_file)
+    anno, mese = partizione
+    return os.path.join(dest, tabella, f"anno={anno}", f"mese={mese:02d}", nome_file)
+
+
+def esporta_tabella(conn, dest, tabella, da_id, a_id, formato=FORMATO_PARQUET, partiziona=False,
+                    blocco=BLOCCO_DEFAULT):
+    """
+    Scrive le righe di `tabella` con da_id < id <= a_id in
+    DEST/<tabella>/[anno=../mese=../]part-<da_id+1>-<a_id>.<ext>.
+    Ritorna il numero di righe esportate.
+    """
+    modello = TABELLE[tabella]
+    schema = schema_arrow(modello)
+    nome_file = f"part-{da_id + 1}-{a_id}{ESTENSIONI[formato]}"
+    inizio = 2 if partiziona else 0
+
+    risultato = conn.execution_options(yield_per=blocco).execute(
+        query_esportazione(modello, da_id, a_id, partiziona)
+    )
+    aperto, partizione, esportate = None, None, 0
+    try:
+        for righe in risultato.partitions(blocco):
+            # Un blocco può contenere la fine di una partizione e l'inizio della successiva
+            while righe:
+                chiave = (righe[0][0], righe[0][1]) if partiziona else None
+                if partiziona:
+                    fine = next((i for i, r in enumerate(righe) if (r[0], r[1]) != chiave), len(righe))
+                else:
+                    fine = len(righe)
+                if aperto is None or chiave != partizione:
+                    if aperto is not None:
+                        aperto.chiudi()
+                    aperto = _FilePartizione(_percorso_file(dest, tabella, nome_file, chiave), schema, formato)
+                    partizione = chiave
+                aperto.scrivi(_batch(righe[:fine], schema, inizio))
+                esportate += fine
+                righe = righe[fine:]
+    finally:
+        risultato.close()
+    if aperto is not None:
+        aperto.chiudi()
+    return esportate
+
+
+def _leggi_stato(dest):
+    percorso = os.path.join(dest, FILE_STATO)
+    if not os.path.exists(percorso):
+        return None
+    with open(percorso, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _salva_stato(dest, stato):
+    percorso = os.path.join(dest, FILE_STATO)
+    with open(percorso + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(stato, f, indent=2)
+    os.replace(percorso + ".tmp", percorso)
+
+
+def _rimuovi_parziali(dest, tabella, da_id):
+    """
+    Toglie i file di un'esportazione incrementale interrotta: partono dallo
+    stesso id (lo stato non era stato aggiornato) e verrebbero duplicati.
+    """
+    for percorso in glob.glob(os.path.join(dest, tabella, "**", f"part-{da_id + 1}-*"), recursive=True):
+        os.remove(percorso)
+
+
+def _ultimi_id_assegnati(conn):
+    """
+    {tabella: ultimo id assegnato} da sqlite_sequence, che con AUTOINCREMENT
+    non torna indietro quando si cancellano le righe più recenti (0 per le
+    tabelle in cui non è mai stato inserito nulla).
+    """
+    assegnati = dict(conn.exec_driver_sql("SELECT name, seq FROM sqlite_sequence").fetchall())
+    return {tabella: assegnati.get(tabella, 0) for tabella in TABELLE}
+
+
+def esporta(engine, dest, formato=FORMATO_PARQUET, partiziona=False, incrementale=False,
+            blocco=BLOCCO_DEFAULT):
+    """
+    Esporta le TABELLE in `dest`. Senza `incrementale` le cartelle delle
+    tabelle vengono ricreate da zero; in entrambi i casi lo stato salvato
+    permette alla prossima esportazione incrementale di ripartire da qui.
+    Ritorna {tabella: righe esportate}.
+    """
+    if formato not in ESTENSIONI:
+        raise ValueError(f"Formato non supportato: {formato}")
+    os.makedirs(dest, exist_ok=True)
+
+    stato = _leggi_stato(dest) if incrementale else None
+    if stato is not None and (stato["formato"], stato["partiziona"]) != (formato, partiziona):
+        raise ValueError(
+            f"{dest} contiene un'esportazione {stato['formato']} "
+            f"{'partizionata' if stato['partiziona'] else 'non partizionata'}: "
+            "usa le stesse opzioni o una destinazione nuova"
+        )
+    ultimi = stato["ultimo_id"] if stato is not None else {}
+
+    esportate = {}
+    # Una sola transazione di lettura: i limiti e le righe lette sono
+    # coerenti anche se nel frattempo il thread scrittore salva altre fatture
+    with engine.connect() as conn, conn.begin():
+        massimi = _ultimi_id_assegnati(conn)
+        for tabella, a_id in massimi.items():
+            da_id = ultimi.get(tabella, 0)
+            if not incrementale:
+                shutil.rmtree(os.path.join(dest, tabella), ignore_errors=True)
+            else:
+                _rimuovi_parziali(dest, tabella, da_id)
+            if a_id <= da_id:
+                esportate[tabella] = 0
+                continue
+            esportate[tabella] = esporta_tabella(conn, dest, tabella, da_id, a_id, formato, partiziona, blocco)
+            logger.info(f"📦 {tabella}: {esportate[tabella]} righe esportate")
+
+    _salva_stato(dest, {
+        "formato": formato,
+        "partiziona": partiziona,
+        "ultimo_id": {tabella: max(massimi[tabella], ultimi.get(tabella, 0)) for tabella in TABELLE},
+        "data_export": datetime.now().isoformat(timespec="seconds"),
+    })
+    return esportate
+
+
+def crea_engine_esportazione(url=DB_URL):
+    """
+    Engine per l'esportazione: WAL e busy_timeout come la UI, ma senza
+    temp_store=MEMORY (l'ordinamento per partizione può finire su file
+    temporanei invece che in RAM) e con la transazione aperta subito, così
+    tutte le letture vedono la stessa istantanea del DB.
+    """
+    engine = abilita_savepoint(crea_engine(url, profilo=None))
+
+    @event.listens_for(engine, "connect")
+    def _imposta_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dest", help="cartella di destinazione")
+    parser.add_argument("--formato", choices=sorted(ESTENSIONI), default=FORMATO_PARQUET)
+    parser.add_argument("--partiziona", action="store_true", help="partizioni per anno e mese della fattura")
+    parser.add_argument("--incrementale", action="store_true", help="solo le righe aggiunte dall'ultima esportazione")
+    parser.add_argument("--blocco", type=int, default=BLOCCO_DEFAULT, help="righe lette per blocco")
+    parser.add_argument("--db", default=DB_URL, help="URL del DB (default: quello dell'applicazione)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    engine = crea_engine_esportazione(args.db)
+    try:
+        # Un DB non ancora aperto dall'applicazione aggiornata non ha le
+        # tabelle AUTOINCREMENT da cui si legge l'ultimo id
+        esegui_migrazioni(engine)
+        esportate = esporta(engine, args.dest, args.formato, args.partiziona, args.incrementale, args.blocco)
+    finally:
+        engine.dispose()
+    print(f"✅ Esportazione in {args.dest}: " + ", ".join(f"{t} {n}" for t, n in esportate.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# services/liquidazione_iva.py
+
+"""
+Liquidazione IVA periodica (mensile o trimestrale) dai DatiRiepilogoIVA.
+
+Una sola query carica in array NumPy le colonne che servono (periodo del
+documento, tipo documento, aliquota, natura, esigibilità, imponibile,
+imposta); i totali per periodo, aliquota, natura ed esigibilità si
+calcolano poi con group-by vettoriali (np.unique + np.bincount) invece
+di un ciclo sugli oggetti ORM.
+
+Le note di credito (TD04, e TD08 semplificata) riportano importi positivi
+nel tracciato: qui entrano con il segno meno.
+
+Il costo è quasi tutto nella lettura delle righe; il raggruppamento in
+memoria è veloce e si può ripetere sugli stessi array (mensile, trimestrale,
+...) senza rileggere il DB. La stessa liquidazione fatta con un GROUP BY in
+SQL è in liquidazione_iva_sql(), per il confronto in
+benchmarks/bench_liquidazione.py e nei test.
+
+Uso:
+    python -m services.liquidazione_iva 2024 [--trimestrale]
+"""
+
+import argparse
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+from sqlalchemy import text
+
+PERIODICITA_MENSILE = "mensile"
+PERIODICITA_TRIMESTRALE = "trimestrale"
+
+# Tipi documento che stornano imponibile e imposta
+TIPI_NOTA_CREDITO = ("TD04", "TD08")
+
+RigaLiquidazione = namedtuple(
+    "RigaLiquidazione",
+    "anno periodo aliquota_iva natura esigibilita_iva n_riepiloghi imponibile imposta",
+)
+
+# anno = 0 per le fatture senza data, come nelle tabelle dei totali
+_COLONNE = (
+    "coalesce(CAST(strftime('%Y', f.data) AS INTEGER), 0) AS anno, "
+    "coalesce(CAST(strftime('%m', f.data) AS INTEGER), 0) AS mese, "
+    "coalesce(r.aliquota_iva, 0) AS aliquota_iva, "
+    "coalesce(r.natura, '') AS natura, "
+    "coalesce(r.esigibilita_iva, '') AS esigibilita_iva"
+)
+
+_FROM = "FROM dati_riepilogo_iva AS r JOIN fatture AS f ON f.id = r.fattura_id"
+
+_NOTA_CREDITO = "f.tipo_documento IN ({})".format(", ".join(f"'{t}'" for t in TIPI_NOTA_CREDITO))
+
+
+def _filtro_anno(anno):
+    """
+    WHERE sull'anno della fattura (intervallo su f.data) e parametri.
+    """
+    if anno is None:
+        return "", {}
+    return "WHERE f.data >= :inizio AND f.data < :fine", {
+        "inizio": date(anno, 1, 1).isoformat(),
+        "fine": date(anno + 1, 1, 1).isoformat(),
+    }
+
+
+def _periodo(mesi, periodicita):
+    if periodicita == PERIODICITA_MENSILE:
+        return mesi
+    if periodicita == PERIODICITA_TRIMESTRALE:
+        # mese 0 (senza data) resta periodo 0
+        return np.where(mesi > 0, (mesi - 1) // 3 + 1, 0)
+    raise ValueError(f"Periodicità non supportata: {periodicita}")
+
+
+def carica_riepiloghi(conn, anno=None):
+    """
+    Colonne dei riepiloghi IVA (con anno, mese e tipo documento della fattura)
+    come dizionario di array NumPy, lette con una sola query.
+    Imponibile e imposta hanno già il segno meno per le note di credito.
+    """
+    where, parametri = _filtro_anno(anno)
+    righe = conn.execute(text(
+        f"SELECT {_COLONNE}, "
+        f"CASE WHEN {_NOTA_CREDITO} THEN -1.0 ELSE 1.0 END AS segno, "
+        "coalesce(r.imponibile_importo, 0) AS imponibile, coalesce(r.imposta, 0) AS imposta "
+        f"{_FROM} {where}"
+    ), parametri).all()
+
+    colonne = list(zip(*righe)) if righe else [()] * 8
+    anni, mesi, aliquote, nature, esigibilita, segni, imponibili, imposte = colonne
+    segni = np.array(segni, dtype=np.float64)
+    return {
+        "anno": np.array(anni, dtype=np.int64),
+        "mese": np.array(mesi, dtype=np.int64),
+        "aliquota_iva": np.array(aliquote, dtype=np.float64),
+        "natura": np.array(nature, dtype=object),
+        "esigibilita_iva": np.array(esigibilita, dtype=object),
+        "imponibile": np.array(imponibili, dtype=np.float64) * segni,
+        "imposta": np.array(imposte, dtype=np.float64) * segni,
+    }
+
+
+def _raggruppa(chiavi, valori):
+    """
+    Group-by vettoriale: `chiavi` e `valori` sono liste di array della stessa
+    lunghezza. Ritorna (chiavi distinte, conteggi, somme) con le chiavi in
+    ordine crescente.
+    """
+    # Ogni colonna chiave diventa un codice intero; le combinazioni un solo intero
+    distinte, codici = zip(*(np.unique(c, return_inverse=True) for c in chiavi))
+    combinato = np.ravel_multi_index([c.ravel() for c in codici], [len(d) for d in distinte])
+    gruppi, indice = np.unique(combinato, return_inverse=True)
+    conteggi = np.bincount(indice, minlength=len(gruppi))
+    somme = [np.bincount(indice, weights=v, minlength=len(gruppi)) for v in valori]
+    codici_gruppi = np.unravel_index(gruppi, [len(d) for d in distinte])
+    return [d[c] for d, c in zip(distinte, codici_gruppi)], conteggi, somme
+
+
+def raggruppa_liquidazione(colonne, periodicita=PERIODICITA_MENSILE):
+    """
+    Imponibile e imposta per (anno, periodo, aliquota, natura, esigibilità)
+    dalle colonne di carica_riepiloghi(), con periodo = mese (1-12) o
+    trimestre (1-4). Lista di RigaLiquidazione ordinata per chiave.
+    Le stesse colonne si possono raggruppare più volte (mensile e
+    trimestrale) senza rileggere il DB.
+    """
+    periodi = _periodo(colonne["mese"], periodicita)
+    if len(colonne["anno"]) == 0:
+        return []
+    chiavi, conteggi, (imponibili, imposte) = _raggruppa(
+        [colonne["anno"], periodi, colonne["aliquota_iva"], colonne["natura"], colonne["esigibilita_iva"]],
+        [colonne["imponibile"], colonne["imposta"]],
+    )
+    return [
+        RigaLiquidazione(int(a), int(p), float(al), n, e, int(c), round(float(imp), 2), round(float(iva), 2))
+        for a, p, al, n, e, c, imp, iva in zip(*chiavi, conteggi, imponibili, imposte)
+    ]
+
+
+def liquidazione_iva(conn, anno=None, periodicita=PERIODICITA_MENSILE):
+    """
+    Liquidazione dell'anno (o di tutto l'archivio): carica_riepiloghi() + raggruppa_liquidazione().
+    """
+    return raggruppa_liquidazione(carica_riepiloghi(conn, anno), periodicita)
+
+
+def liquidazione_iva_sql(conn, anno=None, periodicita=PERIODICITA_MENSILE):
+    """
+    Come liquidazione_iva(), con il raggruppamento fatto da SQLite (GROUP BY).
+    """
+    if periodicita == PERIODICITA_MENSILE:
+        periodo = "mese"
+    elif periodicita == PERIODICITA_TRIMESTRALE:
+        periodo = "CASE WHEN mese > 0 THEN (mese - 1) / 3 + 1 ELSE 0 END"
+    else:
+        raise ValueError(f"Periodicità non supportata: {periodicita}")
+    where, parametri = _filtro_anno(anno)
+    segno = f"CASE WHEN {_NOTA_CREDITO} THEN -1.0 ELSE 1.0 END"
+    righe = conn.execute(text(
+        f"SELECT anno, {periodo} AS periodo, aliquota_iva, natura, esigibilita_iva, "
+        "count(*), sum(imponibile), sum(imposta) FROM ("
+        f"SELECT {_COLONNE}, "
+        f"{segno} * coalesce(r.imponibile_importo, 0) AS imponibile, "
+        f"{segno} * coalesce(r.imposta, 0) AS imposta "
+        f"{_FROM} {where}"
+        ") GROUP BY 1, 2, 3, 4, 5 ORDER BY 1, 2, 3, 4, 5"
+    ), parametri).all()
+    return [
+        RigaLiquidazione(a, p, al, n, e, c, round(imp, 2), round(iva, 2))
+        for a, p, al, n, e, c, imp, iva in righe
+    ]
+
+
+def totali_periodo(righe):
+    """
+    {(anno, periodo): (imponibile, imposta)} sommando aliquote, nature ed esigibilità.
+    """
+    totali = {}
+    for riga in righe:
+        imponibile, imposta = totali.get((riga.anno, riga.periodo), (0.0, 0.0))
+        totali[(riga.anno, riga.periodo)] = (
+            round(imponibile + riga.imponibile, 2), round(imposta + riga.imposta, 2)
+        )
+    return totali
+
+
+def main():
+    from database.db_session import engine, init_db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("anno", type=int)
+    parser.add_argument("--trimestrale", action="store_true", help="periodi trimestrali invece che mensili")
+    args = parser.parse_args()
+
+    init_db()
+    periodicita = PERIODICITA_TRIMESTRALE if args.trimestrale else PERIODICITA_MENSILE
+    with engine.connect() as conn:
+        righe = liquidazione_iva(conn, args.anno, periodicita)
+    print(f"{'periodo':>7} {'aliquota':>8} {'natura':>6} {'esig.':>5} {'n':>6} {'imponibile':>14} {'imposta':>12}")
+    for riga in righe:
+        print(f"{riga.periodo:>7} {riga.aliquota_iva:>8.2f} {riga.natura:>6} {riga.esigibilita_iva:>5} "
+              f"{riga.n_riepiloghi:>6} {riga.imponibile:>14.2f} {riga.imposta:>12.2f}")
+    for (anno, periodo), (imponibile, imposta) in sorted(totali_periodo(righe).items()):
+        print(f"📊 {anno} periodo {periodo}: imponibile {imponibile:.2f}, imposta {imposta:.2f}")
+
+
+if __name__ == "__main__":
+    main()
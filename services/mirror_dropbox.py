@@ -0,0 +1,182 @@
+# services/mirror_dropbox.py
+
+"""
+Copia locale dei file scaricati da Dropbox, indirizzata per content_hash
+(l'hash che Dropbox riporta nell'elenco dei file): ogni contenuto è salvato
+una sola volta in  <cartella>/<primi 2 caratteri>/<content_hash>.
+
+Sta davanti ai download (services.dropbox_service.scarica_in_parallelo):
+se il contenuto di una voce dell'elenco è già nel mirror si legge da disco,
+altrimenti si scarica e si salva. Ricostruire il DB da zero riscarica
+quindi dalla rete solo i file nuovi o modificati.
+
+Lo spazio occupato ha un limite: superato, si cancellano i file usati meno
+di recente (LRU sulla data di modifica, aggiornata a ogni lettura).
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+
+CARTELLA_MIRROR = os.getenv("DROPBOX_MIRROR_DIR", "mirror_dropbox")
+# Spazio massimo del mirror; 0 lo disattiva
+MAX_MB_MIRROR = int(os.getenv("DROPBOX_MIRROR_MB", "1024"))
+# Superato il limite si libera spazio fino a questa frazione, così la
+# pulizia (che scorre tutta la cartella) non riparte a ogni file
+QUOTA_DOPO_PULIZIA = 0.9
+
+# Dimensione dei blocchi del content_hash di Dropbox
+BLOCCO_CONTENT_HASH = 4 * 1024 * 1024
+
+
+def content_hash_dropbox(dati):
+    """
+    Il content_hash di Dropbox: SHA-256 della concatenazione degli SHA-256
+    dei blocchi da 4 MB del file.
+    """
+    digest_blocchi = b"".join(
+        hashlib.sha256(dati[inizio:inizio + BLOCCO_CONTENT_HASH]).digest()
+        for inizio in range(0, len(dati), BLOCCO_CONTENT_HASH)
+    )
+    return hashlib.sha256(digest_blocchi).hexdigest()
+
+
+class MirrorDropbox:
+    """
+    Mirror su disco in `cartella`, al più `max_byte` byte. Può essere usato
+    da più thread insieme (i download paralleli).
+    """
+
+    def __init__(self, cartella=CARTELLA_MIRROR, max_byte=MAX_MB_MIRROR * 1024 * 1024):
+        self.cartella = cartella
+        self.max_byte = max_byte
+        self.letti = 0
+        self.salvati = 0
+        self.rimossi = 0
+        self._lock = threading.Lock()
+        self._dimensione = sum(dimensione for _, dimensione, _ in self._file())
+
+    def percorso(self, content_hash):
+        return os.path.join(self.cartella, content_hash[:2], content_hash)
+
+    def _file(self):
+        """
+        (data di modifica, dimensione, path) di ogni file del mirror.
+        """
+        if not os.path.isdir(self.cartella):
+            return
+        for sottocartella in os.scandir(self.cartella):
+            if not sottocartella.is_dir():
+                continue
+            for voce in os.scandir(sottocartella.path):
+                if voce.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stato = voce.stat()
+                except FileNotFoundError:  # rimosso nel frattempo
+                    continue
+                yield stato.st_mtime, stato.st_size, voce.path
+
+    def leggi(self, content_hash):
+        """
+        I byte con questo content_hash, None se non sono nel mirror (o il file
+        su disco è rovinato, e allora viene rimosso).
+        """
+        if not content_hash:
+            return None
+        percorso = self.percorso(content_hash)
+        try:
+            with open(percorso, "rb") as f:
+                dati = f.read()
+        except FileNotFoundError:
+            return None
+        if content_hash_dropbox(dati) != content_hash:
+            self._rimuovi(percorso, len(dati))
+            return None
+        try:
+            # Usato adesso: ultimo della coda LRU
+            os.utime(percorso)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.letti += 1
+        return dati
+
+    def salva(self, content_hash, dati):
+        """
+        Salva `dati` se il loro hash è `content_hash` (un download troncato non
+        entra nel mirror). Ritorna True se il contenuto è nel mirror.
+        """
+        if not content_hash or self.max_byte <= 0 or len(dati) > self.max_byte:
+            return False
+        if content_hash_dropbox(dati) != content_hash:
+            return False
+        destinazione = self.percorso(content_hash)
+        if os.path.exists(destinazione):
+            return True
+
+        cartella = os.path.dirname(destinazione)
+        os.makedirs(cartella, exist_ok=True)
+        fd, temporaneo = tempfile.mkstemp(dir=cartella, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dati)
+            os.replace(temporaneo, destinazione)
+        except BaseException:
+            if os.path.exists(temporaneo):
+                os.remove(temporaneo)
+            raise
+        with self._lock:
+            self.salvati += 1
+            self._dimensione += len(dati)
+            if self._dimensione > self.max_byte:
+                self._libera_spazio()
+        return True
+
+    def _rimuovi(self, percorso, dimensione):
+        try:
+            os.remove(percorso)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._dimensione -= dimensione
+            self.rimossi += 1
+
+    def _libera_spazio(self):
+        # Chiamata con il lock preso: ricalcola la dimensione dal disco e
+        # cancella dal file usato meno di recente
+        file = sorted(self._file())
+        self._dimensione = sum(dimensione for _, dimensione, _ in file)
+        obiettivo = self.max_byte * QUOTA_DOPO_PULIZIA
+        for _, dimensione, percorso in file:
+            if self._dimensione <= obiettivo:
+                break
+            try:
+                os.remove(percorso)
+            except FileNotFoundError:
+                pass
+            self._dimensione -= dimensione
+            self.rimossi += 1
+
+    def dimensione(self):
+        with self._lock:
+            return self._dimensione
+
+
+_mirror = None
+_lock_mirror = threading.Lock()
+
+
+def mirror_condiviso():
+    """
+    Il mirror dell'applicazione (CARTELLA_MIRROR, MAX_MB_MIRROR), None se
+    disattivato con DROPBOX_MIRROR_MB=0.
+    """
+    global _mirror
+    if MAX_MB_MIRROR <= 0:
+        return None
+    with _lock_mirror:
+        if _mirror is None:
+            _mirror = MirrorDropbox()
+        return _mirror
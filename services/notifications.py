@@ -1,8 +1,19 @@
 # services/notifications.py
 
 from datetime import date, timedelta
-from database.db_session import SessionLocal
-from database.models import Fattura
+from database.db_session import sessione_lettura
+from database.query_fatture import query_non_pagate_in_scadenza
+
+def _scadenze(db, giorni_avviso):
+    oggi = date.today()
+    limite = oggi + timedelta(days=giorni_avviso)
+
+    scadute = query_non_pagate_in_scadenza(db, fine=oggi).all()
+
+    # `limite` compreso: l'intervallo è [oggi, limite + 1 giorno)
+    imminenti = query_non_pagate_in_scadenza(db, inizio=oggi, fine=limite + timedelta(days=1)).all()
+
+    return scadute, imminenti
 
 def check_scadenze_imminenti(giorni_avviso=7):
     """
@@ -10,22 +21,12 @@ def check_scadenze_imminenti(giorni_avviso=7):
     - scadute: Fatture con data_scadenza < oggi e non pagate
     - imminenti: Fatture con data_scadenza entro X giorni e non pagate
     """
-    db = SessionLocal()
-    oggi = date.today()
-    limite = oggi + timedelta(days=giorni_avviso)
-
-    scadute = db.query(Fattura).filter(
-        Fattura.pagata == False,
-        Fattura.data_scadenza != None,
-        Fattura.data_scadenza < oggi
-    ).all()
-
-    imminenti = db.query(Fattura).filter(
-        Fattura.pagata == False,
-        Fattura.data_scadenza != None,
-        Fattura.data_scadenza >= oggi,
-        Fattura.data_scadenza <= limite
-    ).all()
+    with sessione_lettura() as db:
+        return _scadenze(db, giorni_avviso)
 
-    db.close()
-    return scadute, imminenti
+async def check_scadenze_imminenti_async(repository, giorni_avviso=7):
+    """
+    Come check_scadenze_imminenti, con il RepositoryFatture asincrono
+    (database/repository_async.py): non blocca il loop della UI.
+    """
+    return await repository.esegui(_scadenze, giorni_avviso)
@@ -0,0 +1,355 @@
+# services/p7m_service.py
+
+"""
+Decodifica in-process delle buste CAdES/PKCS#7 (.p7m) senza lanciare openssl.
+
+Legge la struttura ASN.1 del CMS SignedData (RFC 5652) e ne estrae il
+contenuto firmato (l'XML della fattura). Accetta:
+  - DER e BER (lunghezze indefinite, OCTET STRING spezzati in blocchi)
+  - PEM ("-----BEGIN PKCS7-----" / "-----BEGIN CMS-----") e base64 senza intestazioni
+
+La firma NON viene verificata: come con `openssl smime -verify -noverify`
+ci interessa solo il contenuto. In più, estrai_firmatari() legge dai
+SignerInfo e dai certificati allegati chi ha firmato e quando.
+"""
+
+import base64
+import binascii
+from datetime import datetime, timezone
+
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_SIGNING_TIME = "1.2.840.113549.1.9.5"
+
+# Attributi del DN che interessano (X.520)
+ATTRIBUTI_DN = {
+    "2.5.4.3": "common_name",
+    "2.5.4.4": "cognome",
+    "2.5.4.42": "nome",
+    "2.5.4.5": "numero_serie_soggetto",  # per le firme qualificate: "TINIT-<codice fiscale>"
+    "2.5.4.6": "paese",
+    "2.5.4.10": "organizzazione",
+    "2.5.4.97": "identificativo_organizzazione",  # "VATIT-<partita iva>"
+}
+
+# Tag universali ASN.1
+_OID = 0x06
+_SEQUENCE = 0x10
+_SET = 0x11
+_UTC_TIME = 0x17
+
+_CODIFICHE_STRINGHE = {
+    0x0C: "utf-8",      # UTF8String
+    0x13: "ascii",      # PrintableString
+    0x16: "ascii",      # IA5String
+    0x14: "latin-1",    # T61String
+    0x1E: "utf-16-be",  # BMPString
+    0x1C: "utf-32-be",  # UniversalString
+}
+
+
+class ErroreP7M(ValueError):
+    """
+    Il file non è una busta PKCS#7 SignedData leggibile.
+    """
+
+
+class _Nodo:
+    """
+    Un elemento TLV: classe e numero del tag, flag costruito e contenuto.
+    Per i tipi costruiti `figli` contiene i nodi interni già decodificati
+    (per i primitivi è una lista vuota).
+    """
+    __slots__ = ("classe", "numero", "costruito", "contenuto", "figli", "grezzo")
+
+    def __init__(self, classe, numero, costruito, contenuto, figli, grezzo):
+        self.classe = classe
+        self.numero = numero
+        self.costruito = costruito
+        self.contenuto = contenuto
+        self.figli = figli
+        self.grezzo = grezzo
+
+    def universale(self, numero):
+        return self.classe == 0 and self.numero == numero
+
+    def contestuale(self, numero):
+        return self.classe == 2 and self.numero == numero
+
+
+def _leggi_nodo(buf, pos, fine):
+    """
+    Decodifica il TLV che inizia in `pos`. Ritorna (nodo, posizione successiva).
+    """
+    if pos + 2 > fine:
+        raise ErroreP7M("struttura ASN.1 troncata")
+
+    inizio = pos
+    primo = buf[pos]
+    pos += 1
+    classe = primo >> 6
+    costruito = bool(primo & 0x20)
+    numero = primo & 0x1F
+    if numero == 0x1F:
+        # Tag in forma lunga
+        numero = 0
+        while True:
+            if pos >= fine:
+                raise ErroreP7M("tag ASN.1 troncato")
+            b = buf[pos]
+            pos += 1
+            numero = (numero << 7) | (b & 0x7F)
+            if not b & 0x80:
+                break
+
+    if pos >= fine:
+        raise ErroreP7M("lunghezza ASN.1 mancante")
+    lunghezza = buf[pos]
+    pos += 1
+
+    if lunghezza == 0x80:
+        # Lunghezza indefinita (BER): i figli terminano con 00 00
+        if not costruito:
+            raise ErroreP7M("lunghezza indefinita su un tipo primitivo")
+        figli = []
+        while True:
+            if pos + 2 > fine:
+                raise ErroreP7M("fine del contenuto (EOC) mancante")
+            if buf[pos] == 0 and buf[pos + 1] == 0:
+                pos += 2
+                break
+            figlio, pos = _leggi_nodo(buf, pos, fine)
+            figli.append(figlio)
+        return _Nodo(classe, numero, True, None, figli, buf[inizio:pos]), pos
+
+    if lunghezza & 0x80:
+        n_byte = lunghezza & 0x7F
+        if n_byte == 0 or pos + n_byte > fine:
+            raise ErroreP7M("lunghezza ASN.1 non valida")
+        lunghezza = int.from_bytes(buf[pos:pos + n_byte], "big")
+        pos += n_byte
+
+    fine_nodo = pos + lunghezza
+    if fine_nodo > fine:
+        raise ErroreP7M("contenuto ASN.1 oltre la fine del file")
+
+    figli = []
+    if costruito:
+        p = pos
+        while p < fine_nodo:
+            figlio, p = _leggi_nodo(buf, p, fine_nodo)
+            figli.append(figlio)
+
+    return _Nodo(classe, numero, costruito, buf[pos:fine_nodo], figli, buf[inizio:fine_nodo]), fine_nodo
+
+
+def _ottetti(nodo):
+    """
+    Contenuto di un OCTET STRING, primitivo o spezzato in blocchi (BER).
+    """
+    if not nodo.costruito:
+        return bytes(nodo.contenuto)
+    return b"".join(_ottetti(figlio) for figlio in nodo.figli)
+
+
+def _oid(nodo):
+    if not nodo.universale(_OID):
+        raise ErroreP7M("atteso un OBJECT IDENTIFIER")
+    dati = nodo.contenuto
+    valori = []
+    corrente = 0
+    for b in dati:
+        corrente = (corrente << 7) | (b & 0x7F)
+        if not b & 0x80:
+            valori.append(corrente)
+            corrente = 0
+    if not valori:
+        raise ErroreP7M("OBJECT IDENTIFIER vuoto")
+    primo = valori[0]
+    if primo < 80:
+        testa = [primo // 40, primo % 40]
+    else:
+        testa = [2, primo - 80]
+    return ".".join(str(v) for v in testa + valori[1:])
+
+
+def _stringa(nodo):
+    codifica = _CODIFICHE_STRINGHE.get(nodo.numero) if nodo.classe == 0 else None
+    if codifica is None:
+        return bytes(nodo.contenuto).hex()
+    return bytes(nodo.contenuto).decode(codifica, errors="replace")
+
+
+def _tempo(nodo):
+    testo = bytes(nodo.contenuto).decode("ascii", errors="replace").rstrip("Z")
+    if nodo.universale(_UTC_TIME):
+        formati = {12: "%y%m%d%H%M%S", 10: "%y%m%d%H%M"}
+    else:
+        testo = testo.split(".")[0]
+        formati = {14: "%Y%m%d%H%M%S"}
+    # strptime accetta campi di una cifra: una data troncata verrebbe letta
+    # come un'altra data, invece di essere rifiutata
+    formato = formati.get(len(testo))
+    if formato is None or not testo.isdigit():
+        raise ErroreP7M(f"data non valida: {testo!r}")
+    try:
+        return datetime.strptime(testo, formato).replace(tzinfo=timezone.utc)
+    except ValueError as e:
+        raise ErroreP7M(f"data non valida: {e}") from e
+
+
+def _normalizza_ingresso(dati):
+    """
+    Ritorna i byte DER/BER della busta, decodificando PEM o base64 se serve.
+    """
+    if isinstance(dati, str):
+        dati = dati.encode("ascii", errors="ignore")
+    dati = bytes(dati)
+
+    inizio = dati.lstrip()
+    if inizio[:1] == b"\x30":
+        return inizio
+
+    # PEM: scartiamo le righe di intestazione "-----BEGIN/END ...-----"
+    righe = [r for r in inizio.splitlines() if not r.startswith(b"-----")]
+    try:
+        decodificati = base64.b64decode(b"".join(r.strip() for r in righe), validate=False)
+    except (binascii.Error, ValueError) as e:
+        raise ErroreP7M(f"né DER né base64 valido: {e}")
+    if decodificati[:1] != b"\x30":
+        raise ErroreP7M("il contenuto decodificato non è una struttura ASN.1")
+    return decodificati
+
+
+def _signed_data(dati):
+    """
+    Ritorna i figli della SEQUENCE SignedData.
+    """
+    buf = memoryview(_normalizza_ingresso(dati))
+    content_info, _ = _leggi_nodo(buf, 0, len(buf))
+    if not content_info.costruito or len(content_info.figli) < 2:
+        raise ErroreP7M("ContentInfo non valido")
+    if _oid(content_info.figli[0]) != OID_SIGNED_DATA:
+        raise ErroreP7M("la busta non è di tipo SignedData")
+
+    esplicito = content_info.figli[1]
+    if not esplicito.contestuale(0) or not esplicito.figli:
+        raise ErroreP7M("contenuto SignedData mancante")
+    signed_data = esplicito.figli[0]
+    if not signed_data.costruito or len(signed_data.figli) < 3:
+        raise ErroreP7M("SignedData non valido")
+    return signed_data.figli
+
+
+def estrai_contenuto_p7m(dati):
+    """
+    Estrae (in byte) il contenuto firmato di una busta .p7m.
+    Solleva ErroreP7M se la struttura non è leggibile o la firma è "detached".
+    """
+    figli = _signed_data(dati)
+    encap = figli[2]  # version, digestAlgorithms, encapContentInfo, ...
+    if not encap.costruito or not encap.figli:
+        raise ErroreP7M("encapContentInfo non valido")
+    if len(encap.figli) < 2:
+        raise ErroreP7M("firma detached: la busta non contiene il documento")
+
+    econtent = encap.figli[1]
+    if not econtent.contestuale(0) or not econtent.figli:
+        raise ErroreP7M("eContent non valido")
+    contenuto = _ottetti(econtent.figli[0])
+
+    # Firme multiple "a matrioska": il contenuto è a sua volta una busta .p7m
+    if contenuto[:1] == b"\x30":
+        try:
+            return estrai_contenuto_p7m(contenuto)
+        except ErroreP7M:
+            pass
+    return contenuto
+
+
+def _nome_distinto(nodo):
+    """
+    Converte un Name X.501 in un dict con gli attributi di ATTRIBUTI_DN.
+    """
+    risultato = {}
+    for rdn in nodo.figli or ():
+        for attributo in rdn.figli or ():
+            if len(attributo.figli) < 2:
+                continue
+            chiave = ATTRIBUTI_DN.get(_oid(attributo.figli[0]))
+            if chiave and chiave not in risultato:
+                risultato[chiave] = _stringa(attributo.figli[1])
+    return risultato
+
+
+def _certificati(figli_signed_data):
+    """
+    Indicizza i certificati della busta per (emittente DER, numero di serie).
+    """
+    indice = {}
+    for nodo in figli_signed_data[3:]:
+        if not nodo.contestuale(0):
+            continue
+        for cert in nodo.figli:
+            if not cert.figli:
+                continue
+            tbs = cert.figli[0].figli
+            # Il campo version [0] è opzionale
+            if tbs and tbs[0].contestuale(0):
+                tbs = tbs[1:]
+            if len(tbs) < 5:
+                continue
+            serie, emittente, soggetto = tbs[0], tbs[2], tbs[4]
+            indice[(bytes(emittente.grezzo), bytes(serie.contenuto))] = (
+                _nome_distinto(emittente),
+                _nome_distinto(soggetto),
+            )
+    return indice
+
+
+def estrai_firmatari(dati):
+    """
+    Ritorna una lista di dict, uno per SignerInfo, con:
+      numero_serie_certificato, emittente (dict), soggetto (dict), data_firma
+    I campi non presenti nella busta valgono None.
+    """
+    figli = _signed_data(dati)
+    certificati = _certificati(figli)
+
+    signer_infos = figli[-1]
+    if not signer_infos.universale(_SET):
+        raise ErroreP7M("signerInfos mancante")
+
+    firmatari = []
+    for si in signer_infos.figli:
+        campi = si.figli
+        if not campi or len(campi) < 2:
+            continue
+        firmatario = {
+            "numero_serie_certificato": None,
+            "emittente": None,
+            "soggetto": None,
+            "data_firma": None,
+        }
+
+        sid = campi[1]
+        if sid.universale(_SEQUENCE) and len(sid.figli) == 2:
+            emittente, serie = sid.figli
+            firmatario["numero_serie_certificato"] = format(int.from_bytes(serie.contenuto, "big"), "X")
+            firmatario["emittente"] = _nome_distinto(emittente)
+            trovato = certificati.get((bytes(emittente.grezzo), bytes(serie.contenuto)))
+            if trovato:
+                firmatario["soggetto"] = trovato[1]
+
+        for campo in campi[2:]:
+            if not campo.contestuale(0):
+                continue
+            # signedAttrs: SET OF Attribute { type, SET OF values }
+            for attributo in campo.figli:
+                if len(attributo.figli) == 2 and _oid(attributo.figli[0]) == OID_SIGNING_TIME:
+                    valori = attributo.figli[1].figli
+                    if valori:
+                        firmatario["data_firma"] = _tempo(valori[0])
+
+        firmatari.append(firmatario)
+
+    return firmatari
@@ -1,18 +1,49 @@
 import os
+import re
+import bisect
+import codecs
 import hashlib
+import itertools
 import subprocess
 import tempfile
 import logging
-from datetime import datetime
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
 
-from database.db_session import SessionLocal
+from database.db_session import SessionLocal, SessionImport, sessione_lettura
 from database.models import (
     Fattura,
     RigheFattura,
     DatiRiepilogoIVA,
     DatiPagamento,
     AllegatoFattura,
+    DocumentoXML,
+    comprimi_xml,
+)
+from services.allegati_store import (
+    parcheggia_allegato, pulisci_in_arrivo, salva_al_commit, scarta_allegati, togli_allegati,
+)
+from services.p7m_service import estrai_contenuto_p7m, ErroreP7M
+from services.parser_stream import iter_dati_stream
+from services.validazione_xsd import (
+    VALIDAZIONE_OFF,
+    VALIDAZIONE_STRICT,
+    ErroreValidazione,
+    modalita_validazione,
+    schema_fatturapa,
+    valida_fattura,
+)
+from services.tracciato_fatturapa import (
+    CAMPI_CORPO,
+    CAMPI_TESTATA,
+    SEZIONI_CORPO,
+    namespace_documento,
+    valori_campi,
+    xpath_per_namespace,
 )
 
 # Configurazione logger
@@ -23,16 +54,73 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
+# Parser condivisi: huge_tree perché gli allegati in base64 superano facilmente
+# il limite di 10 MB per nodo di testo di libxml2
+_PARSER_XML = etree.XMLParser(huge_tree=True)
+# Per XML già decodificato in stringa: i byte passati a lxml sono sempre UTF-8,
+# qualunque encoding dichiari il prologo
+_PARSER_XML_UTF8 = etree.XMLParser(huge_tree=True, encoding="utf-8")
+
+# Apertura e chiusura dei body, per ritagliare ogni fattura di un lotto
+_INIZIO_CORPO = re.compile(rb"<(?:[\w.-]+:)?FatturaElettronicaBody[\s>]")
+_FINE_CORPO = re.compile(rb"</(?:[\w.-]+:)?FatturaElettronicaBody\s*>")
+# Commenti e CDATA, dove un tag di body non è un elemento
+_NON_MARKUP = re.compile(rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>", re.S)
+
+_DICHIARAZIONE_ENCODING = re.compile(rb"""^<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+
 def calcola_hash_xml(xml_content):
     """
     Calcola l'hash SHA-256 di un file XML (o XML in memoria).
+    L'hash si calcola sui byte così come sono arrivati; le stringhe
+    vengono codificate in UTF-8.
     """
-    return hashlib.sha256(xml_content.encode("utf-8")).hexdigest()
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode("utf-8")
+    return hashlib.sha256(xml_content).hexdigest()
 
-def decode_p7m_to_xml(p7m_content):
+def calcola_hash_legacy(xml_content):
+    """
+    L'hash con cui le versioni precedenti registravano il file: SHA-256 del
+    testo ricodificato in UTF-8, dopo averlo letto come UTF-8 o, se non
+    valido, come Latin-1. Diverso da calcola_hash_xml() solo per i byte che
+    non sono UTF-8 valido: per tutti gli altri ritorna None.
+    La deduplica controlla anche questo hash, così i file importati prima
+    non vengono importati una seconda volta.
+    """
+    if isinstance(xml_content, str):
+        return None
+    try:
+        xml_content.decode("utf-8")
+    except UnicodeDecodeError:
+        return hashlib.sha256(xml_content.decode("latin-1").encode("utf-8")).hexdigest()
+    return None
+
+def testo_xml(xml_content):
     """
-    Decodifica un file .p7m contenuto in memoria usando OpenSSL.
-    Ritorna l'XML decodificato come stringa.
+    Decodifica i byte di un XML rispettando BOM ed encoding dichiarato nel
+    prologo (default UTF-8). Da usare solo dove serve davvero il testo,
+    ad esempio per la colonna xml_raw.
+    """
+    if isinstance(xml_content, str):
+        return xml_content
+    if xml_content.startswith(codecs.BOM_UTF8):
+        return xml_content[len(codecs.BOM_UTF8):].decode("utf-8", errors="replace")
+    if xml_content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return xml_content.decode("utf-16", errors="replace")
+
+    match = _DICHIARAZIONE_ENCODING.match(xml_content.lstrip())
+    encoding = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        return xml_content.decode(encoding, errors="replace")
+    except LookupError:
+        logger.warning(f"Encoding dichiarato sconosciuto ({encoding}), uso UTF-8")
+        return xml_content.decode("utf-8", errors="replace")
+
+def decode_p7m_openssl(p7m_content):
+    """
+    Decodifica un file .p7m contenuto in memoria usando il comando OpenSSL.
+    Ritorna il contenuto firmato in byte, o None in caso di errore.
     """
     try:
         result = subprocess.run(
@@ -41,136 +129,634 @@ def decode_p7m_to_xml(p7m_content):
             capture_output=True,
             check=True
         )
-        return result.stdout.decode("utf-8")  # Ritorna XML come stringa
+        return result.stdout
     except subprocess.CalledProcessError as e:
         logger.error(f"Errore nella decodifica del p7m: {e.stderr}")
         return None
+    except FileNotFoundError:
+        logger.error("Comando openssl non disponibile per la decodifica del p7m")
+        return None
 
-def leggi_file_con_fallback(xml_path):
+def decode_p7m_to_xml(p7m_content):
     """
-    Prova a leggere il file con diversi encoding.
+    Decodifica un file .p7m contenuto in memoria (DER, BER o PEM/base64).
+    Usa il decoder in-process di services.p7m_service; solo se la busta non
+    è leggibile ripiega su OpenSSL.
+    Ritorna i byte dell'XML firmato (senza decodificarli), o None.
     """
-    encodings = ["utf-8", "latin-1", "windows-1252"]
+    try:
+        return estrai_contenuto_p7m(p7m_content)
+    except ErroreP7M as e:
+        logger.warning(f"Decoder p7m interno fallito ({e}), provo con OpenSSL")
+        return decode_p7m_openssl(p7m_content)
 
-    with open(xml_path, "rb") as f:
-        raw_bytes = f.read()
+ENGINE_XPATH = "xpath"
+ENGINE_STREAM = "stream"
 
-    for enc in encodings:
-        try:
-            return raw_bytes.decode(enc), enc
-        except UnicodeDecodeError:
-            continue
+def _estrai_dati_xpath(tree):
+    """
+    Estrae i dati con le espressioni XPath precompilate del registro
+    (services.tracciato_fatturapa), scelte in base al namespace del documento.
+    Generatore: un dizionario per ogni FatturaElettronicaBody,
+      {"fattura": {...}, "righe": [...], "riepiloghi_iva": [...], "pagamenti": [...], "allegati": [...]}
+    con i campi della testata letti una volta sola e ripetuti in ogni fattura.
+    """
+    compilati = xpath_per_namespace(namespace_documento(tree))
+
+    xp_testata = compilati["testata"]
+    testata = valori_campi(CAMPI_TESTATA, lambda path: xp_testata[path](tree))
+
+    corpi = compilati["corpi"](tree)
+    if not corpi:
+        # Documento senza body: restituiamo comunque la testata
+        dati = {"fattura": testata}
+        for chiave, _, _ in SEZIONI_CORPO:
+            dati[chiave] = []
+        yield dati
+        return
+
+    xp_corpo = compilati["corpo"]
+    for corpo in corpi:
+        dati = {"fattura": dict(testata)}
+        dati["fattura"].update(valori_campi(CAMPI_CORPO, lambda path: xp_corpo[path](corpo)))
 
-    logger.error(f"❌ Errore lettura file {xml_path}: impossibile decodificare con {encodings}")
-    return None, None
+        for chiave, _, campi in SEZIONI_CORPO:
+            xp_nodi, xp_campi = compilati["sezioni"][chiave]
+            dati[chiave] = [
+                valori_campi(campi, lambda path: xp_campi[path](nodo))
+                for nodo in xp_nodi(corpo)
+            ]
 
-def parse_fattura_xml(xml_source, is_memory=False):
+        yield dati
+
+def _segmenti_corpi(xml_bytes):
     """
-    Parser completo del tracciato FatturaPA con gestione degli encoding.
+    Posizioni (inizio, fine) in byte di ogni FatturaElettronicaBody del documento,
+    esclusi i tag dentro commenti e CDATA. Lista vuota se apertura e chiusura
+    non tornano.
     """
-    if not is_memory:
-        ext = os.path.splitext(xml_source)[1].lower()
-        
-        if ext == ".p7m":
-            with open(xml_source, "rb") as f:
-                xml_content = decode_p7m_to_xml(f.read())
-            if not xml_content:
-                logger.error(f"Impossibile decodificare il p7m: {xml_source}")
-                return None
-        else:
-            xml_content, encoding_usato = leggi_file_con_fallback(xml_source)
-            if not xml_content:
-                logger.error(f"Errore lettura file {xml_source}")
-                return None
+    esclusi = [m.span() for m in _NON_MARKUP.finditer(xml_bytes)]
+    inizi_esclusi = [inizio for inizio, _ in esclusi]
+
+    def fuori(posizione):
+        i = bisect.bisect_right(inizi_esclusi, posizione) - 1
+        return i < 0 or posizione >= esclusi[i][1]
+
+    inizi = [m.start() for m in _INIZIO_CORPO.finditer(xml_bytes) if fuori(m.start())]
+    fini = [m.end() for m in _FINE_CORPO.finditer(xml_bytes) if fuori(m.start())]
+    if len(inizi) != len(fini):
+        return []
+    return list(zip(inizi, fini))
+
+def _valida(xml_bytes, encoding, tree, validazione):
+    """
+    Errori di validazione XSD del documento (lista vuota se valido o se la
+    validazione è spenta). Con il motore stream l'albero completo non c'è
+    e il documento viene parsato una volta in più solo per validarlo.
+    In modalità "strict" un documento non valido solleva ErroreValidazione.
+    """
+    if validazione == VALIDAZIONE_OFF:
+        return []
+    if tree is None:
+        parser = _PARSER_XML_UTF8 if encoding else _PARSER_XML
+        tree = etree.fromstring(xml_bytes, parser=parser)
+    errori = valida_fattura(tree)
+    if errori and validazione == VALIDAZIONE_STRICT:
+        raise ErroreValidazione(errori)
+    return errori
+
+def _separa_allegati(allegati):
+    """
+    Toglie dai dati degli allegati i byte decodificati di <Attachment>, uno alla
+    volta, li scrive tra gli allegati in arrivo (vedi services.allegati_store)
+    e li sostituisce con lo SHA-256. Ritorna {sha256: path del file in arrivo},
+    da spostare nell'archivio al commit della fattura.
+    """
+    in_arrivo = {}
+    for al in allegati:
+        contenuto = al.pop("contenuto", None)
+        if contenuto is not None:
+            al["sha256"] = hashlib.sha256(contenuto).hexdigest()
+            # Lo stesso allegato ripetuto nel documento: basta un file
+            if al["sha256"] not in in_arrivo:
+                in_arrivo[al["sha256"]] = parcheggia_allegato(contenuto, al["sha256"])[1]
+    return in_arrivo
+
+def scarta_allegati_record(record):
+    """
+    Cancella i file in arrivo degli allegati di un record che non verrà salvato.
+    """
+    scarta_allegati(record.get("allegati_in_arrivo", {}).values())
+
+def iter_record_fattura(xml_content, engine=ENGINE_XPATH, validazione=None):
+    """
+    Generatore: estrae da un XML in memoria un record "piatto" (solo dict,
+    liste e tipi base, serializzabile con pickle) per ogni FatturaElettronicaBody:
+      {"hash_xml", "hash_legacy", "xml_raw", "corpo", "errori_validazione", "allegati_in_arrivo",
+       "fattura": {...}, "righe": [...], "riepiloghi_iva": [...], "pagamenti": [...], "allegati": [...]}
+    `xml_content` sono preferibilmente i byte originali: lxml rispetta
+    l'encoding dichiarato e "xml_raw" resta in byte fino a fattura_da_record().
+    Gli allegati non entrano nell'archivio qui: decodificati, finiscono in file
+    temporanei e "allegati_in_arrivo" ne ha i path {sha256: path}, spostati
+    nell'archivio solo al commit (vedi salva_blocco_fatture) o da cancellare
+    con scarta_allegati_record() se il record non viene salvato. Nel record,
+    anche passato tra processi, non viaggiano byte degli allegati; in "xml_raw"
+    il base64 di ogni <Attachment> è sostituito dal riferimento "sha256:<hash>"
+    (vedi services.allegati_store).
+    `validazione` ("off" / "warn" / "strict", None = VALIDAZIONE_XSD) attiva il
+    controllo contro lo schema FatturaPA (vedi services.validazione_xsd): gli
+    errori finiscono in "errori_validazione" di ogni record.
+
+    Per i lotti (più body nello stesso file):
+      - "corpo" è il numero del body (da 1)
+      - "xml_raw" è un documento a sé: prologo e testata originali + quel solo body
+      - "hash_xml" del primo body è l'hash del file (così lo scarto pre-parsing
+        per hash continua a funzionare), quello dei successivi è l'hash di
+        "<hash del file>#<numero body>"
+      - "hash_legacy" (vedi calcola_hash_legacy) vale solo per il primo body
+    Solleva etree.XMLSyntaxError se l'XML è corrotto, ErroreValidazione
+    se il documento non è valido in modalità "strict".
+    """
+    if engine not in (ENGINE_XPATH, ENGINE_STREAM):
+        raise ValueError(f"Motore di parsing sconosciuto: {engine}")
+    validazione = modalita_validazione(validazione)
+
+    if isinstance(xml_content, str):
+        xml_bytes, encoding = xml_content.encode("utf-8"), "utf-8"
     else:
-        xml_content = xml_source
+        xml_bytes, encoding = xml_content, None
+
+    if engine == ENGINE_STREAM:
+        errori_validazione = _valida(xml_bytes, encoding, None, validazione)
+        corpi = iter_dati_stream(xml_bytes, encoding=encoding)
+    else:
+        parser = _PARSER_XML_UTF8 if encoding else _PARSER_XML
+        tree = etree.fromstring(xml_bytes, parser=parser)
+        errori_validazione = _valida(xml_bytes, encoding, tree, validazione)
+        corpi = _estrai_dati_xpath(tree)
+
+    hash_file = calcola_hash_xml(xml_content)
+    hash_legacy = calcola_hash_legacy(xml_content)
+    # Lotto o no lo dicono i body letti da lxml: ne bastano due, gli altri
+    # restano da leggere (in memoria un body alla volta). Le posizioni in byte
+    # servono solo a ritagliare "xml_raw"; se non bastano per tutti i body,
+    # da lì in poi xml_raw è il file intero
+    primi = list(itertools.islice(corpi, 2))
+    lotto = len(primi) > 1
+    segmenti = _segmenti_corpi(xml_bytes) if lotto else []
+
+    for n, dati in enumerate(itertools.chain(primi, corpi), 1):
+        xml_raw = xml_content
+        hash_val = hash_file
+        if lotto:
+            if n > 1:
+                hash_val = calcola_hash_xml(f"{hash_file}#{n}")
+            if n == len(segmenti) + 1:
+                logger.warning(f"⚠️ Body {n} del lotto non ritagliabile: salvo il file intero")
+            if n <= len(segmenti):
+                inizio, fine = segmenti[n - 1]
+                xml_raw = xml_bytes[:segmenti[0][0]] + xml_bytes[inizio:fine] + xml_bytes[segmenti[-1][1]:]
+                if encoding:
+                    xml_raw = xml_raw.decode(encoding)
+
+        in_arrivo = _separa_allegati(dati["allegati"])
+        if in_arrivo:
+            xml_raw, altri = togli_allegati(xml_raw, [al["sha256"] for al in dati["allegati"] if "sha256" in al])
+            for sha256, contenuto in altri.items():
+                if sha256 not in in_arrivo:
+                    in_arrivo[sha256] = parcheggia_allegato(contenuto, sha256)[1]
+
+        record = {"hash_xml": hash_val, "hash_legacy": hash_legacy if n == 1 else None, "xml_raw": xml_raw,
+                  "corpo": n, "errori_validazione": errori_validazione, "allegati_in_arrivo": in_arrivo}
+        record.update(dati)
+        yield record
+
+def estrai_record_fattura(xml_content, engine=ENGINE_XPATH, validazione=None):
+    """
+    Come iter_record_fattura(), ma per chi si aspetta una sola fattura:
+    ritorna il record del primo body (i lotti vengono segnalati nel log).
+    Solleva etree.XMLSyntaxError se l'XML è corrotto.
+    """
+    records = list(iter_record_fattura(xml_content, engine, validazione))
+    if len(records) > 1:
+        logger.warning(f"Lotto di {len(records)} fatture: considero solo la prima (usa iter_fatture_xml)")
+        for record in records[1:]:
+            scarta_allegati_record(record)
+    return records[0]
+
+def documento_da_record(record):
+    """
+    Valori della riga DocumentoXML (XML compresso) del record: già pronti se
+    il record viene da parse_fatture_batch, altrimenti calcolati da "xml_raw".
+    """
+    documento = record.get("documento")
+    if documento is None:
+        documento = comprimi_xml(testo_xml(record["xml_raw"]))
+    return documento
+
+def fattura_da_record(record):
+    """
+    Crea gli oggetti ORM (Fattura, RigheFattura, DatiRiepilogoIVA, DatiPagamento,
+    AllegatoFattura, DocumentoXML) a partire da un record prodotto da iter_record_fattura().
+    """
+    fattura_obj = Fattura(**record["fattura"])
+    fattura_obj.hash_xml = record["hash_xml"]
+    fattura_obj.hash_legacy = record.get("hash_legacy")
+    fattura_obj.documento = DocumentoXML(**documento_da_record(record))
+
+    fattura_obj.righe = [RigheFattura(**r) for r in record["righe"]]
+    for dr in record["riepiloghi_iva"]:
+        fattura_obj.riepiloghi_iva.append(DatiRiepilogoIVA(**dr))
+    for dp in record["pagamenti"]:
+        fattura_obj.pagamenti.append(DatiPagamento(**dp))
+    in_arrivo = record.get("allegati_in_arrivo", {})
+    for al in record["allegati"]:
+        allegato = AllegatoFattura(**al)
+        allegato.in_arrivo = in_arrivo.get(al.get("sha256"))
+        fattura_obj.allegati.append(allegato)
+
+    return fattura_obj
+
+def _leggi_sorgente(xml_source, is_memory):
+    """
+    Ritorna i byte dell'XML (decodificando i .p7m), o None in caso di errore.
+    Con is_memory=True `xml_source` è già il contenuto e viene restituito così com'è.
+    """
+    if is_memory:
+        return xml_source
+
+    ext = os.path.splitext(xml_source)[1].lower()
+
+    try:
+        with open(xml_source, "rb") as f:
+            xml_content = f.read()
+    except OSError as e:
+        logger.error(f"Errore lettura file {xml_source}: {e}")
+        return None
+
+    if ext == ".p7m":
+        xml_content = decode_p7m_to_xml(xml_content)
+        if not xml_content:
+            logger.error(f"Impossibile decodificare il p7m: {xml_source}")
+            return None
+
+    return xml_content
+
+def _segnala_errori_validazione(xml_source, record):
+    if record["errori_validazione"] and record["corpo"] == 1:
+        logger.warning(
+            f"Fattura non conforme allo schema ({xml_source}): " + "; ".join(record["errori_validazione"])
+        )
+
+def parse_fattura_xml(xml_source, is_memory=False, engine=ENGINE_XPATH, validazione=None):
+    """
+    Parser completo del tracciato FatturaPA: ritorna una Fattura (per i lotti
+    la prima, vedi iter_fatture_xml).
+    `xml_source` è un path (.xml o .p7m) oppure, con is_memory=True, l'XML in
+    memoria: meglio in byte, così l'encoding dichiarato nel prologo viene rispettato.
+    `engine` sceglie il motore di estrazione:
+      - ENGINE_XPATH ("xpath"): XPath precompilate sull'albero completo (default)
+      - ENGINE_STREAM ("stream"): una sola passata event-driven (iterparse),
+        conviene sulle fatture con migliaia di righe
+    `validazione`: "off" / "warn" / "strict" (vedi services.validazione_xsd);
+    in "strict" una fattura non valida viene scartata (ritorna None).
+    """
+    if engine not in (ENGINE_XPATH, ENGINE_STREAM):
+        raise ValueError(f"Motore di parsing sconosciuto: {engine}")
+
+    xml_content = _leggi_sorgente(xml_source, is_memory)
+    if xml_content is None:
+        return None
 
-    hash_val = calcola_hash_xml(xml_content)
-    
     try:
-        tree = etree.fromstring(xml_content.encode("utf-8"))
+        record = estrai_record_fattura(xml_content, engine, validazione)
     except etree.XMLSyntaxError as e:
         logger.error(f"XML corrotto ({xml_source}): {e}")
         return None
+    except ErroreValidazione as e:
+        logger.error(f"Fattura scartata ({xml_source}): {e}")
+        return None
 
-    fattura_obj = Fattura()
-    fattura_obj.hash_xml = hash_val
-    fattura_obj.xml_raw = xml_content  
-    
-    numero = tree.xpath("//*[local-name()='Numero']/text()")
-    if numero:
-        fattura_obj.numero = numero[0]
+    _segnala_errori_validazione(xml_source, record)
+    return fattura_da_record(record)
 
-    data = tree.xpath("//*[local-name()='Data']/text()")
-    if data:
-        fattura_obj.data = datetime.strptime(data[0], "%Y-%m-%d").date()
-    
-    fornitore = tree.xpath("//*[local-name()='CedentePrestatore']/*[local-name()='DatiAnagrafici']/*[local-name()='Anagrafica']/*[local-name()='Denominazione']/text()")
-    if fornitore:
-        fattura_obj.fornitore = fornitore[0]
-    
-    totale = tree.xpath("//*[local-name()='ImportoTotaleDocumento']/text()")
-    if totale:
-        fattura_obj.totale = float(totale[0])
-    
-    linee_nodes = tree.xpath("//*[local-name()='DettaglioLinee']")
-    righe_list = []
+def iter_fatture_xml(xml_source, is_memory=False, engine=ENGINE_STREAM, validazione=None):
+    """
+    Generatore: come parse_fattura_xml(), ma produce una Fattura per ogni
+    FatturaElettronicaBody del file (lotti di fatture). La testata viene letta
+    una volta sola e, con il motore stream (default), in memoria resta un
+    body alla volta (due all'inizio, per riconoscere il lotto).
+    """
+    xml_content = _leggi_sorgente(xml_source, is_memory)
+    if xml_content is None:
+        return
 
-    for ln in linee_nodes:
-        r = RigheFattura()
+    try:
+        for record in iter_record_fattura(xml_content, engine, validazione):
+            _segnala_errori_validazione(xml_source, record)
+            yield fattura_da_record(record)
+    except etree.XMLSyntaxError as e:
+        logger.error(f"XML corrotto ({xml_source}): {e}")
+    except ErroreValidazione as e:
+        logger.error(f"Fattura scartata ({xml_source}): {e}")
 
-        descr = ln.xpath("./*[local-name()='Descrizione']/text()")
-        r.descrizione = descr[0] if descr else "N/D"
+def _a_blocchi(iterabile, dimensione):
+    blocco = []
+    for elemento in iterabile:
+        blocco.append(elemento)
+        if len(blocco) >= dimensione:
+            yield blocco
+            blocco = []
+    if blocco:
+        yield blocco
 
-        qty = ln.xpath("./*[local-name()='Quantita']/text()")
-        r.quantita = float(qty[0]) if qty else 1.0
+def _inizializza_worker(validazione):
+    """
+    Eseguita una volta all'avvio di ogni processo worker: compila subito lo
+    schema XSD, così nessun blocco ne paga il costo.
+    """
+    if validazione != VALIDAZIONE_OFF:
+        schema_fatturapa()
+
+def _parse_blocco(blocco, engine, validazione=VALIDAZIONE_OFF):
+    """
+    Eseguita nei processi worker: parsa un blocco di (nome, xml) e ritorna,
+    nello stesso ordine, gli esiti {"nome", "record", "errore"}: uno per
+    fattura (i lotti ne producono uno per body, con nome "file.xml#2", ...)
+    oppure uno per file in caso di errore.
+    L'XML viene compresso qui, nel worker: al processo principale arriva
+    "documento" (vedi documento_da_record) al posto di "xml_raw".
+    """
+    esiti = []
+    for nome, xml_content in blocco:
+        try:
+            records = list(iter_record_fattura(xml_content, engine, validazione))
+        except Exception as e:
+            esiti.append({"nome": nome, "record": None, "errore": f"{type(e).__name__}: {e}"})
+            continue
+        for record in records:
+            record["documento"] = comprimi_xml(testo_xml(record.pop("xml_raw")))
+            nome_fattura = nome if record["corpo"] == 1 else f"{nome}#{record['corpo']}"
+            esiti.append({"nome": nome_fattura, "record": record, "errore": None})
+    return esiti
 
-        pu = ln.xpath("./*[local-name()='PrezzoUnitario']/text()")
-        r.prezzo_unitario = float(pu[0]) if pu else 0.0
+def parse_fatture_batch(documenti, workers=None, engine=ENGINE_XPATH, chunk_size=50, validazione=None):
+    """
+    Parsa in parallelo (process pool) un iterabile di coppie (nome, xml).
+    È un generatore: produce liste di esiti {"nome", "record", "errore"}
+    per blocchi di `chunk_size` file, nello stesso ordine dell'input, man mano
+    che i blocchi sono pronti (i lotti producono un esito per ogni body). I record sono dict semplici (vedi estrai_record_fattura),
+    da convertire con fattura_da_record() nel processo che scrive sul DB,
+    con l'XML già compresso in "documento" invece di "xml_raw".
 
-        pt = ln.xpath("./*[local-name()='PrezzoTotale']/text()")
-        if pt:
-            r.importo_riga = float(pt[0])
+    - workers: numero di processi (default: os.cpu_count()); con 1 lavora nel
+      processo corrente, senza pool. I processi sono avviati con "spawn"
+      (ognuno importa i moduli da capo): gli script che lo usano devono
+      avere la guardia if __name__ == "__main__"
+    - al più 2 * workers blocchi sono in lavorazione contemporaneamente, così
+      l'input viene consumato gradualmente e la memoria resta limitata
+    - validazione: "off" / "warn" / "strict" (None = VALIDAZIONE_XSD); in "warn"
+      gli errori sono in esito["record"]["errori_validazione"], in "strict" i
+      file non validi diventano esiti con "errore"
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    validazione = modalita_validazione(validazione)
+    pulisci_in_arrivo()
 
-        righe_list.append(r)
+    blocchi = _a_blocchi(documenti, chunk_size)
 
-    fattura_obj.righe = righe_list
+    if workers <= 1:
+        for blocco in blocchi:
+            yield _parse_blocco(blocco, engine, validazione)
+        return
 
-    rieps = tree.xpath("//*[local-name()='DatiRiepilogo']")
-    for rr in rieps:
-        dr = DatiRiepilogoIVA()
+    # spawn, non fork: il pool nasce mentre altri thread sono attivi (download,
+    # scrittore DB) e un fork copierebbe i loro lock nello stato in cui sono
+    contesto = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=contesto,
+                             initializer=_inizializza_worker, initargs=(validazione,)) as pool:
+        in_lavorazione = deque()
+        for blocco in blocchi:
+            in_lavorazione.append(pool.submit(_parse_blocco, blocco, engine, validazione))
+            if len(in_lavorazione) >= 2 * workers:
+                yield in_lavorazione.popleft().result()
+        while in_lavorazione:
+            yield in_lavorazione.popleft().result()
 
-        aliq = rr.xpath("./*[local-name()='AliquotaIVA']/text()")
-        if aliq:
-            dr.aliquota_iva = float(aliq[0])
+def _rimuovi_documento_orfano(db, hash_xml):
+    """
+    Cancella il documento XML con questo hash rimasto senza fattura, che
+    farebbe fallire l'insert del documento da parte dell'ORM.
+    """
+    if hash_xml is not None:
+        db.query(DocumentoXML).filter(DocumentoXML.hash_xml == hash_xml).delete(synchronize_session=False)
 
-        imp = rr.xpath("./*[local-name()='ImponibileImporto']/text()")
-        if imp:
-            dr.imponibile_importo = float(imp[0])
+def salva_fattura(db, fattura_obj):
+    """
+    Lavoro di scrittura (vedi database/scrittore.py): aggiunge la fattura alla
+    sessione se il suo hash_xml non è già nel DB, senza commit.
+    Ritorna la fattura salvata oppure quella già presente.
+    """
+    existing = db.query(Fattura).filter_by(hash_xml=fattura_obj.hash_xml).first()
+    if existing is None and fattura_obj.hash_legacy is not None:
+        existing = db.query(Fattura).filter_by(hash_xml=fattura_obj.hash_legacy).first()
 
-        fattura_obj.riepiloghi_iva.append(dr)
+    in_arrivo = {a.sha256: a.in_arrivo for a in fattura_obj.allegati if a.in_arrivo is not None}
+    if existing:
+        logger.info(f"Fattura con hash {fattura_obj.hash_xml} già in DB, skip.")
+        scarta_allegati(in_arrivo.values())
+        return existing
 
+    _rimuovi_documento_orfano(db, fattura_obj.hash_xml)
+    db.add(fattura_obj)
+    db.flush()
+    salva_al_commit(db, in_arrivo)
     return fattura_obj
 
-def salva_fattura_su_db(fattura_obj):
+def salva_fattura_su_db(fattura_obj, scrittore=None):
     """
     Salva l'oggetto Fattura nel DB, controllando i duplicati con hash_xml.
+    Con `scrittore` (database.scrittore.ScrittoreDB) il salvataggio passa dal
+    thread scrittore e questa funzione aspetta il commit.
     """
     if not fattura_obj:
         logger.error("Fattura_obj is None, skip saving.")
         return None
 
-    db = SessionLocal()
-    existing = db.query(Fattura).filter_by(hash_xml=fattura_obj.hash_xml).first()
+    if scrittore is not None:
+        return scrittore.esegui(salva_fattura, fattura_obj)
 
-    if existing:
-        logger.info(f"Fattura con hash {fattura_obj.hash_xml} già in DB, skip.")
+    db = SessionLocal()
+    try:
+        salvata = salva_fattura(db, fattura_obj)
+        db.commit()
+        db.refresh(salvata)
+        return salvata
+    finally:
         db.close()
-        return existing
 
-    db.add(fattura_obj)
-    db.commit()
-    db.refresh(fattura_obj)
-    db.close()
+# Tabelle figlie della Fattura: chiave del record -> modello
+_MODELLI_SEZIONI = (
+    ("righe", RigheFattura),
+    ("riepiloghi_iva", DatiRiepilogoIVA),
+    ("pagamenti", DatiPagamento),
+    ("allegati", AllegatoFattura),
+)
+
+def _valori_predefiniti(modello):
+    """
+    Colonna -> default scalare del modello (None se non c'è). Con l'insert
+    bulk i default dell'ORM non vengono applicati ai parametri mancanti:
+    partiamo da qui, così tutte le righe hanno le stesse chiavi (un solo
+    executemany) e gli stessi valori che avrebbe messo db.add().
+    """
+    return {
+        c.key: c.default.arg if c.default is not None and c.default.is_scalar else None
+        for c in modello.__table__.columns
+        if not c.primary_key
+    }
+
+_PREDEFINITI = {modello: _valori_predefiniti(modello) for modello in (Fattura,) + tuple(m for _, m in _MODELLI_SEZIONI)}
+
+def _riga(modello, valori):
+    riga = dict(_PREDEFINITI[modello])
+    riga.update(valori)
+    return riga
+
+def _inserisci_blocco(db, records):
+    """
+    Inserisce i record (già senza duplicati) con un INSERT multiplo per
+    tabella, XML compresso compreso; gli id delle fatture tornano da RETURNING e sono associati
+    ai record tramite hash_xml, che è univoco.
+    """
+    fatture = [_riga(Fattura, dict(r["fattura"], hash_xml=r["hash_xml"])) for r in records]
+    id_per_hash = {
+        hash_val: id_fattura
+        for id_fattura, hash_val in db.execute(insert(Fattura).returning(Fattura.id, Fattura.hash_xml), fatture)
+    }
+
+    for chiave, modello in _MODELLI_SEZIONI:
+        righe = [
+            _riga(modello, dict(valori, fattura_id=id_per_hash[r["hash_xml"]]))
+            for r in records
+            for valori in r[chiave]
+        ]
+        if righe:
+            db.execute(insert(modello), righe)
+
+    # OR REPLACE: un documento rimasto senza fattura (fattura cancellata prima
+    # del trigger di database/migrazioni.py) viene sostituito, non fa fallire il blocco
+    db.execute(
+        insert(DocumentoXML).prefix_with("OR REPLACE"),
+        [dict(documento_da_record(r), hash_xml=r["hash_xml"]) for r in records],
+    )
+
+def salva_blocco_fatture(db, records):
+    """
+    Lavoro di scrittura (vedi database/scrittore.py): salva un blocco di record
+    nella transazione di `db`, senza commit.
+      - i duplicati si cercano con una sola query IN (...)
+        (e si scartano anche i doppioni interni al blocco)
+      - fatture, righe, riepiloghi, pagamenti e allegati vengono inseriti
+        con INSERT multipli (executemany), senza creare oggetti ORM
+    Se il blocco viola l'unicità di hash_xml (es. un altro processo ha appena
+    importato la stessa fattura) viene ripetuto una fattura alla volta,
+    ognuna nel suo SAVEPOINT.
+    Ritorna {"inseriti": [hash...], "saltati": [hash...]} nell'ordine di arrivo.
+    """
+    esito = {"inseriti": [], "saltati": []}
+    # Anche gli hash delle versioni precedenti (vedi calcola_hash_legacy)
+    hash_cercati = {r["hash_xml"] for r in records} | {r["hash_legacy"] for r in records if r.get("hash_legacy")}
+    presenti = {h for (h,) in db.query(Fattura.hash_xml).filter(Fattura.hash_xml.in_(hash_cercati))}
+
+    nuovi = []
+    for r in records:
+        if r["hash_xml"] in presenti or r.get("hash_legacy") in presenti:
+            esito["saltati"].append(r["hash_xml"])
+            scarta_allegati_record(r)
+        else:
+            presenti.add(r["hash_xml"])
+            nuovi.append(r)
+    if not nuovi:
+        return esito
+
+    try:
+        with db.begin_nested():
+            _inserisci_blocco(db, nuovi)
+        # Dopo il SAVEPOINT: se fallisce, i file servono ancora al salvataggio una alla volta
+        for r in nuovi:
+            salva_al_commit(db, r.get("allegati_in_arrivo"))
+        esito["inseriti"].extend(r["hash_xml"] for r in nuovi)
+    except IntegrityError:
+        logger.warning("Conflitto su hash_xml durante l'insert bulk, salvo una fattura alla volta")
+        for r in nuovi:
+            try:
+                with db.begin_nested():
+                    _rimuovi_documento_orfano(db, r["hash_xml"])
+                    db.add(fattura_da_record(r))
+                    salva_al_commit(db, r.get("allegati_in_arrivo"))
+                esito["inseriti"].append(r["hash_xml"])
+            except IntegrityError:
+                esito["saltati"].append(r["hash_xml"])
+    return esito
+
+def salva_fatture_bulk(records, batch_size=500, scrittore=None):
+    """
+    Salva i record prodotti da iter_record_fattura() / parse_fatture_batch()
+    a blocchi di `batch_size` (vedi salva_blocco_fatture), con una transazione
+    (e un solo commit) per blocco.
+    Senza `scrittore` usa l'engine con il profilo "import" (vedi database.db_session);
+    con `scrittore` (database.scrittore.ScrittoreDB) i blocchi passano dal thread
+    scrittore, che può unirli in un solo commit, e la funzione aspetta che siano scritti.
+    Ritorna {"inseriti": [hash...], "saltati": [hash...]} nell'ordine di arrivo.
+    """
+    if scrittore is not None:
+        futuri = [scrittore.invia(salva_blocco_fatture, blocco) for blocco in _a_blocchi(records, batch_size)]
+        esiti = [futuro.result() for futuro in futuri]
+    else:
+        esiti = []
+        for blocco in _a_blocchi(records, batch_size):
+            db = SessionImport()
+            try:
+                esiti.append(salva_blocco_fatture(db, blocco))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    return {
+        "inseriti": [h for esito in esiti for h in esito["inseriti"]],
+        "saltati": [h for esito in esiti for h in esito["saltati"]],
+    }
+
+def carica_hash_noti():
+    """
+    Carica dal DB, con una sola query, l'insieme degli hash_xml già importati.
+    Serve a scartare i documenti noti PRIMA del parsing (vedi scarta_documenti_noti).
+    """
+    with sessione_lettura() as db:
+        return {h for (h,) in db.query(Fattura.hash_xml).filter(Fattura.hash_xml != None)}
+
+def scarta_documenti_noti(documenti, hash_noti, statistiche, on_scartato=None):
+    """
+    Generatore: dalle coppie (nome, xml_in_byte) lascia passare solo i documenti
+    il cui hash (o quello delle versioni precedenti, vedi calcola_hash_legacy)
+    non è in `hash_noti`, senza parsarli.
+    Aggiorna `statistiche["saltati_noti"]` (e chiama `on_scartato(nome)`); gli
+    hash lasciati passare vengono aggiunti a `hash_noti`, così i doppioni nello
+    stesso lotto vengono scartati.
+    """
+    for nome, xml_content in documenti:
+        hash_val = calcola_hash_xml(xml_content)
+        hash_legacy = None if hash_val in hash_noti else calcola_hash_legacy(xml_content)
+        if hash_val in hash_noti or (hash_legacy is not None and hash_legacy in hash_noti):
+            statistiche["saltati_noti"] = statistiche.get("saltati_noti", 0) + 1
+            if on_scartato is not None:
+                on_scartato(nome)
+            continue
+        hash_noti.add(hash_val)
+        yield nome, xml_content
 
-    return fattura_obj
@@ -0,0 +1,145 @@
+# services/parser_stream.py
+
+import io
+from lxml import etree
+
+from services.tracciato_fatturapa import (
+    CAMPI_FATTURA,
+    CORPO,
+    SEZIONI,
+    qualifica,
+    valori_campi,
+)
+
+
+def _pianifica():
+    """
+    Traduce la tabella dei campi in un piano per iterparse:
+    - "ancore": elemento al cui evento `end` si leggono i campi della Fattura
+      (FatturaElettronicaHeader, DatiGenerali, DatiPagamento, ...),
+      con i path resi relativi all'ancora
+    - "sezioni": tag del nodo ripetuto (DettaglioLinee, ...) -> (chiave, campi)
+    - "liberabili": sezioni che nessun campo della Fattura attraversa e che
+      quindi si possono scartare appena lette
+    """
+    ancore = {}
+    for campo in CAMPI_FATTURA:
+        passi = campo.path.split("/")
+        # Header: ancora sull'header intero; Body: ancora sul blocco di secondo livello
+        taglio = 1 if passi[0] == "FatturaElettronicaHeader" else 2
+        ancora = passi[taglio - 1]
+        ancore.setdefault(ancora, []).append(campo._replace(path="/".join(passi[taglio:])))
+
+    sezioni = {}
+    liberabili = set()
+    for chiave, path, campi in SEZIONI:
+        tag = path.split("/")[-1]
+        sezioni[tag] = (chiave, campi)
+        if not any(tag in campo.path.split("/") for campo in CAMPI_FATTURA):
+            liberabili.add(tag)
+
+    tags = tuple("{*}" + t for t in list(ancore) + list(sezioni) + [CORPO])
+    return ancore, sezioni, liberabili, tags
+
+
+_ANCORE, _SEZIONI, _LIBERABILI, TAG_STREAM = _pianifica()
+
+
+def _nome_locale(elem):
+    return etree.QName(elem).localname
+
+
+def _testi(elem, path, ns):
+    """
+    Testi (non vuoti, come text() in XPath) degli elementi in `path` relativo a `elem`.
+    I path che iniziano con "../" partono dal padre.
+    """
+    while path.startswith("../"):
+        elem = elem.getparent()
+        path = path[3:]
+    return [e.text for e in elem.iterfind(qualifica(path, ns, formato="clark")) if e.text]
+
+
+def _libera(elem):
+    """
+    Svuota l'elemento già elaborato e rimuove i fratelli precedenti,
+    così l'albero parziale costruito da iterparse non cresce con il documento.
+    """
+    elem.clear(keep_tail=False)
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def _nuovi_dati(testata):
+    dati = {"fattura": dict(testata)}
+    for chiave, _, _ in SEZIONI:
+        dati[chiave] = []
+    return dati
+
+
+def iter_dati_stream(xml_bytes, encoding=None):
+    """
+    Generatore: estrae i dati con una sola passata sul documento (iterparse)
+    e produce un dizionario per ogni FatturaElettronicaBody:
+      {"fattura": {...}, "righe": [...], "riepiloghi_iva": [...], "pagamenti": [...], "allegati": [...]}
+    La testata (FatturaElettronicaHeader) viene letta una volta e copiata in
+    ogni fattura del lotto; ogni body viene scartato appena prodotto, quindi in
+    memoria resta al più un body alla volta.
+    `encoding` forza la decodifica (None = quello dichiarato nel prologo).
+    Solleva etree.XMLSyntaxError se l'XML è corrotto.
+    """
+    testata = {}
+    corrente = None
+    corpi = 0
+    ns = None
+
+    contesto = etree.iterparse(
+        io.BytesIO(xml_bytes),
+        events=("end",),
+        tag=TAG_STREAM,
+        remove_blank_text=True,
+        huge_tree=True,
+        encoding=encoding,
+    )
+
+    for i, (_, elem) in enumerate(contesto):
+        qname = etree.QName(elem)
+        if i == 0:
+            # Le ancore sono figlie (o discendenti) della radice: il loro
+            # namespace è quello usato per tutti i path del documento
+            ns = qname.namespace
+        nome = qname.localname
+
+        if nome == CORPO:
+            corpi += 1
+            yield corrente if corrente is not None else _nuovi_dati(testata)
+            corrente = None
+            _libera(elem)
+            continue
+
+        if nome == "FatturaElettronicaHeader":
+            testata.update(valori_campi(_ANCORE[nome], lambda path: _testi(elem, path, ns)))
+            continue
+
+        if corrente is None:
+            corrente = _nuovi_dati(testata)
+
+        sezione = _SEZIONI.get(nome)
+        if sezione is not None:
+            chiave, campi = sezione
+            corrente[chiave].append(valori_campi(campi, lambda path: _testi(elem, path, ns)))
+            if nome in _LIBERABILI:
+                _libera(elem)
+            continue
+
+        # Per i campi del body vale la prima occorrenza, come nel motore XPath
+        fattura = corrente["fattura"]
+        campi = [c for c in _ANCORE[nome] if c.colonna not in fattura]
+        if campi:
+            fattura.update(valori_campi(campi, lambda path: _testi(elem, path, ns)))
+
+    if corpi == 0:
+        # Documento senza body: restituiamo comunque quel che c'è
+        yield corrente if corrente is not None else _nuovi_dati(testata)
@@ -0,0 +1,366 @@
+# services/pipeline_resync.py
+
+"""
+Resync da Dropbox come pipeline a stadi collegati da code limitate:
+
+    elenco (elenca_xml, pagina per pagina)
+      -> download (scarica_in_parallelo, thread)      -> coda documenti
+         (o lettura dal mirror locale, services/mirror_dropbox.py)
+      -> parsing (parse_fatture_batch, processi)     -> coda dello scrittore
+      -> scrittura a blocchi (ScrittoreDB, group commit)
+
+Gli stadi lavorano insieme: il primo blocco viene salvato mentre i download
+sono ancora in corso. Se uno stadio è più lento, la coda davanti a lui si
+riempie e quelli a monte si fermano. In memoria ci sono al più max_in_volo
+download, `coda_documenti` documenti in attesa, 2 * workers blocchi in
+parsing e `max_in_scrittura` blocchi in attesa dello scrittore, qualunque
+sia la dimensione dell'archivio.
+
+La sincronizzazione è incrementale (database/sync_dropbox.py): l'elenco
+riparte dal cursore salvato alla fine del resync precedente, e i file il cui
+content_hash di Dropbox è già stato elaborato non vengono scaricati.
+Il cursore avanza anche se qualche file fallisce (download, parsing o
+salvataggio): i file falliti sono registrati in file_dropbox con l'errore e
+riprovati per path, prima dell'elenco, al resync successivo. Il cursore
+resta fermo solo se si interrompe l'elenco stesso.
+
+Ogni `intervallo` secondi i contatori per stadio (quanti, quanti al secondo)
+e le code (backlog) finiscono nel log e in `on_progresso`.
+"""
+
+import itertools
+import queue
+import threading
+import time
+
+from database.sync_dropbox import (
+    carica_stato_dropbox,
+    cancella_file_dropbox,
+    registra_errori_dropbox,
+    registra_file_dropbox,
+    salva_cursore,
+)
+from services.dropbox_service import elenca_xml, metadati_attuali, scarica_in_parallelo, MAX_DOWNLOAD_IN_VOLO
+from services.parser_fatture import (
+    parse_fatture_batch,
+    salva_blocco_fatture,
+    carica_hash_noti,
+    scarta_documenti_noti,
+)
+
+_FINE = object()
+
+# Documenti scaricati in attesa del parsing
+CODA_DOCUMENTI = 256
+# Blocchi parsati mandati allo scrittore e non ancora salvati
+MAX_IN_SCRITTURA = 8
+# File già importati (hash_xml noto) registrati in file_dropbox a gruppi di
+REGISTRA_OGNI = 500
+
+# Stadi con contatore e velocità, nell'ordine della pipeline
+STADI = ("scaricati", "parsati", "inseriti")
+
+
+class Avanzamento:
+    """
+    Contatori della pipeline. Ogni contatore è aggiornato da un solo stadio
+    (thread); istantanea() li legge insieme alle code.
+    """
+
+    def __init__(self):
+        self.inizio = time.perf_counter()
+        self._lock = threading.Lock()
+        self.contatori = {
+            "invariati": 0, "riprovati": 0, "scaricati": 0, "byte_scaricati": 0, "saltati_noti": 0,
+            "in_parsing": 0, "parsati": 0, "non_validi": 0,
+            "lotti_in_scrittura": 0, "inseriti": 0, "gia_presenti": 0,
+            "errori": 0,
+        }
+        self.code = {}  # nome -> funzione che ritorna la lunghezza attuale
+
+    def aggiungi(self, nome, n=1):
+        with self._lock:
+            self.contatori[nome] += n
+
+    def istantanea(self):
+        """
+        {"secondi", "contatori", "al_secondo" (per STADI), "code"}.
+        """
+        secondi = time.perf_counter() - self.inizio
+        with self._lock:
+            contatori = dict(self.contatori)
+        return {
+            "secondi": secondi,
+            "contatori": contatori,
+            "al_secondo": {stadio: contatori[stadio] / secondi if secondi else 0.0 for stadio in STADI},
+            "code": {nome: lunghezza() for nome, lunghezza in self.code.items()},
+        }
+
+
+def descrivi_avanzamento(istantanea):
+    """
+    Una riga leggibile (log e barra di stato) dall'istantanea dell'avanzamento.
+    """
+    c, v, code = istantanea["contatori"], istantanea["al_secondo"], istantanea["code"]
+    return (
+        f"⏭️ {c['invariati']} invariati, {c['riprovati']} riprovati · "
+        f"⬇️ {c['scaricati']} scaricati ({v['scaricati']:.0f}/s, {c['byte_scaricati'] / 1024 ** 2:.1f} MB), "
+        f"{c['saltati_noti']} già presenti · "
+        f"🔍 {c['parsati']} parsati ({v['parsati']:.0f}/s) · "
+        f"💾 {c['inseriti']} inseriti ({v['inseriti']:.0f}/s) · "
+        f"{c['errori']} errori · "
+        f"code: documenti {code.get('documenti', 0)}, in parsing {c['in_parsing']}, "
+        f"blocchi da salvare {c['lotti_in_scrittura']}"
+    )
+
+
+def _salva_blocco_e_file(db, records, file):
+    """
+    Lavoro di scrittura: il blocco di fatture e, nella stessa transazione, i
+    file Dropbox da cui vengono (un file è registrato solo se è salvato).
+    """
+    esito = salva_blocco_fatture(db, records)
+    registra_file_dropbox(db, file)
+    return esito
+
+
+def esegui_resync(client, scrittore, logger, on_progresso=None, intervallo=5.0, hash_noti=None,
+                  cartella="/fatture", stato_dropbox=None, mirror=None,
+                  max_in_volo=MAX_DOWNLOAD_IN_VOLO, coda_documenti=CODA_DOCUMENTI,
+                  max_in_scrittura=MAX_IN_SCRITTURA, workers=None, chunk_size=50):
+    """
+    Scarica, parsa e salva le fatture XML nuove o modificate di Dropbox (vedi
+    il docstring del modulo). `scrittore` è lo ScrittoreDB su cui vanno i
+    blocchi (salva_blocco_fatture), i file elaborati e il nuovo cursore;
+    `hash_noti` gli hash già importati (default: carica_hash_noti());
+    `stato_dropbox` la terna (cursore, {path_lower: content_hash} dei file
+    elaborati, {path_lower: content_hash} dei file da riprovare) da cui
+    riprendere (default: carica_stato_dropbox(cartella); (None, {}, {})
+    rielenca e riscarica tutto); `mirror` l'eventuale MirrorDropbox da cui
+    leggere i file già scaricati in passato (vedi scarica_in_parallelo).
+    Ritorna (statistiche, dettagli): statistiche {"invariati", "riprovati",
+    "ricevuti", "saltati_noti", "parsati", "inseriti", "non_validi", "errori"} e la lista
+    dei messaggi di errore e degli avvisi di validazione, per il log di dettaglio.
+    """
+    avanzamento = Avanzamento()
+    contatori = avanzamento.contatori
+    documenti = queue.Queue(maxsize=coda_documenti)
+    avanzamento.code["documenti"] = documenti.qsize
+    errori, avvisi = [], []
+    lock_errori = threading.Lock()
+    ferma = threading.Event()
+    if hash_noti is None:
+        hash_noti = carica_hash_noti()
+    if stato_dropbox is None:
+        stato_dropbox = carica_stato_dropbox(cartella)
+    cursore, file_noti, da_riprovare = stato_dropbox
+    contenuti_noti = set(file_noti.values())
+    # content_hash dei file scaricati e non ancora registrati, per path_lower
+    content_hash_di = {}
+    ultimo_cursore = []
+    elenco_completo = threading.Event()
+    registrazioni, da_registrare = [], []
+    # (path_lower, content_hash, errore) dei file falliti; path dei file spariti da Dropbox
+    falliti, spariti = [], []
+
+    def errore(messaggio):
+        logger.error(messaggio)
+        avanzamento.aggiungi("errori")
+        with lock_errori:
+            errori.append(messaggio)
+
+    def fallito(file, messaggio):
+        # I file falliti (lista di (path_lower, content_hash)) si riprovano al prossimo resync
+        with lock_errori:
+            falliti.extend((percorso, content_hash, messaggio) for percorso, content_hash in file)
+
+    def metti(elemento):
+        # put con timeout: se il parsing si è fermato per un errore, il download non resta bloccato
+        while not ferma.is_set():
+            try:
+                documenti.put(elemento, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    def registra(percorso, content_hash):
+        # File elaborati senza passare dallo scrittore con un blocco (thread download)
+        da_registrare.append((percorso, content_hash))
+        if len(da_registrare) >= REGISTRA_OGNI:
+            registrazioni.append(scrittore.invia(registra_file_dropbox, list(da_registrare)))
+            da_registrare.clear()
+
+    # -------- Stadio 1-2: elenco e download (thread), già scartati i documenti noti
+    riprovati = set()
+
+    def voci_da_riprovare():
+        # I file falliti le volte precedenti, che dal cursore non tornano più
+        for percorso, voce, problema in metadati_attuali(client, da_riprovare):
+            if problema is not None:
+                messaggio = f"❌ Errore Dropbox per {percorso}: {problema}"
+                errore(messaggio)
+                fallito([(percorso, da_riprovare[percorso])], messaggio)
+            elif voce is None:
+                spariti.append(percorso)
+            else:
+                riprovati.add(voce.path_lower)
+                avanzamento.aggiungi("riprovati")
+                yield voce
+
+    def da_scaricare():
+        elenco = elenca_xml(client, cartella, cursore, on_cursore=ultimo_cursore.append)
+        for entry in itertools.chain(voci_da_riprovare(), (e for e in elenco if e.path_lower not in riprovati)):
+            if entry.content_hash in contenuti_noti:
+                # Stesso contenuto già elaborato: non si scarica
+                avanzamento.aggiungi("invariati")
+                if file_noti.get(entry.path_lower) != entry.content_hash:
+                    registra(entry.path_lower, entry.content_hash)
+                continue
+            content_hash_di[entry.path_lower] = entry.content_hash
+            yield entry
+
+    def scaricati():
+        for entry, contenuto, problema in scarica_in_parallelo(client, da_scaricare(), max_in_volo, mirror=mirror):
+            if problema is not None:
+                messaggio = f"❌ Errore nel download di {entry.path_lower}: {problema}"
+                errore(messaggio)
+                fallito([(entry.path_lower, content_hash_di.pop(entry.path_lower, entry.content_hash))], messaggio)
+                continue
+            avanzamento.aggiungi("scaricati")
+            avanzamento.aggiungi("byte_scaricati", len(contenuto))
+            yield entry.path_lower, contenuto
+            if ferma.is_set():
+                return
+
+    def gia_importato(percorso):
+        registra(percorso, content_hash_di.pop(percorso))
+
+    def stadio_download():
+        try:
+            # saltati_noti è aggiornato solo da questo thread
+            for documento in scarta_documenti_noti(scaricati(), hash_noti, contatori, gia_importato):
+                metti(documento)
+            elenco_completo.set()
+        except Exception as e:
+            errore(f"❌ Errore Dropbox durante il resync: {e}")
+        finally:
+            metti(_FINE)
+
+    # -------- Rapporto periodico su log e UI
+    def rapporto():
+        istantanea = avanzamento.istantanea()
+        logger.info(f"📈 {descrivi_avanzamento(istantanea)}")
+        if on_progresso is not None:
+            on_progresso(istantanea)
+
+    finito = threading.Event()
+
+    def stadio_rapporto():
+        while not finito.wait(intervallo):
+            rapporto()
+
+    # -------- Stadio 3: parsing (processi), alimentato dalla coda documenti
+    def da_parsare():
+        while True:
+            documento = documenti.get()
+            if documento is _FINE:
+                return
+            avanzamento.aggiungi("in_parsing")
+            yield documento
+
+    # -------- Stadio 4: esito delle scritture (callback nel thread scrittore)
+    # La coda dello scrittore è condivisa e lunga: qui si limita quanti
+    # blocchi di questo resync possono aspettare il salvataggio
+    scritture = threading.Condition()
+
+    def salvato(nomi, file, futuro):
+        try:
+            esito = futuro.result()
+            avanzamento.aggiungi("inseriti", len(esito["inseriti"]))
+            avanzamento.aggiungi("gia_presenti", len(esito["saltati"]))
+        except Exception as e:
+            messaggio = f"❌ Errore nel salvataggio di {', '.join(nomi)}: {e}"
+            errore(messaggio)
+            fallito(file, messaggio)
+        finally:
+            with scritture:
+                avanzamento.aggiungi("lotti_in_scrittura", -1)
+                scritture.notify_all()
+
+    thread_download = threading.Thread(target=stadio_download, name="resync-download", daemon=True)
+    thread_rapporto = threading.Thread(target=stadio_rapporto, name="resync-rapporto", daemon=True)
+    thread_download.start()
+    thread_rapporto.start()
+    try:
+        for blocco in parse_fatture_batch(da_parsare(), workers=workers, chunk_size=chunk_size):
+            records, nomi, file = [], [], []
+            for esito in blocco:
+                # Un esito con corpo 1 (o di errore) per ogni file uscito dal parsing
+                if esito["record"] is None or esito["record"]["corpo"] == 1:
+                    avanzamento.aggiungi("in_parsing", -1)
+                    content_hash = content_hash_di.pop(esito["nome"], None)
+                    if esito["errore"]:
+                        messaggio = f"❌ Errore nel parsing di {esito['nome']}: {esito['errore']}"
+                        errore(messaggio)
+                        fallito([(esito["nome"], content_hash)], messaggio)
+                        continue
+                    file.append((esito["nome"], content_hash))
+                avanzamento.aggiungi("parsati")
+                errori_validazione = esito["record"]["errori_validazione"]
+                if errori_validazione:
+                    avanzamento.aggiungi("non_validi")
+                    avvisi.append(f"⚠️ {esito['nome']} non conforme allo schema: " + "; ".join(errori_validazione))
+                records.append(esito["record"])
+                nomi.append(esito["nome"])
+
+            if records:
+                # Il parsing aspetta se lo scrittore è indietro di max_in_scrittura blocchi
+                with scritture:
+                    scritture.wait_for(lambda: contatori["lotti_in_scrittura"] < max_in_scrittura)
+                    avanzamento.aggiungi("lotti_in_scrittura")
+                futuro = scrittore.invia(_salva_blocco_e_file, records, file)
+                futuro.add_done_callback(lambda f, nomi=nomi, file=file: salvato(nomi, file, f))
+
+        # Fine del parsing: si aspetta che lo scrittore abbia salvato tutti i blocchi
+        with scritture:
+            scritture.wait_for(lambda: contatori["lotti_in_scrittura"] == 0)
+        thread_download.join()
+        registrazioni.append(scrittore.invia(registra_file_dropbox, da_registrare))
+        registrazioni.append(scrittore.invia(registra_errori_dropbox, falliti))
+        registrazioni.append(scrittore.invia(cancella_file_dropbox, spariti))
+        registrati = True
+        for futuro in registrazioni:
+            try:
+                futuro.result()
+            except Exception as e:
+                registrati = False
+                errore(f"❌ Errore nella registrazione dei file Dropbox: {e}")
+
+        # Il cursore avanza anche con dei file falliti: sono in file_dropbox, da
+        # riprovare. Resta fermo se l'elenco si è interrotto o se non è stato
+        # possibile registrare i file, che altrimenti andrebbero persi
+        if not (elenco_completo.is_set() and registrati):
+            logger.warning("⚠️ Resync interrotto: il cursore Dropbox non viene aggiornato")
+        elif ultimo_cursore:
+            try:
+                scrittore.invia(salva_cursore, cartella, ultimo_cursore[-1]).result()
+            except Exception as e:
+                errore(f"❌ Errore nel salvataggio del cursore Dropbox: {e}")
+    finally:
+        ferma.set()
+        thread_download.join()
+        finito.set()
+        thread_rapporto.join()
+    rapporto()
+
+    statistiche = {
+        "invariati": contatori["invariati"],
+        "riprovati": contatori["riprovati"],
+        "ricevuti": contatori["scaricati"],
+        "saltati_noti": contatori["saltati_noti"],
+        "parsati": contatori["parsati"],
+        "inseriti": contatori["inseriti"],
+        "non_validi": contatori["non_validi"],
+        "errori": len(errori),
+    }
+    return statistiche, errori + avvisi
@@ -0,0 +1,266 @@
+# services/tracciato_fatturapa.py
+
+"""
+Mappa dichiarativa del tracciato FatturaPA verso le colonne dei modelli
+(Fattura, RigheFattura, DatiRiepilogoIVA, DatiPagamento, AllegatoFattura) e registro delle
+espressioni XPath precompilate per namespace.
+
+Per aggiungere un campo basta una riga nelle tabelle CAMPI_*: entrambi i
+motori di parsing (xpath e stream) leggono da qui.
+"""
+
+import base64
+from collections import namedtuple
+from datetime import datetime
+from lxml import etree
+
+# Namespace del tracciato: v1.2 (FPA12 / FPR12) e il vecchio v1.1 (FPA11).
+# I figli della radice di norma non sono qualificati (chiave None), ma alcuni
+# gestionali dichiarano il namespace di default e qualificano tutto il documento.
+NS_FATTURA_V12 = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2"
+NS_FATTURA_V11 = "http://www.fatturapa.gov.it/sdi/fatturapa/v1.1"
+NAMESPACE_NOTI = (None, NS_FATTURA_V12, NS_FATTURA_V11)
+
+
+def testo(valore):
+    return valore.strip()
+
+def decimale(valore):
+    return float(valore)
+
+def intero(valore):
+    return int(valore)
+
+def data(valore):
+    return datetime.strptime(valore.strip(), "%Y-%m-%d").date()
+
+def allegato(valore):
+    """
+    Decodifica il base64 di <Attachment> (spazi e a capo ignorati). I byte
+    restano nei dati estratti solo fino al salvataggio: il parser li
+    sostituisce con lo SHA-256 e li scrive nell'archivio su disco al commit
+    della fattura (vedi services.parser_fatture).
+    """
+    return base64.b64decode(valore)
+
+
+# colonna: attributo del modello
+# path: percorso relativo (alla radice per la Fattura, al nodo della sezione per le altre)
+# converti: funzione applicata al testo dell'elemento
+# default: valore usato se l'elemento manca (None = colonna non valorizzata)
+# multiplo: se True concatena tutte le occorrenze (es. Causale) invece di prendere la prima
+Campo = namedtuple("Campo", ["colonna", "path", "converti", "default", "multiplo"], defaults=(testo, None, False))
+
+_HEADER = "FatturaElettronicaHeader"
+_TRASMISSIONE = _HEADER + "/DatiTrasmissione"
+_CEDENTE = _HEADER + "/CedentePrestatore"
+_RAPPRESENTANTE = _HEADER + "/RappresentanteFiscale/DatiAnagrafici"
+_CESSIONARIO = _HEADER + "/CessionarioCommittente"
+_TERZO = _HEADER + "/TerzoIntermediarioOSoggettoEmittente/DatiAnagrafici"
+_DOCUMENTO = "FatturaElettronicaBody/DatiGenerali/DatiGeneraliDocumento"
+
+CAMPI_FATTURA = (
+    # Campi "storici" usati da UI e notifiche
+    Campo("numero", _DOCUMENTO + "/Numero"),
+    Campo("data", _DOCUMENTO + "/Data", data),
+    Campo("fornitore", _CEDENTE + "/DatiAnagrafici/Anagrafica/Denominazione"),
+    Campo("totale", _DOCUMENTO + "/ImportoTotaleDocumento", decimale),
+    Campo("data_scadenza", "FatturaElettronicaBody/DatiPagamento/DettaglioPagamento/DataScadenzaPagamento", data),
+
+    # FatturaElettronicaHeader
+    Campo("soggetto_emittente", _HEADER + "/SoggettoEmittente"),
+    Campo("id_paese_trasmittente", _TRASMISSIONE + "/IdTrasmittente/IdPaese"),
+    Campo("id_codice_trasmittente", _TRASMISSIONE + "/IdTrasmittente/IdCodice"),
+    Campo("progressivo_invio", _TRASMISSIONE + "/ProgressivoInvio"),
+    Campo("formato_trasmissione", _TRASMISSIONE + "/FormatoTrasmissione"),
+    Campo("codice_destinatario", _TRASMISSIONE + "/CodiceDestinatario"),
+    Campo("pec_destinatario", _TRASMISSIONE + "/PECDestinatario"),
+
+    Campo("cedente_id_paese", _CEDENTE + "/DatiAnagrafici/IdFiscaleIVA/IdPaese"),
+    Campo("cedente_id_codice", _CEDENTE + "/DatiAnagrafici/IdFiscaleIVA/IdCodice"),
+    Campo("cedente_codice_fiscale", _CEDENTE + "/DatiAnagrafici/CodiceFiscale"),
+    Campo("cedente_denominazione", _CEDENTE + "/DatiAnagrafici/Anagrafica/Denominazione"),
+    Campo("cedente_indirizzo", _CEDENTE + "/Sede/Indirizzo"),
+    Campo("cedente_numero_civico", _CEDENTE + "/Sede/NumeroCivico"),
+    Campo("cedente_cap", _CEDENTE + "/Sede/CAP"),
+    Campo("cedente_comune", _CEDENTE + "/Sede/Comune"),
+    Campo("cedente_provincia", _CEDENTE + "/Sede/Provincia"),
+    Campo("cedente_nazione", _CEDENTE + "/Sede/Nazione"),
+
+    Campo("rappresentante_cf", _RAPPRESENTANTE + "/CodiceFiscale"),
+    Campo("rappresentante_denominazione", _RAPPRESENTANTE + "/Anagrafica/Denominazione"),
+
+    Campo("cessionario_id_paese", _CESSIONARIO + "/DatiAnagrafici/IdFiscaleIVA/IdPaese"),
+    Campo("cessionario_id_codice", _CESSIONARIO + "/DatiAnagrafici/IdFiscaleIVA/IdCodice"),
+    Campo("cessionario_codice_fiscale", _CESSIONARIO + "/DatiAnagrafici/CodiceFiscale"),
+    Campo("cessionario_denominazione", _CESSIONARIO + "/DatiAnagrafici/Anagrafica/Denominazione"),
+    Campo("cessionario_indirizzo", _CESSIONARIO + "/Sede/Indirizzo"),
+    Campo("cessionario_cap", _CESSIONARIO + "/Sede/CAP"),
+    Campo("cessionario_comune", _CESSIONARIO + "/Sede/Comune"),
+    Campo("cessionario_provincia", _CESSIONARIO + "/Sede/Provincia"),
+    Campo("cessionario_nazione", _CESSIONARIO + "/Sede/Nazione"),
+
+    Campo("terzo_id_paese", _TERZO + "/IdFiscaleIVA/IdPaese"),
+    Campo("terzo_id_codice", _TERZO + "/IdFiscaleIVA/IdCodice"),
+    Campo("terzo_denominazione", _TERZO + "/Anagrafica/Denominazione"),
+
+    # FatturaElettronicaBody / DatiGenerali
+    Campo("tipo_documento", _DOCUMENTO + "/TipoDocumento"),
+    Campo("divisa", _DOCUMENTO + "/Divisa"),
+    Campo("data_documento", _DOCUMENTO + "/Data", data),
+    Campo("numero_documento", _DOCUMENTO + "/Numero"),
+    Campo("importo_totale_documento", _DOCUMENTO + "/ImportoTotaleDocumento", decimale),
+    Campo("causale", _DOCUMENTO + "/Causale", multiplo=True),
+)
+
+# Relativi a <DettaglioLinee>
+CAMPI_RIGA = (
+    Campo("numero_linea", "NumeroLinea", intero),
+    Campo("codice_articolo", "CodiceArticolo/CodiceValore"),
+    Campo("descrizione", "Descrizione", default="N/D"),
+    Campo("quantita", "Quantita", decimale, default=1.0),
+    Campo("unita_misura", "UnitaMisura"),
+    Campo("prezzo_unitario", "PrezzoUnitario", decimale, default=0.0),
+    Campo("prezzo_totale", "PrezzoTotale", decimale),
+    Campo("importo_riga", "PrezzoTotale", decimale),
+    Campo("aliquota_iva", "AliquotaIVA", decimale),
+    Campo("natura", "Natura"),
+)
+
+# Relativi a <DatiRiepilogo>
+CAMPI_RIEPILOGO = (
+    Campo("aliquota_iva", "AliquotaIVA", decimale),
+    Campo("natura", "Natura"),
+    Campo("imponibile_importo", "ImponibileImporto", decimale),
+    Campo("imposta", "Imposta", decimale),
+    Campo("esigibilita_iva", "EsigibilitaIVA"),
+)
+
+# Relativi a <DettaglioPagamento>; le condizioni stanno sul <DatiPagamento> padre
+CAMPI_PAGAMENTO = (
+    Campo("condizioni_pagamento", "../CondizioniPagamento"),
+    Campo("modalita_pagamento", "ModalitaPagamento"),
+    Campo("data_scadenza_pagamento", "DataScadenzaPagamento", data),
+    Campo("importo_pagamento", "ImportoPagamento", decimale),
+)
+
+# Relativi a <Allegati>
+CAMPI_ALLEGATO = (
+    Campo("nome_attachment", "NomeAttachment"),
+    Campo("formato_attachment", "FormatoAttachment"),
+    Campo("descrizione_attachment", "DescrizioneAttachment"),
+    Campo("contenuto", "Attachment", allegato),
+)
+
+# Sezioni ripetute: chiave nel dizionario dei dati -> (path del nodo, campi)
+SEZIONI = (
+    ("righe", "FatturaElettronicaBody/DatiBeniServizi/DettaglioLinee", CAMPI_RIGA),
+    ("riepiloghi_iva", "FatturaElettronicaBody/DatiBeniServizi/DatiRiepilogo", CAMPI_RIEPILOGO),
+    ("pagamenti", "FatturaElettronicaBody/DatiPagamento/DettaglioPagamento", CAMPI_PAGAMENTO),
+    ("allegati", "FatturaElettronicaBody/Allegati", CAMPI_ALLEGATO),
+)
+
+# Un file può contenere un "lotto" di fatture: un FatturaElettronicaHeader comune
+# e più FatturaElettronicaBody. I campi della testata si leggono una volta dalla
+# radice, quelli del corpo (e le sezioni) relativamente a ciascun body.
+CORPO = "FatturaElettronicaBody"
+
+def _relativo_al_corpo(path):
+    return path[len(CORPO) + 1:]
+
+CAMPI_TESTATA = tuple(c for c in CAMPI_FATTURA if not c.path.startswith(CORPO + "/"))
+CAMPI_CORPO = tuple(
+    c._replace(path=_relativo_al_corpo(c.path))
+    for c in CAMPI_FATTURA if c.path.startswith(CORPO + "/")
+)
+SEZIONI_CORPO = tuple((chiave, _relativo_al_corpo(path), campi) for chiave, path, campi in SEZIONI)
+
+
+def qualifica(path, ns, formato="xpath"):
+    """
+    Qualifica ogni passo del path con il namespace `ns`.
+    formato="xpath" usa il prefisso f: (per etree.XPath),
+    formato="clark" usa la notazione {ns}tag (per find/findtext).
+    """
+    if ns is None:
+        return path
+    passi = []
+    for passo in path.split("/"):
+        if passo in ("", ".", ".."):
+            passi.append(passo)
+        elif formato == "clark":
+            passi.append(f"{{{ns}}}{passo}")
+        else:
+            passi.append(f"f:{passo}")
+    return "/".join(passi)
+
+
+def namespace_documento(root):
+    """
+    Namespace dei figli della radice (None se non qualificati).
+    """
+    figlio = root.find("*")
+    if figlio is None:
+        return None
+    return etree.QName(figlio).namespace
+
+
+def _compila_testi(campi, ns, namespaces):
+    """
+    Una sola espressione compilata per ogni path distinto,
+    anche se più colonne leggono lo stesso elemento.
+    """
+    compilati = {}
+    for campo in campi:
+        if campo.path not in compilati:
+            compilati[campo.path] = etree.XPath(qualifica(campo.path, ns) + "/text()", namespaces=namespaces)
+    return compilati
+
+
+def _compila(ns):
+    namespaces = {"f": ns} if ns else None
+    return {
+        # relativi alla radice
+        "testata": _compila_testi(CAMPI_TESTATA, ns, namespaces),
+        "corpi": etree.XPath(qualifica(CORPO, ns), namespaces=namespaces),
+        # relativi a ciascun FatturaElettronicaBody
+        "corpo": _compila_testi(CAMPI_CORPO, ns, namespaces),
+        "sezioni": {
+            chiave: (etree.XPath(qualifica(path, ns), namespaces=namespaces),
+                     _compila_testi(campi, ns, namespaces))
+            for chiave, path, campi in SEZIONI_CORPO
+        },
+    }
+
+
+# Registro a livello di modulo: namespace -> espressioni compilate
+_REGISTRO_XPATH = {ns: _compila(ns) for ns in NAMESPACE_NOTI}
+
+
+def xpath_per_namespace(ns):
+    """
+    Ritorna le espressioni compilate per il namespace `ns`,
+    compilandole (una volta sola) se il namespace non è tra quelli noti.
+    """
+    compilati = _REGISTRO_XPATH.get(ns)
+    if compilati is None:
+        compilati = _REGISTRO_XPATH[ns] = _compila(ns)
+    return compilati
+
+
+def valori_campi(campi, testi_per_path):
+    """
+    Applica converter e default della tabella `campi`.
+    `testi_per_path` è una funzione path -> lista dei testi trovati.
+    """
+    valori = {}
+    for campo in campi:
+        testi = testi_per_path(campo.path)
+        if testi:
+            if campo.multiplo:
+                valori[campo.colonna] = campo.converti(" ".join(t.strip() for t in testi))
+            else:
+                valori[campo.colonna] = campo.converti(testi[0])
+        elif campo.default is not None:
+            valori[campo.colonna] = campo.default
+    return valori
@@ -0,0 +1,100 @@
+# services/validazione_xsd.py
+
+"""
+Validazione opzionale delle fatture contro lo schema ufficiale
+assets/Schema_VFPA12_v1.2.3.xsd.
+
+Lo schema viene compilato una sola volta per processo (anche nei worker di
+parse_fatture_batch) e riusato per tutti i documenti. Modalità:
+  - "off":    nessuna validazione (default)
+  - "warn":   il documento viene importato, gli errori finiscono nel log e nel record
+  - "strict": il documento non valido viene scartato (ErroreValidazione)
+Il default si può cambiare con la variabile d'ambiente VALIDAZIONE_XSD.
+"""
+
+import os
+import functools
+from lxml import etree
+
+VALIDAZIONE_OFF = "off"
+VALIDAZIONE_WARN = "warn"
+VALIDAZIONE_STRICT = "strict"
+MODALITA_VALIDAZIONE = (VALIDAZIONE_OFF, VALIDAZIONE_WARN, VALIDAZIONE_STRICT)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "..", "assets", "Schema_VFPA12_v1.2.3.xsd")
+
+# Oltre questo numero gli errori di un documento non vengono riportati
+MAX_ERRORI = 20
+
+# Lo schema importa xmldsig-core dal sito del W3C. Per non dipendere dalla rete
+# forniamo al suo posto uno schema minimo: ds:Signature esiste ma il suo
+# contenuto non viene controllato (la firma XML non ci interessa).
+_URL_XMLDSIG = "http://www.w3.org/TR/2002/REC-xmldsig-core-20020212/xmldsig-core-schema.xsd"
+_XMLDSIG_MINIMO = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+           targetNamespace="http://www.w3.org/2000/09/xmldsig#"
+           elementFormDefault="qualified">
+  <xs:element name="Signature">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:any namespace="##any" processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+
+class ErroreValidazione(ValueError):
+    """
+    Il documento non rispetta lo schema FatturaPA. `errori` è la lista dei messaggi.
+    """
+
+    def __init__(self, errori):
+        self.errori = errori
+        super().__init__(f"{len(errori)} errori di validazione XSD: " + "; ".join(errori[:3]))
+
+
+class _RisolutoreXmldsig(etree.Resolver):
+    def resolve(self, url, id, context):
+        if url == _URL_XMLDSIG:
+            return self.resolve_string(_XMLDSIG_MINIMO, context)
+        return None
+
+
+def modalita_validazione(validazione=None):
+    """
+    Normalizza la modalità (None = quella di VALIDAZIONE_XSD, di default "off").
+    """
+    if validazione is None:
+        validazione = os.getenv("VALIDAZIONE_XSD", VALIDAZIONE_OFF)
+    validazione = validazione.strip().lower()
+    if validazione not in MODALITA_VALIDAZIONE:
+        raise ValueError(f"Modalità di validazione sconosciuta: {validazione}")
+    return validazione
+
+
+@functools.lru_cache(maxsize=None)
+def schema_fatturapa():
+    """
+    Lo schema FatturaPA compilato: la prima chiamata lo carica, le successive
+    (nello stesso processo) ritornano lo stesso oggetto.
+    """
+    parser = etree.XMLParser()
+    parser.resolvers.add(_RisolutoreXmldsig())
+    return etree.XMLSchema(etree.parse(os.path.abspath(SCHEMA_PATH), parser))
+
+
+def valida_fattura(documento):
+    """
+    Valida un documento già parsato (albero o elemento radice) e ritorna la
+    lista degli errori ("riga N: messaggio"); lista vuota se è valido.
+    """
+    schema = schema_fatturapa()
+    if schema.validate(documento):
+        return []
+    errori = [f"riga {e.line}: {e.message}" for e in schema.error_log]
+    if len(errori) > MAX_ERRORI:
+        errori = errori[:MAX_ERRORI] + [f"... altri {len(errori) - MAX_ERRORI} errori"]
+    return errori
@@ -0,0 +1,39 @@
+# tests/test_corpus_fatturapa.py
+
+import pytest
+from lxml import etree
+
+from benchmarks.corpus_fatturapa import genera_fattura, genera_corpus, busta_p7m, ENCODING_CORPUS
+from services.p7m_service import estrai_contenuto_p7m
+from services.parser_fatture import iter_record_fattura
+from services.validazione_xsd import valida_fattura
+
+
+@pytest.mark.parametrize("encoding", ENCODING_CORPUS)
+@pytest.mark.parametrize("formato", ["FPR12", "FPA12"])
+def test_fattura_generata_conforme_allo_schema(encoding, formato, tmp_path, monkeypatch):
+    from services import allegati_store
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path))
+
+    xml = genera_fattura(numero=7, righe=12, corpi=2, allegati=1, dimensione_allegato=1024,
+                         formato=formato, encoding=encoding)
+    assert valida_fattura(etree.fromstring(xml)) == []
+
+    records = list(iter_record_fattura(xml))
+    assert [r["fattura"]["numero"] for r in records] == ["7/1", "7/2"]
+    assert all(len(r["righe"]) == 12 and len(r["allegati"]) == 1 for r in records)
+    # Il riepilogo IVA torna con il totale del documento
+    for r in records:
+        totale = sum(d["imponibile_importo"] + d["imposta"] for d in r["riepiloghi_iva"])
+        assert round(totale, 2) == r["fattura"]["importo_totale_documento"]
+
+
+def test_busta_p7m_generata():
+    xml = genera_fattura(numero=1)
+    assert estrai_contenuto_p7m(busta_p7m(xml)) == xml
+
+
+def test_genera_corpus_riproducibile():
+    assert genera_corpus(20, seed=3, dimensione_allegato=256) == genera_corpus(20, seed=3, dimensione_allegato=256)
+    nomi = [nome for nome, _ in genera_corpus(50, seed=1, quota_p7m=0.5, dimensione_allegato=256)]
+    assert any(n.endswith(".p7m") for n in nomi) and any(n.endswith(".xml") for n in nomi)
@@ -2,7 +2,7 @@
 
 import pytest
 from database.db_session import init_db, SessionLocal
-from database.models import Fattura
+from database.models import Base, Fattura
 
 @pytest.fixture(scope="module")
 def setup_test_db():
@@ -27,3 +27,164 @@ def test_inserisci_fattura(setup_test_db):
     assert len(fatture) == 1
     assert fatture[0].numero == "TST-001"
     db.close()
+
+def test_migrazione_allegati_su_disco(tmp_path, monkeypatch):
+    """
+    Un DB creato con una versione precedente viene aggiornato: nuove colonne,
+    allegati base64 spostati su disco, indici, XML compresso in documenti_xml
+    (senza il base64 degli allegati),
+    fatture esistenti nell'indice full-text e nei totali, user_version avanzata.
+    """
+    import base64
+    import hashlib
+    from sqlalchemy import create_engine
+    from database.migrazioni import esegui_migrazioni, MIGRAZIONI
+    from services import allegati_store
+
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path / "allegati"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'vecchio.db'}")
+    contenuto = b"contenuto allegato"
+    # Schema della versione precedente: quello attuale senza le modifiche delle migrazioni
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE documenti_xml")
+        for indice in ("ix_fatture_data_fornitore", "ix_fatture_fornitore_data", "ix_fatture_scadenza_non_pagate"):
+            conn.exec_driver_sql(f"DROP INDEX {indice}")
+        conn.exec_driver_sql("ALTER TABLE fatture ADD COLUMN xml_raw TEXT")
+        codificato = base64.b64encode(contenuto).decode("ascii")
+        conn.exec_driver_sql(
+            "INSERT INTO fatture (numero, fornitore, hash_xml, xml_raw) VALUES "
+            "('1', 'Alfa', 'abc', ?), ('2', 'Beta', NULL, '<Fattura>2</Fattura>')",
+            (f"<Fattura>1<Attachment>{codificato}</Attachment></Fattura>",),
+        )
+        conn.exec_driver_sql("INSERT INTO righe_fattura (fattura_id, descrizione) VALUES (1, 'Consulenza fiscale')")
+        conn.exec_driver_sql("DROP TABLE allegato_fattura")
+        conn.exec_driver_sql(
+            "CREATE TABLE allegato_fattura (id INTEGER PRIMARY KEY, fattura_id INTEGER, "
+            "nome_attachment VARCHAR, formato_attachment VARCHAR, attachment TEXT)"
+        )
+        conn.exec_driver_sql(
+            "INSERT INTO allegato_fattura (fattura_id, nome_attachment, attachment) VALUES (1, 'a.pdf', ?)",
+            (codificato,),
+        )
+
+    esegui_migrazioni(engine)
+    esegui_migrazioni(engine)  # la seconda volta non fa nulla
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA user_version").scalar() == MIGRAZIONI[-1][0]
+        sha256, attachment = conn.exec_driver_sql("SELECT sha256, attachment FROM allegato_fattura").one()
+    assert sha256 == hashlib.sha256(contenuto).hexdigest()
+    assert attachment is None
+    assert allegati_store.leggi_allegato(sha256) == contenuto
+
+    with engine.connect() as conn:
+        indici = {r[1] for r in conn.exec_driver_sql("PRAGMA index_list(fatture)")}
+    assert {"ix_fatture_data_fornitore", "ix_fatture_fornitore_data", "ix_fatture_scadenza_non_pagate"} <= indici
+
+    from sqlalchemy.orm import Session
+    from database.models import DocumentoXML
+    with engine.connect() as conn:
+        assert "xml_raw" not in {r[1] for r in conn.exec_driver_sql("PRAGMA table_info(fatture)")}
+        hash_2 = conn.exec_driver_sql("SELECT hash_xml FROM fatture WHERE numero = '2'").scalar()
+    assert hash_2 == hashlib.sha256(b"<Fattura>2</Fattura>").hexdigest()
+    with Session(engine) as db:
+        # Nell'XML il base64 dell'allegato è sostituito dal riferimento all'archivio
+        assert db.get(DocumentoXML, "abc").testo() == f"<Fattura>1<Attachment>sha256:{sha256}</Attachment></Fattura>"
+        assert db.get(DocumentoXML, hash_2).testo() == "<Fattura>2</Fattura>"
+
+    with engine.connect() as conn:
+        trovate = conn.exec_driver_sql("SELECT rowid FROM fatture_fts WHERE fatture_fts MATCH 'consul*'").all()
+    assert trovate == [(1,)]
+
+    from database.totali import verifica_totali
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT sum(n_fatture) FROM totali_fornitore_mese").scalar() == 2
+        assert verifica_totali(conn) == []
+
+def test_profili_sqlite(tmp_path):
+    from database.db_session import crea_engine, PROFILI, PROFILO_IMPORT
+
+    engine = crea_engine(f"sqlite:///{tmp_path / 'profilo.db'}", PROFILO_IMPORT)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == PROFILI[PROFILO_IMPORT]["cache_size"]
+        assert conn.exec_driver_sql("PRAGMA temp_store").scalar() == 2  # MEMORY
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == PROFILI[PROFILO_IMPORT]["busy_timeout"]
+    engine.dispose()
+
+def test_lettura_durante_scrittura(tmp_path):
+    """
+    Con WAL la UI legge mentre un import tiene aperta una transazione di scrittura.
+    """
+    from sqlalchemy import insert, func, select
+    from database.db_session import crea_engine, PROFILO_IMPORT, PROFILO_INTERATTIVO
+    from database.models import Base
+
+    url = f"sqlite:///{tmp_path / 'concorrenza.db'}"
+    scrittore = crea_engine(url, PROFILO_IMPORT)
+    lettore = crea_engine(url, PROFILO_INTERATTIVO, connect_args={"timeout": 0})
+    Base.metadata.create_all(scrittore)
+    with scrittore.begin() as conn:
+        conn.execute(insert(Fattura), [{"numero": "PRIMA"}])
+
+    with scrittore.begin() as conn:
+        conn.execute(insert(Fattura), [{"numero": f"IMPORT-{i}"} for i in range(1000)])
+        # Transazione ancora aperta: il lettore vede l'ultimo commit, senza attese
+        with lettore.connect() as lettura:
+            assert lettura.execute(select(func.count(Fattura.id))).scalar() == 1
+
+    with lettore.connect() as lettura:
+        assert lettura.execute(select(func.count(Fattura.id))).scalar() == 1001
+    scrittore.dispose()
+    lettore.dispose()
+
+
+def test_migrazione_id_autoincrement(tmp_path):
+    """
+    Le tabelle esportate di un DB precedente vengono ricreate AUTOINCREMENT
+    con gli stessi id, indici e trigger: l'id cancellato non viene riusato.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    from database.migrazioni import esegui_migrazioni
+    from database.models import DatiPagamento, DatiRiepilogoIVA, RigheFattura
+    from database.totali import verifica_totali
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'vecchio.db'}")
+    ricreate = [m.__table__ for m in (Fattura, RigheFattura, DatiRiepilogoIVA, DatiPagamento)]
+    Base.metadata.create_all(engine, tables=[t for t in Base.metadata.sorted_tables if t not in ricreate])
+    with engine.begin() as conn:
+        for tabella in ricreate:
+            ddl = str(CreateTable(tabella).compile(dialect=engine.dialect))
+            conn.exec_driver_sql(ddl.replace(" AUTOINCREMENT", ""))
+            for indice in tabella.indexes:
+                conn.exec_driver_sql(str(CreateIndex(indice).compile(dialect=engine.dialect)))
+        conn.exec_driver_sql("INSERT INTO fatture (numero, fornitore) VALUES ('1', 'Alfa'), ('2', 'Beta')")
+        conn.exec_driver_sql("INSERT INTO righe_fattura (fattura_id, descrizione) VALUES (2, 'Consulenza fiscale')")
+        conn.exec_driver_sql(
+            "INSERT INTO dati_riepilogo_iva (fattura_id, aliquota_iva, imponibile_importo, imposta) VALUES (2, 22, 100, 22)"
+        )
+
+    esegui_migrazioni(engine)
+
+    with engine.begin() as conn:
+        for tabella in ricreate:
+            ddl = conn.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (tabella.name,)
+            ).scalar()
+            assert "AUTOINCREMENT" in ddl
+        # Le chiavi esterne nominano ancora fatture, non la tabella temporanea
+        assert "REFERENCES fatture (" in conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE name = 'righe_fattura'"
+        ).scalar()
+        assert "ix_fatture_scadenza_non_pagate" in {r[1] for r in conn.exec_driver_sql("PRAGMA index_list(fatture)")}
+        assert conn.exec_driver_sql("SELECT rowid FROM fatture_fts WHERE fatture_fts MATCH 'beta'").all() == [(2,)]
+
+        # Trigger di cascata e totali ancora attivi dopo la ricreazione
+        conn.exec_driver_sql("DELETE FROM fatture WHERE id = 2")
+        assert conn.exec_driver_sql("SELECT count(*) FROM righe_fattura").scalar() == 0
+        assert verifica_totali(conn) == []
+        conn.exec_driver_sql("INSERT INTO fatture (numero, fornitore) VALUES ('3', 'Gamma')")
+        assert conn.exec_driver_sql("SELECT max(id) FROM fatture").scalar() == 3
@@ -26,3 +26,110 @@ def test_upload_xml_to_dropbox(mock_dbx, tmp_path):
 
     # Controlliamo che il mock abbia chiamato dbx.files_upload
     mock_dbx.files_upload.assert_called_once()
+
+@patch("services.dropbox_service.dbx")
+def test_scarica_tutti_xml_memoria_byte_grezzi(mock_dbx):
+    """
+    I file scaricati restano in byte, senza tentativi di decodifica.
+    """
+    from dropbox.files import FileMetadata
+    from services.dropbox_service import scarica_tutti_xml_memoria
+
+    contenuto = '<?xml version="1.0" encoding="ISO-8859-1"?><a>è</a>'.encode("iso-8859-1")
+    entry = FileMetadata(name="f.xml", path_lower="/fatture/2024/01/x/f.xml")
+    mock_dbx.files_list_folder.return_value = MagicMock(entries=[entry], cursor="c", has_more=False)
+    mock_dbx.files_download.return_value = (entry, MagicMock(content=contenuto))
+
+    risultato = scarica_tutti_xml_memoria(MagicMock())
+    assert risultato == {"f.xml": contenuto}
+
+
+def test_scarica_in_parallelo_limita_le_richieste_e_riprova():
+    from benchmarks.dropbox_finto import DropboxFinto, file_finti
+    from services.dropbox_service import scarica_tutti_xml_memoria
+
+    file = file_finti(60, dimensione=10)
+    percorsi = sorted(file)
+    # Il primo file fallisce due volte (poi riesce), il secondo sempre
+    client = DropboxFinto(file, latenza=0.01, per_pagina=25, errori={percorsi[0]: 2, percorsi[1]: 99})
+    logger = MagicMock()
+
+    with patch("services.dropbox_service.ATTESA_TENTATIVO", 0.0):
+        risultato = scarica_tutti_xml_memoria(logger, client=client, max_in_volo=4)
+
+    attesi = {p.rsplit("/", 1)[-1]: c for p, c in file.items() if p != percorsi[1]}
+    assert risultato == attesi
+    assert 1 < client.max_in_volo <= 4
+    assert client.download == 60 + 2 + 2  # file + tentativi ripetuti (3 per il secondo)
+    logger.error.assert_called_once()
+
+
+def test_scarica_in_parallelo_in_ordine_di_completamento():
+    import time
+    from types import SimpleNamespace
+    from services.dropbox_service import scarica_in_parallelo
+
+    class ClientLento:
+        def files_download(self, path):
+            time.sleep({"/lento": 0.2, "/medio": 0.1}.get(path, 0.0))
+            return None, SimpleNamespace(content=path.encode())
+
+    voci = [SimpleNamespace(path_lower=p) for p in ("/lento", "/medio", "/veloce")]
+    ordine = [voce.path_lower for voce, _, errore in scarica_in_parallelo(ClientLento(), voci, max_in_volo=3)]
+    assert ordine == ["/veloce", "/medio", "/lento"]
+
+
+def test_osservatore_sincronizza_sui_nuovi_file():
+    import threading
+    from benchmarks.dropbox_finto import DropboxFinto, file_finti
+    from services.dropbox_service import OsservatoreDropbox, elenca_xml
+
+    client = DropboxFinto(file_finti(3, dimensione=10))
+    cursori = []
+    sincronizzati = []
+    arrivato = threading.Event()
+
+    def sincronizza():
+        # Come il resync incrementale: elenca dal cursore salvato e lo fa avanzare
+        cursore = cursori[-1] if cursori else None
+        sincronizzati.extend(v.path_lower for v in elenca_xml(client, cursore=cursore, on_cursore=cursori.append))
+        arrivato.set()
+
+    sincronizza()
+    arrivato.clear()
+    osservatore = OsservatoreDropbox(sincronizza, lambda: cursori[-1], MagicMock(), client=client, timeout=1)
+    osservatore.avvia()
+    try:
+        client.aggiungi("/fatture/nuova.xml", b"<FatturaElettronica/>")
+        assert arrivato.wait(5)
+    finally:
+        osservatore.ferma()
+    assert len(sincronizzati) == 4 and sincronizzati[-1] == "/fatture/nuova.xml"
+
+
+def test_carica_xml_su_dropbox_in_blocco():
+    from benchmarks.dropbox_finto import DropboxFinto, file_finti
+    from services.dropbox_service import carica_xml_su_dropbox, IndiceDropbox
+
+    presenti = file_finti(3, dimensione=10)
+    client = DropboxFinto(presenti, latenza=0.005)
+    indice = IndiceDropbox(client)
+    nuovi = {f"/fatture/2024/01/Nuovo/ft_{i}.xml": b"<FatturaElettronica>%d</FatturaElettronica>" % i
+             for i in range(20)}
+    # Un file già su Dropbox (anche con maiuscole diverse) non viene ricaricato
+    gia_su_dropbox = sorted(presenti)[0].upper()
+    file = list(nuovi.items()) + [(gia_su_dropbox, b"altro")]
+
+    with patch("services.dropbox_service.BLOCCO_UPLOAD", 16):
+        esito = carica_xml_su_dropbox(file, client=client, indice=indice, max_in_volo=4)
+
+    assert sorted(esito["caricati"]) == sorted(nuovi) and esito["presenti"] == [gia_su_dropbox]
+    assert esito["errori"] == {}
+    assert all(client.file[p] == dati for p, dati in nuovi.items())
+    # Nessuna richiesta per file per controllare l'esistenza, una sola conferma in blocco
+    assert client.sessioni == 20 and client.batch == 1 and client.richieste_upload == 0
+
+    # L'indice sa già dei file caricati: il secondo giro non carica niente
+    esito = carica_xml_su_dropbox(file, client=client, indice=indice)
+    assert esito["caricati"] == [] and len(esito["presenti"]) == 21
+    assert client.sessioni == 20
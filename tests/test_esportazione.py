@@ -0,0 +1,117 @@
+# tests/test_esportazione.py
+
+import json
+import pytest
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from sqlalchemy.orm import sessionmaker
+
+from database.models import Base, Fattura, RigheFattura, DatiPagamento
+from database.migrazioni import esegui_migrazioni
+from services.esportazione import crea_engine_esportazione, esporta, FILE_STATO
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = crea_engine_esportazione(f"sqlite:///{tmp_path / 'export.db'}")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    yield engine
+    engine.dispose()
+
+
+def _aggiungi(engine, fatture):
+    with sessionmaker(bind=engine)() as db:
+        for numero, data, righe in fatture:
+            fattura = Fattura(numero=numero, data=data, fornitore="Alfa", totale=10.0 * righe)
+            fattura.righe = [RigheFattura(descrizione=f"riga {k}", importo_riga=10.0) for k in range(righe)]
+            fattura.pagamenti = [DatiPagamento(modalita_pagamento="MP05", data_scadenza_pagamento=data)]
+            db.add(fattura)
+        db.commit()
+
+
+def _leggi(dest, tabella, formato="parquet", partiziona=False):
+    return ds.dataset(dest / tabella, format="ipc" if formato == "arrow" else formato,
+                      partitioning="hive" if partiziona else None).to_table()
+
+
+@pytest.mark.parametrize("formato", ["parquet", "arrow"])
+def test_esportazione_completa_a_blocchi(engine, tmp_path, formato):
+    _aggiungi(engine, [(f"FT/{i}", date(2024, 1, 1 + i), 3) for i in range(7)])
+    dest = tmp_path / "export"
+
+    # Blocchi più piccoli delle tabelle: più record batch nello stesso file
+    esportate = esporta(engine, str(dest), formato=formato, blocco=4)
+
+    assert esportate == {"fatture": 7, "righe_fattura": 21, "dati_riepilogo_iva": 0, "dati_pagamento": 7}
+    fatture = _leggi(dest, "fatture", formato).sort_by("id")
+    assert fatture.column("numero").to_pylist() == [f"FT/{i}" for i in range(7)]
+    assert fatture.schema.field("data").type == pa.date32()
+    assert fatture.column("data")[0].as_py() == date(2024, 1, 1)
+    assert fatture.column("pagata").to_pylist() == [False] * 7
+    assert _leggi(dest, "righe_fattura", formato).num_rows == 21
+
+
+def test_partizioni_per_anno_e_mese(engine, tmp_path):
+    _aggiungi(engine, [("A", date(2024, 1, 5), 1), ("B", date(2024, 2, 5), 2),
+                       ("C", date(2024, 1, 20), 1), ("D", None, 1)])
+    dest = tmp_path / "export"
+
+    esporta(engine, str(dest), partiziona=True, blocco=2)
+
+    assert (dest / "fatture" / "anno=2024" / "mese=01" / "part-1-4.parquet").exists()
+    assert (dest / "righe_fattura" / "anno=2024" / "mese=02" / "part-1-5.parquet").exists()
+    assert (dest / "fatture" / "anno=0" / "mese=00" / "part-1-4.parquet").exists()
+    fatture = _leggi(dest, "fatture", partiziona=True)
+    per_mese = {(r["anno"], r["mese"], r["numero"]) for r in fatture.to_pylist()}
+    assert per_mese == {(2024, 1, "A"), (2024, 2, "B"), (2024, 1, "C"), (0, 0, "D")}
+    righe = _leggi(dest, "righe_fattura", partiziona=True)
+    assert sorted(r["mese"] for r in righe.to_pylist()) == [0, 1, 1, 2, 2]
+
+
+def test_esportazione_incrementale(engine, tmp_path):
+    dest = tmp_path / "export"
+    _aggiungi(engine, [("A", date(2024, 1, 5), 2)])
+    esporta(engine, str(dest), partiziona=True, incrementale=True)
+
+    _aggiungi(engine, [("B", date(2024, 1, 6), 1), ("C", date(2024, 3, 1), 1)])
+    esportate = esporta(engine, str(dest), partiziona=True, incrementale=True)
+
+    assert esportate["fatture"] == 2 and esportate["righe_fattura"] == 2
+    assert sorted(p.name for p in (dest / "fatture" / "anno=2024" / "mese=01").iterdir()) == [
+        "part-1-1.parquet", "part-2-3.parquet",
+    ]
+    assert sorted(_leggi(dest, "fatture", partiziona=True).column("numero").to_pylist()) == ["A", "B", "C"]
+    stato = json.loads((dest / FILE_STATO).read_text())
+    assert stato["ultimo_id"]["fatture"] == 3 and stato["ultimo_id"]["righe_fattura"] == 4
+
+    # Niente di nuovo: nessun file aggiunto
+    assert esporta(engine, str(dest), partiziona=True, incrementale=True)["fatture"] == 0
+    assert _leggi(dest, "fatture", partiziona=True).num_rows == 3
+
+    # Le opzioni devono restare quelle dell'esportazione esistente
+    with pytest.raises(ValueError):
+        esporta(engine, str(dest), partiziona=False, incrementale=True)
+
+
+def test_incrementale_dopo_cancellazione_dell_ultima(engine, tmp_path):
+    """
+    Cancellata la fattura più recente, la nuova non ne riprende l'id
+    (AUTOINCREMENT) e la prossima esportazione incrementale la include.
+    """
+    dest = tmp_path / "export"
+    _aggiungi(engine, [("A", date(2024, 1, 5), 1), ("B", date(2024, 1, 6), 1)])
+    esporta(engine, str(dest), incrementale=True)
+
+    with sessionmaker(bind=engine)() as db:
+        db.delete(db.query(Fattura).filter_by(numero="B").one())
+        db.commit()
+    _aggiungi(engine, [("C", date(2024, 1, 7), 1)])
+    esportate = esporta(engine, str(dest), incrementale=True)
+
+    assert esportate["fatture"] == 1 and esportate["righe_fattura"] == 1
+    fatture = _leggi(dest, "fatture").sort_by("id")
+    assert fatture.column("numero").to_pylist() == ["A", "B", "C"]
+    assert fatture.column("id").to_pylist() == [1, 2, 3]
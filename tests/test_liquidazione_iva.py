@@ -0,0 +1,72 @@
+# tests/test_liquidazione_iva.py
+
+import pytest
+from datetime import date
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.models import Base, Fattura, DatiRiepilogoIVA
+from services.liquidazione_iva import (
+    liquidazione_iva,
+    liquidazione_iva_sql,
+    totali_periodo,
+    RigaLiquidazione,
+    PERIODICITA_TRIMESTRALE,
+)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'liquidazione.db'}")
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all([
+            _fattura(date(2024, 1, 10), "TD01", [(22.0, None, "I", 100.0, 22.0), (0.0, "N2.2", "I", 50.0, 0.0)]),
+            _fattura(date(2024, 1, 25), "TD01", [(22.0, None, "I", 200.0, 44.0)]),
+            # Nota di credito: importi positivi nel tracciato, stornati in liquidazione
+            _fattura(date(2024, 2, 3), "TD04", [(22.0, None, "I", 50.0, 11.0)]),
+            _fattura(date(2024, 4, 1), "TD01", [(10.0, None, "S", 80.0, 8.0)]),
+            _fattura(date(2023, 12, 31), "TD01", [(22.0, None, "I", 999.0, 219.78)]),
+        ])
+        db.commit()
+    with engine.connect() as conn:
+        yield conn
+    engine.dispose()
+
+
+def _fattura(data, tipo, riepiloghi):
+    fattura = Fattura(data=data, tipo_documento=tipo)
+    fattura.riepiloghi_iva = [
+        DatiRiepilogoIVA(aliquota_iva=aliquota, natura=natura, esigibilita_iva=esigibilita,
+                         imponibile_importo=imponibile, imposta=imposta)
+        for aliquota, natura, esigibilita, imponibile, imposta in riepiloghi
+    ]
+    return fattura
+
+
+def test_liquidazione_mensile(conn):
+    righe = liquidazione_iva(conn, 2024)
+    assert righe == [
+        RigaLiquidazione(2024, 1, 0.0, "N2.2", "I", 1, 50.0, 0.0),
+        RigaLiquidazione(2024, 1, 22.0, "", "I", 2, 300.0, 66.0),
+        RigaLiquidazione(2024, 2, 22.0, "", "I", 1, -50.0, -11.0),
+        RigaLiquidazione(2024, 4, 10.0, "", "S", 1, 80.0, 8.0),
+    ]
+    assert righe == liquidazione_iva_sql(conn, 2024)
+
+
+def test_liquidazione_trimestrale(conn):
+    righe = liquidazione_iva(conn, periodicita=PERIODICITA_TRIMESTRALE)
+    assert righe == liquidazione_iva_sql(conn, periodicita=PERIODICITA_TRIMESTRALE)
+    assert totali_periodo(righe) == {
+        (2023, 4): (999.0, 219.78),
+        (2024, 1): (300.0, 55.0),
+        (2024, 2): (80.0, 8.0),
+    }
+
+
+def test_liquidazione_senza_riepiloghi(conn):
+    assert liquidazione_iva(conn, 2030) == []
+    assert liquidazione_iva_sql(conn, 2030) == []
+    with pytest.raises(ValueError):
+        liquidazione_iva(conn, 2024, periodicita="annuale")
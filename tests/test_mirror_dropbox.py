@@ -0,0 +1,73 @@
+# tests/test_mirror_dropbox.py
+
+import hashlib
+import os
+from unittest.mock import MagicMock
+
+from benchmarks.dropbox_finto import DropboxFinto, file_finti
+from services.dropbox_service import scarica_tutti_xml_memoria
+from services.mirror_dropbox import MirrorDropbox, content_hash_dropbox, BLOCCO_CONTENT_HASH
+
+
+def test_content_hash_a_blocchi():
+    dati = b"a" * BLOCCO_CONTENT_HASH + b"b"
+    atteso = hashlib.sha256(
+        hashlib.sha256(b"a" * BLOCCO_CONTENT_HASH).digest() + hashlib.sha256(b"b").digest()
+    ).hexdigest()
+    assert content_hash_dropbox(dati) == atteso
+    assert content_hash_dropbox(b"") == hashlib.sha256(b"").hexdigest()
+
+
+def test_salva_e_leggi(tmp_path):
+    mirror = MirrorDropbox(str(tmp_path), max_byte=1024)
+    dati = b"<FatturaElettronica/>"
+    content_hash = content_hash_dropbox(dati)
+
+    assert mirror.leggi(content_hash) is None
+    # Un contenuto che non corrisponde all'hash (download troncato) non entra
+    assert not mirror.salva(content_hash, dati[:-1])
+    assert mirror.salva(content_hash, dati)
+    assert mirror.leggi(content_hash) == dati
+    assert mirror.dimensione() == len(dati)
+
+    # Un file rovinato su disco viene scartato e rimosso
+    with open(mirror.percorso(content_hash), "wb") as f:
+        f.write(b"rovinato")
+    assert mirror.leggi(content_hash) is None
+    assert not os.path.exists(mirror.percorso(content_hash))
+
+
+def test_limite_rimuove_i_meno_usati(tmp_path):
+    mirror = MirrorDropbox(str(tmp_path), max_byte=300)
+    contenuti = [bytes([i]) * 100 for i in range(3)]
+    hash_ = [content_hash_dropbox(c) for c in contenuti]
+    for i, (content_hash, dati) in enumerate(zip(hash_, contenuti)):
+        mirror.salva(content_hash, dati)
+        os.utime(mirror.percorso(content_hash), (1000 + i, 1000 + i))
+    # Il primo, letto adesso, diventa il più recente
+    assert mirror.leggi(hash_[0]) == contenuti[0]
+
+    mirror.salva(content_hash_dropbox(b"z" * 100), b"z" * 100)
+    assert mirror.leggi(hash_[1]) is None
+    assert mirror.leggi(hash_[0]) == contenuti[0]
+    assert mirror.dimensione() <= 300
+
+    # Il conteggio riparte dal disco
+    assert MirrorDropbox(str(tmp_path), max_byte=300).dimensione() == mirror.dimensione()
+
+
+def test_ricostruzione_servita_dal_mirror(tmp_path):
+    file = file_finti(30, dimensione=10)
+    mirror = MirrorDropbox(str(tmp_path))
+
+    client = DropboxFinto(file, per_pagina=7)
+    primo = scarica_tutti_xml_memoria(MagicMock(), client=client, mirror=mirror)
+    assert client.download == 30
+
+    # Un file modificato è l'unico che torna in rete
+    percorso = sorted(file)[0]
+    file[percorso] = b"<FatturaElettronica>nuova</FatturaElettronica>"
+    client = DropboxFinto(file, per_pagina=7)
+    secondo = scarica_tutti_xml_memoria(MagicMock(), client=client, mirror=mirror)
+    assert client.download == 1
+    assert secondo == {**primo, percorso.rsplit("/", 1)[-1]: file[percorso]}
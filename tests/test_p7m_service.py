@@ -0,0 +1,153 @@
+# tests/test_p7m_service.py
+
+import base64
+import shutil
+import subprocess
+import pytest
+from datetime import datetime, timezone
+
+from services.p7m_service import estrai_contenuto_p7m, estrai_firmatari, ErroreP7M
+from services.parser_fatture import decode_p7m_to_xml, decode_p7m_openssl
+
+XML = b'<?xml version="1.0" encoding="UTF-8"?><FatturaElettronica><Numero>1</Numero></FatturaElettronica>'
+
+# --- Mini encoder DER, solo per costruire buste di prova -------------------
+
+def _tlv(tag, contenuto):
+    n = len(contenuto)
+    if n < 0x80:
+        lunghezza = bytes([n])
+    else:
+        b = n.to_bytes((n.bit_length() + 7) // 8, "big")
+        lunghezza = bytes([0x80 | len(b)]) + b
+    return bytes([tag]) + lunghezza + contenuto
+
+def _seq(*figli):
+    return _tlv(0x30, b"".join(figli))
+
+def _set(*figli):
+    return _tlv(0x31, b"".join(figli))
+
+def _oid(testo):
+    valori = [int(v) for v in testo.split(".")]
+    corpo = bytes([valori[0] * 40 + valori[1]])
+    for v in valori[2:]:
+        pezzi = [v & 0x7F]
+        v >>= 7
+        while v:
+            pezzi.append(0x80 | (v & 0x7F))
+            v >>= 7
+        corpo += bytes(reversed(pezzi))
+    return _tlv(0x06, corpo)
+
+def _ctx(n, contenuto):
+    return _tlv(0xA0 | n, contenuto)
+
+def _nome(cn, serial):
+    return _seq(
+        _set(_seq(_oid("2.5.4.6"), _tlv(0x13, b"IT"))),
+        _set(_seq(_oid("2.5.4.3"), _tlv(0x0C, cn.encode("utf-8")))),
+        _set(_seq(_oid("2.5.4.5"), _tlv(0x13, serial.encode()))),
+    )
+
+def _busta(contenuto_econtent, data_firma=b"240131103000Z"):
+    emittente = _nome("CA Firma Qualificata", "CA-1")
+    soggetto = _nome("Mario Rossì", "TINIT-RSSMRA80A01H501U")
+    serie = _tlv(0x02, b"\x12\x34")
+    algoritmo = _seq(_oid("2.16.840.1.101.3.4.2.1"))
+    certificato = _seq(_seq(_ctx(0, _tlv(0x02, b"\x02")), serie, algoritmo, emittente, _seq(), soggetto))
+    signer_info = _seq(
+        _tlv(0x02, b"\x01"),
+        _seq(emittente, serie),
+        algoritmo,
+        _ctx(0, _seq(_oid("1.2.840.113549.1.9.5"), _set(_tlv(0x17, data_firma)))),
+        algoritmo,
+        _tlv(0x04, b"firma"),
+    )
+    signed_data = _seq(
+        _tlv(0x02, b"\x01"),
+        _set(algoritmo),
+        _seq(_oid("1.2.840.113549.1.7.1"), _ctx(0, contenuto_econtent)),
+        _ctx(0, certificato),
+        _set(signer_info),
+    )
+    return _seq(_oid("1.2.840.113549.1.7.2"), _ctx(0, signed_data))
+
+# ---------------------------------------------------------------------------
+
+def test_estrai_contenuto_der():
+    assert estrai_contenuto_p7m(_busta(_tlv(0x04, XML))) == XML
+
+def test_estrai_contenuto_pem_e_base64():
+    der = _busta(_tlv(0x04, XML))
+    b64 = base64.encodebytes(der)
+    pem = b"-----BEGIN PKCS7-----\n" + b64 + b"-----END PKCS7-----\n"
+    assert estrai_contenuto_p7m(pem) == XML
+    assert estrai_contenuto_p7m(b64) == XML
+    assert estrai_contenuto_p7m(b64.decode("ascii")) == XML
+
+def test_estrai_contenuto_ber_a_blocchi():
+    """
+    OCTET STRING costruito a lunghezza indefinita, come lo producono alcuni software di firma.
+    """
+    blocchi = b"".join(_tlv(0x04, XML[i:i + 16]) for i in range(0, len(XML), 16))
+    ber = b"\x24\x80" + blocchi + b"\x00\x00"
+    assert estrai_contenuto_p7m(_busta(ber)) == XML
+
+def test_estrai_contenuto_busta_nidificata():
+    interna = _busta(_tlv(0x04, XML))
+    assert estrai_contenuto_p7m(_busta(_tlv(0x04, interna))) == XML
+
+def test_estrai_contenuto_non_valido():
+    with pytest.raises(ErroreP7M):
+        estrai_contenuto_p7m(XML)
+    with pytest.raises(ErroreP7M):
+        estrai_contenuto_p7m(_busta(_tlv(0x04, XML))[:40])
+
+def test_estrai_firmatari():
+    firmatari = estrai_firmatari(_busta(_tlv(0x04, XML)))
+    assert len(firmatari) == 1
+    f = firmatari[0]
+    assert f["numero_serie_certificato"] == "1234"
+    assert f["emittente"]["common_name"] == "CA Firma Qualificata"
+    assert f["soggetto"] == {
+        "paese": "IT",
+        "common_name": "Mario Rossì",
+        "numero_serie_soggetto": "TINIT-RSSMRA80A01H501U",
+    }
+    assert f["data_firma"] == datetime(2024, 1, 31, 10, 30, tzinfo=timezone.utc)
+
+def test_estrai_firmatari_data_firma_troncata():
+    with pytest.raises(ErroreP7M):
+        estrai_firmatari(_busta(_tlv(0x04, XML), data_firma=b"2401311"))
+    with pytest.raises(ErroreP7M):
+        estrai_firmatari(_busta(_tlv(0x04, XML), data_firma=b"241331103000Z"))  # mese 13
+
+def test_decode_p7m_to_xml_senza_openssl(monkeypatch):
+    """
+    Il decoder interno non deve lanciare processi esterni.
+    """
+    def vietato(*args, **kwargs):
+        raise AssertionError("subprocess non atteso")
+    monkeypatch.setattr(subprocess, "run", vietato)
+    assert decode_p7m_to_xml(_busta(_tlv(0x04, XML))) == XML
+
+@pytest.mark.skipif(shutil.which("openssl") is None, reason="openssl non disponibile")
+def test_stesso_risultato_di_openssl(tmp_path):
+    """
+    Su una busta firmata davvero, il decoder interno e openssl devono coincidere.
+    """
+    chiave, cert = tmp_path / "k.pem", tmp_path / "c.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", str(chiave),
+         "-out", str(cert), "-subj", "/CN=Firmatario Test/C=IT", "-days", "1"],
+        check=True, capture_output=True,
+    )
+    firmato = subprocess.run(
+        ["openssl", "smime", "-sign", "-binary", "-nodetach", "-outform", "DER",
+         "-signer", str(cert), "-inkey", str(chiave)],
+        input=XML, check=True, capture_output=True,
+    ).stdout
+
+    assert estrai_contenuto_p7m(firmato) == decode_p7m_openssl(firmato) == XML
+    assert estrai_firmatari(firmato)[0]["soggetto"]["common_name"] == "Firmatario Test"
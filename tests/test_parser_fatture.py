@@ -1,6 +1,7 @@
 # tests/test_parser_fatture.py
 
 import os
+import re
 import pytest
 from services.parser_fatture import parse_fattura_xml
 
@@ -50,3 +51,642 @@ def test_parse_fattura_xml_minimal(tmp_path):
     assert fattura.totale == 100.50
     assert len(fattura.righe) == 1
     assert fattura.righe[0].descrizione == "Servizio di prova"
+
+XML_COMPLETO = """<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12" xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+    <FatturaElettronicaHeader>
+        <DatiTrasmissione>
+            <IdTrasmittente>
+                <IdPaese>IT</IdPaese>
+                <IdCodice>01234567890</IdCodice>
+            </IdTrasmittente>
+            <ProgressivoInvio>00001</ProgressivoInvio>
+            <FormatoTrasmissione>FPR12</FormatoTrasmissione>
+            <CodiceDestinatario>0000000</CodiceDestinatario>
+        </DatiTrasmissione>
+        <CedentePrestatore>
+            <DatiAnagrafici>
+                <IdFiscaleIVA>
+                    <IdPaese>IT</IdPaese>
+                    <IdCodice>01234567890</IdCodice>
+                </IdFiscaleIVA>
+                <Anagrafica>
+                    <Denominazione>Fornitore Srl</Denominazione>
+                </Anagrafica>
+            </DatiAnagrafici>
+        </CedentePrestatore>
+        <CessionarioCommittente>
+            <DatiAnagrafici>
+                <Anagrafica>
+                    <Denominazione>Cliente Spa</Denominazione>
+                </Anagrafica>
+            </DatiAnagrafici>
+        </CessionarioCommittente>
+    </FatturaElettronicaHeader>
+    <FatturaElettronicaBody>
+        <DatiGenerali>
+            <DatiGeneraliDocumento>
+                <TipoDocumento>TD01</TipoDocumento>
+                <Divisa>EUR</Divisa>
+                <Data>2024-05-31</Data>
+                <Numero>FT/77</Numero>
+                <ImportoTotaleDocumento>36.60</ImportoTotaleDocumento>
+                <Causale>Prima parte</Causale>
+                <Causale>seconda parte</Causale>
+            </DatiGeneraliDocumento>
+        </DatiGenerali>
+        <DatiBeniServizi>
+            <DettaglioLinee>
+                <Descrizione>Riga uno</Descrizione>
+                <PrezzoUnitario>10.00</PrezzoUnitario>
+                <PrezzoTotale>10.00</PrezzoTotale>
+            </DettaglioLinee>
+            <DettaglioLinee>
+                <Descrizione>Riga due</Descrizione>
+                <Quantita>2.00</Quantita>
+                <PrezzoUnitario>10.00</PrezzoUnitario>
+                <PrezzoTotale>20.00</PrezzoTotale>
+            </DettaglioLinee>
+            <DatiRiepilogo>
+                <AliquotaIVA>22.00</AliquotaIVA>
+                <ImponibileImporto>30.00</ImponibileImporto>
+                <Imposta>6.60</Imposta>
+                <EsigibilitaIVA>I</EsigibilitaIVA>
+            </DatiRiepilogo>
+        </DatiBeniServizi>
+        <DatiPagamento>
+            <CondizioniPagamento>TP02</CondizioniPagamento>
+            <DettaglioPagamento>
+                <ModalitaPagamento>MP05</ModalitaPagamento>
+                <DataScadenzaPagamento>2024-06-30</DataScadenzaPagamento>
+                <ImportoPagamento>36.60</ImportoPagamento>
+            </DettaglioPagamento>
+        </DatiPagamento>
+    </FatturaElettronicaBody>
+</p:FatturaElettronica>
+"""
+
+def test_parse_fattura_xml_motori_equivalenti():
+    """
+    Il motore streaming deve produrre gli stessi dati del motore XPath.
+    """
+    f_xpath = parse_fattura_xml(XML_COMPLETO, is_memory=True, engine="xpath")
+    f_stream = parse_fattura_xml(XML_COMPLETO, is_memory=True, engine="stream")
+
+    for f in (f_xpath, f_stream):
+        assert f.numero == "FT/77"
+        assert str(f.data) == "2024-05-31"
+        assert f.fornitore == "Fornitore Srl"
+        assert f.totale == 36.60
+
+    assert f_stream.hash_xml == f_xpath.hash_xml
+    righe = lambda f: [(r.descrizione, r.quantita, r.prezzo_unitario, r.importo_riga) for r in f.righe]
+    assert righe(f_stream) == righe(f_xpath)
+    assert righe(f_stream)[0] == ("Riga uno", 1.0, 10.0, 10.0)
+    riep = lambda f: [(r.aliquota_iva, r.imponibile_importo, r.imposta, r.esigibilita_iva) for r in f.riepiloghi_iva]
+    assert riep(f_stream) == riep(f_xpath) == [(22.0, 30.0, 6.60, "I")]
+
+def test_parse_fattura_xml_campi_tracciato():
+    """
+    Le colonne mappate in services.tracciato_fatturapa vengono valorizzate da entrambi i motori.
+    """
+    for engine in ("xpath", "stream"):
+        f = parse_fattura_xml(XML_COMPLETO, is_memory=True, engine=engine)
+        assert f.formato_trasmissione == "FPR12"
+        assert f.cedente_id_codice == "01234567890"
+        assert f.cessionario_denominazione == "Cliente Spa"
+        assert f.tipo_documento == "TD01"
+        assert f.numero_documento == "FT/77"
+        assert f.causale == "Prima parte seconda parte"
+        assert str(f.data_scadenza) == "2024-06-30"
+        assert [r.numero_linea for r in f.righe] == [None, None]
+        assert len(f.pagamenti) == 1
+        pag = f.pagamenti[0]
+        assert (pag.condizioni_pagamento, pag.modalita_pagamento, pag.importo_pagamento) == ("TP02", "MP05", 36.60)
+
+def test_parse_fattura_xml_namespace_di_default():
+    """
+    Documenti che qualificano anche i figli (xmlns di default) usano il registro per quel namespace.
+    """
+    xml_default_ns = XML_COMPLETO.replace("p:FatturaElettronica", "FatturaElettronica").replace("xmlns:p=", "xmlns=")
+    for engine in ("xpath", "stream"):
+        f = parse_fattura_xml(xml_default_ns, is_memory=True, engine=engine)
+        assert f.numero == "FT/77"
+        assert f.fornitore == "Fornitore Srl"
+        assert len(f.righe) == 2
+        assert len(f.pagamenti) == 1
+
+def test_parse_fattura_xml_motore_sconosciuto():
+    with pytest.raises(ValueError):
+        parse_fattura_xml(XML_COMPLETO, is_memory=True, engine="sax")
+
+def test_registro_xpath_compilato_una_volta():
+    from services.tracciato_fatturapa import xpath_per_namespace, NS_FATTURA_V12
+    assert xpath_per_namespace(NS_FATTURA_V12) is xpath_per_namespace(NS_FATTURA_V12)
+    altro = xpath_per_namespace("urn:gestionale:sconosciuto")
+    assert altro is xpath_per_namespace("urn:gestionale:sconosciuto")
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parse_fatture_batch_ordinato_con_errori(workers):
+    """
+    parse_fatture_batch restituisce blocchi ordinati di record picklabili
+    e un errore per ogni file non parsabile.
+    """
+    import pickle
+    from services.parser_fatture import parse_fatture_batch, fattura_da_record
+
+    documenti = [(f"f{i}.xml", XML_COMPLETO.replace("FT/77", f"FT/{i}")) for i in range(7)]
+    documenti.insert(3, ("rotto.xml", "<FatturaElettronica><non chiuso"))
+
+    blocchi = list(parse_fatture_batch(documenti, workers=workers, chunk_size=3))
+
+    assert [len(b) for b in blocchi] == [3, 3, 2]
+    esiti = [e for b in blocchi for e in b]
+    assert [e["nome"] for e in esiti] == [nome for nome, _ in documenti]
+
+    rotto = esiti[3]
+    assert rotto["record"] is None
+    assert "XMLSyntaxError" in rotto["errore"]
+
+    validi = [e for e in esiti if e["errore"] is None]
+    assert [e["record"]["fattura"]["numero"] for e in validi] == [f"FT/{i}" for i in range(7)]
+    record = pickle.loads(pickle.dumps(validi[0]["record"]))
+    fattura = fattura_da_record(record)
+    assert fattura.numero == "FT/0"
+    assert len(fattura.righe) == 2
+
+def test_parse_fattura_xml_encoding_dichiarato(tmp_path):
+    """
+    I byte vengono passati a lxml così come sono: un file ISO-8859-1 dichiarato
+    nel prologo viene letto correttamente, e l'hash è quello dei byte originali.
+    """
+    import hashlib
+    xml_latin1 = XML_COMPLETO.replace('encoding="UTF-8"', 'encoding="ISO-8859-1"').replace(
+        "Fornitore Srl", "Caffè Città Srl").encode("iso-8859-1")
+    xml_file = tmp_path / "latin1.xml"
+    xml_file.write_bytes(xml_latin1)
+
+    for fattura in (parse_fattura_xml(str(xml_file)),
+                    parse_fattura_xml(xml_latin1, is_memory=True, engine="stream")):
+        assert fattura.fornitore == "Caffè Città Srl"
+        assert fattura.hash_xml == hashlib.sha256(xml_latin1).hexdigest()
+        assert "Caffè Città Srl" in fattura.xml_raw
+
+def test_fatture_non_utf8_importate_con_hash_precedente(tmp_path):
+    """
+    Un file non UTF-8 importato dalle versioni precedenti (hash del testo
+    ricodificato in UTF-8) è riconosciuto come già importato.
+    """
+    import hashlib
+    from sqlalchemy.orm import Session
+    from database.db_session import crea_engine
+    from database.models import Base, Fattura
+    from services.parser_fatture import (
+        calcola_hash_legacy, iter_record_fattura, salva_blocco_fatture, salva_fattura, scarta_documenti_noti,
+    )
+
+    xml_latin1 = XML_COMPLETO.replace('encoding="UTF-8"', 'encoding="ISO-8859-1"').replace(
+        "Fornitore Srl", "Caffè Città Srl").encode("iso-8859-1")
+    legacy = hashlib.sha256(xml_latin1.decode("latin-1").encode("utf-8")).hexdigest()
+    assert calcola_hash_legacy(xml_latin1) == legacy
+    assert calcola_hash_legacy(XML_COMPLETO.encode("utf-8")) is None
+
+    statistiche = {}
+    assert list(scarta_documenti_noti([("vecchio.xml", xml_latin1)], {legacy}, statistiche)) == []
+    assert statistiche["saltati_noti"] == 1
+
+    engine = crea_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add(Fattura(numero="FT/77", hash_xml=legacy))
+        db.commit()
+        record = next(iter_record_fattura(xml_latin1))
+        assert salva_blocco_fatture(db, [record]) == {"inseriti": [], "saltati": [record["hash_xml"]]}
+        assert salva_fattura(db, parse_fattura_xml(xml_latin1, is_memory=True)).hash_xml == legacy
+        assert db.query(Fattura).count() == 1
+    engine.dispose()
+
+def test_parse_fattura_xml_stringa_con_prologo_non_utf8():
+    """
+    Una stringa già decodificata resta valida anche se il prologo dichiara un altro encoding.
+    """
+    xml_str = XML_COMPLETO.replace('encoding="UTF-8"', 'encoding="windows-1252"').replace("Fornitore Srl", "Società €uro")
+    for engine in ("xpath", "stream"):
+        assert parse_fattura_xml(xml_str, is_memory=True, engine=engine).fornitore == "Società €uro"
+
+def test_scarta_documenti_noti_prima_del_parsing():
+    """
+    I documenti con hash già noto (o ripetuti nello stesso lotto) non arrivano al parser.
+    """
+    from services.parser_fatture import scarta_documenti_noti, calcola_hash_xml
+
+    nuovo = XML_COMPLETO.encode("utf-8")
+    noto = XML_COMPLETO.replace("FT/77", "FT/1").encode("utf-8")
+    hash_noti = {calcola_hash_xml(noto)}
+    statistiche = {}
+
+    passati = list(scarta_documenti_noti(
+        [("noto.xml", noto), ("nuovo.xml", nuovo), ("copia.xml", nuovo)], hash_noti, statistiche))
+
+    assert passati == [("nuovo.xml", nuovo)]
+    assert statistiche["saltati_noti"] == 2
+
+def test_carica_hash_noti():
+    from database.db_session import init_db
+    from services.parser_fatture import carica_hash_noti, salva_fattura_su_db
+
+    init_db()
+    fattura = parse_fattura_xml(XML_COMPLETO.replace("FT/77", "FT/HASH").encode("utf-8"), is_memory=True)
+    salva_fattura_su_db(fattura)
+    assert fattura.hash_xml in carica_hash_noti()
+
+def _lotto(n_corpi):
+    """
+    Lotto di fatture: la testata di XML_COMPLETO e `n_corpi` body, ognuno con numero e righe propri.
+    """
+    inizio = XML_COMPLETO.index("<FatturaElettronicaBody>")
+    fine = XML_COMPLETO.index("</FatturaElettronicaBody>") + len("</FatturaElettronicaBody>")
+    corpo = XML_COMPLETO[inizio:fine]
+    corpi = "".join(
+        corpo.replace("FT/77", f"L/{i}").replace("Riga uno", f"Riga uno body {i}")
+        for i in range(1, n_corpi + 1)
+    )
+    return XML_COMPLETO[:inizio] + corpi + XML_COMPLETO[fine:]
+
+@pytest.mark.parametrize("engine", ["xpath", "stream"])
+def test_iter_fatture_xml_lotto(engine):
+    """
+    Un file con più FatturaElettronicaBody produce una Fattura per body,
+    con la testata condivisa e righe non mescolate.
+    """
+    from services.parser_fatture import iter_fatture_xml, calcola_hash_xml
+
+    xml_lotto = _lotto(3).encode("utf-8")
+    fatture = list(iter_fatture_xml(xml_lotto, is_memory=True, engine=engine))
+
+    assert [f.numero for f in fatture] == ["L/1", "L/2", "L/3"]
+    assert all(f.fornitore == "Fornitore Srl" and f.formato_trasmissione == "FPR12" for f in fatture)
+    assert [len(f.righe) for f in fatture] == [2, 2, 2]
+    assert fatture[1].righe[0].descrizione == "Riga uno body 2"
+    assert [len(f.pagamenti) for f in fatture] == [1, 1, 1]
+
+    # Hash univoci; il primo body conserva l'hash del file
+    assert fatture[0].hash_xml == calcola_hash_xml(xml_lotto)
+    assert len({f.hash_xml for f in fatture}) == 3
+
+    # Ogni xml_raw è un documento autonomo con testata e un solo body
+    for i, f in enumerate(fatture, 1):
+        singola = parse_fattura_xml(f.xml_raw, is_memory=True)
+        assert singola.numero == f"L/{i}"
+        assert singola.fornitore == "Fornitore Srl"
+        assert f.xml_raw.count("<FatturaElettronicaBody>") == 1
+
+@pytest.mark.parametrize("engine", ["xpath", "stream"])
+def test_lotto_deciso_dai_body_letti(engine):
+    """
+    Un body commentato non fa di un file un lotto, e non sfalsa il ritaglio
+    dei body di un lotto vero.
+    """
+    from services.parser_fatture import iter_record_fattura, calcola_hash_xml
+
+    inizio = XML_COMPLETO.index("<FatturaElettronicaBody>")
+    commento = "<!-- <FatturaElettronicaBody></FatturaElettronicaBody> -->"
+    singola = (XML_COMPLETO[:inizio] + commento + XML_COMPLETO[inizio:]).encode("utf-8")
+    records = list(iter_record_fattura(singola, engine=engine))
+    assert len(records) == 1
+    assert records[0]["hash_xml"] == calcola_hash_xml(singola) and records[0]["xml_raw"] == singola
+
+    lotto = _lotto(2)
+    inizio = lotto.index("<FatturaElettronicaBody>")
+    lotto = (lotto[:inizio] + commento + lotto[inizio:]).encode("utf-8")
+    records = list(iter_record_fattura(lotto, engine=engine))
+    assert [r["fattura"]["numero"] for r in records] == ["L/1", "L/2"]
+    assert len({r["hash_xml"] for r in records}) == 2
+    for n, r in enumerate(records, 1):
+        (singola,) = iter_record_fattura(r["xml_raw"], engine=engine)
+        assert singola["fattura"]["numero"] == f"L/{n}"
+
+@pytest.mark.parametrize("engine", ["xpath", "stream"])
+def test_lotto_letto_un_body_alla_volta(engine, monkeypatch):
+    """
+    Per capire se è un lotto bastano i primi due body: gli altri vengono
+    letti solo quando servono.
+    """
+    from services import parser_fatture
+
+    letti = []
+
+    def contati(estrai):
+        def estrai_contati(*args, **kwargs):
+            for dati in estrai(*args, **kwargs):
+                letti.append(dati["fattura"]["numero"])
+                yield dati
+        return estrai_contati
+
+    monkeypatch.setattr(parser_fatture, "_estrai_dati_xpath", contati(parser_fatture._estrai_dati_xpath))
+    monkeypatch.setattr(parser_fatture, "iter_dati_stream", contati(parser_fatture.iter_dati_stream))
+
+    records = parser_fatture.iter_record_fattura(_lotto(5).encode("utf-8"), engine=engine)
+    assert next(records)["fattura"]["numero"] == "L/1"
+    assert letti == ["L/1", "L/2"]
+    assert next(records)["fattura"]["numero"] == "L/2"
+    assert next(records)["fattura"]["numero"] == "L/3"
+    assert letti == ["L/1", "L/2", "L/3"]
+    assert [r["corpo"] for r in records] == [4, 5]
+
+def test_parse_fatture_batch_lotto():
+    from services.parser_fatture import parse_fatture_batch
+
+    documenti = [("lotto.xml", _lotto(2).encode("utf-8")), ("singola.xml", XML_COMPLETO.encode("utf-8"))]
+    esiti = [e for b in parse_fatture_batch(documenti, workers=1) for e in b]
+    assert [e["nome"] for e in esiti] == ["lotto.xml", "lotto.xml#2", "singola.xml"]
+    assert [e["record"]["fattura"]["numero"] for e in esiti] == ["L/1", "L/2", "FT/77"]
+    # L'XML arriva dai worker già compresso
+    from services.parser_fatture import fattura_da_record
+    assert all("xml_raw" not in e["record"] for e in esiti)
+    assert fattura_da_record(esiti[2]["record"]).xml_raw == XML_COMPLETO
+
+def test_parse_fattura_xml_lotto_prima_fattura():
+    fattura = parse_fattura_xml(_lotto(2), is_memory=True)
+    assert fattura.numero == "L/1"
+    assert len(fattura.righe) == 2
+
+@pytest.mark.parametrize("engine", ["xpath", "stream"])
+def test_allegati_salvati_su_disco(engine, tmp_path, monkeypatch):
+    """
+    Gli <Allegati> vengono decodificati durante il parsing ma scritti
+    nell'archivio su disco (una volta sola) solo al commit della fattura;
+    nella Fattura e nell'XML salvato resta il riferimento SHA-256.
+    """
+    import base64
+    import hashlib
+    from sqlalchemy.orm import Session
+    from database.db_session import crea_engine
+    from database.models import Base
+    from services import allegati_store
+    from services.parser_fatture import salva_fattura
+
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path / "allegati"))
+    pdf = b"%PDF-1.4 allegato di prova" * 100
+    codificato = base64.encodebytes(pdf).decode("ascii")  # con gli a capo, come nei file reali
+    blocco = (
+        "<Allegati><NomeAttachment>fattura.pdf</NomeAttachment>"
+        "<FormatoAttachment>PDF</FormatoAttachment>"
+        "<DescrizioneAttachment>Copia cortesia</DescrizioneAttachment>"
+        f"<Attachment>{codificato}</Attachment></Allegati>"
+    )
+    xml = XML_COMPLETO.replace("</FatturaElettronicaBody>", blocco * 2 + "</FatturaElettronicaBody>")
+
+    fattura = parse_fattura_xml(xml.encode("utf-8"), is_memory=True, engine=engine)
+
+    sha256 = hashlib.sha256(pdf).hexdigest()
+    assert [(a.nome_attachment, a.formato_attachment, a.descrizione_attachment, a.sha256) for a in fattura.allegati] == [
+        ("fattura.pdf", "PDF", "Copia cortesia", sha256)
+    ] * 2
+    assert all(a.attachment is None for a in fattura.allegati)
+    assert not allegati_store.esiste_allegato(sha256)
+    assert codificato not in fattura.xml_raw
+    assert fattura.xml_raw.count(f"<Attachment>sha256:{sha256}</Attachment>") == 2
+    # Decodificato una volta sola in un file in arrivo, fuori dall'archivio
+    in_arrivo = tmp_path / "allegati" / ".in_arrivo"
+    assert len(os.listdir(in_arrivo)) == 1
+
+    engine_db = crea_engine(f"sqlite:///{tmp_path / 'allegati.db'}")
+    Base.metadata.create_all(engine_db)
+    with Session(engine_db) as db:
+        salva_fattura(db, fattura)
+        db.rollback()
+        assert not allegati_store.esiste_allegato(sha256)
+        assert os.listdir(in_arrivo) == []
+
+        fattura = parse_fattura_xml(xml.encode("utf-8"), is_memory=True, engine=engine)
+        testo = fattura.xml_raw
+        salva_fattura(db, fattura)
+        db.commit()
+    engine_db.dispose()
+
+    assert allegati_store.leggi_allegato(sha256) == pdf
+    assert os.listdir(in_arrivo) == []
+    # Stesso contenuto, un solo file
+    assert os.listdir(tmp_path / "allegati" / sha256[:2]) == [sha256]
+    # Il documento integrale si ricompone dall'archivio
+    reinserito = allegati_store.reinserisci_allegati(testo)
+    assert [base64.b64decode(t) for t in re.findall(r"<Attachment>(.*?)</Attachment>", reinserito)] == [pdf, pdf]
+
+def test_allegati_dai_worker_come_file(tmp_path, monkeypatch):
+    """
+    Dai processi worker i record arrivano con il path dei file in arrivo,
+    non con i byte degli allegati; quelli di fatture già presenti si cancellano.
+    """
+    import base64
+    import hashlib
+    from services import allegati_store
+    from services.parser_fatture import parse_fatture_batch, salva_blocco_fatture
+    from sqlalchemy.orm import Session
+    from database.db_session import crea_engine
+    from database.models import Base
+
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path / "allegati"))
+    monkeypatch.setenv("ALLEGATI_DIR", str(tmp_path / "allegati"))  # letta dai worker all'import
+    pdf = b"%PDF-1.4 dal worker" * 50
+    blocco = f"<Allegati><NomeAttachment>a.pdf</NomeAttachment><Attachment>{base64.b64encode(pdf).decode()}</Attachment></Allegati>"
+    xml = XML_COMPLETO.replace("</FatturaElettronicaBody>", blocco + "</FatturaElettronicaBody>").encode("utf-8")
+
+    (esito,), = parse_fatture_batch([("a.xml", xml)], workers=2)
+    record = esito["record"]
+    sha256 = hashlib.sha256(pdf).hexdigest()
+    (percorso,) = record["allegati_in_arrivo"].values()
+    assert list(record["allegati_in_arrivo"]) == [sha256]
+    with open(percorso, "rb") as f:
+        assert f.read() == pdf
+    assert not any(isinstance(v, bytes) for al in record["allegati"] for v in al.values())
+
+    engine_db = crea_engine(f"sqlite:///{tmp_path / 'worker.db'}")
+    Base.metadata.create_all(engine_db)
+    with Session(engine_db) as db:
+        assert salva_blocco_fatture(db, [record])["inseriti"] == [record["hash_xml"]]
+        db.commit()
+        assert allegati_store.leggi_allegato(sha256) == pdf and not os.path.exists(percorso)
+
+        # Di nuovo: la fattura c'è già e il file in arrivo viene cancellato
+        (esito,), = parse_fatture_batch([("a.xml", xml)], workers=1)
+        assert salva_blocco_fatture(db, [esito["record"]])["saltati"] == [record["hash_xml"]]
+        db.commit()
+    engine_db.dispose()
+    assert os.listdir(tmp_path / "allegati" / ".in_arrivo") == []
+
+XML_VALIDO = """<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12" xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+    <FatturaElettronicaHeader>
+        <DatiTrasmissione>
+            <IdTrasmittente><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdTrasmittente>
+            <ProgressivoInvio>00001</ProgressivoInvio>
+            <FormatoTrasmissione>FPR12</FormatoTrasmissione>
+            <CodiceDestinatario>0000000</CodiceDestinatario>
+        </DatiTrasmissione>
+        <CedentePrestatore>
+            <DatiAnagrafici>
+                <IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdFiscaleIVA>
+                <Anagrafica><Denominazione>Fornitore Srl</Denominazione></Anagrafica>
+                <RegimeFiscale>RF01</RegimeFiscale>
+            </DatiAnagrafici>
+            <Sede><Indirizzo>Via Roma 1</Indirizzo><CAP>00100</CAP><Comune>Roma</Comune><Nazione>IT</Nazione></Sede>
+        </CedentePrestatore>
+        <CessionarioCommittente>
+            <DatiAnagrafici>
+                <CodiceFiscale>RSSMRA80A01H501U</CodiceFiscale>
+                <Anagrafica><Denominazione>Cliente Spa</Denominazione></Anagrafica>
+            </DatiAnagrafici>
+            <Sede><Indirizzo>Via Milano 2</Indirizzo><CAP>20100</CAP><Comune>Milano</Comune><Nazione>IT</Nazione></Sede>
+        </CessionarioCommittente>
+    </FatturaElettronicaHeader>
+    <FatturaElettronicaBody>
+        <DatiGenerali>
+            <DatiGeneraliDocumento>
+                <TipoDocumento>TD01</TipoDocumento>
+                <Divisa>EUR</Divisa>
+                <Data>2024-05-31</Data>
+                <Numero>V/1</Numero>
+                <ImportoTotaleDocumento>12.20</ImportoTotaleDocumento>
+            </DatiGeneraliDocumento>
+        </DatiGenerali>
+        <DatiBeniServizi>
+            <DettaglioLinee>
+                <NumeroLinea>1</NumeroLinea>
+                <Descrizione>Riga valida</Descrizione>
+                <PrezzoUnitario>10.00</PrezzoUnitario>
+                <PrezzoTotale>10.00</PrezzoTotale>
+                <AliquotaIVA>22.00</AliquotaIVA>
+            </DettaglioLinee>
+            <DatiRiepilogo>
+                <AliquotaIVA>22.00</AliquotaIVA>
+                <ImponibileImporto>10.00</ImponibileImporto>
+                <Imposta>2.20</Imposta>
+            </DatiRiepilogo>
+        </DatiBeniServizi>
+    </FatturaElettronicaBody>
+</p:FatturaElettronica>
+"""
+
+def test_schema_xsd_compilato_una_volta():
+    from services.validazione_xsd import schema_fatturapa
+    assert schema_fatturapa() is schema_fatturapa()
+
+@pytest.mark.parametrize("engine", ["xpath", "stream"])
+def test_validazione_xsd_modalita(engine):
+    """
+    "warn" importa e riporta gli errori, "strict" scarta i documenti non validi.
+    """
+    from services.parser_fatture import estrai_record_fattura
+
+    for validazione in ("off", "warn", "strict"):
+        record = estrai_record_fattura(XML_VALIDO.encode("utf-8"), engine, validazione)
+        assert record["errori_validazione"] == []
+        assert record["fattura"]["numero"] == "V/1"
+
+    assert estrai_record_fattura(XML_COMPLETO.encode("utf-8"), engine, "off")["errori_validazione"] == []
+    errori = estrai_record_fattura(XML_COMPLETO.encode("utf-8"), engine, "warn")["errori_validazione"]
+    assert any("RegimeFiscale" in e for e in errori)
+    assert parse_fattura_xml(XML_COMPLETO.encode("utf-8"), is_memory=True, engine=engine, validazione="strict") is None
+
+def test_validazione_xsd_modalita_sconosciuta():
+    with pytest.raises(ValueError):
+        parse_fattura_xml(XML_VALIDO, is_memory=True, validazione="forse")
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parse_fatture_batch_validazione(workers):
+    """
+    Gli errori di validazione sono riportati per ogni file, anche dai worker.
+    """
+    from services.parser_fatture import parse_fatture_batch
+
+    documenti = [("valido.xml", XML_VALIDO.encode("utf-8")), ("incompleto.xml", XML_COMPLETO.encode("utf-8"))]
+
+    esiti = [e for b in parse_fatture_batch(documenti, workers=workers, validazione="warn") for e in b]
+    assert esiti[0]["record"]["errori_validazione"] == []
+    assert esiti[1]["record"]["errori_validazione"]
+
+    esiti = [e for b in parse_fatture_batch(documenti, workers=workers, validazione="strict") for e in b]
+    assert esiti[0]["errore"] is None
+    assert esiti[1]["record"] is None
+    assert esiti[1]["errore"].startswith("ErroreValidazione")
+
+def test_salva_fatture_bulk():
+    """
+    Una query IN per blocco trova i duplicati (anche interni al blocco);
+    le fatture nuove vengono inserite con righe e pagamenti, con i default dell'ORM.
+    """
+    from database.db_session import init_db, SessionLocal
+    from database.models import Fattura
+    from services.parser_fatture import iter_record_fattura, salva_fattura_su_db, salva_fatture_bulk
+
+    init_db()
+    gia_presente = next(iter_record_fattura(XML_COMPLETO.replace("FT/77", "BULK-0").encode("utf-8")))
+    salva_fattura_su_db(parse_fattura_xml(XML_COMPLETO.replace("FT/77", "BULK-0").encode("utf-8"), is_memory=True))
+    lotto = list(iter_record_fattura(_lotto(2).replace("L/", "BULK-").encode("utf-8")))
+
+    for batch_size in (500, 1):
+        records = [gia_presente] + lotto + [lotto[0]]
+        esito = salva_fatture_bulk(records, batch_size=batch_size)
+        if batch_size == 500:
+            assert esito["inseriti"] == [r["hash_xml"] for r in lotto]
+            assert esito["saltati"] == [gia_presente["hash_xml"], lotto[0]["hash_xml"]]
+        else:
+            assert esito["inseriti"] == []
+            assert len(esito["saltati"]) == 4
+
+    db = SessionLocal()
+    try:
+        salvate = db.query(Fattura).filter(Fattura.numero.in_(["BULK-1", "BULK-2"])).order_by(Fattura.numero).all()
+        assert [f.numero for f in salvate] == ["BULK-1", "BULK-2"]
+        for f in salvate:
+            assert f.pagata is False
+            assert f.totale == 36.60
+            assert len(f.righe) == 2 and len(f.riepiloghi_iva) == 1 and len(f.pagamenti) == 1
+            assert f.xml_raw.count("<FatturaElettronicaBody>") == 1
+    finally:
+        db.close()
+
+def test_fatture_cancellate_in_sql_reimportabili(tmp_path):
+    """
+    Una cancellazione in SQL (senza l'ORM) porta via anche il documento XML;
+    un documento già orfano non impedisce di reimportare la fattura.
+    """
+    from sqlalchemy import func, select
+    from sqlalchemy.orm import Session
+    from database.db_session import crea_engine, abilita_savepoint, PROFILO_IMPORT
+    from database.migrazioni import esegui_migrazioni
+    from database.models import Base, Fattura, DocumentoXML, RigheFattura
+    from services.parser_fatture import iter_record_fattura, salva_blocco_fatture, salva_fattura
+
+    engine = abilita_savepoint(crea_engine(f"sqlite:///{tmp_path / 'orfani.db'}", PROFILO_IMPORT))
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    records = list(iter_record_fattura(_lotto(2).replace("L/", "ORF-").encode("utf-8")))
+
+    with Session(engine) as db:
+        assert len(salva_blocco_fatture(db, records)["inseriti"]) == 2
+        db.commit()
+        db.query(Fattura).delete()
+        db.commit()
+        assert db.scalar(select(func.count()).select_from(DocumentoXML)) == 0
+        assert db.scalar(select(func.count()).select_from(RigheFattura)) == 0
+
+        # Documento rimasto senza fattura (DB cancellato prima del trigger)
+        db.connection().exec_driver_sql("DROP TRIGGER fatture_cascata_ad")
+        db.commit()
+        assert len(salva_blocco_fatture(db, records)["inseriti"]) == 2
+        db.commit()
+        db.query(Fattura).delete()
+        db.commit()
+        assert salva_blocco_fatture(db, records)["inseriti"] == [r["hash_xml"] for r in records]
+        db.commit()
+        assert db.scalar(select(func.count()).select_from(DocumentoXML)) == 2
+
+        db.query(Fattura).delete()
+        db.commit()
+        fattura = parse_fattura_xml(XML_COMPLETO.replace("FT/77", "ORF-ORM").encode("utf-8"), is_memory=True)
+        salva_fattura(db, fattura)
+        db.commit()
+        assert db.get(DocumentoXML, fattura.hash_xml).testo() == fattura.xml_raw
+    engine.dispose()
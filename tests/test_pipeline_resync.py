@@ -0,0 +1,153 @@
+# tests/test_pipeline_resync.py
+
+import logging
+import pytest
+from sqlalchemy import func
+from sqlalchemy.orm import Session, sessionmaker
+
+from benchmarks.corpus_fatturapa import genera_corpus
+from benchmarks.dropbox_finto import DropboxFinto
+from database.db_session import crea_engine, abilita_savepoint, PROFILO_IMPORT
+from database.migrazioni import esegui_migrazioni
+from database.models import Base, Fattura
+from database.scrittore import ScrittoreDB
+from database.sync_dropbox import leggi_cursore, content_hash_noti, file_da_riprovare
+from services.parser_fatture import calcola_hash_xml
+from services.pipeline_resync import esegui_resync, descrivi_avanzamento
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    from services import allegati_store
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path / "allegati"))
+    engine = abilita_savepoint(crea_engine(f"sqlite:///{tmp_path / 'resync.db'}", PROFILO_IMPORT),
+                               begin="BEGIN IMMEDIATE")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def scrittore(engine):
+    scrittore = ScrittoreDB(sessionmaker(bind=engine, expire_on_commit=False))
+    yield scrittore
+    scrittore.chiudi()
+
+
+def _corpus(n):
+    return {f"/fatture/2024/{nome}": xml for nome, xml in genera_corpus(n, quota_lotti=0, quota_p7m=0)}
+
+
+def test_resync_a_stadi(engine, scrittore):
+    file = _corpus(40)
+    percorsi = sorted(file)
+    file[percorsi[0].replace(".xml", "_rotto.xml")] = b"<non-xml"
+    file["/fatture/2024/leggimi.txt"] = b"non e' una fattura"
+    client = DropboxFinto(file, latenza=0.002, per_pagina=7)
+    # Un documento già importato viene scartato prima del parsing
+    hash_noti = {calcola_hash_xml(file[percorsi[1]])}
+    istantanee = []
+
+    statistiche, dettagli = esegui_resync(
+        client, scrittore, logging.getLogger("test_resync"), on_progresso=istantanee.append,
+        intervallo=0.01, hash_noti=hash_noti, stato_dropbox=(None, {}, {}), max_in_volo=4, coda_documenti=5, max_in_scrittura=2, workers=1, chunk_size=4,
+    )
+
+    assert statistiche == {"invariati": 0, "riprovati": 0, "ricevuti": 41, "saltati_noti": 1, "parsati": 39, "inseriti": 39,
+                           "non_validi": 0, "errori": 1}
+    assert len(dettagli) == 1 and "_rotto.xml" in dettagli[0]
+    with engine.connect() as conn:
+        assert conn.execute(func.count(Fattura.id).select()).scalar() == 39
+
+    # L'ultimo rapporto ha i totali per stadio e le code vuote
+    finale = istantanee[-1]
+    assert finale["contatori"]["inseriti"] == 39
+    assert finale["contatori"]["in_parsing"] == 0 and finale["contatori"]["lotti_in_scrittura"] == 0
+    assert finale["code"] == {"documenti": 0}
+    assert "39 inseriti" in descrivi_avanzamento(finale)
+    assert client.max_in_volo <= 4
+
+
+def test_resync_errore_elenco_dropbox(scrittore):
+    class DropboxNonRaggiungibile(DropboxFinto):
+        def files_list_folder(self, path, recursive=False):
+            raise ConnectionError("rete assente")
+
+    statistiche, dettagli = esegui_resync(
+        DropboxNonRaggiungibile({}), scrittore, logging.getLogger("test_resync"), hash_noti=set(),
+        stato_dropbox=(None, {}, {}), workers=1,
+    )
+    assert statistiche["ricevuti"] == 0 and statistiche["errori"] == 1
+    assert "rete assente" in dettagli[0]
+
+
+def _stato(engine):
+    with Session(engine) as db:
+        return leggi_cursore(db, "/fatture"), content_hash_noti(db), file_da_riprovare(db)
+
+
+def _resync(client, scrittore, stato):
+    return esegui_resync(client, scrittore, logging.getLogger("test_resync"), hash_noti=set(),
+                         stato_dropbox=stato, workers=1, chunk_size=4)
+
+
+def test_resync_incrementale(engine, scrittore):
+    file = _corpus(12)
+    client = DropboxFinto(file, per_pagina=5)
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["ricevuti"] == 12 and statistiche["inseriti"] == 12
+    cursore, noti, da_riprovare = _stato(engine)
+    assert cursore is not None and len(noti) == 12 and da_riprovare == {}
+
+    # Niente di nuovo: dal cursore non arriva nessun file, niente download
+    statistiche, _ = _resync(client, scrittore, (cursore, noti, da_riprovare))
+    assert statistiche["ricevuti"] == 0 and client.download == 12
+
+    # Solo i file caricati dopo l'ultimo resync vengono scaricati
+    nuovi = _corpus(14)
+    for percorso in sorted(set(nuovi) - set(file)):
+        client.aggiungi(percorso, nuovi[percorso])
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["ricevuti"] == 2 and statistiche["inseriti"] == 2
+    assert client.download == 14
+
+    # Cursore scaduto: si rielenca tutto, ma i content_hash noti evitano i download
+    client.cursori_scaduti = True
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["invariati"] == 14 and statistiche["ricevuti"] == 0
+    assert client.download == 14
+
+
+def test_resync_con_errori_sposta_il_cursore(engine, scrittore):
+    file = _corpus(5)
+    rotto = "/fatture/2024/rotto.xml"
+    file[rotto] = b"<non-xml"
+    client = DropboxFinto(file)
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["errori"] == 1 and statistiche["inseriti"] == 5
+
+    # Il cursore avanza comunque; il file fallito è registrato da riprovare
+    cursore, noti, da_riprovare = _stato(engine)
+    assert cursore is not None and rotto not in noti and list(da_riprovare) == [rotto]
+
+    # Viene riprovato per path, anche se dal cursore non torna più
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["riprovati"] == 1 and statistiche["ricevuti"] == 1 and statistiche["errori"] == 1
+    assert client.download == 7
+
+    # Corretto su Dropbox: scaricato una volta sola (riprovato, non anche dall'elenco) e importato
+    client.aggiungi(rotto, _corpus(6)["/fatture/2024/IT00000000006_00006.xml"])
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["riprovati"] == 1 and statistiche["ricevuti"] == 1 and statistiche["inseriti"] == 1
+    assert statistiche["errori"] == 0
+    _, noti, da_riprovare = _stato(engine)
+    assert rotto in noti and da_riprovare == {}
+
+    # Un file fallito e poi cancellato da Dropbox viene dimenticato
+    client.aggiungi("/fatture/2024/altro.xml", b"<non-xml")
+    _resync(client, scrittore, _stato(engine))
+    client.rimuovi("/fatture/2024/altro.xml")
+    statistiche, _ = _resync(client, scrittore, _stato(engine))
+    assert statistiche["riprovati"] == 0 and statistiche["errori"] == 0
+    assert _stato(engine)[2] == {}
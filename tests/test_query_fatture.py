@@ -0,0 +1,189 @@
+# tests/test_query_fatture.py
+
+import pytest
+from datetime import date
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database.models import Base, Fattura
+from database.migrazioni import esegui_migrazioni
+from database.query_fatture import intervallo_date, query_fatture, query_non_pagate_in_scadenza
+from database.ricerca import aggiorna_righe_al_commit
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'query.db'}")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    sessione = aggiorna_righe_al_commit(sessionmaker(bind=engine))()
+    sessione.add_all([
+        Fattura(numero="1", data=date(2023, 12, 31), fornitore="Alfa", data_scadenza=date(2024, 1, 10)),
+        Fattura(numero="2", data=date(2024, 1, 1), fornitore="Alfa", data_scadenza=date(2024, 1, 20), pagata=True),
+        Fattura(numero="3", data=date(2024, 12, 31), fornitore="Beta", data_scadenza=date(2024, 2, 1)),
+        Fattura(numero="4", data=date(2024, 6, 15), fornitore="Alfa"),
+    ])
+    sessione.commit()
+    yield sessione
+    sessione.close()
+    engine.dispose()
+
+
+def _sql_eseguite(db, funzione):
+    catturate = []
+    engine = db.get_bind()
+
+    def cattura(conn, cursor, statement, parameters, context, executemany):
+        catturate.append(statement)
+
+    event.listen(engine, "before_cursor_execute", cattura)
+    try:
+        funzione()
+    finally:
+        event.remove(engine, "before_cursor_execute", cattura)
+    return catturate
+
+
+def _piano(db, query):
+    """
+    Esegue la query catturando SQL e parametri, poi ne ritorna l'EXPLAIN QUERY PLAN.
+    """
+    catturate = []
+    engine = db.get_bind()
+
+    def cattura(conn, cursor, statement, parameters, context, executemany):
+        catturate.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", cattura)
+    try:
+        query.all()
+    finally:
+        event.remove(engine, "before_cursor_execute", cattura)
+    statement, parametri = catturate[-1]
+    righe = db.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parametri).all()
+    return " | ".join(r[-1] for r in righe)
+
+
+def test_intervallo_date():
+    assert intervallo_date(2024) == (date(2024, 1, 1), date(2025, 1, 1))
+    assert intervallo_date(2024, 2) == (date(2024, 2, 1), date(2024, 3, 1))
+    assert intervallo_date(2024, 12) == (date(2024, 12, 1), date(2025, 1, 1))
+
+
+def test_query_fatture_risultati(db):
+    numeri = lambda q: sorted(f.numero for f in q.all())
+    assert numeri(query_fatture(db, anno=2024)) == ["2", "3", "4"]
+    assert numeri(query_fatture(db, anno=2024, mese=12)) == ["3"]
+    assert numeri(query_fatture(db, anno=2024, cedente="Alfa")) == ["2", "4"]
+    assert numeri(query_fatture(db, mese=12)) == ["1", "3"]
+    assert numeri(query_non_pagate_in_scadenza(db, fine=date(2024, 1, 21))) == ["1"]
+    assert numeri(query_non_pagate_in_scadenza(db, inizio=date(2024, 1, 11))) == ["3"]
+
+
+def test_query_fatture_usano_gli_indici(db):
+    assert "USING INDEX ix_fatture_data_fornitore" in _piano(db, query_fatture(db, anno=2024, mese=3))
+    piano = _piano(db, query_fatture(db, anno=2024, cedente="Alfa"))
+    assert "USING INDEX ix_fatture_fornitore_data" in piano or "USING INDEX ix_fatture_data_fornitore" in piano
+    assert "SCAN" not in piano.replace("SCAN CONSTANT", "")
+
+
+def test_scadenze_usano_indice_parziale(db):
+    oggi = date(2024, 1, 15)
+    for query in (
+        query_non_pagate_in_scadenza(db, fine=oggi),
+        query_non_pagate_in_scadenza(db, inizio=oggi, fine=date(2024, 1, 23)),
+    ):
+        assert "USING INDEX ix_fatture_scadenza_non_pagate" in _piano(db, query)
+
+
+def test_xml_compresso_caricato_solo_su_richiesta(db):
+    """
+    L'elenco non legge mai documenti_xml; l'XML arriva (decompresso) solo leggendo xml_raw.
+    """
+    xml = "<FatturaElettronica>" + "<Riga>uguale</Riga>" * 200 + "</FatturaElettronica>"
+    db.add(Fattura(numero="5", data=date(2024, 3, 1), fornitore="Gamma", hash_xml="h5", xml_raw=xml))
+    db.commit()
+    db.expire_all()
+
+    fatture = []
+    sql = _sql_eseguite(db, lambda: fatture.extend(query_fatture(db, anno=2024).all()))
+    assert not any("documenti_xml" in s for s in sql)
+
+    fattura = next(f for f in fatture if f.numero == "5")
+    sql = _sql_eseguite(db, lambda: fattura.xml_raw)
+    assert any("documenti_xml" in s for s in sql)
+    assert fattura.xml_raw == xml
+    assert fattura.documento.dimensione == len(xml)
+    assert len(fattura.documento.contenuto) < len(xml) / 10
+
+
+def test_ricerca_full_text(db):
+    from database.models import RigheFattura
+
+    fattura = Fattura(numero="FT/99", data=date(2024, 5, 2), fornitore="Ferramenta Rossi",
+                      cessionario_denominazione="Studio Bianchi", causale="Manutenzione caldaia")
+    fattura.righe = [RigheFattura(descrizione="Valvola termostatica"), RigheFattura(descrizione="Manodopera")]
+    db.add(fattura)
+    db.commit()
+
+    numeri = lambda testo: [f.numero for f in query_fatture(db, search=testo).all()]
+    assert numeri("valvola") == ["FT/99"]          # descrizione di una riga
+    assert numeri("ross") == ["FT/99"]             # prefisso
+    assert numeri("bianchi caldaia") == ["FT/99"]  # cessionario e causale, in AND
+    assert numeri("FT/99") == ["FT/99"]
+    assert sorted(numeri('alfa "')) == ["1", "2", "4"]  # la sintassi FTS5 digitata non dà errore
+    assert numeri("NEAR( AND *") == []
+    assert numeri("inesistente") == []
+    assert numeri("valvola") == [f.numero for f in query_fatture(db, anno=2024, search="valvola")]
+
+    # Trigger: update e delete di righe e fatture
+    fattura.righe[0].descrizione = "Rubinetto"
+    db.commit()
+    assert numeri("valvola") == [] and numeri("rubinetto") == ["FT/99"]
+    fattura.fornitore = "Idraulica Verdi"
+    db.commit()
+    assert numeri("rossi") == [] and numeri("verdi rubinetto") == ["FT/99"]
+    db.delete(fattura.righe[0])
+    db.delete(fattura.righe[1])
+    db.delete(fattura)
+    db.commit()
+    assert numeri("verdi") == []
+
+
+def test_ricerca_ordinata_per_pertinenza(db):
+    db.add_all([
+        Fattura(numero="R1", fornitore="Beta", causale="Forniture Delta"),
+        Fattura(numero="R2", fornitore="Delta Srl"),
+    ])
+    db.commit()
+    # Il fornitore pesa più della causale
+    assert [f.numero for f in query_fatture(db, search="delta").all()] == ["R2", "R1"]
+    assert "VIRTUAL TABLE INDEX" in _piano(db, query_fatture(db, search="delta"))
+
+
+def test_ricerca_righe_ricomposte_al_commit(db):
+    from sqlalchemy import insert
+    from database.models import RigheFattura
+    from database.ricerca import TABELLA_DA_AGGIORNARE
+
+    fattura = Fattura(numero="L1", fornitore="Lotto Srl")
+    db.add(fattura)
+    db.commit()
+    # Righe inserite in blocco, come salva_blocco_fatture: i trigger segnano solo la fattura
+    db.execute(insert(RigheFattura), [{"fattura_id": fattura.id, "descrizione": f"articolo {i}"} for i in range(500)])
+    assert db.connection().exec_driver_sql(f"SELECT id FROM {TABELLA_DA_AGGIORNARE}").all() == [(fattura.id,)]
+    # Il rilascio di un SAVEPOINT non ricompone ancora
+    with db.begin_nested():
+        db.add(RigheFattura(fattura_id=fattura.id, descrizione="articolo nel savepoint"))
+    assert db.connection().exec_driver_sql(f"SELECT count(*) FROM {TABELLA_DA_AGGIORNARE}").scalar() == 1
+    db.commit()
+
+    assert db.connection().exec_driver_sql(f"SELECT count(*) FROM {TABELLA_DA_AGGIORNARE}").scalar() == 0
+    assert [f.numero for f in query_fatture(db, search="lotto articolo 499").all()] == ["L1"]
+    assert [f.numero for f in query_fatture(db, search="savepoint").all()] == ["L1"]
+
+    # Le sessioni non agganciate (altri DB, altri engine) non ne risentono
+    with sessionmaker(bind=db.get_bind())() as altra:
+        altra.execute(insert(RigheFattura), [{"fattura_id": fattura.id, "descrizione": "non agganciata"}])
+        altra.commit()
+        assert altra.connection().exec_driver_sql(f"SELECT count(*) FROM {TABELLA_DA_AGGIORNARE}").scalar() == 1
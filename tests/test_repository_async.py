@@ -0,0 +1,112 @@
+# tests/test_repository_async.py
+
+import asyncio
+import time
+from datetime import date, timedelta
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from database.db_session import crea_engine, abilita_savepoint
+from database.migrazioni import esegui_migrazioni
+from database.models import Base, Fattura, RigheFattura, AllegatoFattura
+from database.repository_async import RepositoryFatture, crea_engine_async
+from database.ricerca import aggiorna_righe_al_commit
+from database.scrittore import ScrittoreDB, segna_pagata
+
+
+@pytest.fixture
+def percorso_db(tmp_path):
+    percorso = tmp_path / "async.db"
+    engine = crea_engine(f"sqlite:///{percorso}")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    db = aggiorna_righe_al_commit(sessionmaker(bind=engine))()
+    oggi = date.today()
+    fattura = Fattura(numero="A/1", data=date(2024, 3, 1), fornitore="Alfa", hash_xml="h1",
+                      data_scadenza=oggi + timedelta(days=3), xml_raw="<FatturaElettronica/>")
+    fattura.righe = [RigheFattura(descrizione="Consulenza")]
+    fattura.allegati = [AllegatoFattura(nome_attachment="a.pdf", sha256="0" * 64)]
+    db.add_all([fattura, Fattura(numero="B/1", data=date(2023, 5, 1), fornitore="Beta",
+                                 data_scadenza=oggi - timedelta(days=1))])
+    db.commit()
+    db.close()
+    engine.dispose()
+    return percorso
+
+
+def _esegui(percorso_db, coroutine):
+    async def principale():
+        repository = RepositoryFatture(crea_engine_async(f"sqlite+aiosqlite:///{percorso_db}"))
+        try:
+            return await coroutine(repository)
+        finally:
+            await repository.chiudi()
+    return asyncio.run(principale())
+
+
+def test_query_asincrone(percorso_db):
+    async def interroga(repository):
+        return (
+            await repository.fornitori(),
+            [f.numero for f in await repository.lista_fatture(anno=2024)],
+            [f.numero for f in await repository.lista_fatture(search="consulenza")],
+            await repository.fattura(1),
+            await repository.testo_xml(1),
+            [f.numero for f in await repository.non_pagate_in_scadenza(fine=date.today())],
+        )
+
+    fornitori, del_2024, trovate, fattura, xml, scadute = _esegui(percorso_db, interroga)
+    assert fornitori == ["Alfa", "Beta"]
+    assert del_2024 == ["A/1"]
+    assert trovate == ["A/1"]
+    # Righe e allegati leggibili a sessione chiusa
+    assert [r.descrizione for r in fattura.righe] == ["Consulenza"]
+    assert [a.nome_attachment for a in fattura.allegati] == ["a.pdf"]
+    assert xml == "<FatturaElettronica/>"
+    assert scadute == ["B/1"]
+
+
+def test_scadenze_e_scritture_asincrone(percorso_db):
+    from services.notifications import check_scadenze_imminenti_async
+
+    engine = abilita_savepoint(crea_engine(f"sqlite:///{percorso_db}"), begin="BEGIN IMMEDIATE")
+    scrittore = ScrittoreDB(sessionmaker(bind=engine))
+
+    async def lavora(repository):
+        prima = await check_scadenze_imminenti_async(repository, giorni_avviso=7)
+        assert await repository.scrivi(scrittore, segna_pagata, 1) is True
+        dopo = await check_scadenze_imminenti_async(repository, giorni_avviso=7)
+        return prima, dopo
+
+    try:
+        (scadute, imminenti), (_, imminenti_dopo) = _esegui(percorso_db, lavora)
+    finally:
+        scrittore.chiudi()
+        engine.dispose()
+    assert [f.numero for f in scadute] == ["B/1"]
+    assert [f.numero for f in imminenti] == ["A/1"]
+    assert imminenti_dopo == []
+
+
+def test_il_loop_non_si_blocca_durante_una_query(percorso_db):
+    """
+    Mentre una query lenta gira, le altre coroutine (es. il repaint della UI) vanno avanti.
+    """
+    def query_lenta(db):
+        return db.connection().exec_driver_sql(
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 2000000) "
+            "SELECT count(*) FROM c"
+        ).scalar()
+
+    async def misura(repository):
+        battiti = 0
+        query = asyncio.ensure_future(repository.esegui(query_lenta))
+        inizio = time.perf_counter()
+        while not query.done():
+            await asyncio.sleep(0.005)
+            battiti += 1
+        return await query, battiti, time.perf_counter() - inizio
+
+    risultato, battiti, secondi = _esegui(percorso_db, misura)
+    assert risultato == 2000000
+    assert battiti >= secondi / 0.005 / 4
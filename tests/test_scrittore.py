@@ -0,0 +1,171 @@
+# tests/test_scrittore.py
+
+import hashlib
+import os
+import threading
+import pytest
+from sqlalchemy import event, func
+from sqlalchemy.orm import sessionmaker
+
+from database.db_session import crea_engine, abilita_savepoint, PROFILO_IMPORT
+from database.migrazioni import esegui_migrazioni
+from database.models import Base, Fattura
+from database.scrittore import ScrittoreDB, segna_pagata
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = abilita_savepoint(crea_engine(f"sqlite:///{tmp_path / 'scrittore.db'}", PROFILO_IMPORT),
+                               begin="BEGIN IMMEDIATE")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def scrittore(engine):
+    scrittore = ScrittoreDB(sessionmaker(bind=engine, expire_on_commit=False))
+    yield scrittore
+    scrittore.chiudi()
+
+
+def _conta(engine):
+    with engine.connect() as conn:
+        return conn.execute(func.count(Fattura.id).select()).scalar()
+
+
+def _inserisci(db, numero):
+    fattura = Fattura(numero=numero)
+    db.add(fattura)
+    db.flush()
+    return fattura.id
+
+
+def test_group_commit(engine, scrittore):
+    commit = []
+    event.listen(engine, "commit", lambda conn: commit.append(1))
+    iniziato, sblocca = threading.Event(), threading.Event()
+
+    def occupa(db):
+        iniziato.set()
+        sblocca.wait(5)
+        return _inserisci(db, "primo")
+
+    # Il primo lavoro tiene occupato lo scrittore: gli altri si accodano
+    primo = scrittore.invia(occupa)
+    iniziato.wait(5)
+    futuri = [scrittore.invia(_inserisci, str(i)) for i in range(20)]
+    sblocca.set()
+
+    assert primo.result() == 1
+    assert [f.result() for f in futuri] == list(range(2, 22))
+    assert _conta(engine) == 21
+    assert len(commit) == 2  # il primo lavoro da solo, poi gli altri 20 insieme
+
+
+def test_lavoro_fallito_non_annulla_gli_altri(engine, scrittore):
+    def fallisce(db):
+        _inserisci(db, "annullata")
+        raise ValueError("lavoro sbagliato")
+
+    sblocca = threading.Event()
+    scrittore.invia(lambda db: sblocca.wait(5))
+    futuri = [scrittore.invia(_inserisci, "A"), scrittore.invia(fallisce), scrittore.invia(_inserisci, "B")]
+    sblocca.set()
+
+    with pytest.raises(ValueError):
+        futuri[1].result()
+    assert futuri[0].result() and futuri[2].result()
+    with engine.connect() as conn:
+        assert sorted(n for (n,) in conn.exec_driver_sql("SELECT numero FROM fatture")) == ["A", "B"]
+
+
+def test_allegati_scritti_solo_al_commit_del_lotto(engine, scrittore, tmp_path, monkeypatch):
+    """
+    Gli allegati registrati nei SAVEPOINT dei lavori finiscono su disco al
+    commit del gruppo, non al rilascio; quelli di un lavoro fallito no, e
+    il suo rollback non scarta quelli degli altri.
+    """
+    from services import allegati_store
+    from services.allegati_store import parcheggia_allegato, salva_al_commit, esiste_allegato
+
+    monkeypatch.setattr(allegati_store, "CARTELLA_ALLEGATI", str(tmp_path / "allegati"))
+    contenuti = {nome: f"allegato {nome}".encode() for nome in ("A", "annullata", "B")}
+    sha = {nome: hashlib.sha256(dati).hexdigest() for nome, dati in contenuti.items()}
+    in_arrivo = {}
+
+    def con_allegato(db, nome, fallisce=False):
+        _inserisci(db, nome)
+        _, in_arrivo[nome] = parcheggia_allegato(contenuti[nome])
+        salva_al_commit(db, {sha[nome]: in_arrivo[nome]})
+        if fallisce:
+            raise ValueError("lavoro sbagliato")
+        # Il SAVEPOINT di A è già rilasciato, ma il gruppo non è confermato
+        return esiste_allegato(sha["A"])
+
+    sblocca = threading.Event()
+    scrittore.invia(lambda db: sblocca.wait(5))
+    futuri = [scrittore.invia(con_allegato, "A"), scrittore.invia(con_allegato, "annullata", True),
+              scrittore.invia(con_allegato, "B")]
+    sblocca.set()
+
+    with pytest.raises(ValueError):
+        futuri[1].result()
+    assert futuri[0].result() is False and futuri[2].result() is False
+    assert esiste_allegato(sha["A"]) and esiste_allegato(sha["B"])
+    assert not esiste_allegato(sha["annullata"])
+    # I file in arrivo sono stati spostati nell'archivio o cancellati
+    assert not any(os.path.exists(percorso) for percorso in in_arrivo.values())
+
+
+def test_scritture_da_piu_thread(engine, scrittore):
+    """
+    Più thread (es. parsing e UI) scrivono insieme senza "database is locked".
+    """
+    from services.parser_fatture import salva_blocco_fatture
+
+    def importa(t):
+        for b in range(5):
+            records = [{"hash_xml": f"{t}-{b}-{i}", "fattura": {"numero": f"{t}/{b}/{i}"},
+                        "xml_raw": "<FatturaElettronica/>", "righe": [], "riepiloghi_iva": [],
+                        "pagamenti": [], "allegati": []} for i in range(10)]
+            assert len(scrittore.esegui(salva_blocco_fatture, records)["inseriti"]) == 10
+
+    thread = [threading.Thread(target=importa, args=(t,)) for t in range(4)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    assert _conta(engine) == 200
+
+    assert scrittore.esegui(segna_pagata, 1) is True
+    assert scrittore.esegui(segna_pagata, 10_000) is False
+
+
+def test_chiudi_scrive_i_lavori_in_coda(engine, scrittore):
+    futuri = [scrittore.invia(_inserisci, str(i)) for i in range(5)]
+    scrittore.chiudi()
+    assert all(f.done() for f in futuri)
+    assert _conta(engine) == 5
+    with pytest.raises(RuntimeError):
+        scrittore.invia(_inserisci, "dopo")
+
+
+def test_sessione_lettura_per_thread():
+    from database.db_session import sessione_lettura
+
+    with sessione_lettura() as esterna:
+        with sessione_lettura() as interna:
+            assert interna is esterna
+        assert esterna.is_active
+        sessioni = []
+
+        def leggi():
+            with sessione_lettura() as db:
+                sessioni.append(db)
+
+        t = threading.Thread(target=leggi)
+        t.start()
+        t.join()
+        assert sessioni[0] is not esterna
@@ -0,0 +1,117 @@
+# tests/test_totali.py
+
+import pytest
+from datetime import date
+from sqlalchemy import create_engine, delete, insert
+from sqlalchemy.orm import sessionmaker
+
+from database.models import Base, Fattura, DatiRiepilogoIVA, TotaleFornitoreMese
+from database.migrazioni import esegui_migrazioni
+from database.totali import verifica_totali, ricostruisci_totali, totali_per_fornitore, totali_per_aliquota
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'totali.db'}")
+    Base.metadata.create_all(engine)
+    esegui_migrazioni(engine)
+    sessione = sessionmaker(bind=engine)()
+    yield sessione
+    sessione.close()
+    engine.dispose()
+
+
+def _fattura(numero, data, fornitore, totale, riepiloghi=()):
+    fattura = Fattura(numero=numero, data=data, fornitore=fornitore, totale=totale)
+    fattura.riepiloghi_iva = [
+        DatiRiepilogoIVA(aliquota_iva=aliquota, imponibile_importo=imponibile, imposta=imposta)
+        for aliquota, imponibile, imposta in riepiloghi
+    ]
+    return fattura
+
+
+def _verifica(db):
+    db.commit()
+    assert verifica_totali(db.connection()) == []
+
+
+def test_totali_aggiornati_dai_trigger(db):
+    a = _fattura("1", date(2024, 1, 10), "Alfa", 122.0, [(22.0, 100.0, 22.0)])
+    b = _fattura("2", date(2024, 1, 20), "Alfa", 60.0, [(22.0, 40.0, 8.8), (10.0, 10.0, 1.0)])
+    c = _fattura("3", date(2024, 2, 5), "Beta", 50.0)
+    db.add_all([a, b, c])
+    _verifica(db)
+    assert totali_per_fornitore(db, 2024, 1).all() == [("Alfa", 2, 182.0, 182.0)]
+    assert totali_per_aliquota(db, 2024).all() == [(10.0, 10.0, 1.0), (22.0, 140.0, 30.8)]
+
+    # Segna saldata (come on_segna_saldata)
+    a.pagata = True
+    _verifica(db)
+    assert totali_per_fornitore(db, 2024, 1).one() == ("Alfa", 2, 182.0, 60.0)
+
+    # Cambio di data e fornitore: i totali (anche IVA) passano alla nuova chiave
+    b.data = date(2024, 3, 1)
+    b.fornitore = "Gamma"
+    _verifica(db)
+    assert totali_per_aliquota(db, 2024, 3, "Gamma").all() == [(10.0, 10.0, 1.0), (22.0, 40.0, 8.8)]
+
+    db.delete(b.riepiloghi_iva[1])
+    _verifica(db)
+    db.delete(a)
+    _verifica(db)
+    # Le righe svuotate spariscono
+    assert totali_per_fornitore(db, 2024, 1).all() == []
+    assert totali_per_aliquota(db, 2024, 1).all() == []
+
+
+def test_totali_dopo_delete_sql(db):
+    """
+    Una fattura cancellata in SQL, senza ORM: il trigger toglie dai totali
+    anche i riepiloghi IVA, prima di cancellarli.
+    """
+    a = _fattura("1", date(2024, 1, 10), "Alfa", 122.0, [(22.0, 100.0, 22.0)])
+    b = _fattura("2", date(2024, 1, 20), "Alfa", 60.0, [(22.0, 40.0, 8.8), (10.0, 10.0, 1.0)])
+    db.add_all([a, b])
+    _verifica(db)
+
+    db.execute(delete(Fattura).where(Fattura.id == a.id))
+    _verifica(db)
+    assert totali_per_aliquota(db, 2024).all() == [(10.0, 10.0, 1.0), (22.0, 40.0, 8.8)]
+    db.execute(delete(Fattura))
+    _verifica(db)
+    assert totali_per_fornitore(db, 2024).all() == []
+    assert totali_per_aliquota(db, 2024).all() == []
+
+
+def test_totali_con_insert_multipli(db):
+    # Stesso percorso di salva_fatture_bulk: INSERT multiplo senza ORM
+    righe = [{"numero": str(i), "data": date(2023, 1 + i % 12, 1), "fornitore": f"F{i % 3}",
+              "totale": 10.0, "pagata": False} for i in range(60)]
+    ids = db.execute(insert(Fattura).returning(Fattura.id), righe).scalars().all()
+    db.execute(insert(DatiRiepilogoIVA), [{"fattura_id": i, "aliquota_iva": 22.0,
+                                           "imponibile_importo": 8.2, "imposta": 1.8} for i in ids])
+    _verifica(db)
+    assert sum(r[1] for r in totali_per_fornitore(db, 2023)) == 60
+    assert totali_per_aliquota(db, 2023).one() == pytest.approx((22.0, 492.0, 108.0))
+
+
+def test_ricostruisci_totali(db):
+    db.add(_fattura("1", None, None, 10.0, [(4.0, 9.6, 0.4)]))
+    _verifica(db)
+    # Fatture senza data/fornitore: anno e mese 0, fornitore ""
+    assert totali_per_fornitore(db, 0).one() == ("", 1, 10.0, 10.0)
+
+    db.query(TotaleFornitoreMese).update({"totale": 999.0})
+    db.commit()
+    conn = db.connection()
+    assert len(verifica_totali(conn)) == 1
+    ricostruisci_totali(conn)
+    assert verifica_totali(conn) == []
+
+
+def test_totali_usano_la_chiave_primaria(db):
+    conn = db.connection()
+    piano = conn.exec_driver_sql(
+        "EXPLAIN QUERY PLAN SELECT sum(totale) FROM totali_fornitore_mese WHERE anno = 2024 AND mese = 3"
+    ).all()
+    assert "USING INDEX sqlite_autoindex_totali_fornitore_mese_1" in " ".join(r[-1] for r in piano)
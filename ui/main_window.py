@@ -5,20 +5,23 @@ from PySide6.QtWidgets import (
     QSplitter, QComboBox, QLineEdit, QPushButton, QListWidget,
     QTableWidget, QTableWidgetItem, QTextEdit, QMessageBox
 )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QUrl
+from PySide6.QtGui import QDesktopServices
+from qasync import asyncSlot
+import asyncio
 import os
+import tempfile
 from datetime import date, timedelta
 
 # Import servizi e DB
 from services.pec_service import scarica_allegati_xml
-from services.parser_fatture import parse_fattura_xml, salva_fattura_su_db
-from services.dropbox_service import upload_xml_to_dropbox
+from services.parser_fatture import iter_fatture_xml, salva_fattura_su_db
+from services.dropbox_service import carica_xml_su_dropbox, percorso_dropbox
 from services.notifications import check_scadenze_imminenti  # se usi
-from database.db_session import SessionLocal
-from database.models import Fattura
-
-# Per le query e filtri
-from sqlalchemy import or_, extract
+from services.allegati_store import leggi_allegato
+from database.repository_async import RepositoryFatture
+from database.scrittore import scrittore_condiviso, segna_pagata
+from database.query_fatture import MESI
 
 # IMPORTA la funzione per la trasformazione XSLT
 # (Assumendo che xslt_service.py si trovi in /assets)
@@ -29,6 +32,13 @@ class MainWindow(QMainWindow):
         super().__init__(parent)
         self.logger = logger  # Logger passato dal main
 
+        # Accesso al DB asincrono (loop di qasync, vedi main.py): le query non bloccano la finestra
+        self.repository = RepositoryFatture()
+        # Contatori delle richieste: i risultati di una richiesta superata
+        # da una più recente (es. l'utente ha già cambiato filtro) vengono scartati
+        self._richiesta_tabella = 0
+        self._richiesta_anteprima = 0
+
         self.setWindowTitle("Gestione Fatture - Stile AssoInvoice")
 
         # Widget centrale + layout verticale
@@ -57,6 +67,7 @@ class MainWindow(QMainWindow):
         # Barra di Ricerca Globale
         self.search_line = QLineEdit()
         self.search_line.setPlaceholderText("Ricerca globale...")
+        self.search_line.returnPressed.connect(self.on_applica_filtri)
 
         # Pulsante Applica Filtri
         self.btn_applica_filtri = QPushButton("Applica Filtri")
@@ -131,75 +142,80 @@ class MainWindow(QMainWindow):
         self.splitter.addWidget(self.center_panel)
         self.splitter.addWidget(self.right_panel)
 
-        # Carichiamo la lista di cedenti e la tabella iniziale
-        self.load_cedenti()
-        self.load_fatture_table()
+        # Carichiamo la lista di cedenti, la tabella iniziale e le scadenze
+        # senza aspettare: le query partono quando il loop è avviato
+        asyncio.ensure_future(self.carica_iniziale())
 
+    async def carica_iniziale(self):
+        await self.ricarica()
         # Check scadenze 30gg (opzionale)
-        self.check_scadenze_30gg()
+        await self.check_scadenze_30gg()
+
+    async def ricarica(self):
+        """
+        Ricarica cedenti e tabella (con i filtri attuali), es. dopo un resync.
+        """
+        await self.load_cedenti()
+        await self.on_applica_filtri()
+
+    def _messaggio(self, icona, titolo, testo):
+        """
+        QMessageBox che non blocca: nei metodi async un exec() aprirebbe un
+        loop annidato mentre il task è ancora in esecuzione.
+        """
+        box = QMessageBox(icona, titolo, testo, QMessageBox.StandardButton.Ok, self)
+        box.setAttribute(Qt.WA_DeleteOnClose)
+        box.open()
+
+    def mostra_avanzamento(self, testo):
+        """
+        Avanzamento del resync (scaricati, parsati, inseriti, code) nella barra di stato.
+        """
+        self.statusBar().showMessage(testo)
 
     # ----------------------------------------------------------------
     # PARTE 3: Metodi di caricamento e filtri
     # ----------------------------------------------------------------
 
-    def load_cedenti(self):
+    async def load_cedenti(self):
         """
         Carica la lista dei fornitori (cedenti) e li mostra nella list_cedenti.
         """
-        db = SessionLocal()
         # Distinct dei fornitori
-        fornitori = db.query(Fattura.fornitore).distinct().all()
-        db.close()
+        fornitori = await self.repository.fornitori()
 
         self.list_cedenti.clear()
         self.list_cedenti.addItem("Tutti i cedenti")
-        for (f_name,) in fornitori:
-            if f_name:
-                self.list_cedenti.addItem(f_name)
+        for f_name in fornitori:
+            self.list_cedenti.addItem(f_name)
 
-    def load_fatture_table(self, filters=None):
+    async def load_fatture_table(self, filters=None):
         """
         Carica la tabella delle fatture in base ai filtri specificati.
         Filtri: { anno, mese, cedente, search }
         """
-        db = SessionLocal()
-        query = db.query(Fattura)
-
-        if filters:
-            # Filtro Anno
-            if filters.get("anno") and filters["anno"] != "Tutti gli anni":
-                try:
-                    anno_int = int(filters["anno"])
-                    query = query.filter(extract("year", Fattura.data) == anno_int)
-                except:
-                    pass
-            # Filtro Mese
-            if filters.get("mese") and filters["mese"] != "Tutti i mesi":
-                mesi_map = {
-                    "Gennaio":1,"Febbraio":2,"Marzo":3,"Aprile":4,"Maggio":5,"Giugno":6,
-                    "Luglio":7,"Agosto":8,"Settembre":9,"Ottobre":10,"Novembre":11,"Dicembre":12
-                }
-                mese_str = filters["mese"]
-                if mese_str in mesi_map:
-                    mese_num = mesi_map[mese_str]
-                    query = query.filter(extract("month", Fattura.data) == mese_num)
-
-            # Filtro Cedente
-            if filters.get("cedente") and filters["cedente"] != "Tutti i cedenti":
-                query = query.filter(Fattura.fornitore == filters["cedente"])
-
-            # Ricerca globale (search)
-            if filters.get("search"):
-                kw = filters["search"]
-                query = query.filter(
-                    or_(
-                        Fattura.fornitore.ilike(f"%{kw}%"),
-                        Fattura.numero.ilike(f"%{kw}%")
-                    )
-                )
-
-        fatture = query.all()
-        db.close()
+        filters = filters or {}
+        anno = None
+        if filters.get("anno") and filters["anno"] != "Tutti gli anni":
+            try:
+                anno = int(filters["anno"])
+            except ValueError:
+                pass
+        # MESI.get: None per "Tutti i mesi"
+        mese = MESI.get(filters.get("mese"))
+        cedente = filters.get("cedente")
+        if cedente == "Tutti i cedenti":
+            cedente = None
+
+        self._richiesta_tabella += 1
+        richiesta = self._richiesta_tabella
+
+        # Filtri per data come intervalli: usano gli indici (vedi database/query_fatture.py)
+        fatture = await self.repository.lista_fatture(
+            anno=anno, mese=mese, cedente=cedente, search=filters.get("search")
+        )
+        if richiesta != self._richiesta_tabella:
+            return
 
         # Popoliamo la tabella
         self.table_fatture.setRowCount(len(fatture))
@@ -212,7 +228,8 @@ class MainWindow(QMainWindow):
             stato = "Sì" if f.pagata else "No"
             self.table_fatture.setItem(i, 5, QTableWidgetItem(stato))
 
-    def on_applica_filtri(self):
+    @asyncSlot()
+    async def on_applica_filtri(self):
         """
         Quando l'utente preme 'Applica Filtri' (o cambiano i combo),
         raccogliamo i filtri e ricarichiamo la tabella.
@@ -234,7 +251,7 @@ class MainWindow(QMainWindow):
             "cedente": selected_ced,
             "search": search
         }
-        self.load_fatture_table(filters)
+        await self.load_fatture_table(filters)
 
     def on_cedente_selected(self):
         """
@@ -246,41 +263,68 @@ class MainWindow(QMainWindow):
     # PARTE 4: Scaricare Fatture da PEC e parse
     # ----------------------------------------------------------------
 
-    def on_scarica_pec_clicked(self):
+    @asyncSlot()
+    async def on_scarica_pec_clicked(self):
         """
         Quando clicco sul pulsante 'Scarica Fatture da PEC', scarico i file .xml e li salvo nel DB.
+        Download e parsing girano in un thread: la finestra resta reattiva.
         """
         self.logger.info("Bottone 'Scarica Fatture da PEC' premuto.")
+        loop = asyncio.get_running_loop()
+        self.btn_scarica_pec.setEnabled(False)
         try:
-            scarica_allegati_xml("fatture_temp", logger=self.logger)
+            await loop.run_in_executor(None, lambda: scarica_allegati_xml("fatture_temp", logger=self.logger))
             self.logger.info("Download completato. Ora avvio parse e salvataggio.")
-            self.parse_and_save_fatture("fatture_temp")
+            await loop.run_in_executor(None, self.parse_and_save_fatture, "fatture_temp")
             self.logger.info("Tutte le fatture parse e salvate. Ricarico tabella.")
-            # Ricarichiamo la tabella con i filtri attuali
-            self.on_applica_filtri()
+            # Ricarichiamo cedenti e tabella con i filtri attuali
+            await self.ricarica()
         except Exception as e:
             self.logger.exception("Errore durante la procedura di scaricamento/parse fatture PEC:")
-            QMessageBox.critical(self, "Errore", f"Si è verificato un errore:\n{e}")
+            self._messaggio(QMessageBox.Icon.Critical, "Errore", f"Si è verificato un errore:\n{e}")
+        finally:
+            self.btn_scarica_pec.setEnabled(True)
 
     def parse_and_save_fatture(self, folder):
         """
         Leggiamo i file .xml in 'folder', li parsiamo e salviamo su DB,
-        poi carichiamo su Dropbox (opzionale), infine rimuoviamo i file locali.
+        poi li archiviamo su Dropbox tutti insieme (carica_xml_su_dropbox),
+        infine rimuoviamo i file locali; quelli non caricati restano per il
+        prossimo giro (i duplicati nel DB vengono comunque scartati).
+        Gira fuori dal thread della UI: non deve toccare i widget.
         """
+        da_caricare = []  # (percorso su Dropbox, byte, file locale)
         for fname in os.listdir(folder):
             if fname.lower().endswith(".xml"):
                 full_path = os.path.join(folder, fname)
                 self.logger.debug(f"Parsing file {fname}")
-                fattura_obj = parse_fattura_xml(full_path)
-                salva_fattura_su_db(fattura_obj)
-                self.logger.debug(f"Fattura {fattura_obj.numero} salvata nel DB")
-
-                # Carichiamo su Dropbox se vuoi
-                if (fattura_obj.data and fattura_obj.fornitore and fattura_obj.numero):
-                    self.logger.debug(f"Carico {fname} su Dropbox...")
-                    upload_xml_to_dropbox(full_path, fattura_obj.fornitore,
-                                          fattura_obj.data, fattura_obj.numero)
-                # Rimuoviamo il file locale
+
+                # Un file può contenere un lotto: una Fattura per ogni body
+                fatture = list(iter_fatture_xml(full_path))
+                # Le scritture passano dal thread scrittore (database/scrittore.py)
+                for fattura_obj in fatture:
+                    salva_fattura_su_db(fattura_obj, scrittore=scrittore_condiviso())
+                    self.logger.debug(f"Fattura {fattura_obj.numero} salvata nel DB")
+
+                # Da archiviare su Dropbox (il file intero, con i dati della prima fattura)
+                fattura_obj = fatture[0] if fatture else None
+                if (fattura_obj and fattura_obj.data and fattura_obj.fornitore and fattura_obj.numero):
+                    with open(full_path, "rb") as f:
+                        da_caricare.append((
+                            percorso_dropbox(fattura_obj.fornitore, fattura_obj.data, fattura_obj.numero),
+                            f.read(),
+                            full_path,
+                        ))
+                else:
+                    os.remove(full_path)
+
+        if not da_caricare:
+            return
+        self.logger.debug(f"Carico {len(da_caricare)} file su Dropbox...")
+        esito = carica_xml_su_dropbox([(percorso, dati) for percorso, dati, _ in da_caricare], logger=self.logger)
+        # Rimuoviamo i file locali archiviati (o già presenti su Dropbox)
+        for percorso, _, full_path in da_caricare:
+            if percorso not in esito["errori"]:
                 os.remove(full_path)
 
     # ----------------------------------------------------------------
@@ -296,7 +340,8 @@ class MainWindow(QMainWindow):
         xslt_path = os.path.abspath(xslt_path)
         return xslt_path
 
-    def on_fattura_selected(self):
+    @asyncSlot()
+    async def on_fattura_selected(self):
         """
         Quando seleziono una riga nella tabella,
         carico la fattura corrispondente e, se esiste xml_raw,
@@ -310,18 +355,23 @@ class MainWindow(QMainWindow):
         row = selected_rows[0].row()
         fattura_id = self.table_fatture.item(row, 0).text()
 
-        db = SessionLocal()
-        f = db.query(Fattura).filter(Fattura.id == fattura_id).first()
-        db.close()
+        self._richiesta_anteprima += 1
+        richiesta = self._richiesta_anteprima
+        # Carico solo il documento XML compresso, non l'intera fattura.
+        # Gli allegati restano riferimenti: il FoglioStile ne mostra solo
+        # nome, formato e descrizione
+        xml_raw = await self.repository.testo_xml(int(fattura_id))
+        if richiesta != self._richiesta_anteprima:
+            return
 
-        if f and f.xml_raw:
+        if xml_raw:
             try:
                 xslt_path = self.get_foglio_stile_path()  # ⬅️ Ora viene chiamata con `self.`
-                html = genera_html_da_xml(f.xml_raw, xslt_path)
+                html = genera_html_da_xml(xml_raw, xslt_path)
                 self.text_anteprima.setHtml(html)
             except Exception as ex:
                 self.logger.exception("Errore durante la trasformazione XSLT:")
-                QMessageBox.warning(self, "Anteprima XSLT", f"Errore generazione HTML:\n{ex}")
+                self._messaggio(QMessageBox.Icon.Warning, "Anteprima XSLT", f"Errore generazione HTML:\n{ex}")
                 self.text_anteprima.clear()
         else:
             self.text_anteprima.clear()
@@ -337,86 +387,114 @@ class MainWindow(QMainWindow):
         """
         row = item.row()
         fattura_id = self.table_fatture.item(row, 0).text()
-        self.show_fattura_viewer(fattura_id)
+        asyncio.ensure_future(self.show_fattura_viewer(int(fattura_id)))
 
-    def show_fattura_viewer(self, fattura_id):
+    async def show_fattura_viewer(self, fattura_id):
         """
         Mostriamo una finestra di dialog con i dettagli della fattura.
         (se preferisci, puoi anche qui mostrare XSLT in un QDialog)
         """
-        from PySide6.QtWidgets import QDialog, QVBoxLayout, QTextEdit, QPushButton
+        from PySide6.QtWidgets import QDialog, QVBoxLayout, QTextEdit, QPushButton, QListWidgetItem
 
-        db = SessionLocal()
-        f = db.query(Fattura).filter(Fattura.id == fattura_id).first()
-        db.close()
+        # Righe e allegati arrivano già caricati (vedi fattura_con_dettagli).
+        # Degli allegati servono solo i metadati: il contenuto resta su disco.
+        f = await self.repository.fattura(fattura_id)
         if not f:
             return
 
+        detail_str = f"Fornitore: {f.fornitore}\nData: {f.data}\nNumero: {f.numero}\nTotale: {f.totale}\nPagata: {f.pagata}\n"
+        if f.righe:
+            detail_str += "\nRighe:\n"
+            for r in f.righe:
+                detail_str += f"- {r.descrizione} x {r.quantita} = {r.importo_riga}\n"
+        allegati = [(a.nome_attachment, a.descrizione_attachment, a.sha256) for a in f.allegati]
+        numero = f.numero
+
         dlg = QDialog(self)
-        dlg.setWindowTitle(f"Viewer Fattura {f.numero}")
+        dlg.setWindowTitle(f"Viewer Fattura {numero}")
 
         layout = QVBoxLayout(dlg)
 
         text = QTextEdit()
         text.setReadOnly(True)
-        detail_str = f"Fornitore: {f.fornitore}\nData: {f.data}\nNumero: {f.numero}\nTotale: {f.totale}\nPagata: {f.pagata}\n"
-        if f.righe:
-            detail_str += "\nRighe:\n"
-            for r in f.righe:
-                detail_str += f"- {r.descrizione} x {r.quantita} = {r.importo_riga}\n"
         text.setPlainText(detail_str)
 
         layout.addWidget(text)
 
+        if allegati:
+            lista_allegati = QListWidget()
+            for nome, descrizione, sha256 in allegati:
+                item = QListWidgetItem(f"📎 {nome}" + (f" - {descrizione}" if descrizione else ""))
+                item.setData(Qt.UserRole, (nome, sha256))
+                lista_allegati.addItem(item)
+            lista_allegati.itemDoubleClicked.connect(
+                lambda item: self.apri_allegato(*item.data(Qt.UserRole))
+            )
+            layout.addWidget(lista_allegati)
+
         btn_close = QPushButton("Chiudi")
         btn_close.clicked.connect(dlg.close)
         layout.addWidget(btn_close)
 
         dlg.setLayout(layout)
-        dlg.exec()
+        # show() e non exec(): niente loop annidato dentro la coroutine
+        dlg.setAttribute(Qt.WA_DeleteOnClose)
+        dlg.show()
+
+    def apri_allegato(self, nome, sha256):
+        """
+        Legge l'allegato dall'archivio su disco solo ora che l'utente lo apre,
+        lo copia in una cartella temporanea col suo nome e lo apre con l'app di sistema.
+        """
+        if not sha256:
+            QMessageBox.warning(self, "Allegato", "Allegato non disponibile nell'archivio.")
+            return
+        try:
+            contenuto = leggi_allegato(sha256)
+        except FileNotFoundError:
+            self.logger.error(f"❌ Allegato {sha256} mancante nell'archivio")
+            QMessageBox.warning(self, "Allegato", f"File dell'allegato non trovato:\n{nome}")
+            return
+
+        cartella = tempfile.mkdtemp(prefix="allegato_")
+        percorso = os.path.join(cartella, os.path.basename(nome or sha256))
+        with open(percorso, "wb") as out:
+            out.write(contenuto)
+        QDesktopServices.openUrl(QUrl.fromLocalFile(percorso))
 
     # ----------------------------------------------------------------
     # PARTE 7: Segnare la Fattura come Saldata
     # ----------------------------------------------------------------
-    def on_segna_saldata(self):
+    @asyncSlot()
+    async def on_segna_saldata(self):
         """
         Prendiamo la riga selezionata, settiamo pagata=True su DB, ricarichiamo la tabella.
         """
         selected_rows = self.table_fatture.selectionModel().selectedRows()
         if not selected_rows:
-            QMessageBox.information(self, "Info", "Nessuna fattura selezionata.")
+            self._messaggio(QMessageBox.Icon.Information, "Info", "Nessuna fattura selezionata.")
             return
         row = selected_rows[0].row()
         fattura_id = self.table_fatture.item(row, 0).text()
 
-        db = SessionLocal()
-        f = db.query(Fattura).filter(Fattura.id == fattura_id).first()
-        if f:
-            f.pagata = True
-            db.commit()
-            QMessageBox.information(self, "OK", "Fattura contrassegnata come saldata.")
-        db.close()
+        # Scrittura tramite il thread scrittore: il loop non si blocca in attesa del commit
+        if await self.repository.scrivi(scrittore_condiviso(), segna_pagata, int(fattura_id)):
+            self._messaggio(QMessageBox.Icon.Information, "OK", "Fattura contrassegnata come saldata.")
 
-        self.on_applica_filtri()  # ricarichiamo la tabella con i filtri
+        await self.on_applica_filtri()  # ricarichiamo la tabella con i filtri
 
     # ----------------------------------------------------------------
     # PARTE 8: Notifiche di scadenza entro 30 giorni (opzionale)
     # ----------------------------------------------------------------
-    def check_scadenze_30gg(self):
+    async def check_scadenze_30gg(self):
         """
         Controlla se ci sono fatture non pagate che scadono entro 30 giorni,
         e mostra un popup. (Funziona se hai data_scadenza in DB)
         """
-        db = SessionLocal()
         oggi = date.today()
         limite = oggi + timedelta(days=30)
-        fatture_in_scadenza = db.query(Fattura).filter(
-            Fattura.pagata == False,
-            Fattura.data_scadenza != None,
-            Fattura.data_scadenza <= limite
-        ).all()
-        db.close()
+        fatture_in_scadenza = await self.repository.non_pagate_in_scadenza(fine=limite + timedelta(days=1))
 
         if fatture_in_scadenza:
             msg = f"Hai {len(fatture_in_scadenza)} fatture in scadenza entro 30 giorni!"
-            QMessageBox.warning(self, "Scadenze", msg)
+            self._messaggio(QMessageBox.Icon.Warning, "Scadenze", msg)